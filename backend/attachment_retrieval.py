@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+ATTACHMENT_CHUNK_CHARS = 1200
+ATTACHMENT_CHUNK_OVERLAP_CHARS = 160
+ATTACHMENT_RETRIEVAL_TOP_K = 6
+ATTACHMENT_INDEX_CACHE_MAX_ENTRIES = 32
+ATTACHMENTS_TOTAL_TEXT_BUDGET = 9000
+ATTACHMENT_MIN_TEXT_BUDGET = 600
+ATTACHMENT_MAX_TEXT_BUDGET = 3500
+BM25_K1 = 1.4
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"\w+", flags=re.UNICODE)
+_STEM_PREFIX_CHARS = 6
+
+
+def _tokenize(text: str) -> list[str]:
+  # Лёгкий «стемминг» обрезкой по префиксу: для русских словоформ этого хватает,
+  # чтобы «логов»/«логи»/«логами» попадали в один терм.
+  tokens: list[str] = []
+  for raw in _TOKEN_PATTERN.findall(str(text or "").lower()):
+    if len(raw) < 2 and not raw.isdigit():
+      continue
+    tokens.append(raw[:_STEM_PREFIX_CHARS] if len(raw) > _STEM_PREFIX_CHARS else raw)
+  return tokens
+
+
+def _split_into_chunks(text: str, *, chunk_chars: int, overlap_chars: int) -> list[tuple[int, int]]:
+  safe_text = str(text or "")
+  length = len(safe_text)
+  if length == 0:
+    return []
+  spans: list[tuple[int, int]] = []
+  start = 0
+  step_floor = max(1, chunk_chars - overlap_chars)
+  while start < length:
+    end = min(length, start + chunk_chars)
+    if end < length:
+      # Стараемся резать по границе строки/предложения, чтобы фрагменты читались.
+      window = safe_text[start + step_floor // 2:end]
+      cut = max(window.rfind("\n"), window.rfind(". "))
+      if cut > 0:
+        end = start + step_floor // 2 + cut + 1
+    spans.append((start, end))
+    if end >= length:
+      break
+    start = max(start + 1, end - overlap_chars)
+  return spans
+
+
+@dataclass
+class AttachmentChunkIndex:
+  text_hash: str
+  text: str
+  spans: list[tuple[int, int]]
+  term_freqs: list[Counter[str]]
+  doc_freq: dict[str, int]
+  avg_chunk_len: float
+  chunk_lens: list[int] = field(default_factory=list)
+
+  @classmethod
+  def build(cls, text: str, *, text_hash: str) -> "AttachmentChunkIndex":
+    spans = _split_into_chunks(
+      text,
+      chunk_chars=ATTACHMENT_CHUNK_CHARS,
+      overlap_chars=ATTACHMENT_CHUNK_OVERLAP_CHARS,
+    )
+    term_freqs: list[Counter[str]] = []
+    chunk_lens: list[int] = []
+    doc_freq: dict[str, int] = {}
+    for start, end in spans:
+      tokens = _tokenize(text[start:end])
+      counts = Counter(tokens)
+      term_freqs.append(counts)
+      chunk_lens.append(len(tokens))
+      for term in counts:
+        doc_freq[term] = doc_freq.get(term, 0) + 1
+    avg_len = (sum(chunk_lens) / len(chunk_lens)) if chunk_lens else 0.0
+    return cls(
+      text_hash=text_hash,
+      text=text,
+      spans=spans,
+      term_freqs=term_freqs,
+      doc_freq=doc_freq,
+      avg_chunk_len=avg_len,
+      chunk_lens=chunk_lens,
+    )
+
+  @property
+  def chunk_count(self) -> int:
+    return len(self.spans)
+
+  def score(self, query: str) -> list[float]:
+    query_terms = set(_tokenize(query))
+    scores = [0.0] * len(self.spans)
+    if not query_terms or not self.spans:
+      return scores
+    total = len(self.spans)
+    avg_len = self.avg_chunk_len or 1.0
+    for term in query_terms:
+      df = self.doc_freq.get(term, 0)
+      if df <= 0:
+        continue
+      idf = math.log(1.0 + (total - df + 0.5) / (df + 0.5))
+      for index, counts in enumerate(self.term_freqs):
+        tf = counts.get(term, 0)
+        if tf <= 0:
+          continue
+        norm = BM25_K1 * (1.0 - BM25_B + BM25_B * (self.chunk_lens[index] / avg_len))
+        scores[index] += idf * (tf * (BM25_K1 + 1.0)) / (tf + norm)
+    return scores
+
+
+_INDEX_CACHE: OrderedDict[str, AttachmentChunkIndex] = OrderedDict()
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+def attachment_text_hash(text: str) -> str:
+  return hashlib.sha256(str(text or "").encode("utf-8", errors="replace")).hexdigest()
+
+
+def get_attachment_index(text: str) -> AttachmentChunkIndex:
+  safe_text = str(text or "")
+  text_hash = attachment_text_hash(safe_text)
+  with _INDEX_CACHE_LOCK:
+    cached = _INDEX_CACHE.get(text_hash)
+    if cached is not None:
+      _INDEX_CACHE.move_to_end(text_hash)
+      return cached
+  index = AttachmentChunkIndex.build(safe_text, text_hash=text_hash)
+  with _INDEX_CACHE_LOCK:
+    _INDEX_CACHE[text_hash] = index
+    while len(_INDEX_CACHE) > ATTACHMENT_INDEX_CACHE_MAX_ENTRIES:
+      _INDEX_CACHE.popitem(last=False)
+  return index
+
+
+def _uncovered_span_len(spans: list[tuple[int, int]], chunk_index: int, picked: set[int]) -> int:
+  start, end = spans[chunk_index]
+  if chunk_index - 1 in picked:
+    start = max(start, spans[chunk_index - 1][1])
+  if chunk_index + 1 in picked:
+    end = min(end, spans[chunk_index + 1][0])
+  return max(0, end - start)
+
+
+def select_attachment_chunks(
+  text: str,
+  query: str,
+  *,
+  budget_chars: int,
+  top_k: int = ATTACHMENT_RETRIEVAL_TOP_K,
+) -> dict[str, Any]:
+  """Возвращает релевантные запросу фрагменты текста вложения в пределах budget_chars."""
+  safe_text = str(text or "").strip()
+  safe_budget = max(0, int(budget_chars))
+  if not safe_text or safe_budget <= 0:
+    return {"mode": "empty", "text_hash": "", "total_chunks": 0, "chunks": []}
+  if len(safe_text) <= safe_budget:
+    return {
+      "mode": "full",
+      "text_hash": attachment_text_hash(safe_text),
+      "total_chunks": 1,
+      "chunks": [{"index": 0, "start": 0, "end": len(safe_text), "score": 0.0, "text": safe_text}],
+    }
+
+  index = get_attachment_index(safe_text)
+  scores = index.score(query)
+  ranked = sorted(range(index.chunk_count), key=lambda item: (-scores[item], item))
+  has_matches = any(score > 0 for score in scores)
+  if not has_matches:
+    # Запрос ничего не нашёл: берём начало документа, как раньше делало усечение.
+    ranked = list(range(index.chunk_count))
+  picked: list[int] = []
+  picked_set: set[int] = set()
+  used_chars = 0
+  for chunk_index in ranked[: max(1, int(top_k)) * 2]:
+    if len(picked) >= max(1, int(top_k)):
+      break
+    if has_matches and scores[chunk_index] <= 0:
+      break
+    # Соседние фрагменты перекрываются на ATTACHMENT_CHUNK_OVERLAP_CHARS — в бюджет идут только новые символы.
+    chunk_len = _uncovered_span_len(index.spans, chunk_index, picked_set)
+    if used_chars + chunk_len > safe_budget and picked:
+      continue
+    picked.append(chunk_index)
+    picked_set.add(chunk_index)
+    used_chars += chunk_len
+  picked.sort()
+  chunks: list[dict[str, Any]] = []
+  emitted_end = 0
+  for chunk_index in picked:
+    start, end = index.spans[chunk_index]
+    # Перекрытие с уже выведенным соседом не повторяем: фрагмент начинается там, где кончился предыдущий.
+    start = max(start, emitted_end)
+    emitted_end = max(emitted_end, end)
+    chunk_text = safe_text[start:end].strip()
+    if not chunk_text:
+      continue
+    if len(chunk_text) > safe_budget:
+      chunk_text = chunk_text[: max(0, safe_budget - 1)].rstrip() + "…"
+    chunks.append(
+      {
+        "index": chunk_index,
+        "start": start,
+        "end": end,
+        "score": round(float(scores[chunk_index]), 4),
+        "text": chunk_text,
+      }
+    )
+  return {
+    "mode": "retrieval" if has_matches else "head",
+    "text_hash": index.text_hash,
+    "total_chunks": index.chunk_count,
+    "chunks": chunks,
+  }
+
+
+def plan_attachment_excerpts(attachments: list[Any], query: str) -> list[dict[str, Any]]:
+  """Распределяет общий текстовый бюджет по вложениям и выбирает фрагменты для каждого."""
+  plans: list[dict[str, Any]] = []
+  used_budget = 0
+  for position, attachment in enumerate(list(attachments or [])[:10], start=1):
+    item = attachment.model_dump() if hasattr(attachment, "model_dump") else dict(attachment or {})
+    text_content = str(item.get("textContent") or "").strip()
+    if not text_content or used_budget >= ATTACHMENTS_TOTAL_TEXT_BUDGET:
+      plans.append({"position": position, "selection": None})
+      continue
+    remaining = max(0, ATTACHMENTS_TOTAL_TEXT_BUDGET - used_budget)
+    budget = max(ATTACHMENT_MIN_TEXT_BUDGET, min(ATTACHMENT_MAX_TEXT_BUDGET, remaining))
+    selection = select_attachment_chunks(text_content, query, budget_chars=budget)
+    used_budget += sum(len(chunk["text"]) for chunk in selection["chunks"])
+    plans.append({"position": position, "selection": selection})
+  return plans
+
+
+def build_attachment_retrieval_events(attachments: list[Any], query: str) -> list[dict[str, Any]]:
+  """Метаданные выбора фрагментов в формате tool-событий (name/status/output) для истории чата."""
+  events: list[dict[str, Any]] = []
+  safe_attachments = list(attachments or [])
+  for plan in plan_attachment_excerpts(safe_attachments, query):
+    selection = plan.get("selection")
+    if not isinstance(selection, dict) or selection.get("mode") in {"empty", "full"}:
+      continue
+    attachment = safe_attachments[int(plan["position"]) - 1]
+    item = attachment.model_dump() if hasattr(attachment, "model_dump") else dict(attachment or {})
+    events.append(
+      {
+        "name": "attachments.retrieve",
+        "status": "ok",
+        "output": {
+          "attachment_id": str(item.get("id") or ""),
+          "attachment_name": str(item.get("name") or f"file-{plan['position']}"),
+          "text_hash": selection["text_hash"],
+          "mode": selection["mode"],
+          "total_chunks": selection["total_chunks"],
+          "chunks": [
+            {key: chunk[key] for key in ("index", "start", "end", "score")}
+            for chunk in selection["chunks"]
+          ],
+        },
+      }
+    )
+  return events
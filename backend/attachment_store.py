@@ -0,0 +1,340 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+ATTACHMENT_STORE_DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+ATTACHMENT_STORE_DATA_URL_MEMO_MAX_ENTRIES = 128
+ATTACHMENT_STORE_MAX_DATA_URL_CHARS = 2_000_000
+ATTACHMENT_UPLOAD_DIR_NAME = "incoming"
+# Недописанная загрузка старше этого возраста считается брошенной (процесс упал посреди записи).
+ATTACHMENT_UPLOAD_STALE_SECONDS = 3600.0
+ATTACHMENT_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+_SAFE_SUFFIX_RE = re.compile(r"^\.[a-z0-9]{1,8}$")
+
+
+def is_attachment_sha256(value: Any) -> bool:
+  return bool(ATTACHMENT_SHA256_RE.match(str(value or "").strip().lower()))
+
+
+def _resolve_max_bytes_from_env() -> int:
+  raw = os.getenv("ANCIA_ATTACHMENT_STORE_MAX_MB", "").strip()
+  if not raw:
+    return ATTACHMENT_STORE_DEFAULT_MAX_BYTES
+  try:
+    value_mb = int(raw)
+  except ValueError:
+    return ATTACHMENT_STORE_DEFAULT_MAX_BYTES
+  return max(8, min(16_384, value_mb)) * 1024 * 1024
+
+
+def _guess_suffix(mime_type: str, name_hint: str = "") -> str:
+  suffix = mimetypes.guess_extension(str(mime_type or "").strip().lower()) or ""
+  if not suffix:
+    lower_hint = str(name_hint or "").strip().lower()
+    if "." in lower_hint:
+      suffix = f".{lower_hint.rsplit('.', 1)[-1][:8]}"
+  if not _SAFE_SUFFIX_RE.match(suffix):
+    suffix = ".bin"
+  return suffix
+
+
+class AttachmentStore:
+  """Контентно-адресуемое хранилище вложений: sha256 → файл, вытеснение LRU по суммарному размеру.
+
+  Каталог может быть общим для нескольких процессов (API-воркеры и сервер модели): индекс в памяти
+  у каждого свой, промах проверяется по диску, порядок LRU хранится в mtime. Удаляет файлы только
+  процесс с evict=True — он же периодически пересобирает индекс по диску (sweep).
+  """
+
+  def __init__(self, root_dir: Path | str, *, max_bytes: int | None = None, evict: bool = True) -> None:
+    self._root = Path(root_dir)
+    self._root.mkdir(parents=True, exist_ok=True)
+    try:
+      os.chmod(self._root, 0o700)
+    except OSError:
+      pass
+    self._max_bytes = max(1, int(max_bytes)) if max_bytes is not None else _resolve_max_bytes_from_env()
+    self._evict = bool(evict)
+    self._lock = threading.RLock()
+    # sha256 -> (path, size); порядок = порядок обращений (последний — самый свежий).
+    self._entries: OrderedDict[str, tuple[Path, int]] = OrderedDict()
+    self._total_bytes = 0
+    # sha256(data URL) -> sha256(содержимого): повторный запрос с тем же DataURL не декодирует base64.
+    self._data_url_memo: OrderedDict[str, str] = OrderedDict()
+    self._upload_dir = self._root / ATTACHMENT_UPLOAD_DIR_NAME
+    self._upload_dir.mkdir(parents=True, exist_ok=True)
+    if self._evict:
+      self._remove_stale_uploads()
+    self._load_existing()
+
+  @property
+  def root_dir(self) -> Path:
+    return self._root
+
+  @property
+  def max_bytes(self) -> int:
+    return self._max_bytes
+
+  def _scan_disk(self) -> list[tuple[float, str, Path, int]]:
+    found: list[tuple[float, str, Path, int]] = []
+    for path in self._root.glob("*/*"):
+      if not path.is_file():
+        continue
+      sha = path.name.split(".", 1)[0]
+      if not is_attachment_sha256(sha) or path.name.endswith(".part"):
+        continue
+      try:
+        stat = path.stat()
+      except OSError:
+        continue
+      found.append((stat.st_mtime, sha, path, int(stat.st_size)))
+    found.sort(key=lambda item: item[0])
+    return found
+
+  def _load_existing(self) -> None:
+    found = self._scan_disk()
+    with self._lock:
+      for _mtime, sha, path, size in found:
+        self._entries[sha] = (path, size)
+        self._total_bytes += size
+      self._evict_locked(keep="")
+
+  def _remove_stale_uploads(self) -> int:
+    # Загрузку, которую сейчас пишет другой процесс, не трогаем — только брошенные по возрасту.
+    stale_before = time.time() - ATTACHMENT_UPLOAD_STALE_SECONDS
+    removed = 0
+    for stale_part in self._root.glob("*/*.part"):
+      try:
+        if stale_part.stat().st_mtime < stale_before:
+          stale_part.unlink()
+          removed += 1
+      except OSError:
+        pass
+    return removed
+
+  def _probe_disk_locked(self, sha: str) -> Path | None:
+    # Файл мог записать другой процесс: ищем его по имени, суффикс заранее неизвестен.
+    for path in (self._root / sha[:2]).glob(f"{sha}.*"):
+      if path.name.endswith(".part") or not path.is_file():
+        continue
+      try:
+        size = int(path.stat().st_size)
+      except OSError:
+        continue
+      self._register_locked(sha, path, size)
+      return self._touch_locked(sha)
+    return None
+
+  def _path_for(self, sha: str, suffix: str) -> Path:
+    return self._root / sha[:2] / f"{sha}{suffix}"
+
+  def _touch_locked(self, sha: str) -> Path | None:
+    entry = self._entries.get(sha)
+    if entry is None:
+      return None
+    path, _size = entry
+    if not path.exists():
+      self._entries.pop(sha, None)
+      self._total_bytes = max(0, self._total_bytes - _size)
+      return None
+    self._entries.move_to_end(sha)
+    try:
+      # mtime хранит порядок LRU между перезапусками.
+      os.utime(path, None)
+    except OSError:
+      pass
+    return path
+
+  def _evict_locked(self, *, keep: str) -> None:
+    if not self._evict:
+      return
+    while self._total_bytes > self._max_bytes and self._entries:
+      oldest_sha = next(iter(self._entries))
+      if oldest_sha == keep:
+        if len(self._entries) == 1:
+          break
+        self._entries.move_to_end(oldest_sha)
+        continue
+      path, size = self._entries.pop(oldest_sha)
+      self._total_bytes = max(0, self._total_bytes - size)
+      try:
+        path.unlink()
+      except OSError:
+        pass
+
+  def _register_locked(self, sha: str, path: Path, size: int) -> None:
+    previous = self._entries.pop(sha, None)
+    if previous is not None:
+      self._total_bytes = max(0, self._total_bytes - previous[1])
+    self._entries[sha] = (path, size)
+    self._total_bytes += size
+    self._evict_locked(keep=sha)
+
+  def has(self, sha: str) -> bool:
+    return bool(self.resolve(sha))
+
+  def resolve(self, sha: str) -> str:
+    safe_sha = str(sha or "").strip().lower()
+    if not is_attachment_sha256(safe_sha):
+      return ""
+    with self._lock:
+      path = self._touch_locked(safe_sha)
+      if path is None:
+        path = self._probe_disk_locked(safe_sha)
+    return str(path) if path is not None else ""
+
+  def describe(self, sha: str) -> dict[str, Any] | None:
+    path_value = self.resolve(sha)
+    if not path_value:
+      return None
+    path = Path(path_value)
+    mime_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    try:
+      size = int(path.stat().st_size)
+    except OSError:
+      return None
+    return {
+      "sha256": path.name.split(".", 1)[0],
+      "path": path_value,
+      "size": size,
+      "mime_type": mime_type,
+    }
+
+  def put_bytes(self, raw_bytes: bytes, *, mime_type: str = "", name_hint: str = "") -> dict[str, Any]:
+    payload = bytes(raw_bytes or b"")
+    if not payload:
+      raise ValueError("attachment payload is empty")
+    sha = hashlib.sha256(payload).hexdigest()
+    existing = self.describe(sha)
+    if existing is not None:
+      return existing
+    suffix = _guess_suffix(mime_type, name_hint)
+    target = self._path_for(sha, suffix)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.part")
+    with open(temp_path, "wb") as handle:
+      handle.write(payload)
+    return self.commit_file(temp_path, sha=sha, size=len(payload), suffix=suffix)
+
+  def commit_file(
+    self,
+    temp_path: Path | str,
+    *,
+    sha: str,
+    size: int,
+    suffix: str = "",
+    mime_type: str = "",
+    name_hint: str = "",
+  ) -> dict[str, Any]:
+    """Переносит уже записанный временный файл в хранилище под его sha256."""
+    safe_sha = str(sha or "").strip().lower()
+    if not is_attachment_sha256(safe_sha):
+      raise ValueError("invalid attachment sha256")
+    safe_suffix = suffix if _SAFE_SUFFIX_RE.match(str(suffix or "")) else _guess_suffix(mime_type, name_hint)
+    source = Path(temp_path)
+    with self._lock:
+      existing = self._touch_locked(safe_sha)
+      if existing is not None:
+        try:
+          source.unlink()
+        except OSError:
+          pass
+        target = existing
+      else:
+        target = self._path_for(safe_sha, safe_suffix)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, target)
+        try:
+          os.chmod(target, 0o600)
+        except OSError:
+          pass
+        self._register_locked(safe_sha, target, max(0, int(size)))
+    return {
+      "sha256": safe_sha,
+      "path": str(target),
+      "size": max(0, int(size)),
+      "mime_type": mimetypes.guess_type(target.name)[0] or "application/octet-stream",
+    }
+
+  def new_upload_path(self) -> Path:
+    return self._upload_dir / f"{uuid.uuid4().hex}.part"
+
+  @staticmethod
+  def discard_upload(temp_path: Path | str) -> None:
+    try:
+      Path(temp_path).unlink()
+    except OSError:
+      pass
+
+  def put_data_url(self, data_url: str, *, name_hint: str = "") -> dict[str, Any] | None:
+    safe_data_url = str(data_url or "").strip()
+    if not safe_data_url.startswith("data:") or len(safe_data_url) > ATTACHMENT_STORE_MAX_DATA_URL_CHARS:
+      return None
+    url_digest = hashlib.sha256(safe_data_url.encode("ascii", errors="replace")).hexdigest()
+    with self._lock:
+      memo_sha = self._data_url_memo.get(url_digest)
+      if memo_sha is not None:
+        self._data_url_memo.move_to_end(url_digest)
+    if memo_sha is not None:
+      known = self.describe(memo_sha)
+      if known is not None:
+        return known
+
+    try:
+      header, payload = safe_data_url.split(",", 1)
+    except ValueError:
+      return None
+    if ";base64" not in header.lower():
+      return None
+    mime_type = header[5:].split(";", 1)[0].strip().lower()
+    try:
+      raw_bytes = base64.b64decode(payload, validate=False)
+    except (ValueError, binascii.Error):
+      return None
+    if not raw_bytes:
+      return None
+    entry = self.put_bytes(raw_bytes, mime_type=mime_type, name_hint=name_hint)
+    with self._lock:
+      self._data_url_memo[url_digest] = entry["sha256"]
+      while len(self._data_url_memo) > ATTACHMENT_STORE_DATA_URL_MEMO_MAX_ENTRIES:
+        self._data_url_memo.popitem(last=False)
+    return entry
+
+  def sweep(self) -> dict[str, int]:
+    """Пересобирает индекс по диску и вытесняет лишнее (файлы могли добавить другие процессы)."""
+    stale_uploads = self._remove_stale_uploads() if self._evict else 0
+    found = self._scan_disk()
+    with self._lock:
+      self._entries.clear()
+      self._total_bytes = 0
+      for _mtime, sha, path, size in found:
+        self._entries[sha] = (path, size)
+        self._total_bytes += size
+      scanned = len(self._entries)
+      self._evict_locked(keep="")
+      return {
+        "entries": len(self._entries),
+        "total_bytes": self._total_bytes,
+        "evicted": scanned - len(self._entries),
+        "stale_uploads": stale_uploads,
+      }
+
+  def stats(self) -> dict[str, Any]:
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "total_bytes": self._total_bytes,
+        "max_bytes": self._max_bytes,
+        "evict": self._evict,
+      }
@@ -1,14 +1,15 @@
 from __future__ import annotations
 
+import copy
 import datetime as dt
 import hashlib
-import hmac
 import logging
 import os
 import re
 import secrets
 import threading
 import time
+from collections import OrderedDict
 from typing import Any
 
 try:
@@ -17,12 +18,26 @@ try:
     PERMISSION_MODELS_DOWNLOAD,
     PERMISSION_PLUGINS_DOWNLOAD,
   )
+  from backend.password_hashing import (
+    PasswordHashBusyError,
+    PasswordHasherRegistry,
+    PasswordHashExecutor,
+    build_password_hash_executor,
+    build_password_hasher_registry,
+  )
 except ModuleNotFoundError:
   from common import utc_now_iso  # type: ignore
   from access_control import (  # type: ignore
     PERMISSION_MODELS_DOWNLOAD,
     PERMISSION_PLUGINS_DOWNLOAD,
   )
+  from password_hashing import (  # type: ignore
+    PasswordHashBusyError,
+    PasswordHasherRegistry,
+    PasswordHashExecutor,
+    build_password_hash_executor,
+    build_password_hasher_registry,
+  )
 
 
 VALID_USER_ROLES = {"admin", "user"}
@@ -31,13 +46,23 @@ USERNAME_PATTERN = re.compile(r"^[a-zA-Z0-9._-]{3,64}$")
 PASSWORD_MIN_LENGTH = 8
 DEFAULT_SESSION_TTL_HOURS = 24
 DEFAULT_SESSION_TTL_HOURS_LONG = 24 * 14
-PASSWORD_HASH_ALGORITHM = "pbkdf2_sha256"
-PASSWORD_HASH_ITERATIONS = 240_000
 DEFAULT_LOGIN_RATE_WINDOW_SECONDS = 5 * 60
 DEFAULT_LOGIN_RATE_MAX_ATTEMPTS = 8
 DEFAULT_LOGIN_RATE_BLOCK_SECONDS = 10 * 60
 LOGIN_RATE_SCOPE_PREFIX = "auth.login"
 LOGIN_RATE_STORAGE_LOG_COOLDOWN_SECONDS = 60.0
+DEFAULT_SESSION_CACHE_TTL_SECONDS = 15.0
+SESSION_CACHE_MAX_ENTRIES = 4096
+DEFAULT_SESSION_TOUCH_INTERVAL_SECONDS = 60.0
+
+
+def _read_env_seconds(name: str, fallback: float, *, minimum: float, maximum: float) -> float:
+  raw = str(os.getenv(name, "") or "").strip()
+  try:
+    value = float(raw) if raw else fallback
+  except ValueError:
+    value = fallback
+  return max(minimum, min(maximum, value))
 
 
 class AuthError(RuntimeError):
@@ -52,14 +77,27 @@ class AuthRateLimitError(AuthError):
     )
 
 
+class AuthBusyError(AuthError):
+  def __init__(self, retry_after_seconds: int) -> None:
+    self.retry_after_seconds = max(1, int(retry_after_seconds or 1))
+    super().__init__(
+      f"Сервер занят проверкой паролей. Повторите через {self.retry_after_seconds} сек."
+    )
+
+
 class AuthService:
   def __init__(
     self,
     *,
     storage: Any,
     session_ttl_hours: int = DEFAULT_SESSION_TTL_HOURS,
+    password_hashers: PasswordHasherRegistry | None = None,
+    hash_executor: PasswordHashExecutor | None = None,
   ) -> None:
     self._storage = storage
+    # Хэширование паролей — на отдельном ограниченном пуле, а не в общем пуле обработчиков запросов.
+    self._password_hashers = password_hashers or build_password_hasher_registry()
+    self._hash_executor = hash_executor or build_password_hash_executor()
     self._session_ttl_hours = max(1, int(session_ttl_hours or DEFAULT_SESSION_TTL_HOURS))
     self._login_rate_window_seconds = max(
       1,
@@ -92,6 +130,26 @@ class AuthService:
     self._login_rate_lock = threading.Lock()
     self._login_rate_state: dict[str, dict[str, Any]] = {}
     self._login_rate_storage_last_warn_ts = 0.0
+    # Кэш проверенных токенов: token_hash -> сессия и пользователь. TTL короткий,
+    # а logout/изменение пользователя сбрасывают записи сразу — но только в этом процессе:
+    # другие процессы над той же базой принимают отозванный токен, пока не истечёт их TTL.
+    # Поэтому API-воркеры сервера модели по умолчанию запускаются с TTL 0 (см. model_server).
+    self._session_cache_ttl_seconds = _read_env_seconds(
+      "ANCIA_AUTH_SESSION_CACHE_TTL_SECONDS",
+      DEFAULT_SESSION_CACHE_TTL_SECONDS,
+      minimum=0.0,
+      maximum=300.0,
+    )
+    self._session_touch_interval_seconds = _read_env_seconds(
+      "ANCIA_AUTH_SESSION_TOUCH_INTERVAL_SECONDS",
+      DEFAULT_SESSION_TOUCH_INTERVAL_SECONDS,
+      minimum=0.0,
+      maximum=3600.0,
+    )
+    self._session_cache_lock = threading.Lock()
+    self._session_cache: OrderedDict[str, dict[str, Any]] = OrderedDict()
+    # session_id -> monotonic-время последней записи last_seen_at/expires_at.
+    self._session_last_touch: dict[str, float] = {}
 
   _logger = logging.getLogger("ancia.backend.auth")
 
@@ -130,41 +188,34 @@ class AuthService:
       raise AuthError("Пароль слишком длинный.")
     return password
 
-  @staticmethod
-  def _hash_password(password: str, *, salt: bytes | None = None, iterations: int = PASSWORD_HASH_ITERATIONS) -> str:
-    password_bytes = str(password or "").encode("utf-8")
-    if salt is None:
-      salt = os.urandom(16)
-    derived = hashlib.pbkdf2_hmac("sha256", password_bytes, salt, int(iterations))
-    return "$".join(
-      [
-        PASSWORD_HASH_ALGORITHM,
-        str(int(iterations)),
-        salt.hex(),
-        derived.hex(),
-      ]
-    )
-
-  @staticmethod
-  def _verify_password(password: str, password_hash: str) -> bool:
-    safe_hash = str(password_hash or "").strip()
-    if not safe_hash:
-      return False
-    parts = safe_hash.split("$")
-    if len(parts) != 4:
-      return False
-    algorithm, iterations_raw, salt_hex, digest_hex = parts
-    if algorithm != PASSWORD_HASH_ALGORITHM:
-      return False
+  def _run_password_job(self, fn: Any, *args: Any) -> Any:
     try:
-      iterations = max(100_000, int(iterations_raw))
-      salt = bytes.fromhex(salt_hex)
-      expected = bytes.fromhex(digest_hex)
-    except (TypeError, ValueError):
-      return False
+      return self._hash_executor.run(fn, *args)
+    except PasswordHashBusyError as exc:
+      raise AuthBusyError(exc.retry_after_seconds) from exc
+
+  def _hash_password(self, password: str) -> str:
+    return self._run_password_job(self._password_hashers.hash, password)
 
-    actual = hashlib.pbkdf2_hmac("sha256", str(password or "").encode("utf-8"), salt, iterations)
-    return hmac.compare_digest(actual, expected)
+  def _verify_password(self, password: str, password_hash: str) -> tuple[bool, str | None]:
+    """(пароль верный, новый хэш) — новый хэш есть, если сохранённый сделан устаревшим алгоритмом/параметрами."""
+    registry = self._password_hashers
+
+    def verify() -> tuple[bool, str | None]:
+      ok, needs_rehash = registry.verify(password, password_hash)
+      return ok, (registry.hash(password) if ok and needs_rehash else None)
+
+    return self._run_password_job(verify)
+
+  def get_password_hashing_snapshot(self) -> dict[str, Any]:
+    return {
+      "algorithm": self._password_hashers.default.algorithm,
+      "supported": self._password_hashers.algorithms,
+      "executor": self._hash_executor.snapshot(),
+    }
+
+  def close(self) -> None:
+    self._hash_executor.shutdown()
 
   @staticmethod
   def _hash_session_token(token: str) -> str:
@@ -493,6 +544,8 @@ class AuthService:
 
     if revoke_sessions or next_status == "blocked":
       self._storage.revoke_auth_sessions_for_user(safe_user_id)
+    # Роль, права и статус входят в закэшированный payload пользователя.
+    self.invalidate_session_cache(user_id=safe_user_id)
 
     return self._user_public_payload(updated)
 
@@ -524,23 +577,26 @@ class AuthService:
       self._register_failed_login(login_scopes, now)
       raise AuthError("Аккаунт заблокирован.")
 
-    if not self._verify_password(str(password or ""), str(user.get("password_hash") or "")):
+    password_ok, rehashed = self._verify_password(str(password or ""), str(user.get("password_hash") or ""))
+    if not password_ok:
       self._register_failed_login(login_scopes, now)
       raise AuthError("Неверный логин или пароль.")
 
     self._reset_login_rate_limit(login_scopes)
 
     now_iso = utc_now_iso()
+    # Хэш со старыми параметрами/алгоритмом заменяется при первом успешном входе.
     self._storage.update_user(
       str(user.get("id") or ""),
       last_login_at=now_iso,
+      password_hash=rehashed,
     )
+    self.invalidate_session_cache(user_id=str(user.get("id") or ""))
 
     token = secrets.token_urlsafe(36)
     token_hash = self._hash_session_token(token)
     expires_at = self._build_session_expiry_iso(remember=remember)
 
-    self._storage.prune_auth_sessions(now_iso=now_iso)
     session = self._storage.create_auth_session(
       user_id=str(user.get("id") or ""),
       token_hash=token_hash,
@@ -554,16 +610,50 @@ class AuthService:
       "user": self._user_public_payload(user),
     }
 
-  def authenticate_token(self, token: str, *, renew: bool = True) -> dict[str, Any] | None:
-    safe_token = str(token or "").strip()
-    if not safe_token:
+  def prune_sessions(self) -> int:
+    """Удаляет истёкшие и отозванные сессии (задача фонового обслуживания storage_maintenance)."""
+    removed = int(self._storage.prune_auth_sessions(now_iso=utc_now_iso()) or 0)
+    stale_before = time.monotonic() - max(self._session_touch_interval_seconds, self._session_cache_ttl_seconds)
+    with self._session_cache_lock:
+      for session_id in [key for key, ts in self._session_last_touch.items() if ts < stale_before]:
+        self._session_last_touch.pop(session_id, None)
+    return removed
+
+  def _get_cached_session(self, token_hash: str) -> dict[str, Any] | None:
+    if self._session_cache_ttl_seconds <= 0:
       return None
+    with self._session_cache_lock:
+      entry = self._session_cache.get(token_hash)
+      if entry is None:
+        return None
+      if (time.monotonic() - float(entry["cached_at"])) > self._session_cache_ttl_seconds:
+        self._session_cache.pop(token_hash, None)
+        return None
+      self._session_cache.move_to_end(token_hash)
+      return entry
+
+  def _store_cached_session(self, token_hash: str, entry: dict[str, Any]) -> None:
+    if self._session_cache_ttl_seconds <= 0:
+      return
+    with self._session_cache_lock:
+      self._session_cache[token_hash] = entry
+      self._session_cache.move_to_end(token_hash)
+      while len(self._session_cache) > SESSION_CACHE_MAX_ENTRIES:
+        self._session_cache.popitem(last=False)
+
+  def invalidate_session_cache(self, *, token_hash: str = "", user_id: str = "") -> None:
+    """Без аргументов сбрасывает весь кэш; иначе — записи токена и/или пользователя."""
+    with self._session_cache_lock:
+      if not token_hash and not user_id:
+        self._session_cache.clear()
+        return
+      if token_hash:
+        self._session_cache.pop(token_hash, None)
+      if user_id:
+        for cached_hash in [key for key, entry in self._session_cache.items() if entry["user_id"] == user_id]:
+          self._session_cache.pop(cached_hash, None)
 
-    now = self._utc_now()
-    now_iso = now.replace(microsecond=0).isoformat()
-    self._storage.prune_auth_sessions(now_iso=now_iso)
-
-    token_hash = self._hash_session_token(safe_token)
+  def _load_session_entry(self, token_hash: str, now: dt.datetime) -> dict[str, Any] | None:
     session = self._storage.get_auth_session_by_token_hash(token_hash)
     if not session:
       return None
@@ -581,28 +671,67 @@ class AuthService:
       return None
     if str(user.get("status") or "").strip().lower() != "active":
       return None
+    return {
+      "cached_at": time.monotonic(),
+      "session_id": str(session.get("id") or ""),
+      "user_id": str(user.get("id") or ""),
+      "expires_at": str(session.get("expires_at") or ""),
+      "expires_at_dt": expires_at,
+      "user": self._user_public_payload(user),
+    }
 
-    next_expires_at = session.get("expires_at") if isinstance(session.get("expires_at"), str) else ""
-    if renew:
-      next_expires_at = self._build_session_expiry_iso(remember=False)
+  def _claim_session_touch(self, session_id: str) -> bool:
+    # Не чаще одной записи last_seen_at/expires_at на сессию за интервал.
+    now_monotonic = time.monotonic()
+    with self._session_cache_lock:
+      last_touch = self._session_last_touch.get(session_id)
+      if last_touch is not None and (now_monotonic - last_touch) < self._session_touch_interval_seconds:
+        return False
+      self._session_last_touch[session_id] = now_monotonic
+    return True
+
+  def authenticate_token(self, token: str, *, renew: bool = True) -> dict[str, Any] | None:
+    safe_token = str(token or "").strip()
+    if not safe_token:
+      return None
+
+    now = self._utc_now()
+    now_iso = now.replace(microsecond=0).isoformat()
+    token_hash = self._hash_session_token(safe_token)
+    entry = self._get_cached_session(token_hash)
+    if entry is None:
+      entry = self._load_session_entry(token_hash, now)
+      if entry is None:
+        return None
+      self._store_cached_session(token_hash, entry)
+    elif entry["expires_at_dt"] <= now:
+      self.invalidate_session_cache(token_hash=token_hash)
+      return None
+
+    session_id = entry["session_id"]
+    if self._claim_session_touch(session_id):
+      next_expires_at: str | None = None
+      if renew:
+        next_expires_at = self._build_session_expiry_iso(remember=False)
+        parsed_expires_at = self._parse_iso_utc(next_expires_at)
+        with self._session_cache_lock:
+          entry["expires_at"] = next_expires_at
+          if parsed_expires_at is not None:
+            entry["expires_at_dt"] = parsed_expires_at
       self._storage.touch_auth_session(
-        str(session.get("id") or ""),
+        session_id,
         last_seen_at=now_iso,
         expires_at=next_expires_at,
-      )
-    else:
-      self._storage.touch_auth_session(
-        str(session.get("id") or ""),
-        last_seen_at=now_iso,
-        expires_at=None,
+        wait=False,
       )
 
     return {
       "session": {
-        "id": str(session.get("id") or ""),
-        "expires_at": str(next_expires_at or session.get("expires_at") or ""),
+        "id": session_id,
+        "expires_at": str(entry["expires_at"] or ""),
       },
-      "user": self._user_public_payload(user),
+      # Запись кэша общая для запросов: вложенные permissions и т.п. не должны меняться через ответ.
+      "user": copy.deepcopy(entry["user"]),
     }
 
   def logout(self, token: str) -> bool:
@@ -610,10 +739,15 @@ class AuthService:
     if not safe_token:
       return False
     token_hash = self._hash_session_token(safe_token)
+    self.invalidate_session_cache(token_hash=token_hash)
     session = self._storage.get_auth_session_by_token_hash(token_hash)
     if not session:
       return False
-    return self._storage.revoke_auth_session(str(session.get("id") or ""))
+    revoked = self._storage.revoke_auth_session(str(session.get("id") or ""))
+    # Параллельный запрос с этим токеном мог закэшировать сессию между сбросом и отзывом —
+    # сбрасываем ещё раз, когда отзыв уже записан.
+    self.invalidate_session_cache(token_hash=token_hash)
+    return revoked
 
   def get_user_public(self, user_id: str) -> dict[str, Any] | None:
     user = self._storage.get_user_by_id(user_id)
@@ -1,12 +1,39 @@
 from __future__ import annotations
 
 import datetime as dt
+import hashlib
+from typing import Any
+
+# ETag ответа всегда сверяется с ревизией на сервере: браузер может хранить копию, но обязан переспросить.
+REVISION_CACHE_CONTROL = "private, no-cache"
 
 
 def utc_now_iso() -> str:
   return dt.datetime.now(dt.timezone.utc).isoformat()
 
 
+def build_revision_etag(revision: int, *scope: Any) -> str:
+  """Сильный ETag из ревизии и параметров ответа (владелец, чат, лимит, курсор)."""
+  digest = hashlib.sha1("\x1f".join(str(part) for part in scope).encode("utf-8")).hexdigest()[:16]
+  return f'"r{int(revision)}-{digest}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+  """Сравнение для If-None-Match: список значений, '*' и слабые W/-метки (RFC 9110, 13.1.2)."""
+  raw = str(if_none_match or "").strip()
+  if not raw or not etag:
+    return False
+  if raw == "*":
+    return True
+  for candidate in raw.split(","):
+    value = candidate.strip()
+    if value.startswith("W/"):
+      value = value[2:]
+    if value == etag:
+      return True
+  return False
+
+
 def normalize_mood(candidate: str | None, fallback: str = "neutral") -> str:
   value = str(candidate or "").strip().lower()
   if not value:
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import base64
 import binascii
+import functools
 import importlib.util
 import json
 import logging
@@ -13,6 +14,7 @@ import sys
 import tempfile
 import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
 from typing import Any, Callable, Generator
 
@@ -74,6 +76,7 @@ try:
   )
   from backend.schemas import MODEL_TIERS, ChatRequest, RuntimeChatContext, ToolEvent
   from backend.storage import AppStorage
+  from backend.attachment_store import AttachmentStore
   from backend.tooling import ToolRegistry
 except ModuleNotFoundError:
   from common import normalize_mood, utc_now_iso  # type: ignore
@@ -133,6 +136,7 @@ except ModuleNotFoundError:
   )
   from schemas import MODEL_TIERS, ChatRequest, RuntimeChatContext, ToolEvent  # type: ignore
   from storage import AppStorage  # type: ignore
+  from attachment_store import AttachmentStore  # type: ignore
   from tooling import ToolRegistry  # type: ignore
 
 LOGGER = logging.getLogger("ancia.engine")
@@ -198,6 +202,9 @@ class PythonModelEngine(EngineModelsMixin):
   MAX_HISTORY_MESSAGES = 12
   MAX_HISTORY_TOTAL_CHARS = 5200
   MAX_HISTORY_ENTRY_CHARS = 900
+  MAX_HISTORY_MESSAGES_TOKEN_BUDGET = 64
+  HISTORY_MESSAGE_OVERHEAD_TOKENS = 4
+  TOKEN_COUNT_CACHE_MAX_ENTRIES = 4096
   MAX_TOOL_CALL_ROUNDS = 4
   MAX_TOOL_CALLS_PER_ROUND = 4
   MAX_CONTEXT_WINDOW_LIMIT = 262_144
@@ -214,8 +221,15 @@ class PythonModelEngine(EngineModelsMixin):
       return "unavailable"
     return "mlx_lm"
 
-  def __init__(self, storage: AppStorage, *, base_system_prompt: str) -> None:
+  def __init__(
+    self,
+    storage: AppStorage,
+    *,
+    base_system_prompt: str,
+    attachment_store: AttachmentStore | None = None,
+  ) -> None:
     self._storage = storage
+    self._attachment_store = attachment_store
     self._base_system_prompt = base_system_prompt
     self._runtime_profile = resolve_runtime_profile()
     self._runtime_tuning = apply_runtime_env_tuning(self._runtime_profile)
@@ -234,6 +248,8 @@ class PythonModelEngine(EngineModelsMixin):
     self._state_lock = threading.Lock()
     self._generation_lock = threading.Lock()
     self._generation_stop_event = threading.Event()
+    self._token_count_cache: OrderedDict[tuple[str, str], int] = OrderedDict()
+    self._token_count_cache_lock = threading.Lock()
     self._model: Any = None
     self._tokenizer: Any = None
     self._generate_fn: Callable[..., Any] | None = None
@@ -1124,6 +1140,35 @@ class PythonModelEngine(EngineModelsMixin):
 
     return self._fallback_token_estimate(safe_text), "chars/4"
 
+  def _count_tokens_cached(self, text: str) -> int:
+    safe_text = str(text or "")
+    if not safe_text:
+      return 0
+    # Ключ учитывает загруженную модель: у разных токенизаторов разные счётчики.
+    cache_key = (str(self._loaded_model_id or ""), safe_text)
+    with self._token_count_cache_lock:
+      cached = self._token_count_cache.get(cache_key)
+      if cached is not None:
+        self._token_count_cache.move_to_end(cache_key)
+        return cached
+    count, mode = self._estimate_token_count(safe_text)
+    if mode == "chars/4":
+      return count
+    with self._token_count_cache_lock:
+      self._token_count_cache[cache_key] = int(count)
+      while len(self._token_count_cache) > self.TOKEN_COUNT_CACHE_MAX_ENTRIES:
+        self._token_count_cache.popitem(last=False)
+    return int(count)
+
+  @staticmethod
+  def _resolve_context_reserve_tokens() -> int:
+    reserve_tokens_env = os.getenv("ANCIA_CONTEXT_MIN_RESERVE_TOKENS", "").strip()
+    try:
+      reserve_tokens_raw = int(reserve_tokens_env) if reserve_tokens_env else 192
+    except ValueError:
+      reserve_tokens_raw = 192
+    return max(64, min(768, reserve_tokens_raw))
+
   def _estimate_token_count_exact(self, text: str) -> tuple[int, str]:
     count, mode = self._estimate_token_count(text)
     if mode == "chars/4":
@@ -1137,12 +1182,12 @@ class PythonModelEngine(EngineModelsMixin):
     *,
     active_tools: set[str],
     tool_definitions: dict[str, dict[str, Any]] | None = None,
+    tool_registry: ToolRegistry | None = None,
   ) -> dict[str, Any]:
     safe_active_tools = {str(name or "").strip().lower() for name in active_tools if str(name or "").strip()}
     safe_tool_definitions = tool_definitions if isinstance(tool_definitions, dict) else {}
 
     history_budget_env = os.getenv("ANCIA_CONTEXT_MIN_HISTORY_CHARS", "").strip()
-    reserve_tokens_env = os.getenv("ANCIA_CONTEXT_MIN_RESERVE_TOKENS", "").strip()
 
     try:
       history_budget_chars_raw = int(history_budget_env) if history_budget_env else 3600
@@ -1150,11 +1195,7 @@ class PythonModelEngine(EngineModelsMixin):
       history_budget_chars_raw = 3600
     history_budget_chars = max(1200, min(self.MAX_HISTORY_TOTAL_CHARS, history_budget_chars_raw))
 
-    try:
-      reserve_tokens_raw = int(reserve_tokens_env) if reserve_tokens_env else 192
-    except ValueError:
-      reserve_tokens_raw = 192
-    reserve_tokens = max(64, min(768, reserve_tokens_raw))
+    reserve_tokens = self._resolve_context_reserve_tokens()
 
     synthetic_request = ChatRequest.model_validate(
       {
@@ -1179,6 +1220,7 @@ class PythonModelEngine(EngineModelsMixin):
       synthetic_request,
       active_tools=safe_active_tools,
       tool_definitions=safe_tool_definitions,
+      tool_registry=tool_registry,
     )
     system_prompt_tokens, token_estimation_mode = self._estimate_token_count(system_prompt_text)
 
@@ -1218,7 +1260,7 @@ class PythonModelEngine(EngineModelsMixin):
     if not isinstance(entries, list):
       return []
     out: list[dict[str, Any]] = []
-    for item in entries[:64]:
+    for item in entries[-64:]:
       raw = item.model_dump() if hasattr(item, "model_dump") else item
       if not isinstance(raw, dict):
         continue
@@ -1255,6 +1297,7 @@ class PythonModelEngine(EngineModelsMixin):
           "size": max(0, int(raw.get("size") or 0)),
           "textContent": str(raw.get("textContent") or ""),
           "dataUrl": str(raw.get("dataUrl") or "").strip(),
+          "sha256": str(raw.get("sha256") or "").strip().lower(),
         }
       )
     return out
@@ -1326,6 +1369,7 @@ class PythonModelEngine(EngineModelsMixin):
     active_tools: set[str] | None = None,
     tool_definitions: dict[str, dict[str, Any]] | None = None,
     tool_schemas: dict[str, dict[str, Any]] | None = None,
+    tool_registry: ToolRegistry | None = None,
   ) -> dict[str, Any]:
     safe_active_tools = {str(name or "").strip().lower() for name in (active_tools or set()) if str(name or "").strip()}
     safe_tool_definitions = tool_definitions if isinstance(tool_definitions, dict) else {}
@@ -1356,10 +1400,16 @@ class PythonModelEngine(EngineModelsMixin):
       256,
       min(model_context_limit, int(model_params.get("context_window") or model_context_limit)),
     )
+    # Тот же бюджет ответа, что резервирует генерация (_prepare_generation), — иначе оценка истории расходится.
+    completion_tokens = max(
+      16,
+      min(self.MAX_COMPLETION_TOKENS_LIMIT, model_context_limit, int(model_params.get("max_tokens") or 256)),
+    )
 
     requirements = self.get_context_window_requirements(
       active_tools=safe_active_tools,
       tool_definitions=safe_tool_definitions,
+      tool_registry=tool_registry,
     )
     reserve_tokens = max(0, int(requirements.get("reserve_tokens") or 0))
 
@@ -1380,6 +1430,9 @@ class PythonModelEngine(EngineModelsMixin):
         turns=[],
         active_tools=safe_active_tools,
         tool_definitions=safe_tool_definitions,
+        tool_registry=tool_registry,
+        context_window=context_window,
+        completion_tokens=completion_tokens,
       )
       prompt_tokens, token_mode = self._estimate_prompt_tokens_from_messages_exact(
         messages_full,
@@ -1420,6 +1473,9 @@ class PythonModelEngine(EngineModelsMixin):
           turns=[],
           active_tools=safe_active_tools,
           tool_definitions=safe_tool_definitions,
+          tool_registry=tool_registry,
+          context_window=context_window,
+          completion_tokens=completion_tokens,
         )
         prompt_no_attachments_tokens, _ = self._estimate_prompt_tokens_from_messages_exact(
           no_attachments_messages,
@@ -1553,8 +1609,14 @@ class PythonModelEngine(EngineModelsMixin):
       data_url = str(item.get("dataUrl") or "").strip()
       if self._is_safe_image_data_url(data_url):
         return True
+      if self._has_stored_attachment(str(item.get("sha256") or "")):
+        return True
     return False
 
+  def _has_stored_attachment(self, sha: str) -> bool:
+    store = self._attachment_store
+    return bool(store is not None and sha and store.has(sha))
+
   @staticmethod
   def _is_image_analysis_intent(user_text: str) -> bool:
     safe_text = str(user_text or "").strip()
@@ -1920,6 +1982,7 @@ class PythonModelEngine(EngineModelsMixin):
     attachments = list(getattr(request, "attachments", None) or [])
     inputs: list[str] = []
     temp_files: list[str] = []
+    store = self._attachment_store
     for attachment in attachments[:6]:
       item = self._attachment_to_dict(attachment)
       kind = self._normalize_attachment_kind(str(item.get("kind") or "file"))
@@ -1927,6 +1990,16 @@ class PythonModelEngine(EngineModelsMixin):
       data_url = str(item.get("dataUrl") or "").strip()
       if kind != "image" and not mime_type.startswith("image/"):
         continue
+      if store is not None:
+        # Файл из контентно-адресуемого хранилища переживает раунды инструментов и регенерации,
+        # поэтому его не удаляем: повторный запрос с тем же изображением не декодирует base64 заново.
+        path = store.resolve(str(item.get("sha256") or ""))
+        if not path and self._is_safe_image_data_url(data_url):
+          entry = store.put_data_url(data_url, name_hint=str(item.get("name") or ""))
+          path = str(entry.get("path") or "") if entry else ""
+        if path:
+          inputs.append(path)
+          continue
       path = self._decode_image_data_url_to_temp_file(
         data_url,
         file_name_hint=str(item.get("name") or ""),
@@ -2033,7 +2106,6 @@ class PythonModelEngine(EngineModelsMixin):
   def _build_attachment_context(self, request: ChatRequest) -> str:
     return build_attachment_context_fn(
       request,
-      truncate_text_fn=self._truncate_text,
       supports_vision=self._supports_selected_model_vision(),
     )
 
@@ -2043,20 +2115,46 @@ class PythonModelEngine(EngineModelsMixin):
     turns: list[dict[str, Any]] | None = None,
     active_tools: set[str] | None = None,
     tool_definitions: dict[str, dict[str, Any]] | None = None,
+    tool_registry: ToolRegistry | None = None,
+    context_window: int | None = None,
+    completion_tokens: int | None = None,
   ) -> list[dict[str, Any]]:
+    history_token_budget: int | None = None
+    max_history_messages = self.MAX_HISTORY_MESSAGES
+    if context_window is not None and int(context_window) > 0:
+      # Окно делят промпт и ответ: кроме резерва вычитаем бюджет ответа и JSON-схемы инструментов,
+      # которые шаблон чата добавит к промпту. Системный промпт и сообщение пользователя вычтет build_messages.
+      reserved_tokens = self._resolve_context_reserve_tokens() + max(0, int(completion_tokens or 0))
+      if active_tools and tool_registry is not None and hasattr(tool_registry, "build_llm_schema_map"):
+        schema_map = tool_registry.build_llm_schema_map(active_tools)
+        if schema_map:
+          reserved_tokens += self._count_tokens_cached(
+            json.dumps([schema_map[name] for name in sorted(schema_map)], ensure_ascii=False)
+          )
+      history_token_budget = max(0, int(context_window) - reserved_tokens)
+      max_history_messages = self.MAX_HISTORY_MESSAGES_TOKEN_BUDGET
+    build_system_prompt_bound = (
+      functools.partial(build_system_prompt, tool_registry=tool_registry)
+      if tool_registry is not None
+      else build_system_prompt
+    )
     return build_messages_fn(
       request,
       base_system_prompt=self._base_system_prompt,
       active_tools=active_tools or set(),
       tool_definitions=tool_definitions or {},
       turns=turns,
-      build_system_prompt_fn=build_system_prompt,
+      build_system_prompt_fn=build_system_prompt_bound,
       truncate_text_fn=self._truncate_text,
       build_attachment_context_fn=self._build_attachment_context,
       supports_vision=self._supports_selected_model_vision(),
-      max_history_messages=self.MAX_HISTORY_MESSAGES,
+      max_history_messages=max_history_messages,
       max_history_total_chars=self.MAX_HISTORY_TOTAL_CHARS,
       max_history_entry_chars=self.MAX_HISTORY_ENTRY_CHARS,
+      history_token_budget=history_token_budget,
+      count_tokens_fn=self._count_tokens_cached,
+      history_message_overhead_tokens=self.HISTORY_MESSAGE_OVERHEAD_TOKENS,
+      stored_image_exists_fn=self._has_stored_attachment,
     )
 
   def _render_vlm_prompt(
@@ -2949,6 +3047,9 @@ class PythonModelEngine(EngineModelsMixin):
           turns or None,
           generation_active_tools,
           tool_definitions=tool_definitions,
+          tool_registry=tool_registry,
+          context_window=plan.context_window_override,
+          completion_tokens=plan.max_tokens_override,
         )
         prompt = self._render_prompt(
           messages,
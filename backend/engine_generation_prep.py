@@ -5,7 +5,14 @@ import os
 import re
 from typing import Any, Callable
 
+try:
+  from backend.attachment_retrieval import plan_attachment_excerpts
+except ModuleNotFoundError:
+  from attachment_retrieval import plan_attachment_excerpts  # type: ignore
+
 MAX_IMAGE_DATA_URL_CHARS = 2_000_000
+# Меньше этого свежее сообщение не усекаем — обрывок бесполезен, лучше оставить историю пустой.
+HISTORY_TRUNCATED_ENTRY_MIN_TOKENS = 32
 SAFE_IMAGE_DATA_URL_RE = re.compile(
   r"^data:image/(?:png|jpe?g|webp|gif|bmp|x-icon|vnd\.microsoft\.icon|avif);base64,[a-z0-9+/=]+$",
   flags=re.IGNORECASE,
@@ -80,7 +87,6 @@ def normalize_attachment_kind(kind: str) -> str:
 def build_attachment_context(
   request: Any,
   *,
-  truncate_text_fn: Callable[[str, int], str],
   supports_vision: bool,
 ) -> str:
   attachments = list(getattr(request, "attachments", None) or [])
@@ -88,8 +94,8 @@ def build_attachment_context(
     return ""
 
   lines: list[str] = ["Вложения пользователя:"]
-  total_text_budget = 9000
-  used_budget = 0
+  # Большие тексты не режем вслепую: берём фрагменты, релевантные сообщению пользователя.
+  excerpt_plans = plan_attachment_excerpts(attachments, str(getattr(request, "message", "") or ""))
 
   for index, attachment in enumerate(attachments[:10], start=1):
     item = attachment.model_dump() if hasattr(attachment, "model_dump") else dict(attachment)
@@ -104,14 +110,19 @@ def build_attachment_context(
     suffix_parts.append(size_label)
     lines.append(f"{index}. {name} ({', '.join(suffix_parts)})")
 
-    text_content = str(item.get("textContent") or "").strip()
-    if text_content and used_budget < total_text_budget:
-      remaining = max(0, total_text_budget - used_budget)
-      excerpt = truncate_text_fn(text_content, max(600, min(3500, remaining)))
-      used_budget += len(excerpt)
-      lines.append("```text")
-      lines.append(excerpt)
-      lines.append("```")
+    selection = excerpt_plans[index - 1].get("selection") if index - 1 < len(excerpt_plans) else None
+    if isinstance(selection, dict) and selection.get("chunks"):
+      if selection.get("mode") != "full":
+        lines.append(
+          f"Показаны фрагменты {len(selection['chunks'])} из {selection['total_chunks']} "
+          f"({'по релевантности запросу' if selection.get('mode') == 'retrieval' else 'начало документа'})."
+        )
+      for chunk in selection["chunks"]:
+        if selection.get("mode") != "full":
+          lines.append(f"[фрагмент {chunk['index'] + 1}, символы {chunk['start']}–{chunk['end']}]")
+        lines.append("```text")
+        lines.append(chunk["text"])
+        lines.append("```")
       continue
 
     if kind == "image":
@@ -150,6 +161,7 @@ def _resolve_image_blocks(
   *,
   truncate_text_fn: Callable[[str, int], str],
   supports_vision: bool,
+  stored_image_exists_fn: Callable[[str], bool] | None = None,
 ) -> list[dict[str, Any]]:
   if not supports_vision:
     return []
@@ -161,6 +173,11 @@ def _resolve_image_blocks(
     if kind != "image":
       continue
     data_url = str(item.get("dataUrl") or "").strip()
+    stored_sha = str(item.get("sha256") or "").strip().lower()
+    if not data_url and stored_sha and callable(stored_image_exists_fn) and stored_image_exists_fn(stored_sha):
+      # Байты изображения лежат в хранилище вложений; шаблону чата нужен только сам блок.
+      image_blocks.append({"type": "image_url", "image_url": {"url": f"attachment:{stored_sha}"}})
+      continue
     if not _is_safe_image_data_url(data_url):
       continue
     if len(data_url) > MAX_IMAGE_DATA_URL_CHARS:
@@ -204,34 +221,16 @@ def _build_user_message_content(
   ]
 
 
-def build_messages(
-  request: Any,
+def _select_history_by_chars(
+  history: list[Any],
   *,
-  base_system_prompt: str,
-  active_tools: set[str],
-  tool_definitions: dict[str, dict[str, Any]] | None,
-  turns: list[dict[str, Any]] | None,
-  build_system_prompt_fn: Callable[..., str],
   truncate_text_fn: Callable[[str, int], str],
-  build_attachment_context_fn: Callable[[Any], str],
-  supports_vision: bool,
   max_history_messages: int,
   max_history_total_chars: int,
   max_history_entry_chars: int,
 ) -> list[dict[str, Any]]:
-  messages: list[dict[str, Any]] = []
-  system_prompt = build_system_prompt_fn(
-    base_system_prompt,
-    request,
-    active_tools=active_tools,
-    tool_definitions=tool_definitions or {},
-  )
-  if system_prompt.strip():
-    messages.append({"role": "system", "content": system_prompt.strip()})
-
   selected_history: list[dict[str, Any]] = []
   total_chars = 0
-  history = getattr(getattr(request, "context", None), "history", None) or []
   for entry in reversed(history):
     role = str(getattr(entry, "role", "") or "").strip().lower()
     if role not in {"user", "assistant", "system"}:
@@ -246,9 +245,99 @@ def build_messages(
     selected_history.append({"role": role, "content": text})
     if len(selected_history) >= max_history_messages:
       break
+  selected_history.reverse()
+  return selected_history
+
 
+def _truncate_to_token_budget(
+  text: str,
+  token_budget: int,
+  *,
+  count_tokens_fn: Callable[[str], int],
+  truncate_text_fn: Callable[[str, int], str],
+) -> str:
+  if token_budget < HISTORY_TRUNCATED_ENTRY_MIN_TOKENS:
+    return ""
+  limit = len(text)
+  for _ in range(6):
+    candidate = truncate_text_fn(text, limit)
+    cost = max(1, int(count_tokens_fn(candidate)))
+    if cost <= token_budget:
+      return candidate
+    # Символы на токен почти постоянны: сжимаем пропорционально с запасом и пересчитываем.
+    limit = int(limit * token_budget / cost * 0.9)
+    if limit < 16:
+      return ""
+  return ""
+
+
+def _select_history_by_tokens(
+  history: list[Any],
+  *,
+  token_budget: int,
+  count_tokens_fn: Callable[[str], int],
+  max_history_messages: int,
+  message_overhead_tokens: int,
+  truncate_text_fn: Callable[[str, int], str] | None = None,
+) -> list[dict[str, Any]]:
+  # Идём от свежих сообщений к старым и берём, пока помещаемся в бюджет.
+  # count_tokens_fn кэширует подсчёт по тексту, поэтому выбор стоит O(сообщений).
+  selected_history: list[dict[str, Any]] = []
+  remaining = max(0, int(token_budget))
+  for entry in reversed(history):
+    role = str(getattr(entry, "role", "") or "").strip().lower()
+    if role not in {"user", "assistant", "system"}:
+      continue
+    text = str(getattr(entry, "text", "") or "").strip()
+    if not text:
+      continue
+    cost = max(0, int(count_tokens_fn(text))) + message_overhead_tokens
+    if cost > remaining:
+      # Самое свежее сообщение целиком не влезает — берём его усечённым, а не теряем всю историю.
+      if not selected_history and truncate_text_fn is not None:
+        truncated = _truncate_to_token_budget(
+          text,
+          remaining - message_overhead_tokens,
+          count_tokens_fn=count_tokens_fn,
+          truncate_text_fn=truncate_text_fn,
+        )
+        if truncated:
+          selected_history.append({"role": role, "content": truncated})
+      break
+    remaining -= cost
+    selected_history.append({"role": role, "content": text})
+    if len(selected_history) >= max_history_messages:
+      break
   selected_history.reverse()
-  messages.extend(selected_history)
+  return selected_history
+
+
+def build_messages(
+  request: Any,
+  *,
+  base_system_prompt: str,
+  active_tools: set[str],
+  tool_definitions: dict[str, dict[str, Any]] | None,
+  turns: list[dict[str, Any]] | None,
+  build_system_prompt_fn: Callable[..., str],
+  truncate_text_fn: Callable[[str, int], str],
+  build_attachment_context_fn: Callable[[Any], str],
+  supports_vision: bool,
+  max_history_messages: int,
+  max_history_total_chars: int,
+  max_history_entry_chars: int,
+  history_token_budget: int | None = None,
+  count_tokens_fn: Callable[[str], int] | None = None,
+  history_message_overhead_tokens: int = 4,
+  stored_image_exists_fn: Callable[[str], bool] | None = None,
+) -> list[dict[str, Any]]:
+  """Собирает сообщения; при history_token_budget история подбирается по токенам, иначе по символам."""
+  system_prompt = build_system_prompt_fn(
+    base_system_prompt,
+    request,
+    active_tools=active_tools,
+    tool_definitions=tool_definitions or {},
+  ).strip()
 
   user_text = str(getattr(request, "message", "") or "").strip()
   attachment_context = build_attachment_context_fn(request)
@@ -256,12 +345,45 @@ def build_messages(
     request,
     truncate_text_fn=truncate_text_fn,
     supports_vision=supports_vision,
+    stored_image_exists_fn=stored_image_exists_fn,
   )
   user_content = _build_user_message_content(
     user_text=user_text,
     attachment_context=attachment_context,
     image_blocks=image_blocks,
   )
+
+  history = list(getattr(getattr(request, "context", None), "history", None) or [])
+  if history_token_budget is not None and callable(count_tokens_fn):
+    # Из бюджета вычитаем системный промпт, черновик с вложениями и turns; остаток — под историю.
+    overhead = max(0, int(history_message_overhead_tokens))
+    fixed_tokens = 0
+    if system_prompt:
+      fixed_tokens += count_tokens_fn(system_prompt) + overhead
+    fixed_tokens += count_tokens_fn(_message_content_to_text(user_content)) + overhead
+    for turn in turns or []:
+      fixed_tokens += count_tokens_fn(_message_content_to_text(turn.get("content"))) + overhead
+    selected_history = _select_history_by_tokens(
+      history,
+      token_budget=int(history_token_budget) - fixed_tokens,
+      count_tokens_fn=count_tokens_fn,
+      max_history_messages=max_history_messages,
+      message_overhead_tokens=overhead,
+      truncate_text_fn=truncate_text_fn,
+    )
+  else:
+    selected_history = _select_history_by_chars(
+      history,
+      truncate_text_fn=truncate_text_fn,
+      max_history_messages=max_history_messages,
+      max_history_total_chars=max_history_total_chars,
+      max_history_entry_chars=max_history_entry_chars,
+    )
+
+  messages: list[dict[str, Any]] = []
+  if system_prompt:
+    messages.append({"role": "system", "content": system_prompt})
+  messages.extend(selected_history)
   messages.append({"role": "user", "content": user_content})
 
   if turns:
@@ -7,13 +7,14 @@ import os
 import re
 import threading
 import time
-from pathlib import Path
+from typing import Any
 
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
 try:
+  from backend.attachment_store import AttachmentStore
   from backend.auth_service import AuthService
   from backend.deployment import (
     DEPLOYMENT_MODE_REMOTE_SERVER,
@@ -21,9 +22,16 @@ try:
     resolve_cors_origins_for_mode,
     resolve_deployment_mode,
   )
+  from backend.model_server import ModelServerClient, resolve_model_server_socket
   from backend.plugin_host_api import PluginHostApi
-  from backend.storage import AppStorage
+  from backend.runtime_paths import load_system_prompt, resolve_data_dir, resolve_plugins_root_dir
+  from backend.startup_gate import DeferredStartupApp
+  from backend.storage import AppStorage, MigrationProgress, ReadOnlySettings, pending_schema_migration
+  from backend.storage_maintenance import build_storage_maintenance
+  from backend.storage_shards import ShardedAppStorage, is_owner_sharding_enabled
+  from backend.workload_executors import WorkloadExecutors, build_workload_route_class
 except ModuleNotFoundError:
+  from attachment_store import AttachmentStore  # type: ignore
   from auth_service import AuthService  # type: ignore
   from deployment import (  # type: ignore
     DEPLOYMENT_MODE_REMOTE_SERVER,
@@ -31,8 +39,14 @@ except ModuleNotFoundError:
     resolve_cors_origins_for_mode,
     resolve_deployment_mode,
   )
+  from model_server import ModelServerClient, resolve_model_server_socket  # type: ignore
   from plugin_host_api import PluginHostApi  # type: ignore
-  from storage import AppStorage  # type: ignore
+  from runtime_paths import load_system_prompt, resolve_data_dir, resolve_plugins_root_dir  # type: ignore
+  from startup_gate import DeferredStartupApp  # type: ignore
+  from storage import AppStorage, MigrationProgress, ReadOnlySettings, pending_schema_migration  # type: ignore
+  from storage_maintenance import build_storage_maintenance  # type: ignore
+  from storage_shards import ShardedAppStorage, is_owner_sharding_enabled  # type: ignore
+  from workload_executors import WorkloadExecutors, build_workload_route_class  # type: ignore
 
 try:
   from backend.tooling import PluginManager, ToolRegistry
@@ -56,49 +70,6 @@ except ModuleNotFoundError:
   from engine import PythonModelEngine, build_system_prompt  # type: ignore
 
 
-def resolve_data_dir() -> Path:
-  env_path = os.getenv("ANCIA_BACKEND_DATA_DIR", "").strip()
-  if env_path:
-    return Path(env_path).expanduser().resolve()
-  return (Path(__file__).resolve().parent / ".runtime").resolve()
-
-
-def resolve_plugins_root_dir() -> Path:
-  env_path = os.getenv("ANCIA_PLUGINS_DIR", "").strip()
-  if env_path:
-    return Path(env_path).expanduser().resolve()
-  return (Path(__file__).resolve().parent / "plugins").resolve()
-
-
-def resolve_system_prompt_path() -> Path:
-  env_path = os.getenv("ANCIA_SYSTEM_PROMPT", "").strip()
-  if env_path:
-    return Path(env_path).expanduser().resolve()
-
-  backend_dir = Path(__file__).resolve().parent
-  project_root = backend_dir.parent
-  candidate_paths = [
-    (project_root / "system_prompt.txt").resolve(),
-    (backend_dir / "data" / "system_prompt.txt").resolve(),
-  ]
-  for candidate in candidate_paths:
-    if candidate.exists():
-      return candidate
-
-  return candidate_paths[-1]
-
-
-def load_system_prompt() -> str:
-  path = resolve_system_prompt_path()
-  if path.exists():
-    try:
-      return path.read_text(encoding="utf-8").strip()
-    except OSError:
-      pass
-
-  return "Ты локальный агент Ancia. Отвечай кратко и сохраняй контекст пользователя."
-
-
 LOGGER = logging.getLogger("ancia.backend.main")
 
 _SENSITIVE_LOG_PATTERN = re.compile(
@@ -147,6 +118,7 @@ RATE_LIMIT_RULES: dict[tuple[str, str], tuple[str, int]] = {
   ("POST", "/chat/stream"): ("ANCIA_RATE_LIMIT_CHAT_STREAM_PER_WINDOW", 8),
   ("POST", "/models/load"): ("ANCIA_RATE_LIMIT_MODELS_LOAD_PER_WINDOW", 4),
   ("POST", "/plugins/install"): ("ANCIA_RATE_LIMIT_PLUGINS_INSTALL_PER_WINDOW", 6),
+  ("POST", "/attachments/upload"): ("ANCIA_RATE_LIMIT_ATTACHMENT_UPLOAD_PER_WINDOW", 30),
 }
 REQUEST_SIZE_LIMIT_RULES: dict[tuple[str, str], tuple[str, int]] = {
   ("POST", "/chat"): ("ANCIA_MAX_BODY_CHAT_BYTES", 280_000),
@@ -155,6 +127,7 @@ REQUEST_SIZE_LIMIT_RULES: dict[tuple[str, str], tuple[str, int]] = {
   ("POST", "/plugins/install"): ("ANCIA_MAX_BODY_PLUGINS_INSTALL_BYTES", 200_000),
   ("POST", "/models/load"): ("ANCIA_MAX_BODY_MODELS_LOAD_BYTES", 80_000),
   ("POST", "/models/select"): ("ANCIA_MAX_BODY_MODELS_SELECT_BYTES", 80_000),
+  ("POST", "/attachments/upload"): ("ANCIA_MAX_BODY_ATTACHMENT_UPLOAD_BYTES", 12_000_000),
 }
 _RATE_LIMIT_STATE_LOCK = threading.Lock()
 _RATE_LIMIT_STATE: dict[str, list[float]] = {}
@@ -350,40 +323,31 @@ def _is_local_recovery_request(request: Request | None) -> bool:
   return _is_loopback_client(request)
 
 
-def make_app() -> FastAPI:
-  _install_sensitive_log_filter()
-  app = FastAPI(title="Ancia Agent Backend", version="0.1.0")
+class SecurityMiddleware:
+  """Лимит тела запроса, авторизация, доступ к /admin/* и лимиты частоты — чистым ASGI.
 
-  data_dir = resolve_data_dir()
-  data_dir.mkdir(parents=True, exist_ok=True)
+  В отличие от @app.middleware("http") (BaseHTTPMiddleware) не заводит задачу на запрос и не
+  оборачивает поток ответа: длинные ответы вроде /chat/stream уходят клиенту напрямую.
+  """
 
-  storage = AppStorage(data_dir / "app.db")
-  deployment_mode = resolve_deployment_mode(storage)
-  cors_origins = resolve_cors_origins_for_mode(deployment_mode)
-  app.add_middleware(
-    CORSMiddleware,
-    allow_origins=cors_origins,
-    allow_credentials=allow_credentials_for_mode(deployment_mode),
-    allow_methods=["*"],
-    allow_headers=["*"],
-  )
-  LOGGER.info(
-    "Deployment mode '%s' active; CORS origins: %d",
-    deployment_mode,
-    len(cors_origins),
-  )
+  def __init__(self, app: Any, *, storage: AppStorage, auth_service: AuthService) -> None:
+    self.app = app
+    self._storage = storage
+    self._auth_service = auth_service
 
-  # Приходит часть OPTIONS не как CORS preflight (без Origin/Access-Control-Request-Method),
-  # поэтому FastAPI по умолчанию отвечает 405. Ловим все OPTIONS и отдаём 204.
-  @app.options("/{full_path:path}")
-  def options_passthrough(full_path: str) -> Response:
-    return Response(status_code=204)
-
-  auth_service = AuthService(storage=storage)
-  app.state.auth_service = auth_service
+  async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+    if scope.get("type") != "http":
+      await self.app(scope, receive, send)
+      return
+    # Request над тем же scope: request.state пишет в scope["state"], его видят обработчики маршрутов.
+    response = self._check(Request(scope))
+    if response is None:
+      await self.app(scope, receive, send)
+      return
+    await response(scope, receive, send)
 
-  @app.middleware("http")
-  async def security_middleware(request: Request, call_next):
+  def _check(self, request: Request) -> Response | None:
+    """None — пропустить запрос дальше, иначе готовый ответ с отказом."""
     path = str(request.url.path or "/").strip() or "/"
     method = str(request.method or "").strip().upper()
 
@@ -396,28 +360,24 @@ def make_app() -> FastAPI:
           content={"detail": f"Payload too large. Max {limit_bytes} bytes."},
         )
 
-    if request.method.upper() == "OPTIONS":
-      return await call_next(request)
+    if method == "OPTIONS":
+      return None
 
-    runtime_mode = resolve_deployment_mode(storage)
+    runtime_mode = resolve_deployment_mode(self._storage)
     request.state.deployment_mode = runtime_mode
     request.state.auth = None
 
     if runtime_mode != DEPLOYMENT_MODE_REMOTE_SERVER:
       # local / remote_client modes are non-account modes on this backend.
-      return await call_next(request)
+      return None
 
     if _is_public_path(path):
-      return await call_next(request)
+      return None
 
     # Desktop recovery path:
     # allow switching remote_server -> local from trusted loopback request.
-    if (
-      request.method.upper() == "PATCH"
-      and path == "/settings"
-      and _is_local_recovery_request(request)
-    ):
-      return await call_next(request)
+    if method == "PATCH" and path == "/settings" and _is_local_recovery_request(request):
+      return None
 
     token = _extract_bearer_token(request)
     if not token:
@@ -426,7 +386,7 @@ def make_app() -> FastAPI:
         content={"detail": "Authentication required."},
       )
 
-    auth_payload = auth_service.authenticate_token(token, renew=True)
+    auth_payload = self._auth_service.authenticate_token(token, renew=True)
     if not isinstance(auth_payload, dict):
       return JSONResponse(
         status_code=401,
@@ -444,21 +404,93 @@ def make_app() -> FastAPI:
 
     if _is_rate_limited_request(method, path):
       subject = _resolve_rate_limit_subject(request)
-      exceeded, retry_after = _consume_rate_limit(storage, method, path, subject)
+      exceeded, retry_after = _consume_rate_limit(self._storage, method, path, subject)
       if exceeded:
         return JSONResponse(
           status_code=429,
           content={"detail": "Too many requests. Please retry later."},
           headers={"Retry-After": str(retry_after)},
         )
+    return None
+
 
-    return await call_next(request)
+STORAGE_MIGRATION_PROGRESS = MigrationProgress()
+
+
+def build_cors_options(deployment_mode: str) -> dict[str, Any]:
+  return {
+    "allow_origins": resolve_cors_origins_for_mode(deployment_mode),
+    "allow_credentials": allow_credentials_for_mode(deployment_mode),
+    "allow_methods": ["*"],
+    "allow_headers": ["*"],
+  }
+
+
+def make_app() -> FastAPI:
+  _install_sensitive_log_filter()
+  app = FastAPI(title="Ancia Agent Backend", version="0.1.0")
+  # Синхронные обработчики — в свои пулы по классу нагрузки (db/cpu/generation/network), а не в общий пул AnyIO:
+  # долгие стримы генерации не должны отнимать потоки у коротких запросов к БД. Класс маршрута задаём до регистрации роутов.
+  workload_executors = WorkloadExecutors()
+  app.router.route_class = build_workload_route_class(workload_executors)
+  app.state.workload_executors = workload_executors
+
+  data_dir = resolve_data_dir()
+  data_dir.mkdir(parents=True, exist_ok=True)
+
+  storage = AppStorage(data_dir / "app.db", migration_progress=STORAGE_MIGRATION_PROGRESS)
+  deployment_mode = resolve_deployment_mode(storage)
+  if deployment_mode == DEPLOYMENT_MODE_REMOTE_SERVER and is_owner_sharding_enabled():
+    # Режим хранится в настройках основной базы, поэтому узнаём его до выбора варианта хранилища.
+    storage.close()
+    storage = ShardedAppStorage(data_dir / "app.db", migration_progress=STORAGE_MIGRATION_PROGRESS)
+    LOGGER.info("Per-owner SQLite shards enabled: %s", storage.shards_dir)
+  cors_options = build_cors_options(deployment_mode)
+  app.add_middleware(CORSMiddleware, **cors_options)
+  LOGGER.info(
+    "Deployment mode '%s' active; CORS origins: %d",
+    deployment_mode,
+    len(cors_options["allow_origins"]),
+  )
+
+  # Приходит часть OPTIONS не как CORS preflight (без Origin/Access-Control-Request-Method),
+  # поэтому FastAPI по умолчанию отвечает 405. Ловим все OPTIONS и отдаём 204.
+  @app.options("/{full_path:path}")
+  def options_passthrough(full_path: str) -> Response:
+    return Response(status_code=204)
+
+  auth_service = AuthService(storage=storage)
+  app.state.auth_service = auth_service
+  # API-воркер при отдельном сервере модели (python -m backend.model_server): модель, checkpoint/vacuum и
+  # прочее общее обслуживание базы — в том процессе, здесь остаются только сессии и лимитер этого воркера.
+  model_server_socket = resolve_model_server_socket()
+  # Каталог вложений общий с сервером модели: файлы вытесняет только он, воркер лишь пишет и читает.
+  attachment_store = AttachmentStore(data_dir / "attachments", evict=not model_server_socket)
+  # Очистка сессий/лимитов/аудита, checkpoint и vacuum — в одном фоновом потоке, а не в запросах.
+  storage_maintenance = build_storage_maintenance(
+    storage,
+    auth_service=auth_service,
+    attachment_store=attachment_store,
+    shared_tasks=not model_server_socket,
+  )
+  storage_maintenance.start()
+  app.state.storage_maintenance = storage_maintenance
+
+  app.add_middleware(SecurityMiddleware, storage=storage, auth_service=auth_service)
 
   system_prompt = load_system_prompt()
-  model_engine = PythonModelEngine(storage, base_system_prompt=system_prompt)
-  auto_load_enabled = os.getenv("ANCIA_ENABLE_MODEL_EAGER_LOAD", "").strip() == "1"
-  if auto_load_enabled:
-    model_engine.start_background_load()
+  if model_server_socket:
+    model_engine = ModelServerClient(model_server_socket)
+    LOGGER.info("Using model server at %s", model_server_socket)
+  else:
+    model_engine = PythonModelEngine(
+      storage,
+      base_system_prompt=system_prompt,
+      attachment_store=attachment_store,
+    )
+    auto_load_enabled = os.getenv("ANCIA_ENABLE_MODEL_EAGER_LOAD", "").strip() == "1"
+    if auto_load_enabled:
+      model_engine.start_background_load()
   tool_registry = ToolRegistry()
 
   def is_autonomous_mode() -> bool:
@@ -517,12 +549,40 @@ def make_app() -> FastAPI:
     build_system_prompt_fn=build_system_prompt,
     refresh_tool_registry_fn=refresh_tool_registry,
     auth_service=auth_service,
+    attachment_store=attachment_store,
+    maintenance=storage_maintenance,
   )
 
+  @app.on_event("shutdown")
+  def stop_background_state() -> None:
+    storage_maintenance.stop()
+    auth_service.close()
+    workload_executors.shutdown()
+    # Лимитер держит состояние в памяти — сохраняем его, чтобы после перезапуска лимиты продолжали действовать.
+    try:
+      storage.flush_rate_limit_state()
+    except Exception as exc:
+      LOGGER.warning("Failed to persist rate limiter state: %s", exc)
+
   return app
 
 
-app = make_app()
+def create_app() -> FastAPI | DeferredStartupApp:
+  """Без ожидающих миграций — обычное приложение; иначе сборка уходит в фон, а /health сразу отвечает прогрессом."""
+  pending = pending_schema_migration(resolve_data_dir() / "app.db")
+  if pending is None:
+    return make_app()
+  LOGGER.info("Storage schema migration pending: v%s -> v%s; serving /health while it runs", *pending)
+  # Режим (а с ним и CORS) читаем из файла напрямую: AppStorage откроется только после миграции.
+  cors_options = build_cors_options(resolve_deployment_mode(ReadOnlySettings(resolve_data_dir() / "app.db")))
+  return DeferredStartupApp(
+    make_app,
+    progress_fn=STORAGE_MIGRATION_PROGRESS.snapshot,
+    wrap_gate=lambda gate: CORSMiddleware(gate, **cors_options),
+  )
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
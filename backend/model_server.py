@@ -0,0 +1,627 @@
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Callable, Generator, Iterator
+
+from pydantic import BaseModel
+
+try:
+  from backend.attachment_store import AttachmentStore
+  from backend.engine import PythonModelEngine
+  from backend.engine_support import ModelResult
+  from backend.runtime_paths import load_system_prompt, resolve_data_dir
+  from backend.schemas import AttachmentRef, ChatRequest, RuntimeChatContext, ToolEvent
+  from backend.storage import AppStorage
+  from backend.storage_maintenance import build_storage_maintenance
+  from backend.tooling import ToolRegistry
+except ModuleNotFoundError:
+  from attachment_store import AttachmentStore  # type: ignore
+  from engine import PythonModelEngine  # type: ignore
+  from engine_support import ModelResult  # type: ignore
+  from runtime_paths import load_system_prompt, resolve_data_dir  # type: ignore
+  from schemas import AttachmentRef, ChatRequest, RuntimeChatContext, ToolEvent  # type: ignore
+  from storage import AppStorage  # type: ignore
+  from storage_maintenance import build_storage_maintenance  # type: ignore
+  from tooling import ToolRegistry  # type: ignore
+
+LOGGER = logging.getLogger("ancia.model_server")
+
+MODEL_SERVER_SOCKET_ENV = "ANCIA_MODEL_SERVER_SOCKET"
+MODEL_SERVER_SOCKET_NAME = "model-server.sock"
+MODEL_SERVER_FRAME_MAX_BYTES = 64 * 1024 * 1024
+MODEL_SERVER_CONNECT_TIMEOUT_SECONDS = 2.0
+# sun_path: 104 байта на macOS, 108 на Linux — берём меньшее.
+MODEL_SERVER_SOCKET_PATH_MAX_BYTES = 103
+MODEL_SERVER_WORKERS_STOP_TIMEOUT_SECONDS = 10.0
+# Кэш сессий у каждого воркера свой: logout на одном воркере не виден остальным до истечения TTL.
+# Поэтому по умолчанию воркеры кэш не держат; ANCIA_AUTH_SESSION_CACHE_TTL_SECONDS задаёт
+# допустимое окно, в течение которого отозванный токен ещё принимается другими воркерами.
+MODEL_SERVER_WORKER_SESSION_CACHE_TTL_SECONDS = "0"
+
+# Методы PythonModelEngine, доступные API-воркерам. Всё остальное сервер отклоняет.
+MODEL_SERVER_METHODS = frozenset({
+  "complete",
+  "delete_local_model_cache",
+  "get_context_usage",
+  "get_context_window_requirements",
+  "get_loaded_model_id",
+  "get_local_cache_map",
+  "get_model_params",
+  "get_runtime_snapshot",
+  "get_selected_model_id",
+  "get_selected_tier",
+  "get_startup_snapshot",
+  "get_unavailable_message",
+  "is_ready",
+  "iter_complete",
+  "list_models_catalog",
+  "request_stop_generation",
+  "set_model_params",
+  "set_selected_model",
+  "start_background_load",
+  "summarize_history_segment",
+  "suggest_chat_title",
+  "unload_model",
+})
+MODEL_SERVER_STREAM_METHODS = frozenset({"iter_complete"})
+MODEL_SERVER_ATTRIBUTES = frozenset({"model_name", "model_repo"})
+# Обратные вызовы движка к реестру инструментов: сам реестр и плагины живут в API-воркере.
+MODEL_SERVER_TOOL_CALLBACKS = frozenset({
+  "build_llm_schema_map",
+  "build_tool_definition_map",
+  "execute",
+  "get_tool_meta",
+  "has_tool",
+  "render_tools_prompt_block",
+  "resolve_tool_name",
+})
+
+_WIRE_KEY = "__wire__"
+_WIRE_MODELS: dict[str, type[BaseModel]] = {
+  "AttachmentRef": AttachmentRef,
+  "ChatRequest": ChatRequest,
+  "ToolEvent": ToolEvent,
+}
+_WIRE_DATACLASSES: dict[str, type] = {
+  "ModelResult": ModelResult,
+  "RuntimeChatContext": RuntimeChatContext,
+}
+_WIRE_ERRORS: dict[str, type[Exception]] = {
+  "FileNotFoundError": FileNotFoundError,
+  "KeyError": KeyError,
+  "LookupError": LookupError,
+  "PermissionError": PermissionError,
+  "TypeError": TypeError,
+  "ValueError": ValueError,
+}
+
+
+class ModelServerUnavailableError(RuntimeError):
+  """Сервер модели не отвечает; RuntimeError — маршруты уже отдают на него 503."""
+
+
+def resolve_model_server_socket() -> str:
+  return str(os.getenv(MODEL_SERVER_SOCKET_ENV, "") or "").strip()
+
+
+def encode_wire(value: Any) -> Any:
+  """Значение -> JSON для сокета; модели, датаклассы и множества помечаются, чтобы собрать их обратно."""
+  if value is None or isinstance(value, (str, bool, int, float)):
+    return value
+  if isinstance(value, (ToolRegistry, _RemoteToolRegistry)):
+    return {_WIRE_KEY: "tool_registry"}
+  if isinstance(value, (set, frozenset)):
+    return {_WIRE_KEY: "set", "value": [encode_wire(item) for item in sorted(value, key=str)]}
+  if isinstance(value, BaseModel):
+    name = type(value).__name__
+    payload = value.model_dump(mode="json")
+    return {_WIRE_KEY: name, "value": payload} if name in _WIRE_MODELS else payload
+  if dataclasses.is_dataclass(value) and type(value).__name__ in _WIRE_DATACLASSES:
+    return {
+      _WIRE_KEY: type(value).__name__,
+      "value": {field.name: encode_wire(getattr(value, field.name)) for field in dataclasses.fields(value)},
+    }
+  if isinstance(value, dict):
+    return {str(key): encode_wire(item) for key, item in value.items()}
+  if isinstance(value, (list, tuple)):
+    return [encode_wire(item) for item in value]
+  if isinstance(value, Path):
+    return str(value)
+  raise TypeError(f"Unsupported model server value: {type(value).__name__}")
+
+
+def decode_wire(value: Any, *, tool_registry: Any = None) -> Any:
+  if isinstance(value, list):
+    return [decode_wire(item, tool_registry=tool_registry) for item in value]
+  if not isinstance(value, dict):
+    return value
+  kind = value.get(_WIRE_KEY)
+  if kind is None:
+    return {key: decode_wire(item, tool_registry=tool_registry) for key, item in value.items()}
+  if kind == "tool_registry":
+    return tool_registry
+  if kind == "set":
+    return {decode_wire(item) for item in value.get("value") or []}
+  if kind in _WIRE_MODELS:
+    return _WIRE_MODELS[kind].model_validate(value.get("value") or {})
+  if kind in _WIRE_DATACLASSES:
+    fields = {key: decode_wire(item) for key, item in (value.get("value") or {}).items()}
+    return _WIRE_DATACLASSES[kind](**fields)
+  raise TypeError(f"Unsupported model server value kind: {kind}")
+
+
+def _send_frame(sock: socket.socket, payload: dict[str, Any]) -> None:
+  body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+  if len(body) > MODEL_SERVER_FRAME_MAX_BYTES:
+    raise ValueError(f"Model server frame too large: {len(body)} bytes")
+  sock.sendall(struct.pack(">I", len(body)) + body)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes | None:
+  buffer = bytearray(size)
+  view = memoryview(buffer)
+  received = 0
+  while received < size:
+    count = sock.recv_into(view[received:], size - received)
+    if count == 0:
+      return None
+    received += count
+  return bytes(buffer)
+
+
+def _recv_frame(sock: socket.socket) -> dict[str, Any] | None:
+  header = _recv_exact(sock, 4)
+  if header is None:
+    return None
+  (size,) = struct.unpack(">I", header)
+  if size > MODEL_SERVER_FRAME_MAX_BYTES:
+    raise ValueError(f"Model server frame too large: {size} bytes")
+  body = _recv_exact(sock, size)
+  if body is None:
+    return None
+  payload = json.loads(body.decode("utf-8"))
+  return payload if isinstance(payload, dict) else {}
+
+
+def _error_frame(exc: BaseException) -> dict[str, Any]:
+  return {"type": "error", "kind": exc.__class__.__name__, "message": str(exc) or exc.__class__.__name__}
+
+
+def _raise_error_frame(frame: dict[str, Any]) -> None:
+  error_cls = _WIRE_ERRORS.get(str(frame.get("kind") or ""), RuntimeError)
+  raise error_cls(str(frame.get("message") or "Ошибка сервера модели."))
+
+
+class _ServerChannel:
+  """Соединение одного вызова на стороне сервера: ответы, поток событий и обратные вызовы к реестру инструментов."""
+
+  def __init__(self, sock: socket.socket) -> None:
+    self._sock = sock
+    self._lock = threading.Lock()
+
+  def send(self, payload: dict[str, Any]) -> None:
+    with self._lock:
+      _send_frame(self._sock, payload)
+
+  def callback(self, method: str, args: list[Any]) -> Any:
+    with self._lock:
+      _send_frame(self._sock, {"type": "callback", "method": method, "args": encode_wire(args)})
+      reply = _recv_frame(self._sock)
+    if reply is None:
+      raise ConnectionError("API-воркер закрыл соединение с сервером модели")
+    if not reply.get("ok"):
+      raise RuntimeError(str(reply.get("message") or f"Tool callback '{method}' failed"))
+    return decode_wire(reply.get("value"))
+
+
+class _RemoteToolRegistry:
+  """Реестр инструментов для движка в сервере модели: каждый вызов уходит в API-воркер по тому же соединению.
+
+  Реестр не меняется во время одного вызова, поэтому ответы на чтение кэшируются до конца соединения.
+  """
+
+  def __init__(self, channel: _ServerChannel) -> None:
+    self._channel = channel
+    self._cache: dict[str, Any] = {}
+
+  def _read(self, method: str, *args: Any) -> Any:
+    key = json.dumps([method, encode_wire(list(args))], ensure_ascii=False, sort_keys=True)
+    if key not in self._cache:
+      self._cache[key] = self._channel.callback(method, list(args))
+    return self._cache[key]
+
+  def resolve_tool_name(self, name: str) -> str:
+    return str(self._read("resolve_tool_name", name) or "")
+
+  def has_tool(self, name: str) -> bool:
+    return bool(self._read("has_tool", name))
+
+  def get_tool_meta(self, name: str) -> dict[str, Any]:
+    return dict(self._read("get_tool_meta", name) or {})
+
+  def build_llm_schema_map(self, names: set[str] | None = None) -> dict[str, dict[str, Any]]:
+    return dict(self._read("build_llm_schema_map", names) or {})
+
+  def build_tool_definition_map(self, names: set[str] | None = None) -> dict[str, dict[str, Any]]:
+    return dict(self._read("build_tool_definition_map", names) or {})
+
+  def render_tools_prompt_block(self, names: set[str] | None = None) -> str:
+    return str(self._read("render_tools_prompt_block", names) or "")
+
+  def execute(self, name: str, args: dict[str, Any], runtime: Any) -> dict[str, Any]:
+    # runtime не передаём: воркер исполняет инструмент со своим исходным контекстом запроса.
+    return self._channel.callback("execute", [name, args])
+
+
+class _ModelServerHandler(socketserver.BaseRequestHandler):
+  def handle(self) -> None:
+    self.server.model_server._serve_connection(self.request)  # type: ignore[attr-defined]
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+
+class ModelServer:
+  """Один PythonModelEngine на процесс за Unix-сокетом; API-воркеры ходят сюда через ModelServerClient.
+
+  Одно соединение — один вызов: кадр запроса, затем кадры ответа (для iter_complete — поток событий).
+  """
+
+  def __init__(self, engine: Any, socket_path: str) -> None:
+    self._engine = engine
+    self.socket_path = str(socket_path)
+    self._server: _UnixServer | None = None
+    self._thread: threading.Thread | None = None
+
+  def start(self) -> None:
+    path = Path(self.socket_path)
+    if len(os.fsencode(str(path))) > MODEL_SERVER_SOCKET_PATH_MAX_BYTES:
+      raise ValueError(f"Model server socket path is too long, set {MODEL_SERVER_SOCKET_ENV}: {path}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists() or path.is_symlink():
+      path.unlink()
+    # Сокет создаётся уже с правами 0600: между bind и chmod чужой процесс не успеет подключиться.
+    previous_umask = os.umask(0o077)
+    try:
+      server = _UnixServer(str(path), _ModelServerHandler)
+    finally:
+      os.umask(previous_umask)
+    server.model_server = self  # type: ignore[attr-defined]
+    os.chmod(path, 0o600)
+    self._server = server
+    self._thread = threading.Thread(target=server.serve_forever, name="ancia-model-server", daemon=True)
+    self._thread.start()
+    LOGGER.info("Model server listening on %s", path)
+
+  def shutdown(self) -> None:
+    server = self._server
+    if server is None:
+      return
+    self._server = None
+    server.shutdown()
+    server.server_close()
+    try:
+      Path(self.socket_path).unlink()
+    except OSError:
+      pass
+
+  def _serve_connection(self, sock: socket.socket) -> None:
+    try:
+      request = _recv_frame(sock)
+    except (OSError, ValueError):
+      return
+    if not request:
+      return
+    channel = _ServerChannel(sock)
+    try:
+      method = str(request.get("method") or "")
+      if method == "get_attribute":
+        name = str(request.get("name") or "")
+        if name not in MODEL_SERVER_ATTRIBUTES:
+          raise AttributeError(f"Unsupported model server attribute: {name}")
+        channel.send({"type": "result", "value": encode_wire(getattr(self._engine, name))})
+        return
+      if method not in MODEL_SERVER_METHODS:
+        raise AttributeError(f"Unsupported model server method: {method}")
+      tool_registry = _RemoteToolRegistry(channel)
+      args = decode_wire(request.get("args") or [], tool_registry=tool_registry)
+      kwargs = decode_wire(request.get("kwargs") or {}, tool_registry=tool_registry)
+      target = getattr(self._engine, method)
+      if method in MODEL_SERVER_STREAM_METHODS:
+        self._stream(channel, target(*args, **kwargs))
+        return
+      channel.send({"type": "result", "value": encode_wire(target(*args, **kwargs))})
+    except OSError:
+      return
+    except Exception as exc:
+      try:
+        channel.send(_error_frame(exc))
+      except OSError:
+        pass
+
+  def _stream(self, channel: _ServerChannel, iterator: Generator[Any, None, Any]) -> None:
+    try:
+      while True:
+        try:
+          item = next(iterator)
+        except StopIteration as stop:
+          channel.send({"type": "done", "value": encode_wire(stop.value)})
+          return
+        channel.send({"type": "item", "value": encode_wire(item)})
+    except OSError:
+      # Воркер закрыл поток (клиент ушёл) — останавливаем генерацию, как при закрытии потока в одном процессе.
+      self._engine.request_stop_generation()
+      raise
+    finally:
+      iterator.close()
+
+
+class ModelServerClient:
+  """Заменитель PythonModelEngine в API-воркере: вызовы уходят в сервер модели по Unix-сокету.
+
+  Реестр инструментов и контекст запроса остаются в воркере — сервер дёргает их обратными вызовами.
+  """
+
+  _summarize_tool_event = staticmethod(PythonModelEngine._summarize_tool_event)
+  _truncate_text = staticmethod(PythonModelEngine._truncate_text)
+
+  def __init__(self, socket_path: str, *, connect_timeout_seconds: float = MODEL_SERVER_CONNECT_TIMEOUT_SECONDS) -> None:
+    self.socket_path = str(socket_path)
+    self._connect_timeout_seconds = max(0.1, float(connect_timeout_seconds))
+
+  def __getattr__(self, name: str) -> Callable[..., Any]:
+    if name not in MODEL_SERVER_METHODS:
+      raise AttributeError(name)
+
+    def call(*args: Any, **kwargs: Any) -> Any:
+      return self._call(name, *args, **kwargs)
+
+    return call
+
+  def _open(self, request: dict[str, Any]) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.settimeout(self._connect_timeout_seconds)
+      sock.connect(self.socket_path)
+      # Генерация и инструменты могут идти долго — дальше ждём без таймаута.
+      sock.settimeout(None)
+      _send_frame(sock, request)
+    except OSError as exc:
+      sock.close()
+      raise ModelServerUnavailableError(f"Сервер модели недоступен ({self.socket_path}): {exc}") from exc
+    return sock
+
+  @staticmethod
+  def _exchange(sock: socket.socket, *, tool_registry: Any, runtime: Any) -> Iterator[dict[str, Any]]:
+    while True:
+      try:
+        frame = _recv_frame(sock)
+      except OSError as exc:
+        raise ModelServerUnavailableError(f"Соединение с сервером модели прервано: {exc}") from exc
+      if frame is None:
+        raise ModelServerUnavailableError("Сервер модели закрыл соединение без ответа.")
+      if frame.get("type") != "callback":
+        yield frame
+        continue
+      method = str(frame.get("method") or "")
+      try:
+        if tool_registry is None or method not in MODEL_SERVER_TOOL_CALLBACKS:
+          raise RuntimeError(f"Unsupported tool callback: {method}")
+        args = decode_wire(frame.get("args") or [])
+        if method == "execute":
+          value = tool_registry.execute(args[0], args[1], runtime)
+        else:
+          value = getattr(tool_registry, method)(*args)
+        reply = {"ok": True, "value": encode_wire(value)}
+      except Exception as exc:
+        reply = {"ok": False, "message": str(exc) or exc.__class__.__name__}
+      _send_frame(sock, reply)
+
+  def _request(self, method: str, args: tuple, kwargs: dict[str, Any]) -> dict[str, Any]:
+    return {"method": method, "args": encode_wire(list(args)), "kwargs": encode_wire(kwargs)}
+
+  def _call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+    with closing(self._open(self._request(method, args, kwargs))) as sock:
+      for frame in self._exchange(sock, tool_registry=kwargs.get("tool_registry"), runtime=kwargs.get("runtime")):
+        if frame.get("type") == "error":
+          _raise_error_frame(frame)
+        return decode_wire(frame.get("value"))
+    raise ModelServerUnavailableError("Сервер модели закрыл соединение без ответа.")
+
+  def _get_attribute(self, name: str) -> Any:
+    try:
+      with closing(self._open({"method": "get_attribute", "name": name})) as sock:
+        for frame in self._exchange(sock, tool_registry=None, runtime=None):
+          if frame.get("type") == "error":
+            _raise_error_frame(frame)
+          return frame.get("value")
+    except ModelServerUnavailableError:
+      return ""
+    return ""
+
+  @property
+  def model_name(self) -> str:
+    return str(self._get_attribute("model_name") or "")
+
+  @property
+  def model_repo(self) -> str:
+    return str(self._get_attribute("model_repo") or "")
+
+  def _unavailable_snapshot(self, exc: Exception) -> dict[str, Any]:
+    return {
+      "status": "error",
+      "stage": "model_server",
+      "message": str(exc),
+      "details": {"progress_percent": 0, "model_server_socket": self.socket_path},
+    }
+
+  # /health и списки моделей должны отвечать и без сервера модели — отдаём состояние ошибки, а не 500.
+  def get_startup_snapshot(self) -> dict[str, Any]:
+    try:
+      return dict(self._call("get_startup_snapshot") or {})
+    except ModelServerUnavailableError as exc:
+      return self._unavailable_snapshot(exc)
+
+  def get_runtime_snapshot(self) -> dict[str, Any]:
+    try:
+      snapshot = dict(self._call("get_runtime_snapshot") or {})
+      available = True
+    except ModelServerUnavailableError as exc:
+      snapshot = {"startup": self._unavailable_snapshot(exc)}
+      available = False
+    snapshot["model_server"] = {"socket": self.socket_path, "available": available}
+    return snapshot
+
+  def is_ready(self) -> bool:
+    try:
+      return bool(self._call("is_ready"))
+    except ModelServerUnavailableError:
+      return False
+
+  def list_models_catalog(self) -> list[dict[str, Any]]:
+    try:
+      return list(self._call("list_models_catalog") or [])
+    except ModelServerUnavailableError:
+      return []
+
+  def get_selected_model_id(self, tier: str | None = None) -> str:
+    try:
+      return str(self._call("get_selected_model_id", tier) or "")
+    except ModelServerUnavailableError:
+      return ""
+
+  def get_loaded_model_id(self) -> str:
+    try:
+      return str(self._call("get_loaded_model_id") or "")
+    except ModelServerUnavailableError:
+      return ""
+
+  def iter_complete(
+    self,
+    *,
+    request: ChatRequest,
+    runtime: RuntimeChatContext,
+    tool_registry: ToolRegistry,
+    active_tools: set[str],
+  ) -> Generator[Any, None, ModelResult]:
+    payload = self._request(
+      "iter_complete",
+      (),
+      {"request": request, "runtime": runtime, "tool_registry": tool_registry, "active_tools": active_tools},
+    )
+    with closing(self._open(payload)) as sock:
+      for frame in self._exchange(sock, tool_registry=tool_registry, runtime=runtime):
+        frame_type = frame.get("type")
+        if frame_type == "item":
+          yield decode_wire(frame.get("value"))
+        elif frame_type == "done":
+          return decode_wire(frame.get("value"))
+        elif frame_type == "error":
+          _raise_error_frame(frame)
+    raise ModelServerUnavailableError("Сервер модели закрыл поток без результата.")
+
+
+def _resolve_default_socket_path(data_dir: Path) -> str:
+  return resolve_model_server_socket() or str((data_dir / MODEL_SERVER_SOCKET_NAME).resolve())
+
+
+def _read_api_workers(raw: str) -> int:
+  try:
+    return max(0, min(64, int(str(raw or "0").strip() or 0)))
+  except ValueError:
+    return 0
+
+
+def _build_api_workers_env(socket_path: str) -> dict[str, str]:
+  env = {**os.environ, MODEL_SERVER_SOCKET_ENV: socket_path}
+  # Лимиты запросов и попыток входа считаются по общей строке в SQLite, иначе бюджет растёт в N раз.
+  env["ANCIA_RATE_LIMIT_SHARED"] = "1"
+  env.setdefault("ANCIA_AUTH_SESSION_CACHE_TTL_SECONDS", MODEL_SERVER_WORKER_SESSION_CACHE_TTL_SECONDS)
+  return env
+
+
+def main(argv: list[str] | None = None) -> int:
+  parser = argparse.ArgumentParser(
+    description="Ancia model server: one PythonModelEngine behind a Unix socket, optionally with N uvicorn API workers",
+  )
+  parser.add_argument("--socket", default="", help=f"путь к Unix-сокету (по умолчанию {MODEL_SERVER_SOCKET_ENV} или <data>/{MODEL_SERVER_SOCKET_NAME})")
+  parser.add_argument("--api-workers", type=int, default=_read_api_workers(os.getenv("ANCIA_API_WORKERS", "0")),
+                      help="сколько uvicorn-воркеров запустить; 0 — только сервер модели")
+  parser.add_argument("--host", default=os.getenv("ANCIA_BACKEND_HOST", "127.0.0.1"))
+  parser.add_argument("--port", type=int, default=int(os.getenv("ANCIA_BACKEND_PORT", "5055")))
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+  data_dir = resolve_data_dir()
+  data_dir.mkdir(parents=True, exist_ok=True)
+  socket_path = str(args.socket or "").strip() or _resolve_default_socket_path(data_dir)
+  # Миграции схемы проходят здесь, один раз и до старта воркеров: параллельные миграции из нескольких процессов небезопасны.
+  storage = AppStorage(data_dir / "app.db")
+  attachment_store = AttachmentStore(data_dir / "attachments")
+  engine = PythonModelEngine(
+    storage,
+    base_system_prompt=load_system_prompt(),
+    attachment_store=attachment_store,
+  )
+  if os.getenv("ANCIA_ENABLE_MODEL_EAGER_LOAD", "").strip() == "1":
+    engine.start_background_load()
+  # Общие для базы задачи обслуживания выполняет только этот процесс; воркеры оставляют себе сессии.
+  maintenance = build_storage_maintenance(storage, attachment_store=attachment_store)
+  maintenance.start()
+  server = ModelServer(engine, socket_path)
+  server.start()
+
+  stop_event = threading.Event()
+  for signum in (signal.SIGINT, signal.SIGTERM):
+    signal.signal(signum, lambda *_: stop_event.set())
+
+  workers: subprocess.Popen | None = None
+  exit_code = 0
+  try:
+    if args.api_workers > 0:
+      workers = subprocess.Popen(
+        [
+          sys.executable, "-m", "uvicorn", "backend.main:app",
+          "--host", str(args.host),
+          "--port", str(args.port),
+          "--workers", str(args.api_workers),
+        ],
+        cwd=str(Path(__file__).resolve().parents[1]),
+        env=_build_api_workers_env(socket_path),
+      )
+      LOGGER.info("Started %d API workers on %s:%s (pid %s)", args.api_workers, args.host, args.port, workers.pid)
+    while not stop_event.wait(0.5):
+      if workers is not None and workers.poll() is not None:
+        exit_code = int(workers.returncode or 0)
+        LOGGER.warning("API workers exited with code %s", exit_code)
+        break
+  finally:
+    if workers is not None and workers.poll() is None:
+      workers.terminate()
+      try:
+        workers.wait(timeout=MODEL_SERVER_WORKERS_STOP_TIMEOUT_SECONDS)
+      except subprocess.TimeoutExpired:
+        workers.kill()
+    engine.request_stop_generation()
+    server.shutdown()
+    maintenance.stop()
+    storage.close()
+  return exit_code
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
@@ -0,0 +1,328 @@
+from __future__ import annotations
+
+import abc
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+try:
+  from argon2 import PasswordHasher as _Argon2PasswordHasher  # type: ignore
+  from argon2.exceptions import InvalidHashError, VerificationError  # type: ignore
+except ImportError:
+  _Argon2PasswordHasher = None
+
+PBKDF2_ALGORITHM = "pbkdf2_sha256"
+PBKDF2_DEFAULT_ITERATIONS = 240_000
+PBKDF2_MIN_ITERATIONS = 100_000
+SCRYPT_ALGORITHM = "scrypt"
+# n=2^15, r=8: ~32 MiB и ~50-100 мс на хэш — порядок PBKDF2 с 240k итераций, но дороже для GPU.
+SCRYPT_DEFAULT_N = 1 << 15
+SCRYPT_DEFAULT_R = 8
+SCRYPT_DEFAULT_P = 1
+ARGON2_ALGORITHM = "argon2"
+PASSWORD_SALT_BYTES = 16
+
+PASSWORD_HASH_DEFAULT_CONCURRENCY = 2
+PASSWORD_HASH_DEFAULT_QUEUE_SIZE = 8
+PASSWORD_HASH_DEFAULT_QUEUE_TIMEOUT_SECONDS = 5.0
+
+
+def _read_env_int(name: str, fallback: int, *, minimum: int, maximum: int) -> int:
+  raw = str(os.getenv(name, "") or "").strip()
+  try:
+    value = int(raw) if raw else fallback
+  except ValueError:
+    value = fallback
+  return max(minimum, min(maximum, value))
+
+
+def _read_env_float(name: str, fallback: float, *, minimum: float, maximum: float) -> float:
+  raw = str(os.getenv(name, "") or "").strip()
+  try:
+    value = float(raw) if raw else fallback
+  except ValueError:
+    value = fallback
+  return max(minimum, min(maximum, value))
+
+
+class PasswordHasher(abc.ABC):
+  """Формат хэша: '<algorithm>$<параметры...>$<salt hex>$<digest hex>'; по префиксу выбирается hasher."""
+
+  algorithm = ""
+
+  def matches(self, encoded: str) -> bool:
+    return encoded.startswith(f"{self.algorithm}$")
+
+  @abc.abstractmethod
+  def hash(self, password: str) -> str:
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def verify(self, password: str, encoded: str) -> bool:
+    raise NotImplementedError
+
+  def needs_rehash(self, encoded: str) -> bool:
+    """True, если хэш сделан с другими параметрами, чем текущие у этого hasher."""
+    return False
+
+
+class Pbkdf2Hasher(PasswordHasher):
+  algorithm = PBKDF2_ALGORITHM
+
+  def __init__(self, iterations: int = PBKDF2_DEFAULT_ITERATIONS) -> None:
+    self.iterations = max(PBKDF2_MIN_ITERATIONS, int(iterations))
+
+  def hash(self, password: str) -> str:
+    salt = os.urandom(PASSWORD_SALT_BYTES)
+    derived = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, self.iterations)
+    return "$".join([self.algorithm, str(self.iterations), salt.hex(), derived.hex()])
+
+  @staticmethod
+  def _parse(encoded: str) -> tuple[int, bytes, bytes] | None:
+    parts = encoded.split("$")
+    if len(parts) != 4:
+      return None
+    try:
+      return max(PBKDF2_MIN_ITERATIONS, int(parts[1])), bytes.fromhex(parts[2]), bytes.fromhex(parts[3])
+    except (TypeError, ValueError):
+      return None
+
+  def verify(self, password: str, encoded: str) -> bool:
+    parsed = self._parse(encoded)
+    if parsed is None:
+      return False
+    iterations, salt, expected = parsed
+    actual = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return hmac.compare_digest(actual, expected)
+
+  def needs_rehash(self, encoded: str) -> bool:
+    parsed = self._parse(encoded)
+    return parsed is None or parsed[0] != self.iterations
+
+
+class ScryptHasher(PasswordHasher):
+  algorithm = SCRYPT_ALGORITHM
+
+  def __init__(self, n: int = SCRYPT_DEFAULT_N, r: int = SCRYPT_DEFAULT_R, p: int = SCRYPT_DEFAULT_P) -> None:
+    self.n = int(n)
+    self.r = int(r)
+    self.p = int(p)
+
+  def _derive(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # maxmem с запасом: по умолчанию OpenSSL ограничивает 32 MiB, а n=2^15, r=8 требует ровно столько.
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+  def hash(self, password: str) -> str:
+    salt = os.urandom(PASSWORD_SALT_BYTES)
+    derived = self._derive(password, salt, self.n, self.r, self.p)
+    return "$".join([self.algorithm, str(self.n), str(self.r), str(self.p), salt.hex(), derived.hex()])
+
+  @staticmethod
+  def _parse(encoded: str) -> tuple[int, int, int, bytes, bytes] | None:
+    parts = encoded.split("$")
+    if len(parts) != 6:
+      return None
+    try:
+      n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+      if n < 2 or n & (n - 1) or r < 1 or p < 1 or n * r > 1 << 24:
+        return None
+      return n, r, p, bytes.fromhex(parts[4]), bytes.fromhex(parts[5])
+    except (TypeError, ValueError):
+      return None
+
+  def verify(self, password: str, encoded: str) -> bool:
+    parsed = self._parse(encoded)
+    if parsed is None:
+      return False
+    n, r, p, salt, expected = parsed
+    try:
+      actual = self._derive(password, salt, n, r, p)
+    except (ValueError, MemoryError):
+      return False
+    return hmac.compare_digest(actual, expected)
+
+  def needs_rehash(self, encoded: str) -> bool:
+    parsed = self._parse(encoded)
+    return parsed is None or parsed[:3] != (self.n, self.r, self.p)
+
+
+class Argon2Hasher(PasswordHasher):
+  """argon2id через argon2-cffi (необязательная зависимость); хэш хранится в стандартном формате '$argon2id$...'."""
+
+  algorithm = ARGON2_ALGORITHM
+
+  def __init__(self) -> None:
+    if _Argon2PasswordHasher is None:
+      raise RuntimeError("argon2-cffi is not installed")
+    self._hasher = _Argon2PasswordHasher()
+
+  def matches(self, encoded: str) -> bool:
+    return encoded.startswith("$argon2")
+
+  def hash(self, password: str) -> str:
+    return str(self._hasher.hash(password))
+
+  def verify(self, password: str, encoded: str) -> bool:
+    try:
+      return bool(self._hasher.verify(encoded, password))
+    except (VerificationError, InvalidHashError):
+      return False
+
+  def needs_rehash(self, encoded: str) -> bool:
+    try:
+      return bool(self._hasher.check_needs_rehash(encoded))
+    except (InvalidHashError, ValueError):
+      return True
+
+
+def is_argon2_available() -> bool:
+  return _Argon2PasswordHasher is not None
+
+
+class PasswordHasherRegistry:
+  """Новые хэши — алгоритмом по умолчанию; проверка — любым известным. Устаревший хэш помечается для пересчёта."""
+
+  def __init__(self, default: PasswordHasher, *, hashers: list[PasswordHasher] | None = None) -> None:
+    self.default = default
+    self._hashers = [default] + [item for item in (hashers or []) if item.algorithm != default.algorithm]
+
+  @property
+  def algorithms(self) -> list[str]:
+    return [item.algorithm for item in self._hashers]
+
+  def _find(self, encoded: str) -> PasswordHasher | None:
+    for hasher in self._hashers:
+      if hasher.matches(encoded):
+        return hasher
+    return None
+
+  def hash(self, password: str) -> str:
+    return self.default.hash(str(password or ""))
+
+  def verify(self, password: str, encoded: str) -> tuple[bool, bool]:
+    """(пароль верный, хэш нужно пересчитать текущим алгоритмом/параметрами)."""
+    safe_encoded = str(encoded or "").strip()
+    hasher = self._find(safe_encoded) if safe_encoded else None
+    if hasher is None:
+      return False, False
+    if not hasher.verify(str(password or ""), safe_encoded):
+      return False, False
+    return True, hasher is not self.default or hasher.needs_rehash(safe_encoded)
+
+
+def build_password_hasher_registry() -> PasswordHasherRegistry:
+  """Алгоритм новых хэшей — ANCIA_PASSWORD_HASHER (pbkdf2_sha256 | scrypt | argon2); старые хэши продолжают проверяться."""
+  hashers: list[PasswordHasher] = [
+    Pbkdf2Hasher(_read_env_int("ANCIA_PASSWORD_PBKDF2_ITERATIONS", PBKDF2_DEFAULT_ITERATIONS, minimum=PBKDF2_MIN_ITERATIONS, maximum=10_000_000)),
+    ScryptHasher(
+      n=1 << _read_env_int("ANCIA_PASSWORD_SCRYPT_LOG2_N", SCRYPT_DEFAULT_N.bit_length() - 1, minimum=14, maximum=20),
+    ),
+  ]
+  if is_argon2_available():
+    hashers.append(Argon2Hasher())
+  requested = str(os.getenv("ANCIA_PASSWORD_HASHER", "") or "").strip().lower()
+  default = next((item for item in hashers if item.algorithm == requested), hashers[0])
+  return PasswordHasherRegistry(default, hashers=hashers)
+
+
+class PasswordHashBusyError(RuntimeError):
+  def __init__(self, retry_after_seconds: int = 1) -> None:
+    self.retry_after_seconds = max(1, int(retry_after_seconds or 1))
+    super().__init__(f"Сервер занят проверкой паролей. Повторите через {self.retry_after_seconds} сек.")
+
+
+class PasswordHashExecutor:
+  """Отдельный маленький пул для хэширования паролей.
+
+  Одновременно считается не больше concurrency хэшей, в очереди ждут не больше queue_size;
+  остальные запросы сразу получают PasswordHashBusyError. Задача, простоявшая в очереди дольше
+  queue_timeout, не считается вовсе — клиент её уже не ждёт. Так всплеск входов (или перебор
+  до срабатывания лимитера) не занимает весь пул обработчиков запросов и CPU.
+  """
+
+  def __init__(
+    self,
+    *,
+    concurrency: int = PASSWORD_HASH_DEFAULT_CONCURRENCY,
+    queue_size: int = PASSWORD_HASH_DEFAULT_QUEUE_SIZE,
+    queue_timeout_seconds: float = PASSWORD_HASH_DEFAULT_QUEUE_TIMEOUT_SECONDS,
+  ) -> None:
+    self.concurrency = max(1, int(concurrency))
+    self.queue_size = max(0, int(queue_size))
+    self.queue_timeout_seconds = max(0.1, float(queue_timeout_seconds))
+    self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ancia-password-hash")
+    self._slots = threading.BoundedSemaphore(self.concurrency + self.queue_size)
+    self._stats_lock = threading.Lock()
+    self._in_flight = 0
+    self._completed = 0
+    self._rejected = 0
+    self._expired = 0
+
+  def _retry_after(self) -> int:
+    return max(1, int(round(self.queue_timeout_seconds)))
+
+  def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+    if not self._slots.acquire(blocking=False):
+      with self._stats_lock:
+        self._rejected += 1
+      raise PasswordHashBusyError(self._retry_after())
+    enqueued_at = time.monotonic()
+    with self._stats_lock:
+      self._in_flight += 1
+
+    def run() -> Any:
+      if time.monotonic() - enqueued_at > self.queue_timeout_seconds:
+        with self._stats_lock:
+          self._expired += 1
+        raise PasswordHashBusyError(self._retry_after())
+      return fn(*args)
+
+    def release(_future: Future) -> None:
+      self._slots.release()
+      with self._stats_lock:
+        self._in_flight -= 1
+        self._completed += 1
+
+    try:
+      future = self._executor.submit(run)
+    except RuntimeError:
+      release(Future())
+      raise
+    future.add_done_callback(release)
+    return future
+
+  def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+    # Ожидание ограничено: очередь не длиннее queue_size, а просроченные задачи не выполняются.
+    return self.submit(fn, *args).result()
+
+  def snapshot(self) -> dict[str, Any]:
+    with self._stats_lock:
+      return {
+        "concurrency": self.concurrency,
+        "queue_size": self.queue_size,
+        "queue_timeout_seconds": self.queue_timeout_seconds,
+        "in_flight": self._in_flight,
+        "completed": self._completed,
+        "rejected": self._rejected,
+        "expired": self._expired,
+      }
+
+  def shutdown(self) -> None:
+    self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def build_password_hash_executor() -> PasswordHashExecutor:
+  return PasswordHashExecutor(
+    concurrency=_read_env_int("ANCIA_PASSWORD_HASH_CONCURRENCY", PASSWORD_HASH_DEFAULT_CONCURRENCY, minimum=1, maximum=64),
+    queue_size=_read_env_int("ANCIA_PASSWORD_HASH_QUEUE_SIZE", PASSWORD_HASH_DEFAULT_QUEUE_SIZE, minimum=0, maximum=1024),
+    queue_timeout_seconds=_read_env_float(
+      "ANCIA_PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS",
+      PASSWORD_HASH_DEFAULT_QUEUE_TIMEOUT_SECONDS,
+      minimum=0.1,
+      maximum=120.0,
+    ),
+  )
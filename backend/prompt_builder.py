@@ -18,12 +18,19 @@ def build_system_prompt(
   *,
   active_tools: set[str] | None = None,
   tool_definitions: dict[str, dict[str, Any]] | None = None,
+  tool_registry: Any = None,
 ) -> str:
   safe_active_tools = active_tools or set()
+  # Блок инструментов зависит только от версии реестра и набора активных инструментов,
+  # поэтому берём его из кэша реестра; пользовательские части собираем поверх.
+  tools_block: str | None = None
+  if tool_registry is not None and hasattr(tool_registry, "render_tools_prompt_block"):
+    tools_block = tool_registry.render_tools_prompt_block(safe_active_tools)
   prompt_with_tools = apply_enabled_tools_prompt(
     base_prompt,
     safe_active_tools,
     tool_definitions=tool_definitions or {},
+    tools_block=tools_block,
   )
   blocks = [prompt_with_tools] if prompt_with_tools else []
   blocks.append(build_chat_mood_prompt())
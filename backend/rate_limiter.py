@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+import zlib
+from typing import Callable, Iterable
+
+RATE_LIMITER_DEFAULT_SHARDS = 16
+RATE_LIMITER_SWEEP_INTERVAL_SECONDS = 90.0
+_GCRA_EPSILON = 1e-9
+
+# (scope, tat, blocked_until) — снимок состояния одного ключа.
+RateLimitStateRow = tuple[str, float, float]
+PersistFn = Callable[[list[RateLimitStateRow], list[str]], None]
+
+
+def gcra_step(
+  state: list[float] | None,
+  *,
+  budget: int,
+  window_seconds: float,
+  now_ts: float,
+  consume: bool = True,
+  block_seconds: float = 0.0,
+) -> tuple[bool, int, list[float] | None, bool]:
+  """Один шаг GCRA над состоянием [tat, blocked_until] ключа.
+
+  Возвращает (limited, retry_after, новое состояние или None, если оно не менялось,
+  нужно ли записать его сразу). Исходный state не изменяется.
+  """
+  emission_interval = window_seconds / max(1, budget)
+  tat_prev = float(state[0]) if state is not None else 0.0
+  blocked_until = float(state[1]) if state is not None else 0.0
+  changed = False
+  if blocked_until > 0:
+    if block_seconds > 0 and blocked_until > now_ts:
+      return True, max(1, int(math.ceil(blocked_until - now_ts))), None, False
+    if blocked_until <= now_ts:
+      blocked_until = 0.0
+      changed = True
+
+  tat = max(tat_prev, now_ts)
+  next_tat = tat + emission_interval
+  if next_tat - now_ts > window_seconds + _GCRA_EPSILON:
+    retry_after = max(1, int(math.ceil(next_tat - window_seconds - now_ts)))
+    if block_seconds > 0:
+      # Как и прежде: при блокировке счётчик попыток обнуляется, дальше решает блокировка.
+      retry_after = max(retry_after, max(1, int(math.ceil(block_seconds))))
+      return True, retry_after, [now_ts, now_ts + block_seconds], True
+    return True, retry_after, ([tat_prev, blocked_until] if changed else None), False
+  if not consume:
+    return False, 0, ([tat_prev, blocked_until] if changed else None), False
+  exhausted = next_tat + emission_interval - now_ts > window_seconds + _GCRA_EPSILON
+  if exhausted and block_seconds > 0:
+    return False, 0, [now_ts, now_ts + block_seconds], True
+  # Исчерпанный бюджет пишем сразу: после перезапуска лимит должен продолжать действовать.
+  return False, 0, [next_tat, blocked_until], exhausted
+
+
+class _Shard:
+  __slots__ = ("lock", "states", "dirty", "last_sweep_ts")
+
+  def __init__(self) -> None:
+    self.lock = threading.Lock()
+    # scope -> [tat, blocked_until]: O(1) памяти на ключ вместо строки на каждое обращение.
+    self.states: dict[str, list[float]] = {}
+    self.dirty: set[str] = set()
+    self.last_sweep_ts = 0.0
+
+
+class GcraRateLimiter:
+  """Шардированный GCRA-лимитер в памяти со снимками состояния во внешнее хранилище.
+
+  Бюджет budget на окно window_seconds эквивалентен ведру на budget запросов, которое
+  пополняется на один запрос каждые window_seconds / budget. Состояние ключа — TAT
+  (theoretical arrival time) и время окончания блокировки. Периодические снимки делает
+  фоновое обслуживание (snapshot), запрос пишет в хранилище только блокировки.
+  """
+
+  def __init__(
+    self,
+    *,
+    persist_fn: PersistFn | None = None,
+    shards: int = RATE_LIMITER_DEFAULT_SHARDS,
+  ) -> None:
+    self._persist_fn = persist_fn
+    self._shards = [_Shard() for _ in range(max(1, int(shards)))]
+    self._snapshot_lock = threading.Lock()
+
+  def _shard_for(self, scope: str) -> _Shard:
+    return self._shards[zlib.crc32(scope.encode("utf-8", errors="replace")) % len(self._shards)]
+
+  def load(self, rows: Iterable[RateLimitStateRow], *, now_ts: float | None = None) -> int:
+    safe_now_ts = float(now_ts) if now_ts is not None else time.time()
+    loaded = 0
+    for scope, tat, blocked_until in rows:
+      safe_scope = str(scope or "")
+      if not safe_scope or (float(tat) <= safe_now_ts and float(blocked_until) <= safe_now_ts):
+        continue
+      shard = self._shard_for(safe_scope)
+      with shard.lock:
+        shard.states[safe_scope] = [float(tat), float(blocked_until)]
+      loaded += 1
+    return loaded
+
+  def consume(
+    self,
+    scope: str,
+    *,
+    budget: int,
+    window_seconds: float,
+    now_ts: float,
+    consume: bool = True,
+    block_seconds: float = 0.0,
+  ) -> tuple[bool, int]:
+    shard = self._shard_for(scope)
+    persist_row: RateLimitStateRow | None = None
+    with shard.lock:
+      self._sweep_locked(shard, now_ts, window_seconds)
+      limited, retry_after, next_state, persist_now = gcra_step(
+        shard.states.get(scope),
+        budget=budget,
+        window_seconds=window_seconds,
+        now_ts=now_ts,
+        consume=consume,
+        block_seconds=block_seconds,
+      )
+      if next_state is not None:
+        shard.states[scope] = next_state
+        if persist_now:
+          persist_row = (scope, next_state[0], next_state[1])
+          shard.dirty.discard(scope)
+        else:
+          shard.dirty.add(scope)
+
+    if persist_row is not None and self._persist_fn is not None:
+      try:
+        self._persist_fn([persist_row], [])
+      except Exception:
+        # Состояние в памяти уже актуально — запишем его со следующим снимком.
+        self._mark_dirty(scope)
+    return limited, retry_after
+
+  def _mark_dirty(self, scope: str) -> None:
+    shard = self._shard_for(scope)
+    with shard.lock:
+      shard.dirty.add(scope)
+
+  def _sweep_locked(self, shard: _Shard, now_ts: float, window_seconds: float) -> None:
+    if (now_ts - shard.last_sweep_ts) < max(RATE_LIMITER_SWEEP_INTERVAL_SECONDS, window_seconds):
+      return
+    shard.last_sweep_ts = now_ts
+    # Ключ с TAT в прошлом и без блокировки неотличим от нового — его можно забыть.
+    stale = [
+      scope
+      for scope, (tat, blocked_until) in shard.states.items()
+      if tat <= now_ts and blocked_until <= now_ts
+    ]
+    for scope in stale:
+      shard.states.pop(scope, None)
+      shard.dirty.add(scope)
+
+  def clear(self, scope: str) -> None:
+    shard = self._shard_for(scope)
+    with shard.lock:
+      shard.states.pop(scope, None)
+      shard.dirty.discard(scope)
+
+  def reset(self) -> None:
+    for shard in self._shards:
+      with shard.lock:
+        shard.states.clear()
+        shard.dirty.clear()
+
+  def snapshot(self, *, now_ts: float | None = None, blocking: bool = True) -> int:
+    """Сохраняет изменённые с прошлого снимка ключи; истёкшие удаляются из хранилища."""
+    if self._persist_fn is None:
+      return 0
+    if not self._snapshot_lock.acquire(blocking=blocking):
+      return 0
+    try:
+      safe_now_ts = float(now_ts) if now_ts is not None else time.time()
+      upserts: list[RateLimitStateRow] = []
+      deletes: list[str] = []
+      for shard in self._shards:
+        with shard.lock:
+          dirty = list(shard.dirty)
+          shard.dirty.clear()
+          for scope in dirty:
+            state = shard.states.get(scope)
+            if state is None or (state[0] <= safe_now_ts and state[1] <= safe_now_ts):
+              deletes.append(scope)
+            else:
+              upserts.append((scope, state[0], state[1]))
+      if upserts or deletes:
+        try:
+          self._persist_fn(upserts, deletes)
+        except Exception:
+          for scope in [*(row[0] for row in upserts), *deletes]:
+            self._mark_dirty(scope)
+          raise
+      return len(upserts) + len(deletes)
+    finally:
+      self._snapshot_lock.release()
+
+  def stats(self) -> dict[str, int]:
+    scopes = 0
+    dirty = 0
+    for shard in self._shards:
+      with shard.lock:
+        scopes += len(shard.states)
+        dirty += len(shard.dirty)
+    return {"shards": len(self._shards), "scopes": scopes, "dirty": dirty}
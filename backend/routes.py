@@ -14,11 +14,13 @@ from urllib import parse as url_parse
 from urllib import request as url_request
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 try:
   from backend.access_control import user_can_download_models
-  from backend.common import normalize_mood, utc_now_iso
+  from backend.attachment_retrieval import build_attachment_retrieval_events
+  from backend.attachment_store import is_attachment_sha256
+  from backend.common import REVISION_CACHE_CONTROL, build_revision_etag, etag_matches, normalize_mood, utc_now_iso
   from backend.deployment import DEPLOYMENT_MODE_REMOTE_SERVER, resolve_deployment_mode
   from backend.plugin_permissions import (
     DEFAULT_DOMAIN_PERMISSION_POLICY,
@@ -32,6 +34,7 @@ try:
     read_tool_permissions,
   )
   from backend.plugin_marketplace_service import PluginMarketplaceService
+  from backend.routes_attachments import register_attachment_routes
   from backend.routes_chat_store import register_chat_store_routes
   from backend.routes_models import register_model_routes
   from backend.routes_plugins import register_plugin_routes
@@ -51,7 +54,9 @@ try:
   )
 except ModuleNotFoundError:
   from access_control import user_can_download_models  # type: ignore
-  from common import normalize_mood, utc_now_iso  # type: ignore
+  from attachment_retrieval import build_attachment_retrieval_events  # type: ignore
+  from attachment_store import is_attachment_sha256  # type: ignore
+  from common import REVISION_CACHE_CONTROL, build_revision_etag, etag_matches, normalize_mood, utc_now_iso  # type: ignore
   from deployment import DEPLOYMENT_MODE_REMOTE_SERVER, resolve_deployment_mode  # type: ignore
   from plugin_permissions import (  # type: ignore
     DEFAULT_DOMAIN_PERMISSION_POLICY,
@@ -65,6 +70,7 @@ except ModuleNotFoundError:
     read_tool_permissions,
   )
   from plugin_marketplace_service import PluginMarketplaceService  # type: ignore
+  from routes_attachments import register_attachment_routes  # type: ignore
   from routes_chat_store import register_chat_store_routes  # type: ignore
   from routes_models import register_model_routes  # type: ignore
   from routes_plugins import register_plugin_routes  # type: ignore
@@ -88,6 +94,11 @@ try:
 except ModuleNotFoundError:
   from netguard import open_safe_http_request  # type: ignore
 
+try:
+  from backend.workload_executors import iterate_in_workload
+except ModuleNotFoundError:
+  from workload_executors import iterate_in_workload  # type: ignore
+
 SAFE_IMAGE_DATA_URL_RE = re.compile(
   r"^data:image/(?:png|jpe?g|webp|gif|bmp|x-icon|vnd\.microsoft\.icon|avif);base64,[a-z0-9+/=]+$",
   flags=re.IGNORECASE,
@@ -113,6 +124,8 @@ def register_api_routes(
   build_system_prompt_fn: Callable[..., str],
   refresh_tool_registry_fn: Callable[[], None] | None = None,
   auth_service: Any | None = None,
+  attachment_store: Any | None = None,
+  maintenance: Any | None = None,
 ) -> None:
   settings_service = SettingsService(storage=storage, model_engine=model_engine)
   get_autonomous_mode = settings_service.get_autonomous_mode
@@ -190,6 +203,7 @@ def register_api_routes(
     selected_model_id = model_engine.get_selected_model_id()
     startup = model_engine.get_startup_snapshot()
     startup_state = str(startup.get("status") or "").strip().lower()
+    workload_executors = getattr(app.state, "workload_executors", None)
     service_state = "ok"
     if startup_state in {"booting", "loading"}:
       service_state = "starting"
@@ -220,6 +234,8 @@ def register_api_routes(
         "autonomous_mode": bool(plugins_payload.get("autonomous_mode")),
       },
       "data_dir": data_dir,
+      "storage": {**storage.get_lock_metrics(), "migration": storage.get_migration_progress()},
+      "executors": workload_executors.snapshot() if workload_executors is not None else {},
     }
 
   register_model_routes(
@@ -243,6 +259,7 @@ def register_api_routes(
     default_onboarding_state=DEFAULT_ONBOARDING_STATE,
     refresh_tool_registry_fn=refresh_tool_registry_fn,
     auth_service=auth_service,
+    maintenance=maintenance,
   )
 
   register_plugin_routes(
@@ -262,6 +279,13 @@ def register_api_routes(
     normalize_mood_fn=normalize_mood,
   )
 
+  if attachment_store is not None:
+    register_attachment_routes(
+      app,
+      attachment_store=attachment_store,
+      storage=storage,
+    )
+
   def _fetch_link_headers(url: str) -> tuple[str, dict[str, str]]:
     safe_url = normalize_http_url(url)
     if not safe_url:
@@ -505,15 +529,31 @@ def register_api_routes(
     }
     return int(stage_progress_map.get(stage, 0))
 
-  def _payload_has_image_attachments(payload: ChatRequest) -> bool:
+  def _payload_has_image_attachments(payload: ChatRequest, *, owner_user_id: str = "") -> bool:
     attachments = list(payload.attachments or [])
     for attachment in attachments:
       item = attachment.model_dump() if hasattr(attachment, "model_dump") else dict(attachment)
       data_url = str(item.get("dataUrl") or "").strip()
       if _is_safe_image_data_url(data_url):
         return True
+      if _resolve_stored_attachment_ref(item, owner_user_id=owner_user_id):
+        return True
     return False
 
+  def _resolve_stored_attachment_ref(item: dict[str, Any], *, owner_user_id: str = "") -> str:
+    if attachment_store is None or str(item.get("dataUrl") or "").strip():
+      return ""
+    safe_ref = str(item.get("sha256") or "").strip().lower()
+    if not safe_ref:
+      # Вложение, загруженное через /attachments/upload, может ссылаться на файл только через id.
+      safe_ref = str(item.get("id") or "").strip().lower()
+    if not is_attachment_sha256(safe_ref) or not attachment_store.has(safe_ref):
+      return ""
+    # Хранилище общее: чужой sha256 для владельца выглядит так же, как отсутствующий файл.
+    if not storage.has_attachment_owner(safe_ref, owner_user_id=owner_user_id):
+      return ""
+    return safe_ref
+
   def _selected_model_supports_vision_catalog(selected_model_id: str) -> bool:
     safe_selected_model_id = str(selected_model_id or "").strip().lower()
     if not safe_selected_model_id or not hasattr(model_engine, "list_models_catalog"):
@@ -676,6 +716,8 @@ def register_api_routes(
   ) -> tuple[str, str, str, str, RuntimeChatContext, set[str], str]:
     MAX_ATTACHMENTS_TOTAL_SIZE = 52_428_800
     MAX_ATTACHMENTS_TOTAL_TEXT = 500_000
+    # Берём с запасом: итоговый отбор истории делает движок по токен-бюджету окна контекста.
+    MAX_STORED_HISTORY_FOR_MODEL = 64
 
     def _sanitize_attachment_for_storage(item: dict[str, Any]) -> dict[str, Any]:
       safe_item = dict(item or {})
@@ -796,7 +838,7 @@ def register_api_routes(
     client_history_override: list[HistoryMessage] = []
     if client_history_override_enabled:
       raw_history = list(getattr(payload.context, "history", None) or [])
-      for entry in raw_history[-48:]:
+      for entry in raw_history[-MAX_STORED_HISTORY_FOR_MODEL:]:
         role = str(getattr(entry, "role", "") or "").strip().lower()
         if role not in {"user", "assistant", "system"}:
           continue
@@ -817,7 +859,7 @@ def register_api_routes(
 
     stored_history = storage.get_chat_messages(
       chat_id,
-      limit=24,
+      limit=MAX_STORED_HISTORY_FOR_MODEL,
       owner_user_id=owner_user_id,
     )
     history_from_storage: list[HistoryMessage] = []
@@ -843,6 +885,18 @@ def register_api_routes(
     total_attachment_text = 0
     for index, attachment in enumerate(attachments, start=1):
       payload_item = attachment.model_dump()
+      stored_ref = _resolve_stored_attachment_ref(payload_item, owner_user_id=owner_user_id)
+      if not stored_ref and str(payload_item.get("sha256") or "").strip() and not payload_item.get("dataUrl"):
+        raise HTTPException(
+          status_code=404,
+          detail="Вложение не найдено в хранилище. Загрузите файл повторно.",
+        )
+      stored_info = attachment_store.describe(stored_ref) if stored_ref else None
+      if stored_info is not None:
+        payload_item["sha256"] = stored_ref
+        payload_item["size"] = stored_info["size"]
+        payload_item["mimeType"] = str(payload_item.get("mimeType") or stored_info["mime_type"])
+        attachment.sha256 = stored_ref
       try:
         attachment_size = max(0, int(payload_item.get("size") or 0))
       except (TypeError, ValueError):
@@ -868,7 +922,7 @@ def register_api_routes(
         or safe_mime_for_check.startswith("image/")
         or str(data_url or "").strip().lower().startswith("data:image/")
       )
-      if has_image_markers and not _is_safe_image_data_url(data_url):
+      if has_image_markers and stored_info is None and not _is_safe_image_data_url(data_url):
         raise HTTPException(
           status_code=400,
           detail=(
@@ -876,6 +930,16 @@ def register_api_routes(
             "форматов png/jpeg/webp/gif/bmp/ico/avif; SVG и другие форматы запрещены."
           ),
         )
+      if has_image_markers and stored_info is None and attachment_store is not None:
+        stored_entry = attachment_store.put_data_url(
+          data_url,
+          name_hint=str(payload_item.get("name") or ""),
+        )
+        if stored_entry:
+          storage.grant_attachment_owner(stored_entry["sha256"], owner_user_id=owner_user_id)
+          # В истории чата остаётся ссылка на файл в хранилище вместо выброшенного DataURL.
+          payload_item["sha256"] = stored_entry["sha256"]
+          attachment.sha256 = stored_entry["sha256"]
 
       attachment_payloads.append(_sanitize_attachment_for_storage(payload_item))
       safe_name = str(payload_item.get("name") or f"file-{index}").strip()
@@ -928,6 +992,11 @@ def register_api_routes(
           "meta_suffix": "",
           "attachments": attachment_payloads,
           "attachment_preview_lines": attachment_preview_lines,
+          "attachment_retrieval": (
+            build_attachment_retrieval_events(attachments, user_text)
+            if attachment_payloads
+            else []
+          ),
           "has_attachments": bool(attachment_payloads),
           "request_id": request_id,
         },
@@ -1077,39 +1146,29 @@ def register_api_routes(
       else {}
     )
 
-    # Применяем те же ограничения что и фронтенд (historyAndPersistence.js),
-    # чтобы подсчёт токенов на стороне бэкенда совпадал с фронтендом
-    # и авто-сжатие contextGuard срабатывало своевременно.
-    _MAX_CHARS_PER_MSG = 1400
-    _MAX_TOTAL_CHARS = 18000
-    _raw_history = list(getattr(payload.context, "history", None) or [])
-    _check_history: list[Any] = []
-    _total_chars = 0
-    for _entry in reversed(_raw_history):
-      _role = str(getattr(_entry, "role", "") or "").strip().lower()
-      if _role not in {"user", "assistant", "system"}:
+    # Историю не режем по символам: движок подбирает её по тому же токен-бюджету,
+    # что и при генерации, поэтому проверка и реальный промпт совпадают.
+    check_history: list[dict[str, Any]] = []
+    for entry in list(getattr(payload.context, "history", None) or []):
+      role = str(getattr(entry, "role", "") or "").strip().lower()
+      if role not in {"user", "assistant", "system"}:
         continue
-      _text = str(getattr(_entry, "text", "") or "")
-      if len(_text) > _MAX_CHARS_PER_MSG:
-        _text = _text[:_MAX_CHARS_PER_MSG - 1] + "…"
-      _proj = _total_chars + len(_text)
-      if _proj > _MAX_TOTAL_CHARS and _check_history:
-        break
-      _total_chars = _proj
-      _check_history.append({"role": _role, "text": _text})
-    _check_history.reverse()
+      text = str(getattr(entry, "text", "") or "")
+      if text.strip():
+        check_history.append({"role": role, "text": text})
 
     try:
       usage_payload = model_engine.get_context_usage(
         model_id=str(model_engine.get_selected_model_id() or "").strip().lower(),
         draft_text=str(payload.message or ""),
         pending_assistant_text="",
-        history=_check_history,
+        history=check_history,
         attachments=list(payload.attachments or []),
         history_variants=[],
         active_tools=active_tools,
         tool_definitions=tool_definitions,
         tool_schemas=tool_schemas,
+        tool_registry=tool_registry,
       )
     except RuntimeError:
       raise HTTPException(
@@ -1318,6 +1377,7 @@ def register_api_routes(
         if hasattr(tool_registry, "build_tool_definition_map")
         else {}
       ),
+      tool_registry=tool_registry,
     )
     generation_actions_meta = build_generation_actions_meta(
       source_user_text=user_text,
@@ -1388,7 +1448,7 @@ def register_api_routes(
       owner_user_id=owner_user_id,
       deployment_mode=_resolve_deployment_mode_from_request(request),
     )
-    require_vision_runtime = _payload_has_image_attachments(payload)
+    require_vision_runtime = _payload_has_image_attachments(payload, owner_user_id=owner_user_id)
     _require_model_download_access_for_request(
       request,
       model_id=str(model_engine.get_selected_model_id() or "").strip().lower(),
@@ -1452,7 +1512,7 @@ def register_api_routes(
     def stream_events() -> Generator[str, None, None]:
       selected_model_id = model_engine.get_selected_model_id()
       selected_model_label = resolve_model_display_name(selected_model_id)
-      require_vision_runtime = _payload_has_image_attachments(payload)
+      require_vision_runtime = _payload_has_image_attachments(payload, owner_user_id=owner_user_id)
       required_runtime_backend = _resolve_required_runtime_backend(
         selected_model_id=selected_model_id,
         require_vision_runtime=require_vision_runtime,
@@ -1839,6 +1899,7 @@ def register_api_routes(
             if hasattr(tool_registry, "build_tool_definition_map")
             else {}
           ),
+          tool_registry=tool_registry,
         )
         streamed_reply = str(assistant_stream_text or "")
         model_reply = str(result.reply or "")
@@ -2004,7 +2065,7 @@ def register_api_routes(
         model_engine.request_stop_generation()
 
     return StreamingResponse(
-      stream_events_with_cleanup(),
+      iterate_in_workload(stream_events_with_cleanup()),
       media_type="text/event-stream",
       headers={
         "Cache-Control": "no-cache",
@@ -2022,21 +2083,30 @@ def register_api_routes(
     }
 
   @app.get("/chats/{chat_id}/history")
-  def chat_history(chat_id: str, request: Request, limit: int = 40) -> dict[str, Any]:
+  def chat_history(chat_id: str, request: Request, limit: int = 40) -> Response:
     owner_user_id = _resolve_owner_user_id(request)
     safe_chat_id = str(chat_id or "").strip()
     if not safe_chat_id:
       raise HTTPException(status_code=400, detail="chat_id is required")
-    if storage.get_chat(safe_chat_id, owner_user_id=owner_user_id) is None:
+    # Ревизия чата читается до сообщений: для 304 строки messages не трогаем вовсе.
+    revision = storage.get_chat_revision(safe_chat_id, owner_user_id=owner_user_id)
+    if revision is None:
       raise HTTPException(status_code=404, detail=f"Chat '{safe_chat_id}' not found")
 
     safe_limit = max(1, min(200, int(limit)))
+    etag = build_revision_etag(revision, "history", owner_user_id, safe_chat_id, safe_limit)
+    headers = {"ETag": etag, "Cache-Control": REVISION_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+      return Response(status_code=304, headers=headers)
     history = storage.get_chat_messages(
       safe_chat_id,
       safe_limit,
       owner_user_id=owner_user_id,
     )
-    return {
-      "chat_id": safe_chat_id,
-      "history": history,
-    }
+    return JSONResponse(
+      {
+        "chat_id": safe_chat_id,
+        "history": history,
+      },
+      headers=headers,
+    )
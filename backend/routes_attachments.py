@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+from typing import Any
+
+from fastapi import FastAPI, HTTPException, Request
+
+try:
+  from backend.deployment import DEPLOYMENT_MODE_REMOTE_SERVER
+except ModuleNotFoundError:
+  from deployment import DEPLOYMENT_MODE_REMOTE_SERVER  # type: ignore
+
+ATTACHMENT_UPLOAD_ALLOWED_MIME_TYPES = {
+  "image/png",
+  "image/jpeg",
+  "image/jpg",
+  "image/webp",
+  "image/gif",
+  "image/bmp",
+  "image/x-icon",
+  "image/vnd.microsoft.icon",
+  "image/avif",
+}
+ATTACHMENT_UPLOAD_DEFAULT_MAX_BYTES = 12_000_000
+ATTACHMENT_UPLOAD_SNIFF_BYTES = 16
+
+
+def sniff_image_mime_type(head: bytes) -> str:
+  """Тип изображения по сигнатуре первых байт файла; пустая строка — формат не из разрешённых."""
+  if head.startswith(b"\x89PNG\r\n\x1a\n"):
+    return "image/png"
+  if head.startswith(b"\xff\xd8\xff"):
+    return "image/jpeg"
+  if head.startswith((b"GIF87a", b"GIF89a")):
+    return "image/gif"
+  if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+    return "image/webp"
+  if head.startswith(b"BM"):
+    return "image/bmp"
+  if head.startswith(b"\x00\x00\x01\x00"):
+    return "image/x-icon"
+  if head[4:8] == b"ftyp" and head[8:12] in {b"avif", b"avis"}:
+    return "image/avif"
+  return ""
+
+
+def resolve_attachment_upload_max_bytes() -> int:
+  raw = str(os.getenv("ANCIA_MAX_BODY_ATTACHMENT_UPLOAD_BYTES", "") or "").strip()
+  try:
+    value = int(raw) if raw else ATTACHMENT_UPLOAD_DEFAULT_MAX_BYTES
+  except ValueError:
+    value = ATTACHMENT_UPLOAD_DEFAULT_MAX_BYTES
+  return max(1, min(20_000_000, value))
+
+
+def register_attachment_routes(
+  app: FastAPI,
+  *,
+  attachment_store: Any,
+  storage: Any,
+) -> None:
+  def resolve_owner_user_id(request: Request) -> str:
+    deployment_mode = str(getattr(request.state, "deployment_mode", "") or "").strip().lower()
+    if deployment_mode != DEPLOYMENT_MODE_REMOTE_SERVER:
+      return ""
+    auth_payload = getattr(request.state, "auth", None)
+    if not isinstance(auth_payload, dict):
+      return ""
+    user_payload = auth_payload.get("user")
+    if not isinstance(user_payload, dict):
+      return ""
+    return str(user_payload.get("id") or "").strip()
+
+  @app.post("/attachments/upload")
+  async def upload_attachment(request: Request) -> dict[str, Any]:
+    # Тело запроса — сырые байты файла (без base64 и JSON): пишем на диск по мере чтения
+    # и считаем sha256 инкрементально, чтобы не держать файл целиком в памяти.
+    mime_type = str(request.headers.get("content-type") or "").split(";", 1)[0].strip().lower()
+    if mime_type == "image/jpg":
+      mime_type = "image/jpeg"
+    if mime_type not in ATTACHMENT_UPLOAD_ALLOWED_MIME_TYPES:
+      raise HTTPException(
+        status_code=415,
+        detail=(
+          "Поддерживается загрузка изображений png/jpeg/webp/gif/bmp/ico/avif; "
+          "SVG и другие форматы запрещены."
+        ),
+      )
+    name_hint = str(
+      request.query_params.get("name")
+      or request.headers.get("x-attachment-name")
+      or ""
+    ).strip()[:256]
+    max_bytes = resolve_attachment_upload_max_bytes()
+
+    # Диск и SQLite трогаем только из пула потоков: обработчик асинхронный и не должен держать цикл событий.
+    temp_path = await asyncio.to_thread(attachment_store.new_upload_path)
+    hasher = hashlib.sha256()
+    total_bytes = 0
+    head = b""
+    try:
+      handle = await asyncio.to_thread(open, temp_path, "wb")
+      try:
+        async for chunk in request.stream():
+          if not chunk:
+            continue
+          total_bytes += len(chunk)
+          if total_bytes > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Payload too large. Max {max_bytes} bytes.")
+          if len(head) < ATTACHMENT_UPLOAD_SNIFF_BYTES:
+            head += chunk[: ATTACHMENT_UPLOAD_SNIFF_BYTES - len(head)]
+          hasher.update(chunk)
+          await asyncio.to_thread(handle.write, chunk)
+      finally:
+        await asyncio.to_thread(handle.close)
+    except BaseException as exc:
+      # Уборка тоже уходит в поток; если её прервут (отмена, ошибка ФС), наружу всё равно уходит исходная ошибка.
+      try:
+        await asyncio.to_thread(attachment_store.discard_upload, temp_path)
+      finally:
+        raise exc
+
+    if total_bytes <= 0:
+      await asyncio.to_thread(attachment_store.discard_upload, temp_path)
+      raise HTTPException(status_code=400, detail="Пустой файл вложения.")
+    # Content-Type присылает клиент — тип файла проверяем по его сигнатуре.
+    sniffed_mime_type = sniff_image_mime_type(head)
+    if not sniffed_mime_type:
+      await asyncio.to_thread(attachment_store.discard_upload, temp_path)
+      raise HTTPException(
+        status_code=415,
+        detail="Содержимое файла не похоже на изображение png/jpeg/webp/gif/bmp/ico/avif.",
+      )
+    mime_type = sniffed_mime_type
+
+    entry = await asyncio.to_thread(
+      attachment_store.commit_file,
+      temp_path,
+      sha=hasher.hexdigest(),
+      size=total_bytes,
+      mime_type=mime_type,
+      name_hint=name_hint,
+    )
+    # Ссылку на файл по sha256 потом примет только тот, кто его загрузил (см. attachment_owners).
+    await asyncio.to_thread(
+      storage.grant_attachment_owner,
+      entry["sha256"],
+      owner_user_id=resolve_owner_user_id(request),
+    )
+    return {
+      "ok": True,
+      "id": entry["sha256"],
+      "sha256": entry["sha256"],
+      "name": name_hint,
+      "kind": "image",
+      "mimeType": mime_type,
+      "size": total_bytes,
+    }
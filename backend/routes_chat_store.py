@@ -1,16 +1,30 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import os
 import re
-from typing import Any, Callable
+import tempfile
+from typing import Any, Callable, Iterator
 
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+try:
+  from backend.common import REVISION_CACHE_CONTROL, build_revision_etag, etag_matches
+except ModuleNotFoundError:
+  from common import REVISION_CACHE_CONTROL, build_revision_etag, etag_matches  # type: ignore
 
 try:
   from backend.deployment import DEPLOYMENT_MODE_REMOTE_SERVER
 except ModuleNotFoundError:
   from deployment import DEPLOYMENT_MODE_REMOTE_SERVER  # type: ignore
 
+try:
+  from backend.workload_executors import iterate_in_workload, run_in_workload
+except ModuleNotFoundError:
+  from workload_executors import iterate_in_workload, run_in_workload  # type: ignore
+
 try:
   from backend.schemas import (
     ChatCreateRequest,
@@ -26,6 +40,18 @@ except ModuleNotFoundError:
     MessageUpdateRequest,
   )
 
+CHATS_IMPORT_STREAM_DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+CHATS_IMPORT_SPOOL_MEMORY_BYTES = 1024 * 1024
+
+
+def _resolve_chats_import_stream_max_bytes() -> int:
+  raw = str(os.getenv("ANCIA_MAX_BODY_CHATS_IMPORT_STREAM_BYTES", "") or "").strip()
+  try:
+    value = int(raw) if raw else CHATS_IMPORT_STREAM_DEFAULT_MAX_BYTES
+  except ValueError:
+    value = CHATS_IMPORT_STREAM_DEFAULT_MAX_BYTES
+  return max(1, value)
+
 
 def register_chat_store_routes(
   app: FastAPI,
@@ -84,14 +110,107 @@ def register_chat_store_routes(
         status=status,
         details=details if isinstance(details, dict) else {},
         ip_address=client_host,
+        wait=False,
       )
     except Exception:
       return
 
+  def revision_response(request: Request, etag: str, build_payload: Callable[[], Any]) -> Response:
+    # Ревизия прочитана до сборки ответа: при гонке с записью ETag окажется старше данных, но не новее.
+    headers = {"ETag": etag, "Cache-Control": REVISION_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+      return Response(status_code=304, headers=headers)
+    return JSONResponse(build_payload(), headers=headers)
+
   @app.get("/chats")
-  def list_chats(request: Request) -> dict[str, Any]:
+  def list_chats(request: Request) -> Response:
+    owner_user_id = resolve_owner_user_id(request)
+    revision = storage.get_chat_store_revision(owner_user_id=owner_user_id)
+    # seq берём до чтения чатов: изменения между ними клиент получит повторно через /chats/changes.
+    change_seq = storage.get_chat_change_seq(owner_user_id=owner_user_id)
+    return revision_response(
+      request,
+      build_revision_etag(revision, "chats", owner_user_id),
+      lambda: {**storage.list_chat_store(owner_user_id=owner_user_id), "changeSeq": change_seq},
+    )
+
+  @app.get("/chats/list")
+  def list_chats_page(request: Request, limit: int = 50, cursor: str = "") -> Response:
+    owner_user_id = resolve_owner_user_id(request)
+    revision = storage.get_chat_store_revision(owner_user_id=owner_user_id)
+
+    def build_page() -> dict[str, Any]:
+      try:
+        return storage.list_chats_page(
+          owner_user_id=owner_user_id,
+          limit=limit,
+          cursor=cursor,
+        )
+      except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    return revision_response(
+      request,
+      build_revision_etag(revision, "chats-page", owner_user_id, limit, cursor),
+      build_page,
+    )
+
+  @app.get("/chats/changes")
+  def list_chat_changes(request: Request, since: int = 0, limit: int = 0) -> dict[str, Any]:
+    owner_user_id = resolve_owner_user_id(request)
+    return storage.get_chat_changes(since, owner_user_id=owner_user_id, limit=limit or None)
+
+  @app.get("/chats/{chat_id}/messages")
+  def list_chat_messages_page(
+    chat_id: str,
+    request: Request,
+    limit: int = 50,
+    before: str = "",
+    after: str = "",
+  ) -> Response:
+    owner_user_id = resolve_owner_user_id(request)
+    safe_chat_id = str(chat_id or "").strip()
+    if not safe_chat_id:
+      raise HTTPException(status_code=400, detail="chat_id is required")
+    if str(before or "").strip() and str(after or "").strip():
+      raise HTTPException(status_code=400, detail="use either before or after")
+    revision = storage.get_chat_revision(safe_chat_id, owner_user_id=owner_user_id)
+    if revision is None:
+      raise HTTPException(status_code=404, detail=f"Chat '{safe_chat_id}' not found")
+
+    def build_page() -> dict[str, Any]:
+      try:
+        return storage.get_chat_messages_page(
+          safe_chat_id,
+          owner_user_id=owner_user_id,
+          limit=limit,
+          before=before,
+          after=after,
+        )
+      except (TypeError, ValueError) as exc:
+        raise HTTPException(status_code=400, detail="invalid message cursor") from exc
+
+    return revision_response(
+      request,
+      build_revision_etag(revision, "messages", owner_user_id, safe_chat_id, limit, before, after),
+      build_page,
+    )
+
+  @app.get("/chats/{chat_id}/messages/{message_id}/tool-payload")
+  def get_chat_message_tool_payload(chat_id: str, message_id: str, request: Request) -> dict[str, Any]:
+    # История отдаёт только превью аргументов; полный вывод инструмента — по запросу при раскрытии.
     owner_user_id = resolve_owner_user_id(request)
-    return storage.list_chat_store(owner_user_id=owner_user_id)
+    safe_chat_id = str(chat_id or "").strip()
+    if not safe_chat_id:
+      raise HTTPException(status_code=400, detail="chat_id is required")
+    payload = storage.get_message_tool_payload(
+      safe_chat_id,
+      message_id,
+      owner_user_id=owner_user_id,
+    )
+    if payload is None:
+      raise HTTPException(status_code=404, detail=f"Tool payload for message '{message_id}' not found")
+    return payload
 
   @app.get("/chats/search")
   def search_chats(request: Request, query: str = "", limit: int = 120, chat_id: str = "") -> dict[str, Any]:
@@ -116,12 +235,37 @@ def register_chat_store_routes(
     }
 
   @app.get("/chats/export")
-  def export_chats(request: Request, format: str = "json", chat_id: str = "") -> dict[str, Any]:
+  def export_chats(
+    request: Request,
+    format: str = "json",
+    chat_id: str = "",
+    stream: bool = False,
+  ) -> Any:
     owner_user_id = resolve_owner_user_id(request)
     safe_format = str(format or "json").strip().lower()
-    if safe_format not in {"json", "md", "markdown"}:
-      raise HTTPException(status_code=400, detail="format must be json or md")
+    if safe_format not in {"json", "md", "markdown", "ndjson"}:
+      raise HTTPException(status_code=400, detail="format must be json, md or ndjson")
     safe_chat_id = str(chat_id or "").strip()
+    if safe_format == "ndjson" or stream:
+      # Потоковый экспорт: данные читаются курсором пачками, ответ не собирается в памяти целиком.
+      try:
+        if safe_format == "json":
+          raise HTTPException(status_code=400, detail="stream export supports md or ndjson")
+        if safe_format == "ndjson":
+          chunks = storage.iter_export_chat_store_ndjson(safe_chat_id, owner_user_id=owner_user_id)
+          media_type = "application/x-ndjson"
+          file_suffix = "ndjson"
+        else:
+          chunks = storage.iter_export_chat_store_markdown(safe_chat_id, owner_user_id=owner_user_id)
+          media_type = "text/markdown; charset=utf-8"
+          file_suffix = "md"
+      except ValueError as exc:
+        raise HTTPException(status_code=404, detail=str(exc)) from exc
+      return StreamingResponse(
+        iterate_in_workload(chunks),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="ancia-chats.{file_suffix}"'},
+      )
     try:
       if safe_format == "json":
         return {
@@ -191,6 +335,59 @@ def register_chat_store_routes(
       "store": imported.get("store") or storage.list_chat_store(owner_user_id=owner_user_id),
     }
 
+  @app.post("/chats/import/stream")
+  async def import_chats_stream(request: Request, mode: str = "merge") -> StreamingResponse:
+    owner_user_id = resolve_owner_user_id(request)
+    safe_mode = str(mode or "merge").strip().lower()
+    if safe_mode not in {"replace", "merge"}:
+      raise HTTPException(status_code=400, detail="mode must be replace or merge")
+    max_bytes = _resolve_chats_import_stream_max_bytes()
+    # Тело (NDJSON) сначала сливаем во временный файл: разбор и запись идут построчно
+    # из потока ответа, а большие бэкапы не держатся в памяти.
+    spool = tempfile.SpooledTemporaryFile(max_size=CHATS_IMPORT_SPOOL_MEMORY_BYTES, mode="w+b")
+    total_bytes = 0
+    try:
+      async for chunk in request.stream():
+        if not chunk:
+          continue
+        total_bytes += len(chunk)
+        if total_bytes > max_bytes:
+          raise HTTPException(status_code=413, detail=f"Payload too large. Max {max_bytes} bytes.")
+        # Сверх CHATS_IMPORT_SPOOL_MEMORY_BYTES спул пишет на диск — не на цикле событий.
+        await asyncio.to_thread(spool.write, chunk)
+    except BaseException:
+      spool.close()
+      raise
+    await asyncio.to_thread(spool.seek, 0)
+    events = storage.iter_import_chat_store_ndjson(
+      spool,
+      mode=safe_mode,
+      owner_user_id=owner_user_id,
+    )
+    # Первое событие получаем до ответа: ошибка формата, найденная до записи (replace проверяет
+    # весь файл заранее), уходит кодом 400, а не строкой error внутри ответа 200.
+    try:
+      first_event = await run_in_workload(next, events, None)
+    except ValueError as exc:
+      spool.close()
+      raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except BaseException:
+      spool.close()
+      raise
+
+    def generate_progress() -> Iterator[str]:
+      try:
+        if first_event is not None:
+          yield json.dumps(first_event, ensure_ascii=False) + "\n"
+        for event in events:
+          yield json.dumps(event, ensure_ascii=False) + "\n"
+      except ValueError as exc:
+        yield json.dumps({"type": "error", "detail": str(exc)}, ensure_ascii=False) + "\n"
+      finally:
+        spool.close()
+
+    return StreamingResponse(iterate_in_workload(generate_progress()), media_type="application/x-ndjson")
+
   @app.post("/chats")
   def create_chat(payload: ChatCreateRequest, request: Request) -> dict[str, Any]:
     owner_user_id = resolve_owner_user_id(request)
@@ -117,6 +117,7 @@ def register_model_routes(
     return model_engine.get_context_window_requirements(
       active_tools=active_tools,
       tool_definitions=tool_definitions,
+      tool_registry=tool_registry,
     )
 
   def build_models_payload() -> dict[str, Any]:
@@ -371,6 +372,7 @@ def register_model_routes(
         active_tools=active_tools,
         tool_definitions=tool_definitions,
         tool_schemas=tool_schemas,
+        tool_registry=tool_registry,
       )
     except RuntimeError as exc:
       raise HTTPException(
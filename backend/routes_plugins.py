@@ -144,6 +144,7 @@ def register_plugin_routes(
         status=status,
         details=details if isinstance(details, dict) else {},
         ip_address=ip_address,
+        wait=False,
       )
     except Exception:
       return
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import datetime as dt
 import ipaddress
 import shutil
 from pathlib import Path
@@ -59,6 +60,7 @@ def register_settings_routes(
   default_onboarding_state: dict[str, Any],
   refresh_tool_registry_fn: Callable[[], None] | None = None,
   auth_service: Any | None = None,
+  maintenance: Any | None = None,
 ) -> None:
   def _deployment_mode_from_request(request: Request | None = None) -> str:
     if request is not None:
@@ -171,6 +173,17 @@ def register_settings_routes(
       return raw_header[7:].strip()
     return ""
 
+  def _auth_http_error(exc: Exception, *, status_code: int = 400) -> HTTPException:
+    # Лимит попыток и занятый пул хэширования паролей — 429 с Retry-After, остальное — status_code.
+    retry_after = int(getattr(exc, "retry_after_seconds", 0) or 0)
+    if retry_after > 0:
+      return HTTPException(
+        status_code=429,
+        detail=str(exc),
+        headers={"Retry-After": str(retry_after)},
+      )
+    return HTTPException(status_code=status_code, detail=str(exc))
+
   def _admin_count() -> int:
     if auth_service is None:
       return 0
@@ -318,6 +331,7 @@ def register_settings_routes(
         status=status,
         details=details if isinstance(details, dict) else {},
         ip_address=ip_address,
+        wait=False,
       )
     except Exception:
       return
@@ -558,7 +572,7 @@ def register_settings_routes(
         remote_addr=str(getattr(getattr(request, "client", None), "host", "") or ""),
       )
     except Exception as exc:
-      raise HTTPException(status_code=400, detail=str(exc)) from exc
+      raise _auth_http_error(exc) from exc
 
     _append_audit_event(
       request=request,
@@ -594,7 +608,7 @@ def register_settings_routes(
     try:
       user = auth_service.create_user(username=username, password=password, role="user")
     except Exception as exc:
-      raise HTTPException(status_code=400, detail=str(exc)) from exc
+      raise _auth_http_error(exc) from exc
 
     return {
       "ok": True,
@@ -621,14 +635,7 @@ def register_settings_routes(
         remote_addr=str(getattr(getattr(request, "client", None), "host", "") or ""),
       )
     except Exception as exc:
-      retry_after = int(getattr(exc, "retry_after_seconds", 0) or 0)
-      if retry_after > 0:
-        raise HTTPException(
-          status_code=429,
-          detail=str(exc),
-          headers={"Retry-After": str(retry_after)},
-        ) from exc
-      raise HTTPException(status_code=401, detail=str(exc)) from exc
+      raise _auth_http_error(exc, status_code=401) from exc
 
     return {
       "ok": True,
@@ -698,7 +705,7 @@ def register_settings_routes(
         permissions=permissions,
       )
     except Exception as exc:
-      raise HTTPException(status_code=400, detail=str(exc)) from exc
+      raise _auth_http_error(exc) from exc
 
     _append_audit_event(
       request=request,
@@ -756,7 +763,7 @@ def register_settings_routes(
         revoke_sessions=revoke_sessions,
       )
     except Exception as exc:
-      raise HTTPException(status_code=400, detail=str(exc)) from exc
+      raise _auth_http_error(exc) from exc
 
     _append_audit_event(
       request=request,
@@ -799,3 +806,47 @@ def register_settings_routes(
       "events": events,
       "count": len(events),
     }
+
+  @app.get("/admin/audit/rollups")
+  def admin_audit_rollups(
+    request: Request,
+    days: int = 30,
+    group_by: str = "day",
+    actor_user_id: str = "",
+    action_prefix: str = "",
+    limit: int = 1000,
+  ) -> dict[str, Any]:
+    _require_remote_server_admin(request, action="Просмотр аудита")
+    if not hasattr(storage, "get_audit_rollups"):
+      raise HTTPException(status_code=500, detail="Audit service is not available.")
+    safe_days = max(1, min(3650, int(days or 30)))
+    since_day = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=safe_days - 1)).date().isoformat()
+    safe_group_by = [part.strip().lower() for part in str(group_by or "").split(",") if part.strip()]
+    rollups = storage.get_audit_rollups(
+      since_day=since_day,
+      group_by=safe_group_by,
+      actor_user_id=actor_user_id,
+      action_prefix=action_prefix,
+      limit=limit,
+    )
+    return {
+      "rollups": rollups,
+      "count": len(rollups),
+      "since_day": since_day,
+    }
+
+  @app.get("/admin/diagnostics/storage")
+  def admin_storage_diagnostics(request: Request) -> dict[str, Any]:
+    _require_admin_if_remote(request)
+    payload: dict[str, Any] = {
+      "maintenance": maintenance.snapshot() if maintenance is not None else None,
+    }
+    if hasattr(storage, "get_file_stats"):
+      payload["database"] = storage.get_file_stats()
+    if hasattr(storage, "get_lock_metrics"):
+      payload["locks"] = storage.get_lock_metrics()
+    if hasattr(storage, "list_audit_partitions"):
+      payload["audit_partitions"] = storage.list_audit_partitions()
+    if auth_service is not None and hasattr(auth_service, "get_password_hashing_snapshot"):
+      payload["password_hashing"] = auth_service.get_password_hashing_snapshot()
+    return payload
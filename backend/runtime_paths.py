@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+
+def resolve_data_dir() -> Path:
+  env_path = os.getenv("ANCIA_BACKEND_DATA_DIR", "").strip()
+  if env_path:
+    return Path(env_path).expanduser().resolve()
+  return (Path(__file__).resolve().parent / ".runtime").resolve()
+
+
+def resolve_plugins_root_dir() -> Path:
+  env_path = os.getenv("ANCIA_PLUGINS_DIR", "").strip()
+  if env_path:
+    return Path(env_path).expanduser().resolve()
+  return (Path(__file__).resolve().parent / "plugins").resolve()
+
+
+def resolve_system_prompt_path() -> Path:
+  env_path = os.getenv("ANCIA_SYSTEM_PROMPT", "").strip()
+  if env_path:
+    return Path(env_path).expanduser().resolve()
+
+  backend_dir = Path(__file__).resolve().parent
+  project_root = backend_dir.parent
+  candidate_paths = [
+    (project_root / "system_prompt.txt").resolve(),
+    (backend_dir / "data" / "system_prompt.txt").resolve(),
+  ]
+  for candidate in candidate_paths:
+    if candidate.exists():
+      return candidate
+
+  return candidate_paths[-1]
+
+
+def load_system_prompt() -> str:
+  path = resolve_system_prompt_path()
+  if path.exists():
+    try:
+      return path.read_text(encoding="utf-8").strip()
+    except OSError:
+      pass
+
+  return "Ты локальный агент Ancia. Отвечай кратко и сохраняй контекст пользователя."
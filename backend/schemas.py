@@ -54,6 +54,7 @@ class AttachmentRef(BaseModel):
   size: int = Field(default=0, ge=0, le=52_428_800)
   textContent: str = Field(default="", max_length=120_000)
   dataUrl: str = Field(default="", max_length=2_000_000)
+  sha256: str = Field(default="", max_length=64)
 
 
 class ChatRequest(BaseModel):
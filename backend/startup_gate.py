@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import json
+import logging
+import threading
+from typing import Any, Callable
+
+try:
+  from backend.common import utc_now_iso
+except ModuleNotFoundError:
+  from common import utc_now_iso  # type: ignore
+
+LOGGER = logging.getLogger("ancia.startup")
+
+SERVICE_NAME = "ancia-local-backend"
+STARTUP_RETRY_AFTER_SECONDS = 2
+
+
+class DeferredStartupApp:
+  """ASGI-обёртка на время долгой инициализации (миграции схемы БД).
+
+  Приложение собирается в фоновом потоке; пока сборка идёт, /health отвечает 200 со
+  статусом starting и прогрессом миграции (Tauri и фронтенд ждут именно его), остальные
+  запросы получают 503 с Retry-After, OPTIONS — 204. После сборки все запросы уходят во
+  внутреннее приложение. wrap_gate оборачивает ответы на время старта (CORS того же вида,
+  что у приложения, — иначе браузерный фронтенд не прочитает /health).
+  """
+
+  def __init__(
+    self,
+    build_app: Callable[[], Any],
+    *,
+    progress_fn: Callable[[], dict[str, Any]],
+    wrap_gate: Callable[[Any], Any] | None = None,
+  ) -> None:
+    self._build_app = build_app
+    self._progress_fn = progress_fn
+    self._gate = wrap_gate(self._serve_gate) if wrap_gate is not None else self._serve_gate
+    self._app: Any = None
+    self._error = ""
+    self._started = False
+    self._start_lock: asyncio.Lock | None = None
+    self._thread = threading.Thread(target=self._build, name="ancia-startup", daemon=True)
+    self._thread.start()
+
+  def _build(self) -> None:
+    try:
+      self._app = self._build_app()
+      LOGGER.info("Backend startup finished after storage migration")
+    except Exception as exc:
+      LOGGER.exception("Backend startup failed")
+      self._error = str(exc) or exc.__class__.__name__
+
+  @property
+  def ready(self) -> bool:
+    return self._app is not None
+
+  def wait_ready(self, timeout: float | None = None) -> bool:
+    self._thread.join(timeout)
+    return self.ready
+
+  async def __call__(self, scope: dict[str, Any], receive: Callable, send: Callable) -> None:
+    scope_type = scope.get("type")
+    if scope_type == "lifespan":
+      await self._lifespan(receive, send)
+      return
+    app = self._app
+    if app is not None:
+      await self._ensure_started(app)
+      await app(scope, receive, send)
+      return
+    await self._gate(scope, receive, send)
+
+  async def _serve_gate(self, scope: dict[str, Any], receive: Callable, send: Callable) -> None:
+    scope_type = scope.get("type")
+    if scope_type == "http":
+      if scope.get("method") == "OPTIONS":
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+      elif scope.get("path") == "/health":
+        await self._send_json(send, 200, self._health_payload())
+      else:
+        await self._send_json(
+          send,
+          503,
+          {"detail": "Сервер обновляет базу данных, повторите запрос позже."},
+          extra_headers=[(b"retry-after", str(STARTUP_RETRY_AFTER_SECONDS).encode("ascii"))],
+        )
+      return
+    if scope_type == "websocket":
+      await send({"type": "websocket.close", "code": 1013})
+
+  def _health_payload(self) -> dict[str, Any]:
+    migration = self._progress_fn()
+    percent = float(migration.get("percent") or 0.0)
+    if self._error:
+      startup = {
+        "status": "error",
+        "stage": "error",
+        "message": f"Не удалось обновить базу данных: {self._error}",
+        "details": {"progress_percent": 100, "migration": migration},
+      }
+      status = "degraded"
+    else:
+      step = str(migration.get("step") or "").strip()
+      version = int(migration.get("version") or 0)
+      step_label = f" (v{version}{', ' + step if step else ''})" if version else ""
+      startup = {
+        "status": "booting",
+        "stage": "storage_migration",
+        "message": f"Обновление базы данных{step_label}: {percent:.0f}%",
+        "details": {"progress_percent": round(percent, 1), "migration": migration},
+      }
+      status = "starting"
+    return {
+      "status": status,
+      "service": SERVICE_NAME,
+      "time": utc_now_iso(),
+      "model": {"ready": False},
+      "startup": startup,
+      "storage": {"migration": migration},
+    }
+
+  @staticmethod
+  async def _send_json(
+    send: Callable,
+    status_code: int,
+    payload: dict[str, Any],
+    *,
+    extra_headers: list[tuple[bytes, bytes]] | None = None,
+  ) -> None:
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    headers = [
+      (b"content-type", b"application/json"),
+      (b"content-length", str(len(body)).encode("ascii")),
+      (b"cache-control", b"no-store"),
+      *(extra_headers or []),
+    ]
+    await send({"type": "http.response.start", "status": status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+  async def _ensure_started(self, app: Any) -> None:
+    # Сервер уже прошёл lifespan.startup обёртки — обработчики startup внутреннего
+    # приложения запускаются один раз перед первым переданным ему запросом.
+    if self._started:
+      return
+    if self._start_lock is None:
+      self._start_lock = asyncio.Lock()
+    async with self._start_lock:
+      if self._started:
+        return
+      await self._run_handlers(getattr(getattr(app, "router", None), "on_startup", None) or [])
+      self._started = True
+
+  @staticmethod
+  async def _run_handlers(handlers: list[Callable]) -> None:
+    for handler in handlers:
+      result = handler()
+      if inspect.isawaitable(result):
+        await result
+
+  async def _lifespan(self, receive: Callable, send: Callable) -> None:
+    while True:
+      message = await receive()
+      message_type = message.get("type")
+      if message_type == "lifespan.startup":
+        await send({"type": "lifespan.startup.complete"})
+      elif message_type == "lifespan.shutdown":
+        app = self._app
+        if app is not None:
+          try:
+            await self._run_handlers(getattr(getattr(app, "router", None), "on_shutdown", None) or [])
+          except Exception:
+            LOGGER.exception("Backend shutdown handlers failed")
+        await send({"type": "lifespan.shutdown.complete"})
+        return
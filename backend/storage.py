@@ -1,52 +1,746 @@
 from __future__ import annotations
 
+import base64
+import binascii
+import datetime as dt
+import gzip
 import json
 import math
 import os
+import queue
+import re
 import sqlite3
 import threading
 import time
 import uuid
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Iterable, Iterator
 
 try:
+  from backend.attachment_store import is_attachment_sha256
   from backend.common import normalize_mood, utc_now_iso
+  from backend.rate_limiter import GcraRateLimiter, gcra_step
+  from backend.storage_codec import CODEC_PLAIN, decode_text, encode_text, resolve_compression_min_bytes
 except ModuleNotFoundError:
+  from attachment_store import is_attachment_sha256  # type: ignore
   from common import normalize_mood, utc_now_iso  # type: ignore
+  from rate_limiter import GcraRateLimiter, gcra_step  # type: ignore
+  from storage_codec import CODEC_PLAIN, decode_text, encode_text, resolve_compression_min_bytes  # type: ignore
+
+
+READ_POOL_DEFAULT_SIZE = 4
+READ_POOL_MAX_SIZE = 32
+AUDIT_PARTITION_PERIODS = ("month", "day")
+
+
+def _resolve_audit_partition_period() -> str:
+  raw = str(os.getenv("ANCIA_AUDIT_PARTITION_PERIOD", "") or "").strip().lower()
+  return raw if raw in AUDIT_PARTITION_PERIODS else "month"
+
+
+def _resolve_read_pool_size() -> int:
+  raw = os.getenv("ANCIA_SQLITE_READ_POOL_SIZE", "").strip()
+  if not raw:
+    return READ_POOL_DEFAULT_SIZE
+  try:
+    value = int(raw)
+  except ValueError:
+    return READ_POOL_DEFAULT_SIZE
+  return max(0, min(READ_POOL_MAX_SIZE, value))
+
+
+def _resolve_rate_limit_shared() -> bool:
+  # Несколько процессов над одной базой (API-воркеры сервера модели) должны делить бюджет:
+  # тогда решение принимается по строке в SQLite, а не по состоянию в памяти процесса.
+  return os.getenv("ANCIA_RATE_LIMIT_SHARED", "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+class _WaitStats:
+  """Счётчики ожидания захвата ресурса: сколько раз, сколько из них с ожиданием, суммарно и максимум."""
+
+  def __init__(self) -> None:
+    self._lock = threading.Lock()
+    self._acquisitions = 0
+    self._contended = 0
+    self._wait_total_seconds = 0.0
+    self._wait_max_seconds = 0.0
+
+  def record(self, wait_seconds: float) -> None:
+    with self._lock:
+      self._acquisitions += 1
+      if wait_seconds > 0:
+        self._contended += 1
+        self._wait_total_seconds += wait_seconds
+        self._wait_max_seconds = max(self._wait_max_seconds, wait_seconds)
+
+  def snapshot(self) -> dict[str, Any]:
+    with self._lock:
+      return {
+        "acquisitions": self._acquisitions,
+        "contended": self._contended,
+        "wait_ms_total": round(self._wait_total_seconds * 1000.0, 3),
+        "wait_ms_max": round(self._wait_max_seconds * 1000.0, 3),
+      }
+
+
+class _InstrumentedLock:
+  """RLock писателя с учётом времени ожидания; повторный захват тем же потоком не считается."""
+
+  def __init__(self) -> None:
+    self._lock = threading.RLock()
+    self._owner_depth = threading.local()
+    self.stats = _WaitStats()
+    # monotonic-время последнего освобождения: по нему обслуживание ждёт простоя писателя.
+    self.last_release_at = time.monotonic()
+    # monotonic-время внешнего захвата, пока блокировка занята (любым потоком), иначе None.
+    self.held_since: float | None = None
+
+  def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+    depth = int(getattr(self._owner_depth, "value", 0))
+    if depth > 0:
+      self._lock.acquire()
+      self._owner_depth.value = depth + 1
+      return True
+    wait_seconds = 0.0
+    if not self._lock.acquire(blocking=False):
+      if not blocking:
+        return False
+      started = time.perf_counter()
+      if not self._lock.acquire(timeout=timeout):
+        return False
+      wait_seconds = time.perf_counter() - started
+    self._owner_depth.value = 1
+    self.held_since = time.monotonic()
+    self.stats.record(wait_seconds)
+    return True
+
+  def held_by_current_thread(self) -> bool:
+    return int(getattr(self._owner_depth, "value", 0)) > 0
+
+  def is_held(self) -> bool:
+    return self.held_since is not None
+
+  def release(self) -> None:
+    depth = max(0, int(getattr(self._owner_depth, "value", 1)) - 1)
+    self._owner_depth.value = depth
+    if depth == 0:
+      self.held_since = None
+      self.last_release_at = time.monotonic()
+    self._lock.release()
+
+  def __enter__(self) -> "_InstrumentedLock":
+    self.acquire()
+    return self
+
+  def __exit__(self, *_exc: Any) -> None:
+    self.release()
+
+
+class _ReadConnectionPool:
+  """Пул read-only соединений к той же БД: в WAL читатели не ждут писателя и друг друга."""
+
+  def __init__(self, factory: Callable[[], sqlite3.Connection], size: int) -> None:
+    self._factory = factory
+    self._size = max(1, int(size))
+    self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+    self._lock = threading.Lock()
+    self._created = 0
+    self._closed = False
+    self.stats = _WaitStats()
+
+  def acquire(self) -> sqlite3.Connection:
+    try:
+      conn = self._idle.get_nowait()
+      self.stats.record(0.0)
+      return conn
+    except queue.Empty:
+      pass
+    with self._lock:
+      can_create = self._created < self._size
+      if can_create:
+        self._created += 1
+    if can_create:
+      try:
+        conn = self._factory()
+      except Exception:
+        with self._lock:
+          self._created -= 1
+        raise
+      self.stats.record(0.0)
+      return conn
+    started = time.perf_counter()
+    conn = self._idle.get()
+    self.stats.record(time.perf_counter() - started)
+    return conn
+
+  def release(self, conn: sqlite3.Connection) -> None:
+    if conn.in_transaction:
+      conn.rollback()
+    if self._closed:
+      conn.close()
+      return
+    self._idle.put(conn)
+
+  def close(self) -> None:
+    self._closed = True
+    while True:
+      try:
+        conn = self._idle.get_nowait()
+      except queue.Empty:
+        break
+      conn.close()
+
+  def snapshot(self) -> dict[str, Any]:
+    with self._lock:
+      created = self._created
+    return {
+      "size": self._size,
+      "open": created,
+      "idle": self._idle.qsize(),
+      **self.stats.snapshot(),
+    }
+
+
+SETTINGS_CACHE_VERSION_CHECK_INTERVAL_SECONDS = 1.0
+_SETTINGS_INVALID_JSON = object()
+
+
+def _clone_json_value(value: Any) -> Any:
+  # Кэш отдаёт копии: вызывающий код (в т.ч. плагины) может менять полученные dict/list.
+  if isinstance(value, dict):
+    return {key: _clone_json_value(item) for key, item in value.items()}
+  if isinstance(value, list):
+    return [_clone_json_value(item) for item in value]
+  return value
+
+
+GROUP_COMMIT_MAX_BATCH = 256
+GROUP_COMMIT_BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+GROUP_COMMIT_LATENCY_MS_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0)
+
+
+def _resolve_group_commit_window_seconds() -> float:
+  # 0 (по умолчанию) — без очереди: каждая запись в своей транзакции, как раньше.
+  raw = os.getenv("ANCIA_SQLITE_GROUP_COMMIT_MS", "").strip()
+  try:
+    value_ms = float(raw) if raw else 0.0
+  except ValueError:
+    value_ms = 0.0
+  return max(0.0, min(100.0, value_ms)) / 1000.0
+
+
+class _Histogram:
+  def __init__(self, bounds: tuple[float, ...]) -> None:
+    self._bounds = tuple(bounds)
+    self._counts = [0] * (len(self._bounds) + 1)
+    self._total = 0
+    self._sum = 0.0
+    self._max = 0.0
+
+  def observe(self, value: float) -> None:
+    index = len(self._bounds)
+    for position, bound in enumerate(self._bounds):
+      if value <= bound:
+        index = position
+        break
+    self._counts[index] += 1
+    self._total += 1
+    self._sum += value
+    self._max = max(self._max, value)
+
+  def snapshot(self) -> dict[str, Any]:
+    buckets = {f"le_{bound:g}": count for bound, count in zip(self._bounds, self._counts)}
+    buckets["inf"] = self._counts[-1]
+    return {
+      "count": self._total,
+      "avg": round(self._sum / self._total, 3) if self._total else 0.0,
+      "max": round(self._max, 3),
+      "buckets": buckets,
+    }
+
+
+class _GroupCommitWriter:
+  """Фоновый поток записи: копит операции window_seconds и коммитит их одной транзакцией.
+
+  Каждая операция выполняется в своём SAVEPOINT — ошибка одной не откатывает соседние.
+  Future завершается только после COMMIT, так что дождавшийся вызывающий видит свою запись.
+  """
+
+  def __init__(
+    self,
+    conn: sqlite3.Connection,
+    lock: _InstrumentedLock,
+    *,
+    window_seconds: float,
+    max_batch: int = GROUP_COMMIT_MAX_BATCH,
+  ) -> None:
+    self._conn = conn
+    self._lock = lock
+    self._window_seconds = max(0.0, float(window_seconds))
+    self._max_batch = max(1, int(max_batch))
+    self._queue: queue.SimpleQueue[tuple[Callable[[], Any], Future] | None] = queue.SimpleQueue()
+    self._stats_lock = threading.Lock()
+    self._batch_sizes = _Histogram(GROUP_COMMIT_BATCH_SIZE_BUCKETS)
+    self._commit_latency_ms = _Histogram(GROUP_COMMIT_LATENCY_MS_BUCKETS)
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name="ancia-sqlite-writer", daemon=True)
+    self._thread.start()
+
+  def submit(self, op: Callable[[], Any]) -> Future:
+    if self._closed:
+      raise RuntimeError("storage write queue is closed")
+    future: Future = Future()
+    self._queue.put((op, future))
+    return future
+
+  def close(self) -> None:
+    if self._closed:
+      return
+    self._closed = True
+    self._queue.put(None)
+    self._thread.join(timeout=5.0)
+
+  def _run(self) -> None:
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      batch = [item]
+      stop = False
+      deadline = time.monotonic() + self._window_seconds
+      while len(batch) < self._max_batch:
+        remaining = deadline - time.monotonic()
+        try:
+          next_item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+        except queue.Empty:
+          break
+        if next_item is None:
+          stop = True
+          break
+        batch.append(next_item)
+      self._commit(batch)
+      if stop:
+        return
+
+  def _commit(self, batch: list[tuple[Callable[[], Any], Future]]) -> None:
+    outcomes: list[tuple[Future, Any, BaseException | None]] = []
+    with self._lock:
+      started = time.perf_counter()
+      try:
+        if not self._conn.in_transaction:
+          self._conn.execute("BEGIN")
+        for op, future in batch:
+          if not future.set_running_or_notify_cancel():
+            continue
+          self._conn.execute("SAVEPOINT group_write")
+          try:
+            value = op()
+          except Exception as exc:
+            self._conn.execute("ROLLBACK TO group_write")
+            self._conn.execute("RELEASE group_write")
+            outcomes.append((future, None, exc))
+            continue
+          self._conn.execute("RELEASE group_write")
+          outcomes.append((future, value, None))
+        self._conn.commit()
+      except Exception as exc:
+        try:
+          self._conn.rollback()
+        except sqlite3.Error:
+          pass
+        outcomes = [(future, None, exc) for _op, future in batch if future.running()]
+      latency_ms = (time.perf_counter() - started) * 1000.0
+    with self._stats_lock:
+      self._batch_sizes.observe(float(len(batch)))
+      self._commit_latency_ms.observe(latency_ms)
+    for future, value, error in outcomes:
+      if error is not None:
+        future.set_exception(error)
+      else:
+        future.set_result(value)
+
+  def pending(self) -> int:
+    return self._queue.qsize()
+
+  def snapshot(self) -> dict[str, Any]:
+    with self._stats_lock:
+      return {
+        "pending": self.pending(),
+        "window_ms": round(self._window_seconds * 1000.0, 3),
+        "max_batch": self._max_batch,
+        "batch_size": self._batch_sizes.snapshot(),
+        "commit_latency_ms": self._commit_latency_ms.snapshot(),
+      }
+
+
+class MigrationProgress:
+  """Состояние миграции схемы для /health: пишет поток миграции, читают обработчики запросов."""
+
+  def __init__(self) -> None:
+    self._lock = threading.Lock()
+    self._state: dict[str, Any] = {
+      "status": "idle",
+      "from_version": 0,
+      "to_version": 0,
+      "version": 0,
+      "step": "",
+      "done": 0,
+      "total": 0,
+      "started_at": "",
+      "finished_at": "",
+      "error": "",
+    }
+    self._started_monotonic = 0.0
+    self._peak_percent = 0.0
+
+  def start(self, from_version: int, to_version: int) -> None:
+    with self._lock:
+      self._state.update(
+        status="running",
+        from_version=int(from_version),
+        to_version=int(to_version),
+        version=int(from_version),
+        step="",
+        done=0,
+        total=0,
+        started_at=utc_now_iso(),
+        finished_at="",
+        error="",
+      )
+      self._started_monotonic = time.monotonic()
+      self._peak_percent = 0.0
+
+  def update(self, **fields: Any) -> None:
+    with self._lock:
+      self._state.update(fields)
+
+  def finish(self, *, error: str = "") -> None:
+    with self._lock:
+      self._state.update(status="error" if error else "done", finished_at=utc_now_iso(), error=error)
+
+  def snapshot(self) -> dict[str, Any]:
+    with self._lock:
+      state = dict(self._state)
+      started = self._started_monotonic
+      peak_percent = self._peak_percent
+    from_version = int(state["from_version"])
+    to_version = int(state["to_version"])
+    done = int(state["done"])
+    total = int(state["total"])
+    step_fraction = min(1.0, done / total) if total > 0 else 0.0
+    # Каждая версия — равная доля общей шкалы; внутри пакетного шага — доля обработанных строк.
+    if state["status"] == "done":
+      percent = 100.0
+    elif to_version > from_version:
+      finished_steps = max(0, int(state["version"]) - from_version - 1)
+      percent = (finished_steps + step_fraction) / (to_version - from_version) * 100.0
+    else:
+      percent = 0.0
+    # Шаги без счётчика строк (подмена таблиц) не должны откатывать шкалу назад.
+    percent = max(peak_percent, min(100.0, max(0.0, percent)))
+    with self._lock:
+      self._peak_percent = max(self._peak_percent, percent)
+    state["percent"] = round(percent, 1)
+    state["step_percent"] = round(step_fraction * 100.0, 1)
+    state["elapsed_seconds"] = round(time.monotonic() - started, 1) if state["status"] == "running" and started else 0.0
+    return state
+
+
+def pending_schema_migration(db_path: Path) -> tuple[int, int] | None:
+  """(текущая, целевая) версия схемы, если файл БД существует и требует миграции; иначе None."""
+  if not db_path.exists():
+    return None
+  try:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=1.0)
+  except sqlite3.Error:
+    return None
+  try:
+    row = conn.execute("PRAGMA user_version").fetchone()
+    current_version = int(row[0]) if row else 0
+  except (sqlite3.Error, TypeError, ValueError):
+    return None
+  finally:
+    conn.close()
+  if current_version <= 0 or current_version >= AppStorage.LATEST_SCHEMA_VERSION:
+    return None
+  return current_version, AppStorage.LATEST_SCHEMA_VERSION
+
+
+class ReadOnlySettings:
+  """Чтение настроек прямо из файла БД, без AppStorage и миграций (пока идёт отложенный старт)."""
+
+  def __init__(self, db_path: Path) -> None:
+    self._db_path = db_path
+
+  def get_setting_json(self, key: str, fallback: Any = None) -> Any:
+    if not self._db_path.exists():
+      return fallback
+    try:
+      conn = sqlite3.connect(f"file:{self._db_path}?mode=ro", uri=True, timeout=1.0)
+    except sqlite3.Error:
+      return fallback
+    try:
+      row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+      return json.loads(row[0]) if row else fallback
+    except (sqlite3.Error, json.JSONDecodeError, TypeError):
+      return fallback
+    finally:
+      conn.close()
 
 
 class AppStorage:
   BASE_SCHEMA_VERSION = 1
-  LATEST_SCHEMA_VERSION = 7
+  LATEST_SCHEMA_VERSION = 16
   RATE_LIMIT_SCOPE_MAX_CHARS = 220
-  RATE_LIMIT_CLEANUP_INTERVAL_SECONDS = 120.0
-  RATE_LIMIT_CLEANUP_RETENTION_SECONDS = 3600.0
-  RATE_LIMIT_BLOCK_RETENTION_SECONDS = 86400.0
-
-  def __init__(self, db_path: Path) -> None:
+  CHAT_PAGE_MAX_LIMIT = 200
+  EXPORT_BATCH_SIZE = 500
+  IMPORT_BATCH_SIZE = 500
+  MESSAGE_PAGE_MAX_LIMIT = 500
+  MESSAGE_SEARCH_FTS_TABLE = "messages_fts"
+  # trigram даёт поиск по подстроке (в т.ч. кириллица, без учёта регистра) — как прежний LIKE;
+  # unicode61 — запасной вариант для SQLite < 3.34, где trigram недоступен.
+  MESSAGE_SEARCH_FTS_TOKENIZERS = ("trigram", "unicode61 remove_diacritics 2")
+  MESSAGE_SEARCH_TRIGRAM_MIN_CHARS = 3
+  # bm25 считается только по самым свежим N совпадениям: частый терм не ранжирует всю историю.
+  MESSAGE_SEARCH_RANK_WINDOW = 2000
+  WAL_SIZE_LIMIT_BYTES = 64 * 1024 * 1024
+  AUDIT_PRUNE_BATCH_SIZE = 5000
+  # Аудит лежит в таблицах-партициях по периодам (audit_events_pYYYYMM[DD]); audit_events — их объединение (VIEW).
+  AUDIT_PARTITION_PREFIX = "audit_events_p"
+  AUDIT_EVENT_COLUMNS = (
+    "id",
+    "actor_user_id",
+    "actor_username",
+    "actor_role",
+    "action",
+    "target_type",
+    "target_id",
+    "status",
+    "details_json",
+    "ip_address",
+    "created_at",
+  )
+  AUDIT_ROLLUP_GROUP_COLUMNS = ("day", "action", "actor_user_id", "status")
+  AUDIT_ROLLUP_MAX_LIMIT = 5000
+  AUDIT_ARCHIVE_BATCH_SIZE = 1000
+  META_COMPRESS_MIGRATION_BATCH_SIZE = 500
+  # Аргументы и вывод инструментов лежат в message_tool_payloads; в meta остаётся краткое превью.
+  TOOL_PAYLOAD_META_KEYS = (("tool_args", "toolArgs"), ("tool_output", "toolOutput"))
+  TOOL_ARGS_PREVIEW_MAX_CHARS = 240
+  TOOL_PAYLOAD_FETCH_BATCH_SIZE = 500
+  CHANGE_LOG_PAGE_DEFAULT_LIMIT = 500
+  CHANGE_LOG_PAGE_MAX_LIMIT = 5000
+  CHANGE_LOG_COMPACT_BATCH_SIZE = 5000
+  # Тяжёлые миграции идут пачками: каждая коммитится вместе с курсором в schema_migration_state.
+  MIGRATION_BATCH_SIZE = 2000
+
+  def __init__(self, db_path: Path, *, migration_progress: MigrationProgress | None = None) -> None:
     db_path.parent.mkdir(parents=True, exist_ok=True)
     self._db_path = db_path
     try:
       os.chmod(db_path.parent, 0o700)
     except OSError:
       pass
-    self._lock = threading.RLock()
-    self._rate_limit_last_cleanup_ts = 0.0
+    # Единственное пишущее соединение под блокировкой; чтение идёт через пул (см. _read).
+    self._lock = _InstrumentedLock()
     self._conn = sqlite3.connect(db_path, check_same_thread=False)
     self._conn.row_factory = sqlite3.Row
+    # Пока файл пуст, auto_vacuum выставляется без перестройки; на готовой базе до VACUUM
+    # прагма ничего не меняет (см. enable_incremental_auto_vacuum).
+    self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
     with self._conn:
       self._conn.execute("PRAGMA journal_mode=WAL")
       self._conn.execute("PRAGMA synchronous=NORMAL")
       self._conn.execute("PRAGMA foreign_keys=ON")
       self._conn.execute("PRAGMA secure_delete=ON")
       self._conn.execute("PRAGMA temp_store=MEMORY")
+      # После checkpoint WAL усекается до этого размера, а не остаётся на пике.
+      self._conn.execute(f"PRAGMA journal_size_limit={self.WAL_SIZE_LIMIT_BYTES}")
     if db_path.exists():
       try:
         os.chmod(db_path, 0o600)
       except OSError:
         pass
+    # meta_json крупнее порога хранится сжатым (колонка meta_codec); распаковка — только при сериализации.
+    self._compress_min_bytes = resolve_compression_min_bytes()
+    self._migration_progress = migration_progress or MigrationProgress()
+    self._audit_partition_period = _resolve_audit_partition_period()
+    # (начало, конец, имя) партиций аудита; загружается лениво под блокировкой писателя.
+    self._audit_partitions: list[tuple[str, str, str]] | None = None
     self._migrate_schema()
+    self._message_search_tokenizer = self._detect_message_search_tokenizer()
+    # Кэш настроек: сырые значения (None — ключа нет) и уже разобранный JSON.
+    self._settings_cache_lock = threading.Lock()
+    self._settings_cache: dict[str, str | None] = {}
+    self._settings_json_cache: dict[str, Any] = {}
+    self._settings_cache_generation = 0
+    self._settings_data_version = self._read_data_version()
+    self._settings_version_checked_at = time.monotonic()
+    self._rate_limiter = GcraRateLimiter(persist_fn=self._persist_rate_limit_state)
+    self._rate_limit_shared = _resolve_rate_limit_shared()
+    if not self._rate_limit_shared:
+      self._rate_limiter.load(self._load_rate_limit_state())
+    read_pool_size = _resolve_read_pool_size()
+    self._read_pool = (
+      _ReadConnectionPool(self._open_read_connection, read_pool_size)
+      if read_pool_size > 0
+      else None
+    )
+    group_commit_window = _resolve_group_commit_window_seconds()
+    self._write_queue = (
+      _GroupCommitWriter(self._conn, self._lock, window_seconds=group_commit_window)
+      if group_commit_window > 0
+      else None
+    )
+
+  def _open_read_connection(self) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+      f"{self._db_path.resolve().as_uri()}?mode=ro",
+      uri=True,
+      check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+  @contextmanager
+  def _read(self) -> Iterator[sqlite3.Connection]:
+    # Видит всё, что закоммичено писателем; незакоммиченную транзакцию писателя — нет,
+    # поэтому внутри `with self._lock, self._conn:` читаем через self._conn.
+    if self._read_pool is None:
+      with self._lock:
+        yield self._conn
+      return
+    conn = self._read_pool.acquire()
+    try:
+      yield conn
+    finally:
+      self._read_pool.release(conn)
+
+  def _dispatch_write(self, op: Callable[[], Any], *, wait: bool = True) -> Any:
+    """Выполняет запись сразу или через очередь group commit; при wait=False возвращает Future."""
+    if self._write_queue is None or self._lock.held_by_current_thread():
+      # Без очереди или изнутри уже захваченной блокировки (иначе ждали бы сами себя).
+      with self._lock, self._conn:
+        value = op()
+      return value if wait else self._completed_write(value, wait=False)
+    future = self._write_queue.submit(op)
+    return future.result() if wait else future
+
+  @staticmethod
+  def _completed_write(value: Any, *, wait: bool) -> Any:
+    if wait:
+      return value
+    future: Future = Future()
+    future.set_result(value)
+    return future
+
+  def flush_writes(self) -> None:
+    if self._write_queue is None or self._lock.held_by_current_thread():
+      return
+    self._write_queue.submit(lambda: None).result()
+
+  def get_lock_metrics(self) -> dict[str, Any]:
+    return {
+      "writer_lock": self._lock.stats.snapshot(),
+      "read_pool": self._read_pool.snapshot() if self._read_pool is not None else None,
+      "write_queue": self._write_queue.snapshot() if self._write_queue is not None else None,
+    }
+
+  def seconds_since_last_write(self) -> float:
+    return max(0.0, time.monotonic() - self._lock.last_release_at)
+
+  def is_writer_idle(self, idle_seconds: float) -> bool:
+    # Длинная транзакция в другом потоке — не простой: last_release_at обновится только при её окончании.
+    if self._lock.is_held():
+      return False
+    if self._write_queue is not None and self._write_queue.pending() > 0:
+      return False
+    return self.seconds_since_last_write() >= max(0.0, float(idle_seconds))
+
+  def checkpoint_wal(self, *, mode: str = "PASSIVE") -> dict[str, int]:
+    """Checkpoint WAL; PASSIVE не ждёт читателей и писателей, поэтому безопасен в фоне."""
+    safe_mode = str(mode or "PASSIVE").strip().upper()
+    if safe_mode not in {"PASSIVE", "FULL", "RESTART", "TRUNCATE"}:
+      safe_mode = "PASSIVE"
+    with self._lock:
+      row = self._conn.execute(f"PRAGMA wal_checkpoint({safe_mode})").fetchone()
+    if row is None:
+      return {"busy": 0, "wal_pages": 0, "checkpointed_pages": 0}
+    return {"busy": int(row[0]), "wal_pages": int(row[1]), "checkpointed_pages": int(row[2])}
+
+  def incremental_vacuum(self, *, max_pages: int = 2048) -> int:
+    """Возвращает в ФС до max_pages свободных страниц; без auto_vacuum=INCREMENTAL — no-op."""
+    safe_max_pages = max(1, int(max_pages or 1))
+    with self._lock:
+      if int(self._conn.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+        return 0
+      before = int(self._conn.execute("PRAGMA freelist_count").fetchone()[0])
+      if before <= 0:
+        return 0
+      # execute() делает один шаг прагмы без столбцов (одна страница); executescript доводит до конца.
+      self._conn.executescript(f"PRAGMA incremental_vacuum({safe_max_pages});")
+      after = int(self._conn.execute("PRAGMA freelist_count").fetchone()[0])
+    return max(0, before - after)
+
+  def enable_incremental_auto_vacuum(self) -> bool:
+    """Переводит существующую базу на auto_vacuum=INCREMENTAL полной перестройкой (VACUUM).
+
+    Держит блокировку писателя всё время перестройки, поэтому вызывается только из
+    обслуживания при простое и только по ANCIA_MAINTENANCE_AUTO_VACUUM_CONVERT=1.
+    """
+    with self._lock:
+      if int(self._conn.execute("PRAGMA auto_vacuum").fetchone()[0]) == 2:
+        return False
+      if self._conn.in_transaction:
+        self._conn.commit()
+      self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+      self._conn.execute("VACUUM")
+    return True
+
+  def optimize(self) -> None:
+    # analysis_limit ограничивает ANALYZE выборкой, чтобы optimize не сканировал большие таблицы целиком.
+    with self._lock:
+      self._conn.execute("PRAGMA analysis_limit=400")
+      self._conn.execute("PRAGMA optimize")
+
+  def get_file_stats(self) -> dict[str, Any]:
+    with self._read() as conn:
+      page_size = int(conn.execute("PRAGMA page_size").fetchone()[0])
+      page_count = int(conn.execute("PRAGMA page_count").fetchone()[0])
+      freelist_count = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+      auto_vacuum = int(conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+    wal_path = Path(f"{self._db_path}-wal")
+    try:
+      wal_bytes = wal_path.stat().st_size if wal_path.exists() else 0
+    except OSError:
+      wal_bytes = 0
+    return {
+      "page_size": page_size,
+      "page_count": page_count,
+      "freelist_count": freelist_count,
+      "db_bytes": page_size * page_count,
+      "wal_bytes": wal_bytes,
+      "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, str(auto_vacuum)),
+      "schema_version": self.LATEST_SCHEMA_VERSION,
+      "seconds_since_last_write": round(self.seconds_since_last_write(), 3),
+    }
+
+  def close(self) -> None:
+    try:
+      self.flush_rate_limit_state()
+    except sqlite3.Error:
+      pass
+    if self._write_queue is not None:
+      self._write_queue.close()
+    if self._read_pool is not None:
+      self._read_pool.close()
+    with self._lock:
+      self._conn.close()
 
   def _get_schema_version_locked(self) -> int:
     row = self._conn.execute("PRAGMA user_version").fetchone()
@@ -168,13 +862,6 @@ class AppStorage:
       )
       """
     )
-    self._conn.execute(
-      """
-      INSERT INTO chats_v4(owner_user_id, id, title, mood, created_at, updated_at)
-      SELECT '', id, title, mood, created_at, updated_at
-      FROM chats
-      """
-    )
     self._conn.execute(
       """
       CREATE TABLE IF NOT EXISTS messages_v4 (
@@ -189,14 +876,43 @@ class AppStorage:
       )
       """
     )
-    self._conn.execute(
-      """
-      INSERT INTO messages_v4(id, owner_user_id, chat_id, role, text, meta_json, timestamp)
-      SELECT m.id, '', m.chat_id, m.role, m.text, m.meta_json, m.timestamp
-      FROM messages m
-      JOIN chats_v4 c ON c.owner_user_id = '' AND c.id = m.chat_id
-      """
-    )
+
+    def copy_chats(cursor: int) -> tuple[int, int]:
+      last_rowid, count = self._rowid_batch_bounds_locked("chats", "rowid", cursor)
+      if count:
+        self._conn.execute(
+          """
+          INSERT OR IGNORE INTO chats_v4(owner_user_id, id, title, mood, created_at, updated_at)
+          SELECT '', id, title, mood, created_at, updated_at
+          FROM chats
+          WHERE rowid > ? AND rowid <= ?
+          """,
+          (cursor, last_rowid),
+        )
+      return last_rowid, count
+
+    def copy_messages(cursor: int) -> tuple[int, int]:
+      last_id, count = self._rowid_batch_bounds_locked("messages", "id", cursor)
+      if count:
+        self._conn.execute(
+          """
+          INSERT OR IGNORE INTO messages_v4(id, owner_user_id, chat_id, role, text, meta_json, timestamp)
+          SELECT m.id, '', m.chat_id, m.role, m.text, m.meta_json, m.timestamp
+          FROM messages m
+          JOIN chats_v4 c ON c.owner_user_id = '' AND c.id = m.chat_id
+          WHERE m.id > ? AND m.id <= ?
+          """,
+          (cursor, last_id),
+        )
+      return last_id, count
+
+    self._run_migration_batches_locked(4, "copy_chats", copy_chats, total=self._count_rows_locked("chats"))
+    self._run_migration_batches_locked(4, "copy_messages", copy_messages, total=self._count_rows_locked("messages"))
+    # Подмена таблиц — одной транзакцией вместе с user_version (коммит в _migrate_schema):
+    # без явного BEGIN каждый DDL зафиксировался бы отдельно.
+    self._migration_progress.update(step="swap_tables", done=0, total=0)
+    if not self._conn.in_transaction:
+      self._conn.execute("BEGIN IMMEDIATE")
     self._conn.execute("DROP TABLE messages")
     self._conn.execute("DROP TABLE chats")
     self._conn.execute("ALTER TABLE chats_v4 RENAME TO chats")
@@ -272,47 +988,625 @@ class AppStorage:
       "CREATE INDEX IF NOT EXISTS idx_api_rate_limit_blocks_until ON api_rate_limit_blocks(blocked_until)"
     )
 
+  def _migrate_v7_to_v8_locked(self) -> None:
+    # Хранилище вложений общее и адресуется по sha256: ссылку принимаем только от того,
+    # кто сохранял этот файл сам.
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS attachment_owners (
+        owner_user_id TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY(owner_user_id, sha256)
+      ) WITHOUT ROWID
+      """
+    )
+
+  def _migrate_v8_to_v9_locked(self) -> None:
+    # Внешний content-индекс FTS5 поверх messages: текст не дублируется, синхронизация — триггерами.
+    created = False
+    for tokenizer in self.MESSAGE_SEARCH_FTS_TOKENIZERS:
+      try:
+        self._conn.execute(
+          f"""
+          CREATE VIRTUAL TABLE IF NOT EXISTS {self.MESSAGE_SEARCH_FTS_TABLE}
+          USING fts5(text, content='messages', content_rowid='id', tokenize='{tokenizer}')
+          """
+        )
+        created = True
+        break
+      except sqlite3.OperationalError:
+        continue
+    if not created:
+      # Сборка SQLite без FTS5: поиск останется на LIKE.
+      return
+    self._conn.execute(
+      f"""
+      CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO {self.MESSAGE_SEARCH_FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+      END
+      """
+    )
+    self._conn.execute(
+      f"""
+      CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO {self.MESSAGE_SEARCH_FTS_TABLE}({self.MESSAGE_SEARCH_FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+      END
+      """
+    )
+    self._conn.execute(
+      f"""
+      CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO {self.MESSAGE_SEARCH_FTS_TABLE}({self.MESSAGE_SEARCH_FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO {self.MESSAGE_SEARCH_FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+      END
+      """
+    )
+    # Вместо 'rebuild' одним запросом индекс наполняется пачками по id: прерванная миграция
+    # продолжится с курсора, а не начнёт заново (повторная вставка того же rowid испортила бы индекс).
+
+    def index_messages(cursor: int) -> tuple[int, int]:
+      last_id, count = self._rowid_batch_bounds_locked("messages", "id", cursor)
+      if count:
+        self._conn.execute(
+          f"""
+          INSERT INTO {self.MESSAGE_SEARCH_FTS_TABLE}(rowid, text)
+          SELECT id, text FROM messages WHERE id > ? AND id <= ?
+          """,
+          (cursor, last_id),
+        )
+      return last_id, count
+
+    self._run_migration_batches_locked(9, "fts_index", index_messages, total=self._count_rows_locked("messages"))
+
+  def _detect_message_search_tokenizer(self) -> str:
+    with self._lock:
+      row = self._conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type='table' AND name=?",
+        (self.MESSAGE_SEARCH_FTS_TABLE,),
+      ).fetchone()
+    if row is None:
+      return ""
+    sql = str(row["sql"] or "").lower()
+    return "trigram" if "trigram" in sql else "unicode61"
+
+  def _migrate_v9_to_v10_locked(self) -> None:
+    # Лимитер запросов живёт в памяти (GCRA): вместо строки на каждое обращение храним
+    # по одной строке состояния на ключ. Действующие блокировки переносим, журнал обращений удаляем.
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS api_rate_limit_state (
+        scope TEXT PRIMARY KEY,
+        tat REAL NOT NULL DEFAULT 0,
+        blocked_until REAL NOT NULL DEFAULT 0,
+        updated_at REAL NOT NULL
+      )
+      """
+    )
+    self._conn.execute(
+      """
+      INSERT OR REPLACE INTO api_rate_limit_state(scope, tat, blocked_until, updated_at)
+      SELECT scope, 0, blocked_until, updated_at
+      FROM api_rate_limit_blocks
+      WHERE blocked_until > ?
+      """,
+      (time.time(),),
+    )
+    self._conn.execute("DROP TABLE IF EXISTS api_rate_limit_hits")
+    self._conn.execute("DROP TABLE IF EXISTS api_rate_limit_blocks")
+
+  def _migrate_v10_to_v11_locked(self) -> None:
+    # Переход на auto_vacuum=INCREMENTAL требует полной перестройки файла (VACUUM), поэтому
+    # при миграции его не делаем: новая база получает режим при открытии, существующая —
+    # по желанию через обслуживание (enable_incremental_auto_vacuum). Шаг оставлен ради нумерации.
+    return
+
+  def _migrate_v11_to_v12_locked(self) -> None:
+    # Сжимаем только meta_json: text читает внешний FTS-индекс (content='messages'),
+    # ему нужен исходный текст в таблице.
+    columns = {str(row["name"]) for row in self._conn.execute("PRAGMA table_info(messages)").fetchall()}
+    if "meta_codec" not in columns:
+      self._conn.execute("ALTER TABLE messages ADD COLUMN meta_codec INTEGER NOT NULL DEFAULT 0")
+    if self._compress_min_bytes <= 0:
+      return
+
+    def compress_meta(cursor: int) -> tuple[int, int]:
+      rows = self._conn.execute(
+        """
+        SELECT id, meta_json
+        FROM messages
+        WHERE id > ? AND meta_codec = 0 AND length(CAST(meta_json AS BLOB)) >= ?
+        ORDER BY id ASC
+        LIMIT ?
+        """,
+        (cursor, self._compress_min_bytes, self.META_COMPRESS_MIGRATION_BATCH_SIZE),
+      ).fetchall()
+      if not rows:
+        return cursor, 0
+      updates = []
+      for row in rows:
+        value, codec = encode_text(str(row["meta_json"] or "{}"), min_bytes=self._compress_min_bytes)
+        if codec != CODEC_PLAIN:
+          updates.append((value, codec, int(row["id"])))
+      if updates:
+        self._conn.executemany("UPDATE messages SET meta_json=?, meta_codec=? WHERE id=?", updates)
+      return int(rows[-1]["id"]), len(rows)
+
+    total = int(
+      self._conn.execute(
+        "SELECT COUNT(*) FROM messages WHERE meta_codec = 0 AND length(CAST(meta_json AS BLOB)) >= ?",
+        (self._compress_min_bytes,),
+      ).fetchone()[0]
+    )
+    self._run_migration_batches_locked(12, "compress_meta", compress_meta, total=total)
+
+  def _migrate_v12_to_v13_locked(self) -> None:
+    # Полезная нагрузка инструментов (tool_args/tool_output) — в отдельной таблице: история
+    # читает и распаковывает только короткую meta, полный вывод отдаётся по запросу.
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS message_tool_payloads (
+        message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+        payload_json BLOB NOT NULL,
+        payload_codec INTEGER NOT NULL DEFAULT 0,
+        args_bytes INTEGER NOT NULL DEFAULT 0,
+        output_bytes INTEGER NOT NULL DEFAULT 0
+      )
+      """
+    )
+
+    def split_payloads(cursor: int) -> tuple[int, int]:
+      rows = self._conn.execute(
+        """
+        SELECT id, meta_json, meta_codec
+        FROM messages
+        WHERE id > ? AND role = 'tool'
+        ORDER BY id ASC
+        LIMIT ?
+        """,
+        (cursor, self.META_COMPRESS_MIGRATION_BATCH_SIZE),
+      ).fetchall()
+      if not rows:
+        return cursor, 0
+      for row in rows:
+        meta_value, meta_codec, tool_payload = self._prepare_message_meta(
+          self._decode_meta(row["meta_json"], row["meta_codec"])
+        )
+        if tool_payload is None:
+          continue
+        self._conn.execute(
+          "UPDATE messages SET meta_json=?, meta_codec=? WHERE id=?",
+          (meta_value, meta_codec, int(row["id"])),
+        )
+        self._store_tool_payload_locked(int(row["id"]), tool_payload)
+      return int(rows[-1]["id"]), len(rows)
+
+    total = int(self._conn.execute("SELECT COUNT(*) FROM messages WHERE role = 'tool'").fetchone()[0])
+    self._run_migration_batches_locked(13, "split_tool_payloads", split_payloads, total=total)
+
+  def _migrate_v13_to_v14_locked(self) -> None:
+    # Счётчики ревизий для ETag: общий на владельца (список чатов) и у каждого чата (история).
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS chat_store_revisions (
+        owner_user_id TEXT PRIMARY KEY,
+        revision INTEGER NOT NULL DEFAULT 0
+      )
+      """
+    )
+    columns = {str(row["name"]) for row in self._conn.execute("PRAGMA table_info(chats)").fetchall()}
+    if "revision" not in columns:
+      self._conn.execute("ALTER TABLE chats ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+    initial_revision = self._next_revision_floor()
+    self._conn.execute("UPDATE chats SET revision=?", (initial_revision,))
+    self._conn.execute(
+      """
+      INSERT OR IGNORE INTO chat_store_revisions(owner_user_id, revision)
+      SELECT DISTINCT owner_user_id, ? FROM chats
+      """,
+      (initial_revision,),
+    )
+
+  def _migrate_v14_to_v15_locked(self) -> None:
+    # Журнал изменений чатов для дельта-синхронизации (/chats/changes). Пишется в той же
+    # транзакции, что и сама запись; AUTOINCREMENT не даёт переиспользовать seq после очистки.
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS chat_change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_user_id TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        message_id INTEGER,
+        op TEXT NOT NULL,
+        created_at TEXT NOT NULL
+      )
+      """
+    )
+    self._conn.execute(
+      "CREATE INDEX IF NOT EXISTS idx_chat_change_log_owner_seq ON chat_change_log(owner_user_id, seq)"
+    )
+    # Всё, что не старше change_floor_seq, из журнала уже удалено: клиенту с since ниже нужна полная загрузка.
+    columns = {str(row["name"]) for row in self._conn.execute("PRAGMA table_info(chat_store_revisions)").fetchall()}
+    if "change_floor_seq" not in columns:
+      self._conn.execute("ALTER TABLE chat_store_revisions ADD COLUMN change_floor_seq INTEGER NOT NULL DEFAULT 0")
+
+  def _migrate_v15_to_v16_locked(self) -> None:
+    # Аудит по партициям: вставка и выборка касаются только таблиц свежих периодов,
+    # старые периоды целиком уходят в архив, а счётчики для дашборда — в audit_rollups.
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS audit_partitions (
+        name TEXT PRIMARY KEY,
+        period_start TEXT NOT NULL,
+        period_end TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        archived_at TEXT NOT NULL DEFAULT '',
+        archive_path TEXT NOT NULL DEFAULT '',
+        archived_rows INTEGER NOT NULL DEFAULT 0
+      )
+      """
+    )
+    # Идентификаторы сквозные для всех партиций, чтобы id события не зависел от периода.
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS audit_event_sequence (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+      )
+      """
+    )
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS audit_rollups (
+        day TEXT NOT NULL,
+        action TEXT NOT NULL,
+        actor_user_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        events INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(day, action, actor_user_id, status)
+      ) WITHOUT ROWID
+      """
+    )
+    row = self._conn.execute("SELECT type FROM sqlite_master WHERE name='audit_events'").fetchone()
+    if row is not None and str(row["type"]) == "table":
+      self._conn.execute("ALTER TABLE audit_events RENAME TO audit_events_legacy")
+    legacy = self._conn.execute(
+      "SELECT 1 FROM sqlite_master WHERE type='table' AND name='audit_events_legacy'"
+    ).fetchone()
+    if legacy is None:
+      self._conn.execute("INSERT OR IGNORE INTO audit_event_sequence(name, value) VALUES ('audit_events', 0)")
+      self._rebuild_audit_view_locked()
+      return
+    self._conn.execute(
+      """
+      INSERT OR IGNORE INTO audit_event_sequence(name, value)
+      SELECT 'audit_events', COALESCE(MAX(id), 0) FROM audit_events_legacy
+      """
+    )
+    columns_sql = ", ".join(self.AUDIT_EVENT_COLUMNS)
+    placeholders = ", ".join("?" for _ in self.AUDIT_EVENT_COLUMNS)
+
+    def move_events(cursor: int) -> tuple[int, int]:
+      rows = self._conn.execute(
+        f"SELECT {columns_sql} FROM audit_events_legacy WHERE id > ? ORDER BY id ASC LIMIT ?",
+        (cursor, self.MIGRATION_BATCH_SIZE),
+      ).fetchall()
+      if not rows:
+        return cursor, 0
+      by_partition: dict[str, list[tuple[Any, ...]]] = {}
+      rollups: dict[tuple[str, str, str, str], int] = {}
+      for row in rows:
+        moment = self._parse_audit_moment(str(row["created_at"] or ""))
+        name = self._audit_partition_for_locked(moment)
+        by_partition.setdefault(name, []).append(tuple(row[column] for column in self.AUDIT_EVENT_COLUMNS))
+        key = (moment.date().isoformat(), str(row["action"] or ""), str(row["actor_user_id"] or ""), str(row["status"] or "ok"))
+        rollups[key] = rollups.get(key, 0) + 1
+      for name, values in by_partition.items():
+        self._conn.executemany(f"INSERT OR IGNORE INTO {name}({columns_sql}) VALUES({placeholders})", values)
+      for (day, action, actor_user_id, status), events in rollups.items():
+        self._bump_audit_rollup_locked(day, action, actor_user_id, status, events)
+      return int(rows[-1]["id"]), len(rows)
+
+    self._run_migration_batches_locked(
+      16,
+      "partition_audit_events",
+      move_events,
+      total=self._count_rows_locked("audit_events_legacy"),
+    )
+    if not self._conn.in_transaction:
+      self._conn.execute("BEGIN IMMEDIATE")
+    self._conn.execute("DROP TABLE audit_events_legacy")
+    self._rebuild_audit_view_locked()
+
+  def _create_migration_state_locked(self) -> None:
+    self._conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS schema_migration_state (
+        version INTEGER NOT NULL,
+        step TEXT NOT NULL,
+        cursor INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY(version, step)
+      )
+      """
+    )
+
+  def _count_rows_locked(self, table: str) -> int:
+    row = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+    return int(row[0]) if row else 0
+
+  def _rowid_batch_bounds_locked(self, table: str, key: str, cursor: int) -> tuple[int, int]:
+    """Граница следующей пачки по возрастающему ключу: (последний ключ, строк в пачке)."""
+    row = self._conn.execute(
+      f"""
+      SELECT MAX({key}) AS last_key, COUNT(*) AS total
+      FROM (SELECT {key} FROM {table} WHERE {key} > ? ORDER BY {key} ASC LIMIT ?)
+      """,
+      (int(cursor), self.MIGRATION_BATCH_SIZE),
+    ).fetchone()
+    count = int(row["total"] or 0) if row else 0
+    return (int(row["last_key"]) if count else int(cursor)), count
+
+  def _run_migration_batches_locked(
+    self,
+    version: int,
+    step: str,
+    batch_fn: Callable[[int], tuple[int, int]],
+    *,
+    total: int,
+  ) -> None:
+    """Выполняет шаг миграции пачками. batch_fn(cursor) -> (новый cursor, обработано строк); 0 — шаг завершён.
+
+    Каждая пачка фиксируется вместе с курсором в schema_migration_state: после остановки
+    процесса шаг продолжается с места остановки, а не с начала.
+    """
+    row = self._conn.execute(
+      "SELECT cursor, done FROM schema_migration_state WHERE version=? AND step=?",
+      (version, step),
+    ).fetchone()
+    cursor = int(row["cursor"]) if row else 0
+    done = int(row["done"]) if row else 0
+    self._migration_progress.update(step=step, done=done, total=max(total, done))
+    while True:
+      next_cursor, processed = batch_fn(cursor)
+      if processed <= 0:
+        break
+      cursor = next_cursor
+      done += processed
+      self._conn.execute(
+        """
+        INSERT INTO schema_migration_state(version, step, cursor, done, total, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(version, step) DO UPDATE SET
+          cursor=excluded.cursor,
+          done=excluded.done,
+          total=excluded.total,
+          updated_at=excluded.updated_at
+        """,
+        (version, step, cursor, done, max(total, done), utc_now_iso()),
+      )
+      self._conn.commit()
+      self._migration_progress.update(done=done, total=max(total, done))
+
+  def _apply_migration_locked(self, next_version: int) -> None:
+    if next_version == 2:
+      self._migrate_v1_to_v2_locked()
+    elif next_version == 3:
+      self._migrate_v2_to_v3_locked()
+    elif next_version == 4:
+      self._migrate_v3_to_v4_locked()
+    elif next_version == 5:
+      self._migrate_v4_to_v5_locked()
+    elif next_version == 6:
+      self._migrate_v5_to_v6_locked()
+    elif next_version == 7:
+      self._migrate_v6_to_v7_locked()
+    elif next_version == 8:
+      self._migrate_v7_to_v8_locked()
+    elif next_version == 9:
+      self._migrate_v8_to_v9_locked()
+    elif next_version == 10:
+      self._migrate_v9_to_v10_locked()
+    elif next_version == 11:
+      self._migrate_v10_to_v11_locked()
+    elif next_version == 12:
+      self._migrate_v11_to_v12_locked()
+    elif next_version == 13:
+      self._migrate_v12_to_v13_locked()
+    elif next_version == 14:
+      self._migrate_v13_to_v14_locked()
+    elif next_version == 15:
+      self._migrate_v14_to_v15_locked()
+    elif next_version == 16:
+      self._migrate_v15_to_v16_locked()
+    else:
+      raise RuntimeError(f"Unknown schema migration step: {next_version - 1} -> {next_version}")
+
   def _migrate_schema(self) -> None:
-    with self._lock, self._conn:
-      current_version = self._get_schema_version_locked()
-      if current_version == 0:
-        self._create_schema_v1_locked()
-        self._set_schema_version_locked(self.BASE_SCHEMA_VERSION)
-        current_version = self.BASE_SCHEMA_VERSION
+    with self._lock:
+      with self._conn:
+        current_version = self._get_schema_version_locked()
+        if current_version == 0:
+          self._create_schema_v1_locked()
+          self._set_schema_version_locked(self.BASE_SCHEMA_VERSION)
+          current_version = self.BASE_SCHEMA_VERSION
 
       if current_version > self.LATEST_SCHEMA_VERSION:
         raise RuntimeError(
           f"Database schema version {current_version} is newer than supported "
           f"{self.LATEST_SCHEMA_VERSION}. Update the application."
         )
+      if current_version == self.LATEST_SCHEMA_VERSION:
+        return
 
-      while current_version < self.LATEST_SCHEMA_VERSION:
-        next_version = current_version + 1
-        if next_version == 2:
-          self._migrate_v1_to_v2_locked()
-        elif next_version == 3:
-          self._migrate_v2_to_v3_locked()
-        elif next_version == 4:
-          self._migrate_v3_to_v4_locked()
-        elif next_version == 5:
-          self._migrate_v4_to_v5_locked()
-        elif next_version == 6:
-          self._migrate_v5_to_v6_locked()
-        elif next_version == 7:
-          self._migrate_v6_to_v7_locked()
-        else:
-          raise RuntimeError(f"Unknown schema migration step: {current_version} -> {next_version}")
-        self._set_schema_version_locked(next_version)
-        current_version = next_version
+      # Каждая версия — своя транзакция с user_version; пакетные шаги коммитят промежуточно
+      # и помнят курсор, поэтому прерванная миграция продолжается с последней пачки.
+      self._create_migration_state_locked()
+      self._migration_progress.start(current_version, self.LATEST_SCHEMA_VERSION)
+      try:
+        while current_version < self.LATEST_SCHEMA_VERSION:
+          next_version = current_version + 1
+          self._migration_progress.update(version=next_version, step="", done=0, total=0)
+          with self._conn:
+            self._apply_migration_locked(next_version)
+            self._conn.execute("DELETE FROM schema_migration_state WHERE version=?", (next_version,))
+            self._set_schema_version_locked(next_version)
+          current_version = next_version
+      except Exception as exc:
+        self._migration_progress.finish(error=str(exc) or exc.__class__.__name__)
+        raise
+      self._migration_progress.finish()
+
+  def get_migration_progress(self) -> dict[str, Any]:
+    return self._migration_progress.snapshot()
 
   @staticmethod
-  def _decode_meta(meta_json: str | None) -> dict[str, Any]:
+  def _decode_meta(meta_json: str | bytes | None, meta_codec: int | None = CODEC_PLAIN) -> dict[str, Any]:
     try:
-      payload = json.loads(meta_json or "{}")
+      payload = json.loads(decode_text(meta_json, meta_codec) or "{}")
       return payload if isinstance(payload, dict) else {}
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, zlib.error, ValueError):
       return {}
 
+  def _encode_meta(self, meta: dict[str, Any] | None) -> tuple[str | bytes, int]:
+    return encode_text(json.dumps(meta or {}, ensure_ascii=False), min_bytes=self._compress_min_bytes)
+
+  @classmethod
+  def _tool_args_preview(cls, args: Any) -> dict[str, Any]:
+    # Карточке инструмента в свёрнутом виде хватает скалярных аргументов (url, query).
+    if not isinstance(args, dict):
+      return {}
+    limit = cls.TOOL_ARGS_PREVIEW_MAX_CHARS
+    preview: dict[str, Any] = {}
+    for key, value in args.items():
+      if isinstance(value, str):
+        preview[str(key)] = value if len(value) <= limit else f"{value[:limit]}…"
+      elif value is None or isinstance(value, (bool, int, float)):
+        preview[str(key)] = value
+    return preview
+
+  def _prepare_message_meta(
+    self,
+    meta: dict[str, Any] | None,
+  ) -> tuple[str | bytes, int, tuple[str | bytes, int, int, int] | None]:
+    """Кодирует meta для messages; tool_args/tool_output выносятся в отдельную запись."""
+    safe_meta = dict(meta) if isinstance(meta, dict) else {}
+    if not any(key in safe_meta for keys in self.TOOL_PAYLOAD_META_KEYS for key in keys):
+      meta_value, meta_codec = self._encode_meta(safe_meta)
+      return meta_value, meta_codec, None
+    extracted: dict[str, Any] = {}
+    for key, alias in self.TOOL_PAYLOAD_META_KEYS:
+      value = safe_meta.pop(key, None)
+      alias_value = safe_meta.pop(alias, None)
+      extracted[key] = value if value is not None else (alias_value if alias_value is not None else {})
+    args_bytes = len(json.dumps(extracted["tool_args"], ensure_ascii=False).encode("utf-8"))
+    output_bytes = len(json.dumps(extracted["tool_output"], ensure_ascii=False).encode("utf-8"))
+    payload_value, payload_codec = encode_text(
+      json.dumps(extracted, ensure_ascii=False),
+      min_bytes=self._compress_min_bytes,
+    )
+    safe_meta["tool_args"] = self._tool_args_preview(extracted["tool_args"])
+    safe_meta["tool_payload"] = {"stored": True, "args_bytes": args_bytes, "output_bytes": output_bytes}
+    meta_value, meta_codec = self._encode_meta(safe_meta)
+    return meta_value, meta_codec, (payload_value, payload_codec, args_bytes, output_bytes)
+
+  def _store_tool_payload_locked(
+    self,
+    message_pk: int,
+    tool_payload: tuple[str | bytes, int, int, int] | None,
+  ) -> None:
+    if tool_payload is None:
+      self._conn.execute("DELETE FROM message_tool_payloads WHERE message_id=?", (message_pk,))
+      return
+    self._conn.execute(
+      """
+      INSERT INTO message_tool_payloads(message_id, payload_json, payload_codec, args_bytes, output_bytes)
+      VALUES(?, ?, ?, ?, ?)
+      ON CONFLICT(message_id)
+      DO UPDATE SET
+        payload_json=excluded.payload_json,
+        payload_codec=excluded.payload_codec,
+        args_bytes=excluded.args_bytes,
+        output_bytes=excluded.output_bytes
+      """,
+      (message_pk, *tool_payload),
+    )
+
+  @classmethod
+  def _decode_tool_payload_row(cls, row: sqlite3.Row) -> dict[str, Any]:
+    payload = cls._decode_meta(row["payload_json"], row["payload_codec"])
+    return {
+      "tool_args": payload.get("tool_args", {}),
+      "tool_output": payload.get("tool_output", {}),
+      "args_bytes": int(row["args_bytes"] or 0),
+      "output_bytes": int(row["output_bytes"] or 0),
+    }
+
+  def _attach_tool_payloads(self, conn: sqlite3.Connection, messages: list[dict[str, Any]]) -> None:
+    """Возвращает в meta полные tool_args/tool_output (экспорт должен оставаться полным)."""
+    by_pk: dict[int, dict[str, Any]] = {}
+    for message in messages:
+      meta = message.get("meta")
+      if isinstance(meta, dict) and isinstance(meta.get("tool_payload"), dict):
+        try:
+          by_pk[self._normalize_message_pk(message.get("id") or "")] = meta
+        except (TypeError, ValueError):
+          continue
+    pks = list(by_pk)
+    for start in range(0, len(pks), self.TOOL_PAYLOAD_FETCH_BATCH_SIZE):
+      chunk = pks[start:start + self.TOOL_PAYLOAD_FETCH_BATCH_SIZE]
+      rows = conn.execute(
+        f"""
+        SELECT message_id, payload_json, payload_codec, args_bytes, output_bytes
+        FROM message_tool_payloads
+        WHERE message_id IN ({', '.join('?' for _ in chunk)})
+        """,
+        tuple(chunk),
+      ).fetchall()
+      for row in rows:
+        meta = by_pk[int(row["message_id"])]
+        payload = self._decode_tool_payload_row(row)
+        meta.pop("tool_payload", None)
+        meta["tool_args"] = payload["tool_args"]
+        meta["tool_output"] = payload["tool_output"]
+
+  def get_message_tool_payload(
+    self,
+    chat_id: str,
+    message_id: str,
+    *,
+    owner_user_id: str = "",
+  ) -> dict[str, Any] | None:
+    safe_chat_id = str(chat_id or "").strip()
+    if not safe_chat_id:
+      return None
+    try:
+      message_pk = self._normalize_message_pk(message_id)
+    except (TypeError, ValueError):
+      return None
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    with self._read() as conn:
+      row = conn.execute(
+        """
+        SELECT p.payload_json, p.payload_codec, p.args_bytes, p.output_bytes
+        FROM message_tool_payloads p
+        JOIN messages m ON m.id = p.message_id
+        WHERE p.message_id=? AND m.owner_user_id=? AND m.chat_id=?
+        """,
+        (message_pk, safe_owner, safe_chat_id),
+      ).fetchone()
+    if row is None:
+      return None
+    return {
+      "chat_id": safe_chat_id,
+      "message_id": f"msg-{message_pk}",
+      **self._decode_tool_payload_row(row),
+    }
+
   @staticmethod
   def _normalize_message_pk(message_id: str | int) -> int:
     raw = str(message_id or "").strip().lower()
@@ -330,7 +1624,7 @@ class AppStorage:
   @classmethod
   def _serialize_message_row(cls, row: sqlite3.Row | dict[str, Any]) -> dict[str, Any]:
     payload = dict(row)
-    meta = cls._decode_meta(payload.get("meta_json"))
+    meta = cls._decode_meta(payload.get("meta_json"), payload.get("meta_codec"))
     meta_suffix = str(meta.get("meta_suffix") or meta.get("metaSuffix") or "").strip()
     return {
       "id": f"msg-{payload['id']}",
@@ -363,41 +1657,364 @@ class AppStorage:
       return safe_role
     return default
 
-  @staticmethod
-  def _build_search_snippet(text: str, query: str, max_chars: int = 220) -> str:
-    safe_text = str(text or "").replace("\r\n", "\n").replace("\r", "\n").strip()
-    if not safe_text:
-      return ""
-    compact = " ".join(safe_text.split())
-    if not query:
-      return compact[:max_chars] + ("…" if len(compact) > max_chars else "")
-    lower_text = compact.lower()
-    lower_query = str(query or "").strip().lower()
-    index = lower_text.find(lower_query)
-    if index < 0:
-      return compact[:max_chars] + ("…" if len(compact) > max_chars else "")
-    half = max_chars // 2
-    start = max(0, index - half)
-    end = min(len(compact), start + max_chars)
-    if end - start < max_chars:
-      start = max(0, end - max_chars)
-    snippet = compact[start:end].strip()
-    if start > 0:
-      snippet = f"…{snippet}"
-    if end < len(compact):
-      snippet = f"{snippet}…"
-    return snippet
+  @staticmethod
+  def _build_search_snippet(text: str, query: str, max_chars: int = 220) -> str:
+    safe_text = str(text or "").replace("\r\n", "\n").replace("\r", "\n").strip()
+    if not safe_text:
+      return ""
+    compact = " ".join(safe_text.split())
+    if not query:
+      return compact[:max_chars] + ("…" if len(compact) > max_chars else "")
+    lower_text = compact.lower()
+    lower_query = str(query or "").strip().lower()
+    index = lower_text.find(lower_query)
+    if index < 0:
+      return compact[:max_chars] + ("…" if len(compact) > max_chars else "")
+    half = max_chars // 2
+    start = max(0, index - half)
+    end = min(len(compact), start + max_chars)
+    if end - start < max_chars:
+      start = max(0, end - max_chars)
+    snippet = compact[start:end].strip()
+    if start > 0:
+      snippet = f"…{snippet}"
+    if end < len(compact):
+      snippet = f"{snippet}…"
+    return snippet
+
+  def _generate_chat_id_locked(self, owner_user_id: str) -> str:
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    while True:
+      candidate = f"chat-{uuid.uuid4().hex[:12]}"
+      exists = self._conn.execute(
+        "SELECT 1 FROM chats WHERE owner_user_id=? AND id=?",
+        (safe_owner, candidate),
+      ).fetchone()
+      if not exists:
+        return candidate
+
+  @staticmethod
+  def _next_revision_floor() -> int:
+    # Ревизия не меньше текущего времени в мс: после пересоздания базы старые ETag не совпадут.
+    return int(time.time() * 1000)
+
+  def _bump_chat_revision_locked(self, owner_user_id: str, chat_ids: Iterable[str] = ()) -> int:
+    """Увеличивает ревизию владельца и помечает ею изменённые чаты; вызывается внутри транзакции записи."""
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    self._conn.execute(
+      """
+      INSERT INTO chat_store_revisions(owner_user_id, revision)
+      VALUES(?, ?)
+      ON CONFLICT(owner_user_id) DO UPDATE SET revision=MAX(chat_store_revisions.revision + 1, excluded.revision)
+      """,
+      (safe_owner, self._next_revision_floor()),
+    )
+    row = self._conn.execute(
+      "SELECT revision FROM chat_store_revisions WHERE owner_user_id=?",
+      (safe_owner,),
+    ).fetchone()
+    revision = int(row["revision"] if row else 0)
+    safe_chat_ids = sorted({str(chat_id or "").strip() for chat_id in chat_ids} - {""})
+    for offset in range(0, len(safe_chat_ids), 500):
+      chunk = safe_chat_ids[offset:offset + 500]
+      placeholders = ", ".join("?" for _ in chunk)
+      self._conn.execute(
+        f"UPDATE chats SET revision=? WHERE owner_user_id=? AND id IN ({placeholders})",
+        (revision, safe_owner, *chunk),
+      )
+    return revision
+
+  def _bump_all_chat_revisions_locked(self) -> None:
+    self._conn.execute(
+      "UPDATE chat_store_revisions SET revision=MAX(revision + 1, ?)",
+      (self._next_revision_floor(),),
+    )
+
+  def _record_chat_changes_locked(
+    self,
+    owner_user_id: str,
+    changes: Iterable[tuple[str, int | None, str]],
+  ) -> int:
+    """Пишет (chat_id, message_pk|None, op) в журнал изменений и поднимает ревизии затронутых чатов.
+
+    op: upsert/delete для чата или сообщения; reload — список сообщений чата заменён целиком
+    (очистка, копирование, импорт) и клиенту проще перечитать чат.
+    """
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    now = utc_now_iso()
+    rows = [
+      (safe_owner, str(chat_id or "").strip(), message_pk, op, now)
+      for chat_id, message_pk, op in changes
+      if str(chat_id or "").strip()
+    ]
+    if rows:
+      self._conn.executemany(
+        """
+        INSERT INTO chat_change_log(owner_user_id, chat_id, message_id, op, created_at)
+        VALUES(?, ?, ?, ?, ?)
+        """,
+        rows,
+      )
+    return self._bump_chat_revision_locked(safe_owner, (row[1] for row in rows))
+
+  def _reset_chat_change_log_locked(self, owner_user_id: str | None) -> None:
+    """Отмечает в журнале полную перезапись чатов владельца (None — всех владельцев).
+
+    Маркер reset становится новым change_floor_seq: клиенты с более старым since получат reset
+    и перезагрузят список чатов целиком.
+    """
+    now = utc_now_iso()
+    if owner_user_id is None:
+      self._conn.execute("DELETE FROM chat_change_log")
+      self._conn.execute(
+        """
+        INSERT INTO chat_change_log(owner_user_id, chat_id, message_id, op, created_at)
+        SELECT owner_user_id, '', NULL, 'reset', ? FROM chat_store_revisions
+        """,
+        (now,),
+      )
+      self._conn.execute(
+        """
+        UPDATE chat_store_revisions
+        SET change_floor_seq=COALESCE(
+          (SELECT MAX(seq) FROM chat_change_log l WHERE l.owner_user_id = chat_store_revisions.owner_user_id),
+          change_floor_seq
+        )
+        """
+      )
+      return
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    self._bump_chat_revision_locked(safe_owner)
+    cursor = self._conn.execute(
+      """
+      INSERT INTO chat_change_log(owner_user_id, chat_id, message_id, op, created_at)
+      VALUES(?, '', NULL, 'reset', ?)
+      """,
+      (safe_owner, now),
+    )
+    self._conn.execute(
+      "UPDATE chat_store_revisions SET change_floor_seq=? WHERE owner_user_id=?",
+      (int(cursor.lastrowid or 0), safe_owner),
+    )
+
+  @staticmethod
+  def _read_change_log_bounds(conn: sqlite3.Connection, owner_user_id: str) -> tuple[int, int]:
+    floor_row = conn.execute(
+      "SELECT change_floor_seq FROM chat_store_revisions WHERE owner_user_id=?",
+      (owner_user_id,),
+    ).fetchone()
+    floor_seq = int(floor_row["change_floor_seq"] or 0) if floor_row else 0
+    latest_row = conn.execute(
+      "SELECT MAX(seq) AS seq FROM chat_change_log WHERE owner_user_id=?",
+      (owner_user_id,),
+    ).fetchone()
+    latest_seq = max(floor_seq, int(latest_row["seq"] or 0) if latest_row else 0)
+    return floor_seq, latest_seq
+
+  def get_chat_change_seq(self, *, owner_user_id: str = "") -> int:
+    """Последний seq журнала владельца — отправная точка для /chats/changes после полной загрузки."""
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    with self._read() as conn:
+      return self._read_change_log_bounds(conn, safe_owner)[1]
+
+  def get_chat_changes(self, since: int, *, owner_user_id: str = "", limit: int | None = None) -> dict[str, Any]:
+    """Изменения чатов владельца после since: актуальное состояние затронутых чатов и сообщений.
+
+    Несколько записей об одном объекте сворачиваются в одну; исчезнувшие объекты попадают в deletes.
+    reset=True — since старше сжатого журнала (или из другой базы), нужна полная загрузка /chats.
+    """
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    safe_since = int(since)
+    safe_limit = max(1, min(self.CHANGE_LOG_PAGE_MAX_LIMIT, int(limit or self.CHANGE_LOG_PAGE_DEFAULT_LIMIT)))
+    result: dict[str, Any] = {
+      "since": safe_since,
+      "seq": safe_since,
+      "reset": False,
+      "has_more": False,
+      "chats": {"upserts": [], "deletes": [], "reloaded": []},
+      "messages": {"upserts": [], "deletes": []},
+    }
+
+    with self._read() as conn:
+      floor_seq, latest_seq = self._read_change_log_bounds(conn, safe_owner)
+      if safe_since < 0 or safe_since < floor_seq or safe_since > latest_seq:
+        result["seq"] = latest_seq
+        result["reset"] = True
+        return result
+
+      rows = conn.execute(
+        """
+        SELECT seq, chat_id, message_id, op
+        FROM chat_change_log
+        WHERE owner_user_id=? AND seq > ?
+        ORDER BY seq ASC
+        LIMIT ?
+        """,
+        (safe_owner, safe_since, safe_limit + 1),
+      ).fetchall()
+      has_more = len(rows) > safe_limit
+      rows = rows[:safe_limit]
+      result["has_more"] = has_more
+      result["seq"] = int(rows[-1]["seq"]) if has_more else latest_seq
+
+      touched_chat_ids: set[str] = set()
+      reloaded_chat_ids: set[str] = set()
+      touched_messages: dict[int, str] = {}
+      for row in rows:
+        chat_id = str(row["chat_id"] or "")
+        if not chat_id:
+          continue
+        touched_chat_ids.add(chat_id)
+        if row["message_id"] is not None:
+          touched_messages[int(row["message_id"])] = chat_id
+        elif str(row["op"]) == "reload":
+          reloaded_chat_ids.add(chat_id)
+
+      chat_rows: dict[str, sqlite3.Row] = {}
+      sorted_chat_ids = sorted(touched_chat_ids)
+      for offset in range(0, len(sorted_chat_ids), 500):
+        chunk = sorted_chat_ids[offset:offset + 500]
+        placeholders = ", ".join("?" for _ in chunk)
+        for chat_row in conn.execute(
+          f"""
+          SELECT id, title, mood, created_at, updated_at
+          FROM chats
+          WHERE owner_user_id=? AND id IN ({placeholders})
+          """,
+          (safe_owner, *chunk),
+        ).fetchall():
+          chat_rows[str(chat_row["id"])] = chat_row
+
+      message_rows: dict[int, sqlite3.Row] = {}
+      # Сообщения перечитываемых и удалённых чатов клиент получит (или удалит) вместе с чатом.
+      message_pks = sorted(
+        pk for pk, chat_id in touched_messages.items()
+        if chat_id in chat_rows and chat_id not in reloaded_chat_ids
+      )
+      for offset in range(0, len(message_pks), 500):
+        chunk = message_pks[offset:offset + 500]
+        placeholders = ", ".join("?" for _ in chunk)
+        for message_row in conn.execute(
+          f"""
+          SELECT id, chat_id, role, text, meta_json, meta_codec, timestamp
+          FROM messages
+          WHERE owner_user_id=? AND id IN ({placeholders})
+          """,
+          (safe_owner, *chunk),
+        ).fetchall():
+          message_rows[int(message_row["id"])] = message_row
+
+    for chat_id in sorted_chat_ids:
+      chat_row = chat_rows.get(chat_id)
+      if chat_row is None:
+        result["chats"]["deletes"].append(chat_id)
+        continue
+      summary = self._serialize_chat_row(chat_row, [])
+      summary.pop("messages", None)
+      result["chats"]["upserts"].append(summary)
+      if chat_id in reloaded_chat_ids:
+        result["chats"]["reloaded"].append(chat_id)
+    for pk in message_pks:
+      chat_id = touched_messages[pk]
+      message_row = message_rows.get(pk)
+      if message_row is None or str(message_row["chat_id"]) != chat_id:
+        result["messages"]["deletes"].append({"chatId": chat_id, "id": f"msg-{pk}"})
+        continue
+      message = self._serialize_message_row(message_row)
+      message["chatId"] = chat_id
+      result["messages"]["upserts"].append(message)
+    return result
+
+  def compact_chat_change_log(
+    self,
+    *,
+    older_than_iso: str = "",
+    max_rows: int = 0,
+    batch_size: int | None = None,
+  ) -> dict[str, int]:
+    """Сжимает журнал изменений: схлопывает повторы и удаляет старые записи, сдвигая change_floor_seq."""
+    safe_batch_size = max(1, int(batch_size or self.CHANGE_LOG_COMPACT_BATCH_SIZE))
+    with self._lock, self._conn:
+      # Для since между двумя записями об одном объекте достаточно последней: ответ строится по текущему состоянию.
+      coalesced = self._conn.execute(
+        """
+        DELETE FROM chat_change_log
+        WHERE seq NOT IN (
+          SELECT MAX(seq) FROM chat_change_log GROUP BY owner_user_id, chat_id, message_id, op
+        )
+        """
+      ).rowcount
+      cutoff_seq = 0
+      if older_than_iso:
+        row = self._conn.execute(
+          "SELECT MAX(seq) AS seq FROM chat_change_log WHERE created_at < ?",
+          (str(older_than_iso),),
+        ).fetchone()
+        cutoff_seq = int(row["seq"] or 0) if row else 0
+      if max_rows > 0:
+        total = int(self._conn.execute("SELECT COUNT(1) FROM chat_change_log").fetchone()[0] or 0)
+        if total > max_rows:
+          row = self._conn.execute(
+            "SELECT seq FROM chat_change_log ORDER BY seq ASC LIMIT 1 OFFSET ?",
+            (total - max_rows - 1,),
+          ).fetchone()
+          cutoff_seq = max(cutoff_seq, int(row["seq"]) if row else 0)
+
+    pruned = 0
+    while cutoff_seq > 0:
+      with self._lock, self._conn:
+        row = self._conn.execute(
+          """
+          SELECT MAX(seq) AS seq FROM (
+            SELECT seq FROM chat_change_log WHERE seq <= ? ORDER BY seq ASC LIMIT ?
+          )
+          """,
+          (cutoff_seq, safe_batch_size),
+        ).fetchone()
+        bound_seq = int(row["seq"] or 0) if row else 0
+        if bound_seq <= 0:
+          break
+        self._conn.execute(
+          """
+          UPDATE chat_store_revisions
+          SET change_floor_seq=MAX(
+            change_floor_seq,
+            COALESCE(
+              (SELECT MAX(seq) FROM chat_change_log l
+               WHERE l.owner_user_id = chat_store_revisions.owner_user_id AND l.seq <= ?),
+              0
+            )
+          )
+          """,
+          (bound_seq,),
+        )
+        pruned += self._conn.execute("DELETE FROM chat_change_log WHERE seq <= ?", (bound_seq,)).rowcount
+      if bound_seq >= cutoff_seq:
+        break
+    return {"coalesced": max(0, int(coalesced)), "pruned": pruned}
+
+  def get_chat_store_revision(self, *, owner_user_id: str = "") -> int:
+    """Ревизия списка чатов владельца: меняется при любой записи в его чаты и сообщения."""
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    with self._read() as conn:
+      row = conn.execute(
+        "SELECT revision FROM chat_store_revisions WHERE owner_user_id=?",
+        (safe_owner,),
+      ).fetchone()
+    return int(row["revision"]) if row else 0
 
-  def _generate_chat_id_locked(self, owner_user_id: str) -> str:
+  def get_chat_revision(self, chat_id: str, *, owner_user_id: str = "") -> int | None:
+    """Ревизия чата без чтения сообщений; None — чата нет."""
+    safe_chat_id = str(chat_id or "").strip()
+    if not safe_chat_id:
+      return None
     safe_owner = self._normalize_owner_user_id(owner_user_id)
-    while True:
-      candidate = f"chat-{uuid.uuid4().hex[:12]}"
-      exists = self._conn.execute(
-        "SELECT 1 FROM chats WHERE owner_user_id=? AND id=?",
-        (safe_owner, candidate),
+    with self._read() as conn:
+      row = conn.execute(
+        "SELECT revision FROM chats WHERE owner_user_id=? AND id=?",
+        (safe_owner, safe_chat_id),
       ).fetchone()
-      if not exists:
-        return candidate
+    return int(row["revision"]) if row else None
 
   def get_chat(self, chat_id: str, *, owner_user_id: str = "") -> dict[str, Any] | None:
     safe_chat_id = str(chat_id or "").strip()
@@ -405,8 +2022,8 @@ class AppStorage:
       return None
     safe_owner = self._normalize_owner_user_id(owner_user_id)
 
-    with self._lock:
-      row = self._conn.execute(
+    with self._read() as conn:
+      row = conn.execute(
         """
         SELECT id, title, mood, created_at, updated_at
         FROM chats
@@ -418,8 +2035,8 @@ class AppStorage:
 
   def list_chats(self, *, owner_user_id: str = "") -> list[dict[str, Any]]:
     safe_owner = self._normalize_owner_user_id(owner_user_id)
-    with self._lock:
-      rows = self._conn.execute(
+    with self._read() as conn:
+      rows = conn.execute(
         """
         SELECT id, title, mood, created_at, updated_at
         FROM chats
@@ -458,6 +2075,7 @@ class AppStorage:
           """,
           (safe_owner, safe_chat_id, safe_title, safe_mood, now, now),
         )
+        self._record_chat_changes_locked(safe_owner, ((safe_chat_id, None, "upsert"),))
         return
 
       next_mood = safe_mood or str(existing["mood"] or "")
@@ -469,6 +2087,7 @@ class AppStorage:
         """,
         (next_mood, now, safe_owner, safe_chat_id),
       )
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, None, "upsert"),))
 
   def create_chat(
     self,
@@ -502,6 +2121,7 @@ class AppStorage:
         """,
         (safe_owner, safe_chat_id, safe_title, safe_mood, now, now),
       )
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, None, "upsert"),))
 
     return self.get_chat_session(safe_chat_id, owner_user_id=safe_owner)
 
@@ -545,6 +2165,7 @@ class AppStorage:
       )
       if cursor.rowcount <= 0:
         return None
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, None, "upsert"),))
 
     return self.get_chat_session(safe_chat_id, owner_user_id=safe_owner)
 
@@ -563,7 +2184,10 @@ class AppStorage:
         "DELETE FROM chats WHERE owner_user_id=? AND id=?",
         (safe_owner, safe_chat_id),
       )
-      return cursor.rowcount > 0
+      if cursor.rowcount <= 0:
+        return False
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, None, "delete"),))
+      return True
 
   def duplicate_chat(
     self,
@@ -613,7 +2237,7 @@ class AppStorage:
 
       source_messages = self._conn.execute(
         """
-        SELECT role, text, meta_json, timestamp
+        SELECT id, role, text, meta_json, meta_codec, timestamp
         FROM messages
         WHERE owner_user_id=? AND chat_id=?
         ORDER BY id ASC
@@ -622,25 +2246,37 @@ class AppStorage:
       ).fetchall()
 
       for row in source_messages:
-        self._conn.execute(
+        # meta_json копируется как есть, вместе с кодеком — без распаковки и повторного сжатия.
+        cursor = self._conn.execute(
           """
-          INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, timestamp)
-          VALUES(?, ?, ?, ?, ?, ?)
+          INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, meta_codec, timestamp)
+          VALUES(?, ?, ?, ?, ?, ?, ?)
           """,
           (
             safe_owner,
             next_chat_id,
             str(row["role"] or "assistant"),
             str(row["text"] or ""),
-            str(row["meta_json"] or "{}"),
+            row["meta_json"] if row["meta_json"] is not None else "{}",
+            int(row["meta_codec"] or CODEC_PLAIN),
             str(row["timestamp"] or now),
           ),
         )
+        self._conn.execute(
+          """
+          INSERT INTO message_tool_payloads(message_id, payload_json, payload_codec, args_bytes, output_bytes)
+          SELECT ?, payload_json, payload_codec, args_bytes, output_bytes
+          FROM message_tool_payloads
+          WHERE message_id=?
+          """,
+          (int(cursor.lastrowid or 0), int(row["id"])),
+        )
 
       self._conn.execute(
         "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
         (now, safe_owner, next_chat_id),
       )
+      self._record_chat_changes_locked(safe_owner, ((next_chat_id, None, "reload"),))
 
     return self.get_chat_session(next_chat_id, owner_user_id=safe_owner)
 
@@ -656,12 +2292,12 @@ class AppStorage:
       return []
     safe_owner = self._normalize_owner_user_id(owner_user_id)
 
-    with self._lock:
+    with self._read() as conn:
       if limit is not None:
         safe_limit = max(1, int(limit))
-        rows = self._conn.execute(
+        rows = conn.execute(
           """
-          SELECT id, role, text, meta_json, timestamp
+          SELECT id, role, text, meta_json, meta_codec, timestamp
           FROM messages
           WHERE owner_user_id=? AND chat_id=?
           ORDER BY id DESC
@@ -671,9 +2307,9 @@ class AppStorage:
         ).fetchall()
         rows = list(reversed(rows))
       else:
-        rows = self._conn.execute(
+        rows = conn.execute(
           """
-          SELECT id, role, text, meta_json, timestamp
+          SELECT id, role, text, meta_json, meta_codec, timestamp
           FROM messages
           WHERE owner_user_id=? AND chat_id=?
           ORDER BY id ASC
@@ -690,14 +2326,29 @@ class AppStorage:
     messages = self.get_chat_messages(chat_id, owner_user_id=owner_user_id)
     return self._serialize_chat_row(row, messages)
 
-  def list_chat_store(self, *, owner_user_id: str = "") -> dict[str, Any]:
+  def list_chat_store(self, *, owner_user_id: str = "", include_tool_payloads: bool = False) -> dict[str, Any]:
     safe_owner = self._normalize_owner_user_id(owner_user_id)
     rows = self.list_chats(owner_user_id=safe_owner)
+    # Одним запросом вместо get_chat_messages на каждый чат (N+1).
+    messages_by_chat: dict[str, list[dict[str, Any]]] = {}
+    with self._read() as conn:
+      message_rows = conn.execute(
+        """
+        SELECT id, chat_id, role, text, meta_json, meta_codec, timestamp
+        FROM messages
+        WHERE owner_user_id=?
+        ORDER BY id ASC
+        """,
+        (safe_owner,),
+      ).fetchall()
+      for message_row in message_rows:
+        messages_by_chat.setdefault(str(message_row["chat_id"]), []).append(
+          self._serialize_message_row(message_row)
+        )
+      if include_tool_payloads:
+        self._attach_tool_payloads(conn, [message for messages in messages_by_chat.values() for message in messages])
     sessions = [
-      self._serialize_chat_row(
-        row,
-        self.get_chat_messages(str(row["id"]), owner_user_id=safe_owner),
-      )
+      self._serialize_chat_row(row, messages_by_chat.get(str(row["id"]), []))
       for row in rows
     ]
     return {
@@ -706,9 +2357,144 @@ class AppStorage:
       "sessions": sessions,
     }
 
+  @staticmethod
+  def _encode_chat_cursor(updated_at: str, chat_id: str) -> str:
+    raw = json.dumps([str(updated_at or ""), str(chat_id or "")], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+  @staticmethod
+  def _decode_chat_cursor(cursor: str) -> tuple[str, str]:
+    safe_cursor = str(cursor or "").strip()
+    try:
+      padded = safe_cursor + "=" * (-len(safe_cursor) % 4)
+      payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    except (ValueError, UnicodeError, binascii.Error) as exc:
+      raise ValueError("invalid cursor") from exc
+    if (
+      not isinstance(payload, list)
+      or len(payload) != 2
+      or not all(isinstance(item, str) for item in payload)
+    ):
+      raise ValueError("invalid cursor")
+    return payload[0], payload[1]
+
+  def list_chats_page(
+    self,
+    *,
+    owner_user_id: str = "",
+    limit: int = 50,
+    cursor: str = "",
+  ) -> dict[str, Any]:
+    """Страница чатов без тел сообщений; keyset по (updated_at, id) через idx_chats_owner_updated_at."""
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    safe_limit = max(1, min(self.CHAT_PAGE_MAX_LIMIT, int(limit or 50)))
+    keyset_sql = ""
+    params: list[Any] = [safe_owner]
+    if str(cursor or "").strip():
+      cursor_updated_at, cursor_chat_id = self._decode_chat_cursor(cursor)
+      keyset_sql = "AND (c.updated_at, c.id) < (?, ?)"
+      params.extend([cursor_updated_at, cursor_chat_id])
+    params.append(safe_limit + 1)
+
+    with self._read() as conn:
+      rows = conn.execute(
+        f"""
+        SELECT
+          c.id AS id,
+          c.title AS title,
+          c.mood AS mood,
+          c.created_at AS created_at,
+          c.updated_at AS updated_at,
+          (
+            SELECT COUNT(1) FROM messages m
+            WHERE m.owner_user_id = c.owner_user_id AND m.chat_id = c.id
+          ) AS message_count
+        FROM chats c
+        WHERE c.owner_user_id=?
+          {keyset_sql}
+        ORDER BY c.updated_at DESC, c.id DESC
+        LIMIT ?
+        """,
+        tuple(params),
+      ).fetchall()
+
+    has_more = len(rows) > safe_limit
+    page_rows = rows[:safe_limit]
+    chats: list[dict[str, Any]] = []
+    for row in page_rows:
+      summary = self._serialize_chat_row(row, [])
+      summary.pop("messages", None)
+      summary["messageCount"] = max(0, int(row["message_count"] or 0))
+      chats.append(summary)
+    next_cursor = ""
+    if has_more and page_rows:
+      last_row = page_rows[-1]
+      next_cursor = self._encode_chat_cursor(str(last_row["updated_at"] or ""), str(last_row["id"] or ""))
+    return {
+      "chats": chats,
+      "next_cursor": next_cursor,
+      "has_more": has_more,
+    }
+
+  def get_chat_messages_page(
+    self,
+    chat_id: str,
+    *,
+    owner_user_id: str = "",
+    limit: int = 50,
+    before: str = "",
+    after: str = "",
+  ) -> dict[str, Any]:
+    """Страница сообщений чата по id: before — более старые (листание вверх), after — более новые."""
+    safe_chat_id = str(chat_id or "").strip()
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    safe_limit = max(1, min(self.MESSAGE_PAGE_MAX_LIMIT, int(limit or 50)))
+    before_pk = self._normalize_message_pk(before) if str(before or "").strip() else 0
+    after_pk = self._normalize_message_pk(after) if str(after or "").strip() else 0
+
+    with self._read() as conn:
+      if after_pk:
+        rows = conn.execute(
+          """
+          SELECT id, role, text, meta_json, meta_codec, timestamp
+          FROM messages
+          WHERE owner_user_id=? AND chat_id=? AND id > ?
+          ORDER BY id ASC
+          LIMIT ?
+          """,
+          (safe_owner, safe_chat_id, after_pk, safe_limit + 1),
+        ).fetchall()
+        has_more = len(rows) > safe_limit
+        rows = rows[:safe_limit]
+      else:
+        upper_sql = "AND id < ?" if before_pk else ""
+        params: tuple[Any, ...] = (safe_owner, safe_chat_id, *((before_pk,) if before_pk else ()), safe_limit + 1)
+        rows = conn.execute(
+          f"""
+          SELECT id, role, text, meta_json, meta_codec, timestamp
+          FROM messages
+          WHERE owner_user_id=? AND chat_id=? {upper_sql}
+          ORDER BY id DESC
+          LIMIT ?
+          """,
+          params,
+        ).fetchall()
+        has_more = len(rows) > safe_limit
+        rows = list(reversed(rows[:safe_limit]))
+
+    messages = [self._serialize_message_row(row) for row in rows]
+    return {
+      "chat_id": safe_chat_id,
+      "messages": messages,
+      "has_more": has_more,
+      # Курсор для следующего запроса в том же направлении.
+      "next_before": messages[0]["id"] if (has_more and messages and not after_pk) else "",
+      "next_after": messages[-1]["id"] if (has_more and messages and after_pk) else "",
+    }
+
   def export_chat_store_payload(self, chat_id: str = "", *, owner_user_id: str = "") -> dict[str, Any]:
     safe_owner = self._normalize_owner_user_id(owner_user_id)
-    store = self.list_chat_store(owner_user_id=safe_owner)
+    store = self.list_chat_store(owner_user_id=safe_owner, include_tool_payloads=True)
     safe_chat_id = str(chat_id or "").strip()
     if not safe_chat_id:
       return store
@@ -725,6 +2511,33 @@ class AppStorage:
       "sessions": sessions,
     }
 
+  def _build_message_search_match_query(self, query: str) -> str:
+    safe_query = str(query or "").strip()
+    if self._message_search_tokenizer == "trigram":
+      if len(safe_query) < self.MESSAGE_SEARCH_TRIGRAM_MIN_CHARS:
+        return ""
+      # Фраза из триграмм = поиск подстроки, как у прежнего LIKE '%q%'.
+      return '"' + safe_query.replace('"', '""') + '"'
+    if self._message_search_tokenizer == "unicode61":
+      terms = [term for term in re.findall(r"\w+", safe_query, flags=re.UNICODE) if term]
+      return " ".join(f'"{term}"*' for term in terms)
+    return ""
+
+  def _serialize_search_row(self, row: sqlite3.Row | dict[str, Any], query: str) -> dict[str, Any]:
+    payload = dict(row)
+    text = str(payload.get("text") or "")
+    snippet = " ".join(str(payload.get("fts_snippet") or "").split())
+    return {
+      "chat_id": str(payload.get("chat_id") or ""),
+      "chat_title": str(payload.get("chat_title") or "Новая сессия"),
+      "message_id": f"msg-{payload.get('message_pk')}",
+      "role": self._normalize_message_role(payload.get("role"), "assistant"),
+      "text": text,
+      "snippet": snippet or self._build_search_snippet(text, query),
+      "timestamp": str(payload.get("timestamp") or utc_now_iso()),
+      "meta": self._decode_meta(payload.get("meta_json"), payload.get("meta_codec")),
+    }
+
   def search_messages(
     self,
     query: str,
@@ -740,68 +2553,122 @@ class AppStorage:
     like_query = f"%{safe_query}%"
     safe_chat_id = str(chat_id or "").strip()
     safe_owner = self._normalize_owner_user_id(owner_user_id)
-
-    with self._lock:
-      if safe_chat_id:
-        rows = self._conn.execute(
-          """
+    match_query = self._build_message_search_match_query(safe_query)
+    chat_filter_sql = "AND m.chat_id = ?" if safe_chat_id else ""
+    chat_filter_params: tuple[Any, ...] = (safe_chat_id,) if safe_chat_id else ()
+
+    if not match_query:
+      # Короткий запрос (меньше триграммы) или SQLite без FTS5 — прежний LIKE-поиск.
+      with self._read() as conn:
+        rows = conn.execute(
+          f"""
           SELECT
             m.id AS message_pk,
             m.chat_id AS chat_id,
             m.role AS role,
             m.text AS text,
             m.meta_json AS meta_json,
+            m.meta_codec AS meta_codec,
             m.timestamp AS timestamp,
             c.title AS chat_title
           FROM messages m
           JOIN chats c ON c.owner_user_id = m.owner_user_id AND c.id = m.chat_id
           WHERE m.owner_user_id = ?
-            AND m.chat_id = ?
+            {chat_filter_sql}
             AND (LOWER(m.text) LIKE ? OR LOWER(c.title) LIKE ?)
           ORDER BY m.id DESC
           LIMIT ?
           """,
-          (safe_owner, safe_chat_id, like_query, like_query, safe_limit),
+          (safe_owner, *chat_filter_params, like_query, like_query, safe_limit),
         ).fetchall()
-      else:
-        rows = self._conn.execute(
-          """
+      return [self._serialize_search_row(row, safe_query) for row in rows]
+
+    fts_table = self.MESSAGE_SEARCH_FTS_TABLE
+    with self._read() as conn:
+      window_row = None
+      if not safe_chat_id:
+        # В рамках одного чата совпадений немного — окно нужно только для поиска по всей истории.
+        window_row = conn.execute(
+          f"""
+          SELECT m.id AS message_pk
+          FROM {fts_table}
+          JOIN messages m ON m.id = {fts_table}.rowid
+          WHERE {fts_table} MATCH ?
+            AND m.owner_user_id = ?
+          ORDER BY {fts_table}.rowid DESC
+          LIMIT 1 OFFSET ?
+          """,
+          (match_query, safe_owner, self.MESSAGE_SEARCH_RANK_WINDOW - 1),
+        ).fetchone()
+      min_message_pk = int(window_row["message_pk"]) if window_row is not None else 0
+      rows = conn.execute(
+        f"""
+        SELECT
+          m.id AS message_pk,
+          m.chat_id AS chat_id,
+          m.role AS role,
+          m.text AS text,
+          m.meta_json AS meta_json,
+          m.meta_codec AS meta_codec,
+          m.timestamp AS timestamp,
+          c.title AS chat_title,
+          snippet({fts_table}, 0, '', '', '…', 64) AS fts_snippet
+        FROM {fts_table}
+        JOIN messages m ON m.id = {fts_table}.rowid
+        JOIN chats c ON c.owner_user_id = m.owner_user_id AND c.id = m.chat_id
+        WHERE {fts_table} MATCH ?
+          AND {fts_table}.rowid >= ?
+          AND m.owner_user_id = ?
+          {chat_filter_sql}
+        ORDER BY bm25({fts_table}), m.id DESC
+        LIMIT ?
+        """,
+        (match_query, min_message_pk, safe_owner, *chat_filter_params, safe_limit),
+      ).fetchall()
+      remaining = safe_limit - len(rows)
+      title_rows: list[sqlite3.Row] = []
+      title_chat_ids: list[str] = []
+      if remaining > 0:
+        # Совпадения по названию чата (как раньше). Сначала ищем сами чаты — их на порядки меньше,
+        # иначе планировщик идёт по всем сообщениям владельца в порядке id.
+        title_chat_ids = [
+          str(row["id"])
+          for row in conn.execute(
+            f"""
+            SELECT id FROM chats
+            WHERE owner_user_id = ? AND LOWER(title) LIKE ? {"AND id = ?" if safe_chat_id else ""}
+            """,
+            (safe_owner, like_query, *chat_filter_params),
+          ).fetchall()
+        ]
+      if title_chat_ids:
+        found_ids = [int(row["message_pk"]) for row in rows]
+        exclude_sql = ""
+        if found_ids:
+          exclude_sql = f"AND m.id NOT IN ({', '.join('?' for _ in found_ids)})"
+        title_rows = conn.execute(
+          f"""
           SELECT
             m.id AS message_pk,
             m.chat_id AS chat_id,
             m.role AS role,
             m.text AS text,
             m.meta_json AS meta_json,
+            m.meta_codec AS meta_codec,
             m.timestamp AS timestamp,
             c.title AS chat_title
           FROM messages m
           JOIN chats c ON c.owner_user_id = m.owner_user_id AND c.id = m.chat_id
           WHERE m.owner_user_id = ?
-            AND (LOWER(m.text) LIKE ? OR LOWER(c.title) LIKE ?)
+            AND m.chat_id IN ({', '.join('?' for _ in title_chat_ids)})
+            {exclude_sql}
           ORDER BY m.id DESC
           LIMIT ?
           """,
-          (safe_owner, like_query, like_query, safe_limit),
+          (safe_owner, *title_chat_ids, *found_ids, remaining),
         ).fetchall()
 
-    result: list[dict[str, Any]] = []
-    for row in rows:
-      payload = dict(row)
-      text = str(payload.get("text") or "")
-      role = self._normalize_message_role(payload.get("role"), "assistant")
-      result.append(
-        {
-          "chat_id": str(payload.get("chat_id") or ""),
-          "chat_title": str(payload.get("chat_title") or "Новая сессия"),
-          "message_id": f"msg-{payload.get('message_pk')}",
-          "role": role,
-          "text": text,
-          "snippet": self._build_search_snippet(text, safe_query),
-          "timestamp": str(payload.get("timestamp") or utc_now_iso()),
-          "meta": self._decode_meta(payload.get("meta_json")),
-        }
-      )
-    return result
+    return [self._serialize_search_row(row, safe_query) for row in [*rows, *title_rows]]
 
   def export_chat_store_markdown(self, chat_id: str = "", *, owner_user_id: str = "") -> str:
     store = self.export_chat_store_payload(chat_id, owner_user_id=owner_user_id)
@@ -877,11 +2744,13 @@ class AppStorage:
     imported_active_id = ""
 
     safe_owner = self._normalize_owner_user_id(owner_user_id)
+    imported_chat_ids: list[str] = []
 
     with self._lock, self._conn:
       if safe_mode == "replace":
         self._conn.execute("DELETE FROM messages WHERE owner_user_id=?", (safe_owner,))
         self._conn.execute("DELETE FROM chats WHERE owner_user_id=?", (safe_owner,))
+        self._reset_chat_change_log_locked(safe_owner)
 
       existing_chat_ids = {
         str(row["id"] or "").strip()
@@ -921,6 +2790,7 @@ class AppStorage:
           """,
           (safe_owner, session_id, title, mood, created_at, updated_at),
         )
+        imported_chat_ids.append(session_id)
         created_sessions += 1
         if requested_active_id and source_session_id and source_session_id == requested_active_id:
           imported_active_id = session_id
@@ -937,59 +2807,433 @@ class AppStorage:
           text = str(raw_message.get("text") or "")
           if not text.strip():
             continue
-          timestamp = str(raw_message.get("timestamp") or now_iso)
-          meta = raw_message.get("meta")
+          timestamp = str(raw_message.get("timestamp") or now_iso)
+          meta = raw_message.get("meta")
+          meta_payload = meta if isinstance(meta, dict) else {}
+          meta_suffix = str(raw_message.get("metaSuffix") or "").strip()
+          if meta_suffix and not str(meta_payload.get("meta_suffix") or "").strip():
+            meta_payload["meta_suffix"] = meta_suffix
+          meta_value, meta_codec, tool_payload = self._prepare_message_meta(meta_payload)
+          cursor = self._conn.execute(
+            """
+            INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, meta_codec, timestamp)
+            VALUES(?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+              safe_owner,
+              session_id,
+              role,
+              text,
+              meta_value,
+              meta_codec,
+              timestamp,
+            ),
+          )
+          if tool_payload is not None:
+            self._store_tool_payload_locked(int(cursor.lastrowid or 0), tool_payload)
+          created_messages += 1
+          session_updated_at = timestamp
+        self._conn.execute(
+          "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
+          (session_updated_at, safe_owner, session_id),
+        )
+
+      if safe_mode == "replace" and created_sessions <= 0:
+        fallback_id = "chat-1"
+        self._conn.execute(
+          """
+          INSERT INTO chats(owner_user_id, id, title, mood, created_at, updated_at)
+          VALUES(?, ?, ?, ?, ?, ?)
+          """,
+          (safe_owner, fallback_id, "Новая сессия", "", now_iso, now_iso),
+        )
+        imported_chat_ids.append(fallback_id)
+        created_sessions = 1
+        requested_active_id = fallback_id
+        imported_active_id = fallback_id
+        has_active_id = True
+
+      self._record_chat_changes_locked(safe_owner, [(chat_id, None, "reload") for chat_id in imported_chat_ids])
+
+    store = self.list_chat_store(owner_user_id=safe_owner)
+    if has_active_id:
+      if imported_active_id:
+        store["activeSessionId"] = imported_active_id
+      elif requested_active_id:
+        store["activeSessionId"] = requested_active_id
+
+    return {
+      "mode": safe_mode,
+      "sessions": created_sessions,
+      "messages": created_messages,
+      "store": store,
+    }
+
+  def _iter_export_chat_rows(self, chat_id: str, owner_user_id: str) -> Iterator[sqlite3.Row]:
+    safe_chat_id = str(chat_id or "").strip()
+    if safe_chat_id:
+      row = self.get_chat(safe_chat_id, owner_user_id=owner_user_id)
+      if row is not None:
+        yield row
+      return
+    cursor_key: tuple[str, str] | None = None
+    while True:
+      keyset_sql = "AND (updated_at, id) < (?, ?)" if cursor_key else ""
+      with self._read() as conn:
+        rows = conn.execute(
+          f"""
+          SELECT id, title, mood, created_at, updated_at
+          FROM chats
+          WHERE owner_user_id=? {keyset_sql}
+          ORDER BY updated_at DESC, id DESC
+          LIMIT ?
+          """,
+          (owner_user_id, *(cursor_key or ()), self.EXPORT_BATCH_SIZE),
+        ).fetchall()
+      if not rows:
+        return
+      yield from rows
+      cursor_key = (str(rows[-1]["updated_at"] or ""), str(rows[-1]["id"] or ""))
+
+  def _iter_export_messages(self, chat_id: str, owner_user_id: str) -> Iterator[dict[str, Any]]:
+    # Читаем пачками по id: читающее соединение занято только на время одной пачки.
+    last_pk = 0
+    while True:
+      with self._read() as conn:
+        rows = conn.execute(
+          """
+          SELECT id, role, text, meta_json, meta_codec, timestamp
+          FROM messages
+          WHERE owner_user_id=? AND chat_id=? AND id > ?
+          ORDER BY id ASC
+          LIMIT ?
+          """,
+          (owner_user_id, chat_id, last_pk, self.EXPORT_BATCH_SIZE),
+        ).fetchall()
+        messages = [self._serialize_message_row(row) for row in rows]
+        self._attach_tool_payloads(conn, messages)
+      if not rows:
+        return
+      yield from messages
+      last_pk = int(rows[-1]["id"])
+
+  def _resolve_export_active_chat_id(self, chat_id: str, owner_user_id: str) -> str:
+    safe_chat_id = str(chat_id or "").strip()
+    if safe_chat_id:
+      if self.get_chat(safe_chat_id, owner_user_id=owner_user_id) is None:
+        raise ValueError(f"Chat '{safe_chat_id}' not found")
+      return safe_chat_id
+    for row in self._iter_export_chat_rows("", owner_user_id):
+      return str(row["id"] or "")
+    return ""
+
+  def iter_export_chat_store_ndjson(self, chat_id: str = "", *, owner_user_id: str = "") -> Iterator[str]:
+    """NDJSON-экспорт: строка header, затем chat и его message построчно; память не зависит от объёма."""
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    active_chat_id = self._resolve_export_active_chat_id(chat_id, safe_owner)
+
+    def generate() -> Iterator[str]:
+      yield json.dumps(
+        {
+          "type": "header",
+          "format": "ancia-chats",
+          "version": 1,
+          "exportedAt": utc_now_iso(),
+          "activeSessionId": active_chat_id,
+        },
+        ensure_ascii=False,
+      ) + "\n"
+      for chat_row in self._iter_export_chat_rows(chat_id, safe_owner):
+        session = self._serialize_chat_row(chat_row, [])
+        session.pop("messages", None)
+        yield json.dumps({"type": "chat", **session}, ensure_ascii=False) + "\n"
+        for message in self._iter_export_messages(session["id"], safe_owner):
+          yield json.dumps({"type": "message", "chatId": session["id"], **message}, ensure_ascii=False) + "\n"
+
+    return generate()
+
+  def iter_export_chat_store_markdown(self, chat_id: str = "", *, owner_user_id: str = "") -> Iterator[str]:
+    """Потоковый вариант export_chat_store_markdown с тем же форматом (включая блок ancia-json)."""
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    active_chat_id = self._resolve_export_active_chat_id(chat_id, safe_owner)
+    role_label = {
+      "user": "Пользователь",
+      "assistant": "Ассистент",
+      "tool": "Инструмент",
+      "system": "Система",
+    }
+
+    def generate() -> Iterator[str]:
+      yield f"<!-- ancia-chat-export:1 -->\n# Экспорт чатов Ancia\n\n_Дата: {utc_now_iso()}_\n\n"
+      for chat_row in self._iter_export_chat_rows(chat_id, safe_owner):
+        session_id = str(chat_row["id"] or "").strip()
+        title = str(chat_row["title"] or "Новая сессия").strip()
+        lines = [f"## Чат: {title}"]
+        if session_id:
+          lines.append(f"`{session_id}`")
+        lines.append("")
+        yield "\n".join(lines) + "\n"
+        for message in self._iter_export_messages(session_id, safe_owner):
+          role = self._normalize_message_role(message["role"], "assistant")
+          timestamp = str(message["timestamp"] or "").strip()
+          header = f"### {role_label.get(role, role)}"
+          if timestamp:
+            header = f"{header} · {timestamp}"
+          text = str(message["text"] or "").replace("\r\n", "\n").replace("\r", "\n").strip("\n")
+          body = f"```text\n{text}\n```" if text else "_Пусто_"
+          yield f"{header}\n{body}\n\n"
+
+      # Второй проход курсором — JSON-блок для обратного импорта, собирается по частям.
+      yield "---\n\n```ancia-json\n"
+      yield f'{{"version": 1, "activeSessionId": {json.dumps(active_chat_id, ensure_ascii=False)}, "sessions": ['
+      first_session = True
+      for chat_row in self._iter_export_chat_rows(chat_id, safe_owner):
+        session = self._serialize_chat_row(chat_row, [])
+        session.pop("messages", None)
+        session_json = json.dumps(session, ensure_ascii=False)
+        yield ("\n" if first_session else ",\n") + session_json[:-1] + ', "messages": ['
+        first_session = False
+        first_message = True
+        for message in self._iter_export_messages(session["id"], safe_owner):
+          message_json = json.dumps(message, ensure_ascii=False)
+          yield ("\n" if first_message else ",\n") + message_json
+          first_message = False
+        yield "]}"
+      yield "\n]}\n```\n"
+
+    return generate()
+
+  @staticmethod
+  def _decode_ndjson_line(raw_line: str | bytes) -> str:
+    line = raw_line.decode("utf-8") if isinstance(raw_line, bytes) else str(raw_line)
+    return line.strip()
+
+  def _validate_import_ndjson_lines(self, lines: Iterable[str | bytes]) -> None:
+    """Первый проход replace-импорта: разбирает все строки, ничего не записывая.
+
+    Ошибка формата всплывает здесь — до того, как старые чаты владельца удалены.
+    """
+    line_number = 0
+    for raw_line in lines:
+      try:
+        line = self._decode_ndjson_line(raw_line)
+      except UnicodeDecodeError as exc:
+        raise ValueError(f"Invalid NDJSON at line {line_number + 1}: {exc}") from exc
+      if not line:
+        continue
+      line_number += 1
+      try:
+        json.loads(line)
+      except json.JSONDecodeError as exc:
+        raise ValueError(f"Invalid NDJSON at line {line_number}: {exc}") from exc
+
+  def iter_import_chat_store_ndjson(
+    self,
+    lines: Iterable[str | bytes],
+    *,
+    mode: str = "merge",
+    owner_user_id: str = "",
+    batch_size: int | None = None,
+  ) -> Iterator[dict[str, Any]]:
+    """Построчный импорт NDJSON (формат iter_export_chat_store_ndjson).
+
+    merge пишет executemany-пачками в отдельных транзакциях и после каждой пачки отдаёт событие progress.
+    replace сначала проверяет весь файл (lines перечитывается через seek, иначе буферизуется
+    в список), затем удаляет старые чаты и пишет новые одной транзакцией без промежуточных
+    событий: ошибка в данных не оставляет владельца без истории.
+    """
+    safe_mode = str(mode or "merge").strip().lower()
+    if safe_mode not in {"replace", "merge"}:
+      safe_mode = "merge"
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    safe_batch_size = max(1, min(10_000, int(batch_size or self.IMPORT_BATCH_SIZE)))
+    now_iso = utc_now_iso()
+
+    if safe_mode == "replace":
+      if not callable(getattr(lines, "seek", None)):
+        lines = list(lines)
+      self._validate_import_ndjson_lines(lines)
+      if not isinstance(lines, list):
+        lines.seek(0)  # type: ignore[union-attr]
+      existing_chat_ids: set[str] = set()
+    else:
+      with self._lock, self._conn:
+        existing_chat_ids = {
+          str(row["id"] or "").strip()
+          for row in self._conn.execute(
+            "SELECT id FROM chats WHERE owner_user_id=?",
+            (safe_owner,),
+          ).fetchall()
+        }
+
+    chat_id_map: dict[str, str] = {}
+    chat_updated_at: dict[str, str] = {}
+    pending_chats: list[tuple[Any, ...]] = []
+    pending_messages: list[tuple[Any, ...]] = []
+    pending_tool_payloads: list[tuple[str | bytes, int, int, int] | None] = []
+    touched_chats: set[str] = set()
+    counters = {"sessions": 0, "messages": 0, "skipped": 0, "lines": 0}
+    requested_active_id = ""
+    active_session_id = ""
+
+    def resolve_session_id(raw_session_id: str) -> str:
+      base_id = str(raw_session_id or "").strip() or f"chat-import-{counters['sessions'] + 1}"
+      candidate = base_id
+      suffix = 2
+      while candidate in existing_chat_ids:
+        candidate = f"{base_id}-import-{suffix}"
+        suffix += 1
+      existing_chat_ids.add(candidate)
+      return candidate
+
+    def flush_locked() -> None:
+      if not pending_chats and not pending_messages:
+        return
+      if pending_chats:
+        self._conn.executemany(
+          """
+          INSERT INTO chats(owner_user_id, id, title, mood, created_at, updated_at)
+          VALUES(?, ?, ?, ?, ?, ?)
+          """,
+          pending_chats,
+        )
+      insert_message_sql = """
+        INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, meta_codec, timestamp)
+        VALUES(?, ?, ?, ?, ?, ?, ?)
+      """
+      if any(tool_payload is not None for tool_payload in pending_tool_payloads):
+        # Для вывода инструментов нужен id каждой строки — вставляем по одной, сохраняя порядок.
+        for message_params, tool_payload in zip(pending_messages, pending_tool_payloads):
+          cursor = self._conn.execute(insert_message_sql, message_params)
+          if tool_payload is not None:
+            self._store_tool_payload_locked(int(cursor.lastrowid or 0), tool_payload)
+      elif pending_messages:
+        self._conn.executemany(insert_message_sql, pending_messages)
+      if touched_chats:
+        self._conn.executemany(
+          "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
+          [(chat_updated_at[chat_id], safe_owner, chat_id) for chat_id in touched_chats],
+        )
+      self._record_chat_changes_locked(
+        safe_owner,
+        [(chat_id, None, "reload") for chat_id in {*touched_chats, *(row[1] for row in pending_chats)}],
+      )
+      pending_chats.clear()
+      pending_messages.clear()
+      pending_tool_payloads.clear()
+      touched_chats.clear()
+
+    def flush() -> None:
+      with self._lock, self._conn:
+        flush_locked()
+
+    def import_records(write_batch: Callable[[], None]) -> Iterator[None]:
+      nonlocal requested_active_id
+      for raw_line in lines:
+        line = self._decode_ndjson_line(raw_line)
+        if not line:
+          continue
+        counters["lines"] += 1
+        try:
+          record = json.loads(line)
+        except json.JSONDecodeError as exc:
+          write_batch()
+          raise ValueError(f"Invalid NDJSON at line {counters['lines']}: {exc}") from exc
+        if not isinstance(record, dict):
+          counters["skipped"] += 1
+          continue
+        record_type = str(record.get("type") or "").strip().lower()
+
+        if record_type == "header":
+          requested_active_id = str(record.get("activeSessionId") or "").strip()
+          continue
+
+        if record_type == "chat":
+          source_id = str(record.get("id") or "").strip()
+          session_id = resolve_session_id(source_id)
+          if source_id:
+            chat_id_map[source_id] = session_id
+          created_at = str(record.get("createdAt") or record.get("created_at") or now_iso)
+          updated_at = str(record.get("updatedAt") or record.get("updated_at") or created_at or now_iso)
+          pending_chats.append(
+            (
+              safe_owner,
+              session_id,
+              str(record.get("title") or "").strip() or f"Чат {counters['sessions'] + 1}",
+              normalize_mood(record.get("mood"), ""),
+              created_at,
+              updated_at,
+            )
+          )
+          chat_updated_at[session_id] = updated_at
+          counters["sessions"] += 1
+        elif record_type == "message":
+          session_id = chat_id_map.get(str(record.get("chatId") or record.get("chat_id") or "").strip(), "")
+          text = str(record.get("text") or "")
+          if not session_id or not text.strip():
+            counters["skipped"] += 1
+            continue
+          meta = record.get("meta")
           meta_payload = meta if isinstance(meta, dict) else {}
-          meta_suffix = str(raw_message.get("metaSuffix") or "").strip()
+          meta_suffix = str(record.get("metaSuffix") or "").strip()
           if meta_suffix and not str(meta_payload.get("meta_suffix") or "").strip():
             meta_payload["meta_suffix"] = meta_suffix
-          self._conn.execute(
-            """
-            INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, timestamp)
-            VALUES(?, ?, ?, ?, ?, ?)
-            """,
+          timestamp = str(record.get("timestamp") or now_iso)
+          meta_value, meta_codec, tool_payload = self._prepare_message_meta(meta_payload)
+          pending_tool_payloads.append(tool_payload)
+          pending_messages.append(
             (
               safe_owner,
               session_id,
-              role,
+              self._normalize_message_role(record.get("role"), "assistant"),
               text,
-              json.dumps(meta_payload, ensure_ascii=False),
+              meta_value,
+              meta_codec,
               timestamp,
-            ),
+            )
           )
-          created_messages += 1
-          session_updated_at = timestamp
-        self._conn.execute(
-          "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
-          (session_updated_at, safe_owner, session_id),
-        )
-
-      if safe_mode == "replace" and created_sessions <= 0:
-        fallback_id = "chat-1"
-        self._conn.execute(
-          """
-          INSERT INTO chats(owner_user_id, id, title, mood, created_at, updated_at)
-          VALUES(?, ?, ?, ?, ?, ?)
-          """,
-          (safe_owner, fallback_id, "Новая сессия", "", now_iso, now_iso),
-        )
-        created_sessions = 1
-        requested_active_id = fallback_id
-        imported_active_id = fallback_id
-        has_active_id = True
+          chat_updated_at[session_id] = timestamp
+          touched_chats.add(session_id)
+          counters["messages"] += 1
+        else:
+          counters["skipped"] += 1
+          continue
 
-    store = self.list_chat_store(owner_user_id=safe_owner)
-    if has_active_id:
-      if imported_active_id:
-        store["activeSessionId"] = imported_active_id
-      elif requested_active_id:
-        store["activeSessionId"] = requested_active_id
+        if len(pending_chats) + len(pending_messages) >= safe_batch_size:
+          write_batch()
+          yield None
+      write_batch()
 
-    return {
+    if safe_mode == "replace":
+      # Удаление и все пачки — одна транзакция; внутри неё не уступаем поток (блокировка писателя
+      # не должна ждать, пока клиент дочитает событие), поэтому progress здесь не отдаём.
+      with self._lock, self._conn:
+        self._conn.execute("DELETE FROM messages WHERE owner_user_id=?", (safe_owner,))
+        self._conn.execute("DELETE FROM chats WHERE owner_user_id=?", (safe_owner,))
+        self._reset_chat_change_log_locked(safe_owner)
+        for _ in import_records(flush_locked):
+          pass
+        if counters["sessions"] <= 0:
+          self._conn.execute(
+            """
+            INSERT INTO chats(owner_user_id, id, title, mood, created_at, updated_at)
+            VALUES(?, ?, ?, ?, ?, ?)
+            """,
+            (safe_owner, "chat-1", "Новая сессия", "", now_iso, now_iso),
+          )
+          self._record_chat_changes_locked(safe_owner, (("chat-1", None, "reload"),))
+          counters["sessions"] = 1
+          active_session_id = "chat-1"
+    else:
+      for _ in import_records(flush):
+        yield {"type": "progress", "mode": safe_mode, **counters}
+
+    active_session_id = active_session_id or chat_id_map.get(requested_active_id, "")
+    yield {
+      "type": "done",
       "mode": safe_mode,
-      "sessions": created_sessions,
-      "messages": created_messages,
-      "store": store,
+      "activeSessionId": active_session_id,
+      **counters,
     }
 
   def update_chat_mood(self, chat_id: str, mood: str, *, owner_user_id: str = "") -> None:
@@ -1004,25 +3248,31 @@ class AppStorage:
     meta: dict[str, Any] | None = None,
     timestamp: str | None = None,
     owner_user_id: str = "",
-  ) -> str:
+    wait: bool = True,
+  ) -> str | Future[str]:
     safe_owner = self._normalize_owner_user_id(owner_user_id)
     ts = timestamp or utc_now_iso()
-    payload = json.dumps(meta or {}, ensure_ascii=False)
+    meta_value, meta_codec, tool_payload = self._prepare_message_meta(meta)
 
-    with self._lock, self._conn:
+    def write() -> str:
       cursor = self._conn.execute(
         """
-        INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, timestamp)
-        VALUES(?, ?, ?, ?, ?, ?)
+        INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, meta_codec, timestamp)
+        VALUES(?, ?, ?, ?, ?, ?, ?)
         """,
-        (safe_owner, chat_id, role, text, payload, ts),
+        (safe_owner, chat_id, role, text, meta_value, meta_codec, ts),
       )
+      if tool_payload is not None:
+        self._store_tool_payload_locked(int(cursor.lastrowid or 0), tool_payload)
       self._conn.execute(
         "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
         (ts, safe_owner, chat_id),
       )
+      self._record_chat_changes_locked(safe_owner, ((chat_id, int(cursor.lastrowid or 0), "upsert"),))
       return f"msg-{cursor.lastrowid}"
 
+    return self._dispatch_write(write, wait=wait)
+
   def edit_message(self, chat_id: str, message_id: str, next_text: str, *, owner_user_id: str = "") -> bool:
     safe_chat_id = str(chat_id or "").strip()
     safe_text = str(next_text or "").strip()
@@ -1051,6 +3301,7 @@ class AppStorage:
         "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
         (now, safe_owner, safe_chat_id),
       )
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, message_pk, "upsert"),))
     return True
 
   def update_message(
@@ -1062,46 +3313,57 @@ class AppStorage:
     meta: dict[str, Any] | None = None,
     timestamp: str | None = None,
     owner_user_id: str = "",
-  ) -> bool:
+    wait: bool = True,
+  ) -> bool | Future[bool]:
     safe_chat_id = str(chat_id or "").strip()
     if not safe_chat_id:
-      return False
+      return self._completed_write(False, wait=wait)
     safe_owner = self._normalize_owner_user_id(owner_user_id)
 
     try:
       message_pk = self._normalize_message_pk(message_id)
     except (TypeError, ValueError):
-      return False
+      return self._completed_write(False, wait=wait)
 
     updates: list[str] = []
     params: list[Any] = []
+    tool_payload: tuple[str | bytes, int, int, int] | None = None
     if text is not None:
       updates.append("text=?")
       params.append(str(text))
     if meta is not None:
+      meta_value, meta_codec, tool_payload = self._prepare_message_meta(meta)
       updates.append("meta_json=?")
-      params.append(json.dumps(meta, ensure_ascii=False))
+      params.append(meta_value)
+      updates.append("meta_codec=?")
+      params.append(meta_codec)
 
     if not updates:
-      return False
+      return self._completed_write(False, wait=wait)
 
     now = str(timestamp or utc_now_iso())
     updates.append("timestamp=?")
     params.append(now)
     params.extend([message_pk, safe_owner, safe_chat_id])
 
-    with self._lock, self._conn:
+    def write() -> bool:
       cursor = self._conn.execute(
         f"UPDATE messages SET {', '.join(updates)} WHERE id=? AND owner_user_id=? AND chat_id=?",
         tuple(params),
       )
       if cursor.rowcount <= 0:
         return False
+      if meta is not None:
+        # meta заменяется целиком — вместе с ней заменяется (или удаляется) и вывод инструмента.
+        self._store_tool_payload_locked(message_pk, tool_payload)
       self._conn.execute(
         "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
         (now, safe_owner, safe_chat_id),
       )
-    return True
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, message_pk, "upsert"),))
+      return True
+
+    return self._dispatch_write(write, wait=wait)
 
   def delete_message(self, chat_id: str, message_id: str, *, owner_user_id: str = "") -> bool:
     safe_chat_id = str(chat_id or "").strip()
@@ -1126,6 +3388,7 @@ class AppStorage:
         "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
         (now, safe_owner, safe_chat_id),
       )
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, message_pk, "delete"),))
     return True
 
   def clear_chat_messages(self, chat_id: str, *, owner_user_id: str = "") -> int:
@@ -1143,12 +3406,13 @@ class AppStorage:
         "UPDATE chats SET updated_at=? WHERE owner_user_id=? AND id=?",
         (utc_now_iso(), safe_owner, safe_chat_id),
       )
+      self._record_chat_changes_locked(safe_owner, ((safe_chat_id, None, "reload"),))
       return max(0, int(cursor.rowcount))
 
   def get_recent_messages(self, chat_id: str, limit: int = 30, *, owner_user_id: str = "") -> list[dict[str, Any]]:
     safe_owner = self._normalize_owner_user_id(owner_user_id)
-    with self._lock:
-      rows = self._conn.execute(
+    with self._read() as conn:
+      rows = conn.execute(
         """
         SELECT role, text, timestamp
         FROM messages
@@ -1187,6 +3451,109 @@ class AppStorage:
       "created_at": str(payload.get("created_at") or ""),
     }
 
+  @staticmethod
+  def _parse_audit_moment(created_at: str) -> dt.datetime:
+    try:
+      moment = dt.datetime.fromisoformat(str(created_at or "").strip())
+    except ValueError:
+      return dt.datetime.now(dt.timezone.utc)
+    if moment.tzinfo is None:
+      return moment.replace(tzinfo=dt.timezone.utc)
+    return moment.astimezone(dt.timezone.utc)
+
+  def _audit_period_bounds(self, moment: dt.datetime) -> tuple[str, str, str]:
+    """(имя таблицы, начало, конец) периода, в который попадает moment (UTC)."""
+    if self._audit_partition_period == "day":
+      start = dt.datetime(moment.year, moment.month, moment.day, tzinfo=dt.timezone.utc)
+      end = start + dt.timedelta(days=1)
+      suffix = start.strftime("%Y%m%d")
+    else:
+      start = dt.datetime(moment.year, moment.month, 1, tzinfo=dt.timezone.utc)
+      end = dt.datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1, tzinfo=dt.timezone.utc)
+      suffix = start.strftime("%Y%m")
+    return f"{self.AUDIT_PARTITION_PREFIX}{suffix}", start.isoformat(), end.isoformat()
+
+  def _load_audit_partitions_locked(self) -> list[tuple[str, str, str]]:
+    if self._audit_partitions is None:
+      rows = self._conn.execute(
+        "SELECT name, period_start, period_end FROM audit_partitions WHERE archived_at = '' ORDER BY period_start ASC"
+      ).fetchall()
+      self._audit_partitions = [(str(row["period_start"]), str(row["period_end"]), str(row["name"])) for row in rows]
+    return self._audit_partitions
+
+  def _audit_partition_for_locked(self, moment: dt.datetime) -> str:
+    """Имя действующей партиции для момента; создаёт её (и пересобирает VIEW), если периода ещё нет."""
+    moment_iso = moment.isoformat()
+    partitions = self._load_audit_partitions_locked()
+    # Свежие периоды — в конце списка: обычная вставка находит партицию с первой попытки.
+    for period_start, period_end, name in reversed(partitions):
+      if period_start <= moment_iso < period_end:
+        return name
+    name, period_start, period_end = self._audit_period_bounds(moment)
+    self._conn.execute(
+      f"""
+      CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        actor_user_id TEXT NOT NULL DEFAULT '',
+        actor_username TEXT NOT NULL DEFAULT '',
+        actor_role TEXT NOT NULL DEFAULT '',
+        action TEXT NOT NULL,
+        target_type TEXT NOT NULL DEFAULT '',
+        target_id TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL DEFAULT 'ok',
+        details_json TEXT NOT NULL DEFAULT '{{}}',
+        ip_address TEXT NOT NULL DEFAULT '',
+        created_at TEXT NOT NULL
+      )
+      """
+    )
+    self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_actor ON {name}(actor_user_id, id)")
+    self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_action ON {name}(action, id)")
+    # Период мог быть заархивирован раньше (запись задним числом) — партиция снова становится действующей.
+    self._conn.execute(
+      """
+      INSERT INTO audit_partitions(name, period_start, period_end, created_at)
+      VALUES (?, ?, ?, ?)
+      ON CONFLICT(name) DO UPDATE SET archived_at=''
+      """,
+      (name, period_start, period_end, utc_now_iso()),
+    )
+    partitions.append((period_start, period_end, name))
+    partitions.sort()
+    self._rebuild_audit_view_locked()
+    return name
+
+  def _rebuild_audit_view_locked(self) -> None:
+    self._audit_partitions = None
+    names = [name for _, _, name in self._load_audit_partitions_locked()]
+    columns_sql = ", ".join(self.AUDIT_EVENT_COLUMNS)
+    if names:
+      body = "\nUNION ALL\n".join(f"SELECT {columns_sql} FROM {name}" for name in names)
+    else:
+      body = "SELECT " + ", ".join(f"NULL AS {column}" for column in self.AUDIT_EVENT_COLUMNS) + " WHERE 0"
+    self._conn.execute("DROP VIEW IF EXISTS audit_events")
+    self._conn.execute(f"CREATE VIEW audit_events AS {body}")
+
+  def _next_audit_event_id_locked(self) -> int:
+    self._conn.execute("UPDATE audit_event_sequence SET value = value + 1 WHERE name='audit_events'")
+    row = self._conn.execute("SELECT value FROM audit_event_sequence WHERE name='audit_events'").fetchone()
+    return int(row["value"]) if row else 0
+
+  def _bump_audit_rollup_locked(self, day: str, action: str, actor_user_id: str, status: str, events: int = 1) -> None:
+    self._conn.execute(
+      """
+      INSERT INTO audit_rollups(day, action, actor_user_id, status, events)
+      VALUES (?, ?, ?, ?, ?)
+      ON CONFLICT(day, action, actor_user_id, status) DO UPDATE SET events = events + excluded.events
+      """,
+      (day, action, actor_user_id, status, int(events)),
+    )
+
+  def _drop_audit_partitions_locked(self, names: Iterable[str]) -> None:
+    for name in names:
+      self._conn.execute(f"DROP TABLE IF EXISTS {name}")
+    self._rebuild_audit_view_locked()
+
   def append_audit_event(
     self,
     *,
@@ -1200,7 +3567,8 @@ class AppStorage:
     details: dict[str, Any] | None = None,
     ip_address: str = "",
     created_at: str | None = None,
-  ) -> int:
+    wait: bool = True,
+  ) -> int | Future[int]:
     safe_action = str(action or "").strip().lower()
     if not safe_action:
       raise ValueError("action is required")
@@ -1209,10 +3577,16 @@ class AppStorage:
       safe_status = "ok"
     safe_details = details if isinstance(details, dict) else {}
     safe_created_at = str(created_at or utc_now_iso())
-    with self._lock, self._conn:
-      cursor = self._conn.execute(
-        """
-        INSERT INTO audit_events(
+    safe_actor_user_id = str(actor_user_id or "").strip()
+    moment = self._parse_audit_moment(safe_created_at)
+
+    def insert() -> int:
+      partition = self._audit_partition_for_locked(moment)
+      event_id = self._next_audit_event_id_locked()
+      self._conn.execute(
+        f"""
+        INSERT INTO {partition}(
+          id,
           actor_user_id,
           actor_username,
           actor_role,
@@ -1224,10 +3598,11 @@ class AppStorage:
           ip_address,
           created_at
         )
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
-          str(actor_user_id or "").strip(),
+          event_id,
+          safe_actor_user_id,
           str(actor_username or "").strip().lower(),
           str(actor_role or "").strip().lower(),
           safe_action,
@@ -1239,7 +3614,18 @@ class AppStorage:
           safe_created_at,
         ),
       )
-      return max(0, int(cursor.lastrowid or 0))
+      self._bump_audit_rollup_locked(moment.date().isoformat(), safe_action, safe_actor_user_id, safe_status)
+      return event_id
+
+    def write() -> int:
+      try:
+        return insert()
+      except sqlite3.Error:
+        # Откат мог отменить создание партиции — кэш перечитается из audit_partitions.
+        self._audit_partitions = None
+        raise
+
+    return self._dispatch_write(write, wait=wait)
 
   def list_audit_events(
     self,
@@ -1262,8 +3648,9 @@ class AppStorage:
       where_clauses.append("actor_user_id=?")
       params.append(safe_actor_user_id)
     if safe_action_prefix:
-      where_clauses.append("action LIKE ?")
-      params.append(f"{safe_action_prefix}%")
+      # Диапазон вместо LIKE: префикс идёт по индексу (action, id).
+      where_clauses.append("action >= ? AND action < ?")
+      params.extend([safe_action_prefix, f"{safe_action_prefix}\uffff"])
     if safe_status:
       where_clauses.append("status=?")
       params.append(safe_status)
@@ -1272,29 +3659,225 @@ class AppStorage:
     if where_clauses:
       where_sql = "WHERE " + " AND ".join(where_clauses)
 
-    with self._lock:
-      rows = self._conn.execute(
+    # Аудит пишется без ожидания (wait=False) — дожидаемся очереди, чтобы журнал был полным.
+    self.flush_writes()
+    columns_sql = ", ".join(self.AUDIT_EVENT_COLUMNS)
+    events: list[dict[str, Any]] = []
+    with self._read() as conn:
+      partitions = conn.execute(
+        "SELECT name FROM audit_partitions WHERE archived_at = '' ORDER BY period_start DESC"
+      ).fetchall()
+      # От свежих периодов к старым: выборка останавливается, как только набран limit.
+      for partition in partitions:
+        remaining = safe_limit - len(events)
+        if remaining <= 0:
+          break
+        rows = conn.execute(
+          f"""
+          SELECT {columns_sql}
+          FROM {partition["name"]}
+          {where_sql}
+          ORDER BY id DESC
+          LIMIT ?
+          """,
+          tuple(params + [remaining]),
+        ).fetchall()
+        events.extend(self._serialize_audit_event_row(row) for row in rows)
+    return events
+
+  def list_audit_partitions(self) -> list[dict[str, Any]]:
+    with self._read() as conn:
+      rows = conn.execute(
+        """
+        SELECT name, period_start, period_end, created_at, archived_at, archive_path, archived_rows
+        FROM audit_partitions
+        ORDER BY period_start DESC
+        """
+      ).fetchall()
+    return [
+      {
+        "name": str(row["name"]),
+        "period_start": str(row["period_start"]),
+        "period_end": str(row["period_end"]),
+        "created_at": str(row["created_at"]),
+        "archived": bool(row["archived_at"]),
+        "archived_at": str(row["archived_at"] or ""),
+        "archive_path": str(row["archive_path"] or ""),
+        "archived_rows": int(row["archived_rows"] or 0),
+      }
+      for row in rows
+    ]
+
+  def get_audit_rollups(
+    self,
+    *,
+    since_day: str = "",
+    until_day: str = "",
+    group_by: Iterable[str] = ("day",),
+    actor_user_id: str = "",
+    action_prefix: str = "",
+    limit: int = 1000,
+  ) -> list[dict[str, Any]]:
+    """Счётчики событий аудита по дням/действиям/пользователям; переживают архивацию партиций."""
+    safe_group_by = [column for column in self.AUDIT_ROLLUP_GROUP_COLUMNS if column in set(group_by or ())]
+    if not safe_group_by:
+      safe_group_by = ["day"]
+    safe_limit = max(1, min(self.AUDIT_ROLLUP_MAX_LIMIT, int(limit or 1000)))
+    where_clauses: list[str] = []
+    params: list[Any] = []
+    if since_day:
+      where_clauses.append("day >= ?")
+      params.append(str(since_day)[:10])
+    if until_day:
+      where_clauses.append("day <= ?")
+      params.append(str(until_day)[:10])
+    safe_actor_user_id = str(actor_user_id or "").strip()
+    if safe_actor_user_id:
+      where_clauses.append("actor_user_id=?")
+      params.append(safe_actor_user_id)
+    safe_action_prefix = str(action_prefix or "").strip().lower()
+    if safe_action_prefix:
+      where_clauses.append("action >= ? AND action < ?")
+      params.extend([safe_action_prefix, f"{safe_action_prefix}\uffff"])
+    where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
+    group_sql = ", ".join(safe_group_by)
+    order_sql = "day DESC, events DESC" if "day" in safe_group_by else "events DESC"
+
+    self.flush_writes()
+    with self._read() as conn:
+      rows = conn.execute(
         f"""
-        SELECT
-          id,
-          actor_user_id,
-          actor_username,
-          actor_role,
-          action,
-          target_type,
-          target_id,
-          status,
-          details_json,
-          ip_address,
-          created_at
-        FROM audit_events
+        SELECT {group_sql}, SUM(events) AS events
+        FROM audit_rollups
         {where_sql}
-        ORDER BY id DESC
+        GROUP BY {group_sql}
+        ORDER BY {order_sql}
         LIMIT ?
         """,
         tuple(params + [safe_limit]),
       ).fetchall()
-    return [self._serialize_audit_event_row(row) for row in rows]
+    return [
+      {**{column: str(row[column] or "") for column in safe_group_by}, "events": int(row["events"] or 0)}
+      for row in rows
+    ]
+
+  def _expired_audit_partitions(self, older_than_iso: str) -> list[str]:
+    with self._read() as conn:
+      rows = conn.execute(
+        "SELECT name FROM audit_partitions WHERE archived_at = '' AND period_end <= ? ORDER BY period_start ASC",
+        (older_than_iso,),
+      ).fetchall()
+    return [str(row["name"]) for row in rows]
+
+  def archive_audit_partitions(self, *, older_than_iso: str, archive_dir: Path | None = None) -> dict[str, int]:
+    """Выгружает партиции, целиком старше older_than_iso, в <archive_dir>/<партиция>-<время>.ndjson.gz и удаляет их.
+
+    Выгрузка читает через пул чтения, писатель занят только удалением таблицы. Если в партицию
+    успели дописать (событие задним числом), она остаётся до следующего запуска.
+    """
+    safe_before = self._parse_audit_moment(older_than_iso).isoformat() if str(older_than_iso or "").strip() else ""
+    if not safe_before:
+      return {"partitions": 0, "rows": 0}
+    self.flush_writes()
+    target_dir = archive_dir or (self._db_path.parent / "audit-archive")
+    archived_partitions = 0
+    archived_rows = 0
+    columns_sql = ", ".join(self.AUDIT_EVENT_COLUMNS)
+    for name in self._expired_audit_partitions(safe_before):
+      target_dir.mkdir(parents=True, exist_ok=True)
+      try:
+        os.chmod(target_dir, 0o700)
+      except OSError:
+        pass
+      archived_at = utc_now_iso()
+      stamp = re.sub(r"[^0-9]", "", archived_at)[:14]
+      archive_path = target_dir / f"{name}-{stamp}.ndjson.gz"
+      temp_path = archive_path.with_suffix(".gz.tmp")
+      rows_written = 0
+      last_id = 0
+      with gzip.open(temp_path, "wt", encoding="utf-8") as handle:
+        while True:
+          with self._read() as conn:
+            rows = conn.execute(
+              f"SELECT {columns_sql} FROM {name} WHERE id > ? ORDER BY id ASC LIMIT ?",
+              (last_id, self.AUDIT_ARCHIVE_BATCH_SIZE),
+            ).fetchall()
+          if not rows:
+            break
+          for row in rows:
+            handle.write(json.dumps(self._serialize_audit_event_row(row), ensure_ascii=False))
+            handle.write("\n")
+          rows_written += len(rows)
+          last_id = int(rows[-1]["id"])
+        handle.flush()
+        os.fsync(handle.fileno())
+      try:
+        os.chmod(temp_path, 0o600)
+      except OSError:
+        pass
+      os.replace(temp_path, archive_path)
+
+      def write(name: str = name, rows_written: int = rows_written, last_id: int = last_id) -> bool:
+        row = self._conn.execute(f"SELECT COUNT(*) AS total, COALESCE(MAX(id), 0) AS last_id FROM {name}").fetchone()
+        if int(row["total"]) != rows_written or int(row["last_id"]) != last_id:
+          return False
+        self._conn.execute(
+          "UPDATE audit_partitions SET archived_at=?, archive_path=?, archived_rows=archived_rows + ? WHERE name=?",
+          (archived_at, str(archive_path), rows_written, name),
+        )
+        self._drop_audit_partitions_locked([name])
+        return True
+
+      if self._dispatch_write(write):
+        archived_partitions += 1
+        archived_rows += rows_written
+      else:
+        archive_path.unlink(missing_ok=True)
+    return {"partitions": archived_partitions, "rows": archived_rows}
+
+  def prune_audit_events(self, *, older_than_iso: str, batch_size: int | None = None) -> int:
+    """Удаляет записи аудита старше older_than_iso: целые партиции — DROP TABLE, граничную — пачками."""
+    safe_before = str(older_than_iso or "").strip()
+    if not safe_before:
+      return 0
+    safe_before = self._parse_audit_moment(safe_before).isoformat()
+    safe_batch_size = max(1, int(batch_size or self.AUDIT_PRUNE_BATCH_SIZE))
+    self.flush_writes()
+    removed = 0
+    for name in self._expired_audit_partitions(safe_before):
+      def drop(name: str = name) -> int:
+        row = self._conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()
+        self._conn.execute("DELETE FROM audit_partitions WHERE name=?", (name,))
+        self._drop_audit_partitions_locked([name])
+        return int(row[0]) if row else 0
+
+      removed += int(self._dispatch_write(drop) or 0)
+
+    with self._read() as conn:
+      boundary = conn.execute(
+        "SELECT name FROM audit_partitions WHERE archived_at = '' AND period_start < ? AND period_end > ?",
+        (safe_before, safe_before),
+      ).fetchall()
+    for partition in boundary:
+      name = str(partition["name"])
+      while True:
+        def write(name: str = name) -> int:
+          cursor = self._conn.execute(
+            f"""
+            DELETE FROM {name}
+            WHERE id IN (
+              SELECT id FROM {name} WHERE created_at < ? ORDER BY id LIMIT ?
+            )
+            """,
+            (safe_before, safe_batch_size),
+          )
+          return max(0, int(cursor.rowcount))
+
+        batch_removed = int(self._dispatch_write(write) or 0)
+        removed += batch_removed
+        if batch_removed < safe_batch_size:
+          break
+    return removed
 
   @classmethod
   def _normalize_rate_limit_scope(cls, scope: str) -> str:
@@ -1322,130 +3905,178 @@ class AppStorage:
       safe_now_ts = time.time()
     if safe_now_ts <= 0:
       safe_now_ts = time.time()
-    stale_scope_before = safe_now_ts - safe_window_seconds
-
-    with self._lock, self._conn:
-      self._conn.execute(
-        "DELETE FROM api_rate_limit_hits WHERE scope=? AND ts < ?",
-        (safe_scope, stale_scope_before),
+    if self._rate_limit_shared:
+      return self._consume_rate_limit_shared(
+        safe_scope,
+        budget=safe_budget,
+        window_seconds=safe_window_seconds,
+        now_ts=safe_now_ts,
+        consume=consume,
+        block_seconds=safe_block_seconds,
       )
-      if (safe_now_ts - self._rate_limit_last_cleanup_ts) >= self.RATE_LIMIT_CLEANUP_INTERVAL_SECONDS:
-        stale_global_before = safe_now_ts - max(
-          safe_window_seconds,
-          self.RATE_LIMIT_CLEANUP_RETENTION_SECONDS,
-        )
-        self._conn.execute(
-          "DELETE FROM api_rate_limit_hits WHERE ts < ?",
-          (stale_global_before,),
-        )
-        self._conn.execute(
-          "DELETE FROM api_rate_limit_blocks WHERE blocked_until < ?",
-          (safe_now_ts - self.RATE_LIMIT_BLOCK_RETENTION_SECONDS,),
-        )
-        self._rate_limit_last_cleanup_ts = safe_now_ts
+    # Решение принимается в памяти; в SQLite уходят только снимки (см. _persist_rate_limit_state).
+    return self._rate_limiter.consume(
+      safe_scope,
+      budget=safe_budget,
+      window_seconds=safe_window_seconds,
+      now_ts=safe_now_ts,
+      consume=consume,
+      block_seconds=safe_block_seconds,
+    )
 
-      if safe_block_seconds > 0:
-        block_row = self._conn.execute(
-          "SELECT blocked_until FROM api_rate_limit_blocks WHERE scope=?",
-          (safe_scope,),
+  def _consume_rate_limit_shared(
+    self,
+    scope: str,
+    *,
+    budget: int,
+    window_seconds: float,
+    now_ts: float,
+    consume: bool,
+    block_seconds: float,
+  ) -> tuple[bool, int]:
+    # BEGIN IMMEDIATE берёт блокировку записи SQLite до чтения строки: шаг GCRA
+    # атомарен между процессами, и воркеры не затирают состояние друг друга.
+    with self._lock:
+      self._conn.execute("BEGIN IMMEDIATE")
+      try:
+        row = self._conn.execute(
+          "SELECT tat, blocked_until FROM api_rate_limit_state WHERE scope=?",
+          (scope,),
         ).fetchone()
-        if block_row is not None:
-          try:
-            blocked_until = float(block_row["blocked_until"] or 0.0)
-          except (TypeError, ValueError, KeyError):
-            blocked_until = 0.0
-          if blocked_until > safe_now_ts:
-            retry_after = max(1, int(math.ceil(blocked_until - safe_now_ts)))
-            return True, retry_after
-          self._conn.execute(
-            "DELETE FROM api_rate_limit_blocks WHERE scope=?",
-            (safe_scope,),
-          )
-
-      row = self._conn.execute(
-        "SELECT COUNT(1) AS total, MIN(ts) AS oldest_ts FROM api_rate_limit_hits WHERE scope=?",
-        (safe_scope,),
-      ).fetchone()
-      if row is None:
-        total_hits = 0
-        oldest_ts = safe_now_ts
-      else:
-        try:
-          total_hits = max(0, int(row["total"] or 0))
-        except (TypeError, ValueError, KeyError):
-          total_hits = 0
-        try:
-          oldest_ts = float(row["oldest_ts"] or safe_now_ts)
-        except (TypeError, ValueError, KeyError):
-          oldest_ts = safe_now_ts
-
-      if total_hits >= safe_budget:
-        elapsed = max(0.0, safe_now_ts - oldest_ts)
-        retry_after = max(1, int(math.ceil(safe_window_seconds - elapsed)))
-        if safe_block_seconds > 0:
-          blocked_until = safe_now_ts + safe_block_seconds
-          self._conn.execute(
-            "DELETE FROM api_rate_limit_hits WHERE scope=?",
-            (safe_scope,),
-          )
+        state = [float(row["tat"] or 0.0), float(row["blocked_until"] or 0.0)] if row is not None else None
+        limited, retry_after, next_state, _persist_now = gcra_step(
+          state,
+          budget=budget,
+          window_seconds=window_seconds,
+          now_ts=now_ts,
+          consume=consume,
+          block_seconds=block_seconds,
+        )
+        if next_state is not None:
           self._conn.execute(
             """
-            INSERT INTO api_rate_limit_blocks(scope, blocked_until, updated_at)
-            VALUES(?, ?, ?)
+            INSERT INTO api_rate_limit_state(scope, tat, blocked_until, updated_at)
+            VALUES(?, ?, ?, ?)
             ON CONFLICT(scope)
-            DO UPDATE SET blocked_until=excluded.blocked_until, updated_at=excluded.updated_at
+            DO UPDATE SET tat=excluded.tat, blocked_until=excluded.blocked_until, updated_at=excluded.updated_at
             """,
-            (safe_scope, blocked_until, safe_now_ts),
+            (scope, next_state[0], next_state[1], now_ts),
           )
-          retry_after = max(retry_after, max(1, int(math.ceil(blocked_until - safe_now_ts))))
-        return True, retry_after
+        self._conn.commit()
+      except BaseException:
+        self._conn.rollback()
+        raise
+    return limited, retry_after
+
+  def _load_rate_limit_state(self) -> list[tuple[str, float, float]]:
+    now_ts = time.time()
+    with self._lock, self._conn:
+      self._conn.execute(
+        "DELETE FROM api_rate_limit_state WHERE tat <= ? AND blocked_until <= ?",
+        (now_ts, now_ts),
+      )
+      rows = self._conn.execute(
+        "SELECT scope, tat, blocked_until FROM api_rate_limit_state"
+      ).fetchall()
+    return [(str(row["scope"]), float(row["tat"] or 0.0), float(row["blocked_until"] or 0.0)) for row in rows]
 
-      if consume:
-        self._conn.execute(
-          "INSERT INTO api_rate_limit_hits(scope, ts) VALUES(?, ?)",
-          (safe_scope, safe_now_ts),
+  def _persist_rate_limit_state(self, upserts: list[tuple[str, float, float]], deletes: list[str]) -> None:
+    now_ts = time.time()
+
+    def write() -> None:
+      if upserts:
+        self._conn.executemany(
+          """
+          INSERT INTO api_rate_limit_state(scope, tat, blocked_until, updated_at)
+          VALUES(?, ?, ?, ?)
+          ON CONFLICT(scope)
+          DO UPDATE SET tat=excluded.tat, blocked_until=excluded.blocked_until, updated_at=excluded.updated_at
+          """,
+          [(scope, tat, blocked_until, now_ts) for scope, tat, blocked_until in upserts],
         )
-        if safe_block_seconds > 0 and (total_hits + 1) >= safe_budget:
-          blocked_until = safe_now_ts + safe_block_seconds
-          self._conn.execute(
-            "DELETE FROM api_rate_limit_hits WHERE scope=?",
-            (safe_scope,),
-          )
-          self._conn.execute(
-            """
-            INSERT INTO api_rate_limit_blocks(scope, blocked_until, updated_at)
-            VALUES(?, ?, ?)
-            ON CONFLICT(scope)
-            DO UPDATE SET blocked_until=excluded.blocked_until, updated_at=excluded.updated_at
-            """,
-            (safe_scope, blocked_until, safe_now_ts),
-          )
+      if deletes:
+        self._conn.executemany(
+          "DELETE FROM api_rate_limit_state WHERE scope=?",
+          [(scope,) for scope in deletes],
+        )
+
+    self._dispatch_write(write)
+
+  def flush_rate_limit_state(self) -> int:
+    """Снимок состояния лимитера в SQLite (вызывается периодически и при остановке)."""
+    return self._rate_limiter.snapshot()
+
+  def prune_rate_limit_state(self, *, now_ts: float | None = None) -> int:
+    """Удаляет строки лимитера, которые уже ничего не ограничивают."""
+    safe_now_ts = float(now_ts) if now_ts is not None else time.time()
+
+    def write() -> int:
+      cursor = self._conn.execute(
+        "DELETE FROM api_rate_limit_state WHERE tat <= ? AND blocked_until <= ?",
+        (safe_now_ts, safe_now_ts),
+      )
+      return max(0, int(cursor.rowcount))
 
-    return False, 0
+    return self._dispatch_write(write)
 
   def clear_api_rate_limit_scope(self, scope: str) -> None:
     safe_scope = self._normalize_rate_limit_scope(scope)
     if not safe_scope:
       return
+    self._rate_limiter.clear(safe_scope)
     with self._lock, self._conn:
       self._conn.execute(
-        "DELETE FROM api_rate_limit_hits WHERE scope=?",
-        (safe_scope,),
-      )
-      self._conn.execute(
-        "DELETE FROM api_rate_limit_blocks WHERE scope=?",
+        "DELETE FROM api_rate_limit_state WHERE scope=?",
         (safe_scope,),
       )
 
-  def get_setting(self, key: str) -> str | None:
+  def _read_data_version(self) -> int:
     with self._lock:
-      row = self._conn.execute(
+      row = self._conn.execute("PRAGMA data_version").fetchone()
+    return int(row[0]) if row is not None else 0
+
+  def _invalidate_settings_cache(self) -> None:
+    with self._settings_cache_lock:
+      self._settings_cache.clear()
+      self._settings_json_cache.clear()
+      self._settings_cache_generation += 1
+
+  def _check_settings_data_version(self) -> None:
+    # data_version соединения-писателя меняется только от коммитов других соединений
+    # (другой процесс, внешний редактор БД). Проверяем не чаще раза в секунду и только
+    # если писатель свободен — чтение настроек не должно ждать стриминговых записей.
+    now_monotonic = time.monotonic()
+    if (now_monotonic - self._settings_version_checked_at) < SETTINGS_CACHE_VERSION_CHECK_INTERVAL_SECONDS:
+      return
+    if not self._lock.acquire(blocking=False):
+      return
+    try:
+      self._settings_version_checked_at = now_monotonic
+      row = self._conn.execute("PRAGMA data_version").fetchone()
+    finally:
+      self._lock.release()
+    data_version = int(row[0]) if row is not None else 0
+    if data_version != self._settings_data_version:
+      self._settings_data_version = data_version
+      self._invalidate_settings_cache()
+
+  def get_setting(self, key: str) -> str | None:
+    self._check_settings_data_version()
+    with self._settings_cache_lock:
+      if key in self._settings_cache:
+        return self._settings_cache[key]
+      generation = self._settings_cache_generation
+    with self._read() as conn:
+      row = conn.execute(
         "SELECT value FROM settings WHERE key=?",
         (key,),
       ).fetchone()
-    if not row:
-      return None
-    return str(row["value"])
+    value = str(row["value"]) if row else None
+    with self._settings_cache_lock:
+      # Пока читали, могла пройти запись или сброс — тогда прочитанное уже устарело.
+      if generation == self._settings_cache_generation:
+        self._settings_cache[key] = value
+    return value
 
   def set_setting(self, key: str, value: str) -> None:
     now = utc_now_iso()
@@ -1459,15 +4090,31 @@ class AppStorage:
         """,
         (key, value, now),
       )
+    # Кэш обновляем только после успешного коммита.
+    with self._settings_cache_lock:
+      self._settings_cache[key] = value
+      self._settings_json_cache.pop(key, None)
+      self._settings_cache_generation += 1
 
   def get_setting_json(self, key: str, fallback: Any = None) -> Any:
+    self._check_settings_data_version()
+    with self._settings_cache_lock:
+      cached = self._settings_json_cache.get(key, None)
+      has_cached = key in self._settings_json_cache
+      generation = self._settings_cache_generation
+    if has_cached:
+      return fallback if cached is _SETTINGS_INVALID_JSON else _clone_json_value(cached)
     raw = self.get_setting(key)
     if raw is None:
       return fallback
     try:
-      return json.loads(raw)
+      decoded = json.loads(raw)
     except json.JSONDecodeError:
-      return fallback
+      decoded = _SETTINGS_INVALID_JSON
+    with self._settings_cache_lock:
+      if generation == self._settings_cache_generation:
+        self._settings_json_cache[key] = decoded
+    return fallback if decoded is _SETTINGS_INVALID_JSON else _clone_json_value(decoded)
 
   def set_setting_json(self, key: str, value: Any) -> None:
     self.set_setting(key, json.dumps(value, ensure_ascii=False))
@@ -1487,33 +4134,68 @@ class AppStorage:
     self.set_setting(key, "1" if bool(value) else "0")
 
   def reset_runtime_data(self) -> None:
+    self.flush_writes()
+    self._rate_limiter.reset()
     with self._lock, self._conn:
       self._conn.execute("DELETE FROM messages")
       self._conn.execute("DELETE FROM chats")
       self._conn.execute("DELETE FROM settings")
       self._conn.execute("DELETE FROM plugin_state")
-      self._conn.execute("DELETE FROM api_rate_limit_hits")
-      self._conn.execute("DELETE FROM api_rate_limit_blocks")
+      self._conn.execute("DELETE FROM attachment_owners")
+      self._conn.execute("DELETE FROM api_rate_limit_state")
+      # Ревизии не удаляем, а сдвигаем: закэшированный клиентом ETag не должен совпасть с пустым списком.
+      self._bump_all_chat_revisions_locked()
+      self._reset_chat_change_log_locked(None)
+    self._invalidate_settings_cache()
     with self._lock:
       self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
   def reset_all(self) -> None:
+    self.flush_writes()
+    self._rate_limiter.reset()
     with self._lock, self._conn:
       self._conn.execute("DELETE FROM messages")
       self._conn.execute("DELETE FROM chats")
       self._conn.execute("DELETE FROM settings")
       self._conn.execute("DELETE FROM plugin_state")
+      self._conn.execute("DELETE FROM attachment_owners")
       self._conn.execute("DELETE FROM auth_sessions")
       self._conn.execute("DELETE FROM users")
-      self._conn.execute("DELETE FROM audit_events")
-      self._conn.execute("DELETE FROM api_rate_limit_hits")
-      self._conn.execute("DELETE FROM api_rate_limit_blocks")
+      self._conn.execute("DELETE FROM audit_rollups")
+      audit_partitions = [str(row["name"]) for row in self._conn.execute("SELECT name FROM audit_partitions").fetchall()]
+      self._conn.execute("DELETE FROM audit_partitions")
+      self._drop_audit_partitions_locked(audit_partitions)
+      self._conn.execute("DELETE FROM api_rate_limit_state")
+      self._bump_all_chat_revisions_locked()
+      self._reset_chat_change_log_locked(None)
+    self._invalidate_settings_cache()
     with self._lock:
       self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
+  def grant_attachment_owner(self, sha256: str, *, owner_user_id: str = "") -> None:
+    safe_sha = str(sha256 or "").strip().lower()
+    if not is_attachment_sha256(safe_sha):
+      return
+    with self._lock, self._conn:
+      self._conn.execute(
+        "INSERT OR IGNORE INTO attachment_owners(owner_user_id, sha256, created_at) VALUES(?, ?, ?)",
+        (self._normalize_owner_user_id(owner_user_id), safe_sha, utc_now_iso()),
+      )
+
+  def has_attachment_owner(self, sha256: str, *, owner_user_id: str = "") -> bool:
+    safe_sha = str(sha256 or "").strip().lower()
+    if not is_attachment_sha256(safe_sha):
+      return False
+    with self._read() as conn:
+      row = conn.execute(
+        "SELECT 1 FROM attachment_owners WHERE owner_user_id=? AND sha256=?",
+        (self._normalize_owner_user_id(owner_user_id), safe_sha),
+      ).fetchone()
+    return row is not None
+
   def get_plugin_state(self) -> dict[str, bool]:
-    with self._lock:
-      rows = self._conn.execute("SELECT plugin_id, enabled FROM plugin_state").fetchall()
+    with self._read() as conn:
+      rows = conn.execute("SELECT plugin_id, enabled FROM plugin_state").fetchall()
     return {str(row["plugin_id"]): bool(row["enabled"]) for row in rows}
 
   def set_plugin_enabled(self, plugin_id: str, enabled: bool) -> None:
@@ -1563,8 +4245,8 @@ class AppStorage:
     }
 
   def count_users(self) -> int:
-    with self._lock:
-      row = self._conn.execute("SELECT COUNT(1) AS total FROM users").fetchone()
+    with self._read() as conn:
+      row = conn.execute("SELECT COUNT(1) AS total FROM users").fetchone()
     if row is None:
       return 0
     try:
@@ -1576,8 +4258,8 @@ class AppStorage:
     safe_user_id = str(user_id or "").strip()
     if not safe_user_id:
       return None
-    with self._lock:
-      row = self._conn.execute(
+    with self._read() as conn:
+      row = conn.execute(
         """
         SELECT id, username, password_hash, role, status, permissions_json, created_at, updated_at, last_login_at
         FROM users
@@ -1595,8 +4277,8 @@ class AppStorage:
     safe_username = str(username or "").strip().lower()
     if not safe_username:
       return None
-    with self._lock:
-      row = self._conn.execute(
+    with self._read() as conn:
+      row = conn.execute(
         """
         SELECT id, username, password_hash, role, status, permissions_json, created_at, updated_at, last_login_at
         FROM users
@@ -1611,8 +4293,8 @@ class AppStorage:
     return payload
 
   def list_users(self) -> list[dict[str, Any]]:
-    with self._lock:
-      rows = self._conn.execute(
+    with self._read() as conn:
+      rows = conn.execute(
         """
         SELECT id, username, role, status, permissions_json, created_at, updated_at, last_login_at
         FROM users
@@ -1772,8 +4454,8 @@ class AppStorage:
     safe_token_hash = str(token_hash or "").strip()
     if not safe_token_hash:
       return None
-    with self._lock:
-      row = self._conn.execute(
+    with self._read() as conn:
+      row = conn.execute(
         """
         SELECT id, user_id, token_hash, created_at, expires_at, revoked_at, last_seen_at
         FROM auth_sessions
@@ -1783,23 +4465,33 @@ class AppStorage:
       ).fetchone()
     return dict(row) if row else None
 
-  def touch_auth_session(self, session_id: str, *, last_seen_at: str, expires_at: str | None = None) -> bool:
+  def touch_auth_session(
+    self,
+    session_id: str,
+    *,
+    last_seen_at: str,
+    expires_at: str | None = None,
+    wait: bool = True,
+  ) -> bool | Future[bool]:
     safe_session_id = str(session_id or "").strip()
     if not safe_session_id:
-      return False
+      return self._completed_write(False, wait=wait)
     updates: list[str] = ["last_seen_at=?"]
     params: list[Any] = [str(last_seen_at or utc_now_iso())]
     if expires_at is not None:
       updates.append("expires_at=?")
       params.append(str(expires_at or ""))
     params.append(safe_session_id)
-    with self._lock, self._conn:
+
+    def write() -> bool:
       cursor = self._conn.execute(
         f"UPDATE auth_sessions SET {', '.join(updates)} WHERE id=?",
         tuple(params),
       )
       return cursor.rowcount > 0
 
+    return self._dispatch_write(write, wait=wait)
+
   def revoke_auth_session(self, session_id: str) -> bool:
     safe_session_id = str(session_id or "").strip()
     if not safe_session_id:
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import os
+import threading
+import zlib
+from typing import Any
+
+try:
+  import zstandard  # type: ignore
+except ImportError:
+  zstandard = None
+
+# Значения колонки messages.meta_codec.
+CODEC_PLAIN = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+COMPRESSION_DEFAULT_MIN_BYTES = 1024
+COMPRESSION_ZLIB_LEVEL = 6
+COMPRESSION_ZSTD_LEVEL = 6
+# Сжатие, экономящее меньше ~10%, не окупает распаковку на каждом чтении.
+COMPRESSION_MIN_RATIO = 0.9
+
+_zstd_local = threading.local()
+
+
+def resolve_compression_min_bytes() -> int:
+  """Порог сжатия из ANCIA_SQLITE_COMPRESS_MIN_BYTES; 0 — не сжимать новые записи."""
+  raw = str(os.getenv("ANCIA_SQLITE_COMPRESS_MIN_BYTES", "") or "").strip()
+  try:
+    value = int(raw) if raw else COMPRESSION_DEFAULT_MIN_BYTES
+  except ValueError:
+    value = COMPRESSION_DEFAULT_MIN_BYTES
+  return max(0, min(16 * 1024 * 1024, value))
+
+
+def preferred_codec() -> int:
+  return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+
+def _zstd_compressor() -> Any:
+  # Объекты zstandard не потокобезопасны — держим по одному на поток.
+  compressor = getattr(_zstd_local, "compressor", None)
+  if compressor is None:
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL)
+    _zstd_local.compressor = compressor
+  return compressor
+
+
+def _zstd_decompressor() -> Any:
+  decompressor = getattr(_zstd_local, "decompressor", None)
+  if decompressor is None:
+    decompressor = zstandard.ZstdDecompressor()
+    _zstd_local.decompressor = decompressor
+  return decompressor
+
+
+def encode_text(value: str, *, min_bytes: int, codec: int | None = None) -> tuple[str | bytes, int]:
+  """Возвращает (значение для колонки, codec): короткие и плохо сжимаемые строки остаются текстом."""
+  raw = value.encode("utf-8")
+  if min_bytes <= 0 or len(raw) < min_bytes:
+    return value, CODEC_PLAIN
+  safe_codec = preferred_codec() if codec is None else int(codec)
+  if safe_codec == CODEC_ZSTD and zstandard is not None:
+    packed = _zstd_compressor().compress(raw)
+  elif safe_codec in {CODEC_ZLIB, CODEC_ZSTD}:
+    safe_codec = CODEC_ZLIB
+    packed = zlib.compress(raw, COMPRESSION_ZLIB_LEVEL)
+  else:
+    return value, CODEC_PLAIN
+  if len(packed) > len(raw) * COMPRESSION_MIN_RATIO:
+    return value, CODEC_PLAIN
+  return packed, safe_codec
+
+
+def decode_text(value: Any, codec: Any) -> str:
+  safe_codec = int(codec or CODEC_PLAIN)
+  if value is None:
+    return ""
+  if safe_codec == CODEC_PLAIN:
+    return value.decode("utf-8", errors="replace") if isinstance(value, (bytes, bytearray)) else str(value)
+  raw = bytes(value) if isinstance(value, (bytes, bytearray, memoryview)) else str(value).encode("latin-1")
+  if safe_codec == CODEC_ZLIB:
+    return zlib.decompress(raw).decode("utf-8", errors="replace")
+  if safe_codec == CODEC_ZSTD:
+    if zstandard is None:
+      raise RuntimeError("zstandard is required to read zstd-compressed rows; install the 'zstandard' package")
+    return _zstd_decompressor().decompress(raw).decode("utf-8", errors="replace")
+  raise ValueError(f"Unknown storage codec: {safe_codec}")
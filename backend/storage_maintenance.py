@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+try:
+  from backend.common import utc_now_iso
+except ModuleNotFoundError:
+  from common import utc_now_iso  # type: ignore
+
+MAINTENANCE_DEFAULT_TICK_SECONDS = 5.0
+MAINTENANCE_DEFAULT_IDLE_SECONDS = 5.0
+
+LOGGER = logging.getLogger("ancia.backend.maintenance")
+
+
+def read_maintenance_env_seconds(name: str, fallback: float, *, minimum: float = 0.0, maximum: float = 7 * 86400.0) -> float:
+  raw = str(os.getenv(name, "") or "").strip()
+  try:
+    value = float(raw) if raw else fallback
+  except ValueError:
+    value = fallback
+  return max(minimum, min(maximum, value))
+
+
+class _MaintenanceTask:
+  __slots__ = (
+    "name",
+    "fn",
+    "interval_seconds",
+    "idle_only",
+    "next_run_at",
+    "runs",
+    "failures",
+    "skipped_busy",
+    "last_run_at",
+    "last_duration_ms",
+    "last_result",
+    "last_error",
+  )
+
+  def __init__(
+    self,
+    name: str,
+    fn: Callable[[], Any],
+    *,
+    interval_seconds: float,
+    idle_only: bool,
+    first_run_at: float,
+  ) -> None:
+    self.name = name
+    self.fn = fn
+    self.interval_seconds = interval_seconds
+    self.idle_only = idle_only
+    self.next_run_at = first_run_at
+    self.runs = 0
+    self.failures = 0
+    self.skipped_busy = 0
+    self.last_run_at = ""
+    self.last_duration_ms = 0.0
+    self.last_result: Any = None
+    self.last_error = ""
+
+
+class StorageMaintenance:
+  """Один фоновый поток для периодического обслуживания SQLite.
+
+  Задачи (очистка сессий, лимитов, аудита, журнала изменений чатов, checkpoint, vacuum, optimize) регистрируются
+  с собственным интервалом; задачи с idle_only=True откладываются, пока писатель занят.
+  """
+
+  def __init__(
+    self,
+    *,
+    is_idle_fn: Callable[[], bool] | None = None,
+    tick_seconds: float = MAINTENANCE_DEFAULT_TICK_SECONDS,
+  ) -> None:
+    self._is_idle_fn = is_idle_fn
+    self._tick_seconds = max(0.0, float(tick_seconds))
+    self._tasks: dict[str, _MaintenanceTask] = {}
+    self._lock = threading.Lock()
+    self._run_lock = threading.Lock()
+    self._stop_event = threading.Event()
+    self._thread: threading.Thread | None = None
+    self._started_at = ""
+
+  @property
+  def enabled(self) -> bool:
+    return self._tick_seconds > 0
+
+  def add_task(
+    self,
+    name: str,
+    fn: Callable[[], Any],
+    *,
+    interval_seconds: float,
+    idle_only: bool = False,
+    initial_delay_seconds: float | None = None,
+  ) -> None:
+    safe_interval = float(interval_seconds)
+    if safe_interval <= 0:
+      # Нулевой интервал в настройках — задача выключена.
+      return
+    delay = safe_interval if initial_delay_seconds is None else max(0.0, float(initial_delay_seconds))
+    with self._lock:
+      self._tasks[name] = _MaintenanceTask(
+        name,
+        fn,
+        interval_seconds=safe_interval,
+        idle_only=idle_only,
+        first_run_at=time.monotonic() + delay,
+      )
+
+  def start(self) -> None:
+    if not self.enabled or self._thread is not None:
+      return
+    self._started_at = utc_now_iso()
+    self._thread = threading.Thread(target=self._loop, name="ancia-storage-maintenance", daemon=True)
+    self._thread.start()
+
+  def stop(self, *, timeout: float = 5.0) -> None:
+    self._stop_event.set()
+    thread = self._thread
+    if thread is not None and thread is not threading.current_thread():
+      thread.join(timeout=max(0.0, timeout))
+
+  def _loop(self) -> None:
+    while not self._stop_event.is_set():
+      self.run_pending()
+      self._stop_event.wait(self._tick_seconds)
+
+  def _is_idle(self) -> bool:
+    if self._is_idle_fn is None:
+      return True
+    try:
+      return bool(self._is_idle_fn())
+    except Exception:
+      return False
+
+  def run_pending(self, *, force: bool = False) -> list[str]:
+    """Выполняет задачи, у которых подошёл срок; force=True — все задачи сразу."""
+    executed: list[str] = []
+    with self._run_lock:
+      now = time.monotonic()
+      with self._lock:
+        due = [task for task in self._tasks.values() if force or task.next_run_at <= now]
+      for task in due:
+        if self._stop_event.is_set() and not force:
+          break
+        if task.idle_only and not force and not self._is_idle():
+          # Не мешаем пишущим запросам: попробуем на следующем тике.
+          task.skipped_busy += 1
+          continue
+        self._run_task(task)
+        executed.append(task.name)
+    return executed
+
+  def run_task(self, name: str) -> bool:
+    with self._lock:
+      task = self._tasks.get(name)
+    if task is None:
+      return False
+    with self._run_lock:
+      self._run_task(task)
+    return True
+
+  def _run_task(self, task: _MaintenanceTask) -> None:
+    started = time.perf_counter()
+    task.last_run_at = utc_now_iso()
+    try:
+      task.last_result = task.fn()
+      task.last_error = ""
+    except Exception as exc:
+      task.failures += 1
+      task.last_result = None
+      task.last_error = str(exc) or exc.__class__.__name__
+      LOGGER.warning("Storage maintenance task '%s' failed: %s", task.name, exc)
+    finally:
+      task.runs += 1
+      task.last_duration_ms = round((time.perf_counter() - started) * 1000.0, 3)
+      task.next_run_at = time.monotonic() + task.interval_seconds
+
+  def snapshot(self) -> dict[str, Any]:
+    now = time.monotonic()
+    with self._lock:
+      tasks = list(self._tasks.values())
+    return {
+      "enabled": self.enabled,
+      "running": bool(self._thread is not None and self._thread.is_alive()),
+      "started_at": self._started_at,
+      "tick_seconds": self._tick_seconds,
+      "idle": self._is_idle(),
+      "tasks": [
+        {
+          "name": task.name,
+          "interval_seconds": task.interval_seconds,
+          "idle_only": task.idle_only,
+          "runs": task.runs,
+          "failures": task.failures,
+          "skipped_busy": task.skipped_busy,
+          "last_run_at": task.last_run_at,
+          "last_duration_ms": task.last_duration_ms,
+          "last_result": task.last_result,
+          "last_error": task.last_error,
+          "next_run_in_seconds": round(max(0.0, task.next_run_at - now), 3),
+        }
+        for task in tasks
+      ],
+    }
+
+
+def build_storage_maintenance(
+  storage: Any,
+  *,
+  auth_service: Any = None,
+  attachment_store: Any = None,
+  shared_tasks: bool = True,
+) -> StorageMaintenance:
+  """Собирает планировщик с задачами по умолчанию; интервалы переопределяются через ANCIA_MAINTENANCE_*.
+
+  shared_tasks=False оставляет только задачи с состоянием процесса (сессии, лимитер) — так запускаются
+  API-воркеры при отдельном сервере модели, а общие для базы задачи выполняет один процесс сервера модели.
+  """
+  idle_seconds = read_maintenance_env_seconds("ANCIA_MAINTENANCE_IDLE_SECONDS", MAINTENANCE_DEFAULT_IDLE_SECONDS)
+  maintenance = StorageMaintenance(
+    is_idle_fn=lambda: storage.is_writer_idle(idle_seconds),
+    tick_seconds=read_maintenance_env_seconds(
+      "ANCIA_MAINTENANCE_TICK_SECONDS",
+      MAINTENANCE_DEFAULT_TICK_SECONDS,
+      maximum=3600.0,
+    ),
+  )
+
+  if auth_service is not None:
+    maintenance.add_task(
+      "auth_sessions",
+      auth_service.prune_sessions,
+      interval_seconds=read_maintenance_env_seconds("ANCIA_AUTH_SESSION_PRUNE_INTERVAL_SECONDS", 300.0),
+      initial_delay_seconds=0.0,
+    )
+
+  def prune_rate_limits() -> dict[str, int]:
+    return {
+      "snapshot": int(storage.flush_rate_limit_state() or 0),
+      "pruned": int(storage.prune_rate_limit_state() or 0),
+    }
+
+  maintenance.add_task(
+    "rate_limit_state",
+    prune_rate_limits,
+    interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_RATE_LIMIT_INTERVAL_SECONDS", 30.0),
+  )
+  if not shared_tasks:
+    return maintenance
+
+  audit_retention_days = read_maintenance_env_seconds("ANCIA_AUDIT_RETENTION_DAYS", 180.0, maximum=36500.0)
+  # По умолчанию просроченные партиции аудита уходят в сжатый NDJSON (ANCIA_AUDIT_ARCHIVE_DIR,
+  # иначе <data>/audit-archive); ANCIA_AUDIT_ARCHIVE=0 возвращает простое удаление.
+  audit_archive_enabled = str(os.getenv("ANCIA_AUDIT_ARCHIVE", "1") or "").strip().lower() in {"1", "true", "yes", "on"}
+  audit_archive_dir_raw = str(os.getenv("ANCIA_AUDIT_ARCHIVE_DIR", "") or "").strip()
+  audit_archive_dir = Path(audit_archive_dir_raw).expanduser().resolve() if audit_archive_dir_raw else None
+  if audit_retention_days > 0:
+    def prune_audit() -> Any:
+      threshold = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=audit_retention_days)
+      if audit_archive_enabled and hasattr(storage, "archive_audit_partitions"):
+        return storage.archive_audit_partitions(older_than_iso=threshold.isoformat(), archive_dir=audit_archive_dir)
+      return int(storage.prune_audit_events(older_than_iso=threshold.isoformat()) or 0)
+
+    maintenance.add_task(
+      "audit_events",
+      prune_audit,
+      interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_AUDIT_INTERVAL_SECONDS", 3600.0),
+      idle_only=True,
+      initial_delay_seconds=60.0,
+    )
+
+  change_log_retention_days = read_maintenance_env_seconds("ANCIA_CHAT_CHANGE_LOG_RETENTION_DAYS", 30.0, maximum=36500.0)
+  change_log_max_rows = int(read_maintenance_env_seconds("ANCIA_CHAT_CHANGE_LOG_MAX_ROWS", 200_000.0, maximum=100_000_000.0))
+
+  def compact_change_log() -> dict[str, int]:
+    threshold = ""
+    if change_log_retention_days > 0:
+      threshold = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=change_log_retention_days)).isoformat()
+    return storage.compact_chat_change_log(older_than_iso=threshold, max_rows=change_log_max_rows)
+
+  maintenance.add_task(
+    "chat_change_log",
+    compact_change_log,
+    interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_CHANGE_LOG_INTERVAL_SECONDS", 3600.0),
+    idle_only=True,
+    initial_delay_seconds=120.0,
+  )
+
+  if attachment_store is not None:
+    # Вложения пишут и API-воркеры: владелец вытеснения пересобирает индекс по диску и держит лимит размера.
+    maintenance.add_task(
+      "attachments",
+      attachment_store.sweep,
+      interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_ATTACHMENTS_INTERVAL_SECONDS", 300.0),
+      initial_delay_seconds=30.0,
+    )
+
+  maintenance.add_task(
+    "wal_checkpoint",
+    lambda: storage.checkpoint_wal(mode="PASSIVE"),
+    interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_CHECKPOINT_INTERVAL_SECONDS", 60.0),
+    idle_only=True,
+  )
+  vacuum_pages = int(read_maintenance_env_seconds("ANCIA_MAINTENANCE_VACUUM_PAGES", 2048.0, minimum=1.0, maximum=1_000_000.0))
+  maintenance.add_task(
+    "incremental_vacuum",
+    lambda: storage.incremental_vacuum(max_pages=vacuum_pages),
+    interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_VACUUM_INTERVAL_SECONDS", 600.0),
+    idle_only=True,
+  )
+  if str(os.getenv("ANCIA_MAINTENANCE_AUTO_VACUUM_CONVERT", "") or "").strip().lower() in {"1", "true", "yes", "on"}:
+    # Перестройка файла блокирует запись на всё время VACUUM — только по явному согласию и при простое.
+    maintenance.add_task(
+      "auto_vacuum_convert",
+      storage.enable_incremental_auto_vacuum,
+      interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_AUTO_VACUUM_CONVERT_INTERVAL_SECONDS", 3600.0),
+      idle_only=True,
+      initial_delay_seconds=600.0,
+    )
+  maintenance.add_task(
+    "optimize",
+    storage.optimize,
+    interval_seconds=read_maintenance_env_seconds("ANCIA_MAINTENANCE_OPTIMIZE_INTERVAL_SECONDS", 6 * 3600.0),
+    idle_only=True,
+    initial_delay_seconds=300.0,
+  )
+  return maintenance
@@ -0,0 +1,459 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import threading
+import types
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+try:
+  from backend.storage import AppStorage, MigrationProgress
+except ModuleNotFoundError:
+  from storage import AppStorage, MigrationProgress  # type: ignore
+
+SHARD_DEFAULT_CACHE_SIZE = 32
+SHARD_FILE_PREFIX = "owner-"
+
+LOGGER = logging.getLogger("ancia.backend.storage")
+
+# Методы AppStorage с данными чатов владельца (и его правами на вложения): вызываются на файле шарда этого владельца.
+OWNER_SCOPED_METHODS = (
+  "append_message",
+  "clear_chat_messages",
+  "create_chat",
+  "delete_chat",
+  "delete_message",
+  "duplicate_chat",
+  "edit_message",
+  "ensure_chat",
+  "export_chat_store_markdown",
+  "export_chat_store_payload",
+  "get_chat",
+  "get_chat_change_seq",
+  "get_chat_changes",
+  "get_chat_messages",
+  "get_chat_messages_page",
+  "get_chat_revision",
+  "get_chat_session",
+  "get_chat_store_revision",
+  "get_message_tool_payload",
+  "get_recent_messages",
+  "grant_attachment_owner",
+  "has_attachment_owner",
+  "import_chat_store_payload",
+  "iter_export_chat_store_markdown",
+  "iter_export_chat_store_ndjson",
+  "iter_import_chat_store_ndjson",
+  "list_chat_store",
+  "list_chats",
+  "list_chats_page",
+  "search_messages",
+  "update_chat",
+  "update_chat_mood",
+  "update_message",
+)
+
+
+def is_owner_sharding_enabled() -> bool:
+  return str(os.getenv("ANCIA_SQLITE_SHARD_BY_OWNER", "") or "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+def _resolve_shard_cache_size() -> int:
+  raw = str(os.getenv("ANCIA_SQLITE_SHARD_CACHE_SIZE", "") or "").strip()
+  try:
+    value = int(raw) if raw else SHARD_DEFAULT_CACHE_SIZE
+  except ValueError:
+    value = SHARD_DEFAULT_CACHE_SIZE
+  return max(1, min(4096, value))
+
+
+def shard_path_for_owner(shards_dir: Path, owner_user_id: str) -> Path:
+  # Имя файла — хэш владельца: id пользователя не попадает в ФС и не требует экранирования.
+  digest = hashlib.sha256(str(owner_user_id or "").encode("utf-8")).hexdigest()[:32]
+  return shards_dir / f"{SHARD_FILE_PREFIX}{digest}.db"
+
+
+class _ShardEntry:
+  __slots__ = ("storage", "refs")
+
+  def __init__(self, storage: AppStorage) -> None:
+    self.storage = storage
+    self.refs = 0
+
+
+class ShardPool:
+  """LRU открытых файлов шардов.
+
+  Шард, который сейчас используется (refs > 0), не закрывается: при переполнении кэш
+  временно держит больше capacity файлов и закрывает лишние по мере освобождения.
+  """
+
+  def __init__(
+    self,
+    *,
+    capacity: int,
+    factory: Callable[[Path], AppStorage] = AppStorage,
+  ) -> None:
+    self._capacity = max(1, int(capacity))
+    self._factory = factory
+    self._entries: OrderedDict[Path, _ShardEntry] = OrderedDict()
+    self._lock = threading.Lock()
+    # Открытие нового файла прогоняет миграции — не параллелим его для одного и того же файла.
+    self._open_lock = threading.Lock()
+    self._opened = 0
+    self._evicted = 0
+    self._closed = False
+
+  def _acquire(self, path: Path) -> _ShardEntry:
+    with self._lock:
+      if self._closed:
+        raise RuntimeError("storage shard pool is closed")
+      entry = self._entries.get(path)
+      if entry is not None:
+        entry.refs += 1
+        self._entries.move_to_end(path)
+        return entry
+    with self._open_lock:
+      with self._lock:
+        entry = self._entries.get(path)
+        if entry is not None:
+          entry.refs += 1
+          self._entries.move_to_end(path)
+          return entry
+      storage = self._factory(path)
+      with self._lock:
+        entry = _ShardEntry(storage)
+        entry.refs = 1
+        self._entries[path] = entry
+        self._opened += 1
+    return entry
+
+  def _release(self, path: Path, entry: _ShardEntry) -> None:
+    with self._lock:
+      entry.refs = max(0, entry.refs - 1)
+      evicted = self._evict_locked()
+    for storage in evicted:
+      storage.close()
+
+  def _evict_locked(self) -> list[AppStorage]:
+    evicted: list[AppStorage] = []
+    if len(self._entries) <= self._capacity:
+      return evicted
+    for path in list(self._entries.keys()):
+      if len(self._entries) <= self._capacity:
+        break
+      entry = self._entries[path]
+      if entry.refs > 0:
+        continue
+      del self._entries[path]
+      evicted.append(entry.storage)
+      self._evicted += 1
+    return evicted
+
+  @contextmanager
+  def lease(self, path: Path) -> Iterator[AppStorage]:
+    entry = self._acquire(path)
+    try:
+      yield entry.storage
+    finally:
+      self._release(path, entry)
+
+  def open_paths(self) -> list[Path]:
+    with self._lock:
+      return list(self._entries.keys())
+
+  def snapshot(self) -> dict[str, Any]:
+    with self._lock:
+      return {
+        "capacity": self._capacity,
+        "open": len(self._entries),
+        "in_use": sum(1 for entry in self._entries.values() if entry.refs > 0),
+        "opened": self._opened,
+        "evicted": self._evicted,
+      }
+
+  def close(self) -> None:
+    with self._lock:
+      self._closed = True
+      entries = list(self._entries.values())
+      self._entries.clear()
+    for entry in entries:
+      entry.storage.close()
+
+
+def _owner_routed(name: str) -> Callable[..., Any]:
+  base = getattr(AppStorage, name)
+
+  def routed(self: "ShardedAppStorage", *args: Any, owner_user_id: str = "", **kwargs: Any) -> Any:
+    stack = ExitStack()
+    try:
+      target = stack.enter_context(self._lease_owner(owner_user_id))
+      result = base(target, *args, owner_user_id=owner_user_id, **kwargs)
+    except BaseException:
+      stack.close()
+      raise
+    if isinstance(result, types.GeneratorType):
+      # Потоковый экспорт/импорт: шард держим открытым, пока генератор не дочитан.
+      return _hold_while_iterating(result, stack)
+    stack.close()
+    return result
+
+  routed.__name__ = name
+  routed.__qualname__ = f"ShardedAppStorage.{name}"
+  routed.__doc__ = base.__doc__
+  return routed
+
+
+def _hold_while_iterating(generator: Iterator[Any], stack: ExitStack) -> Iterator[Any]:
+  with stack:
+    yield from generator
+
+
+class ShardedAppStorage(AppStorage):
+  """AppStorage, где чаты и сообщения каждого владельца лежат в отдельном файле SQLite.
+
+  Общие таблицы (пользователи, сессии, настройки, аудит, лимиты) остаются в основной базе.
+  У каждого шарда свой писатель, пул чтения и очередь group commit, поэтому запись одного
+  пользователя не блокирует остальных. Чаты без владельца ('' — локальный режим) остаются в основной базе.
+  """
+
+  def __init__(
+    self,
+    db_path: Path,
+    *,
+    shards_dir: Path | None = None,
+    cache_size: int | None = None,
+    migration_progress: MigrationProgress | None = None,
+  ) -> None:
+    super().__init__(db_path, migration_progress=migration_progress)
+    self._shards_dir = shards_dir or (db_path.parent / "shards")
+    self._shards_dir.mkdir(parents=True, exist_ok=True)
+    try:
+      os.chmod(self._shards_dir, 0o700)
+    except OSError:
+      pass
+    self._shard_pool = ShardPool(capacity=cache_size or _resolve_shard_cache_size())
+    self._warn_if_unsplit()
+
+  def _warn_if_unsplit(self) -> None:
+    with self._read() as conn:
+      row = conn.execute("SELECT COUNT(DISTINCT owner_user_id) FROM chats WHERE owner_user_id <> ''").fetchone()
+    owners = int(row[0] or 0) if row else 0
+    if owners > 0:
+      LOGGER.warning(
+        "Main database still holds chats of %d owner(s); run scripts/split_storage_shards.py to move them to shards",
+        owners,
+      )
+
+  @property
+  def shards_dir(self) -> Path:
+    return self._shards_dir
+
+  @contextmanager
+  def _lease_owner(self, owner_user_id: str) -> Iterator[AppStorage]:
+    safe_owner = self._normalize_owner_user_id(owner_user_id)
+    if not safe_owner:
+      yield self
+      return
+    with self._shard_pool.lease(shard_path_for_owner(self._shards_dir, safe_owner)) as shard:
+      yield shard
+
+  def _shard_files(self) -> list[Path]:
+    return sorted(self._shards_dir.glob(f"{SHARD_FILE_PREFIX}*.db"))
+
+  def _for_each_shard(self, fn: Callable[[AppStorage], Any], *, open_only: bool = False) -> list[Any]:
+    paths = self._shard_pool.open_paths() if open_only else self._shard_files()
+    results = []
+    for path in paths:
+      with self._shard_pool.lease(path) as shard:
+        results.append(fn(shard))
+    return results
+
+  def flush_writes(self) -> None:
+    super().flush_writes()
+    self._for_each_shard(lambda shard: shard.flush_writes(), open_only=True)
+
+  def is_writer_idle(self, idle_seconds: float) -> bool:
+    if not super().is_writer_idle(idle_seconds):
+      return False
+    return all(self._for_each_shard(lambda shard: shard.is_writer_idle(idle_seconds), open_only=True))
+
+  def checkpoint_wal(self, *, mode: str = "PASSIVE") -> dict[str, int]:
+    totals = dict(super().checkpoint_wal(mode=mode))
+    for result in self._for_each_shard(lambda shard: shard.checkpoint_wal(mode=mode), open_only=True):
+      for key, value in result.items():
+        totals[key] = totals.get(key, 0) + int(value)
+    return totals
+
+  def incremental_vacuum(self, *, max_pages: int = 2048) -> int:
+    freed = super().incremental_vacuum(max_pages=max_pages)
+    return freed + sum(self._for_each_shard(lambda shard: shard.incremental_vacuum(max_pages=max_pages), open_only=True))
+
+  def enable_incremental_auto_vacuum(self) -> bool:
+    converted = super().enable_incremental_auto_vacuum()
+    return any([converted, *self._for_each_shard(lambda shard: shard.enable_incremental_auto_vacuum(), open_only=True)])
+
+  def optimize(self) -> None:
+    super().optimize()
+    self._for_each_shard(lambda shard: shard.optimize(), open_only=True)
+
+  def compact_chat_change_log(self, **kwargs: Any) -> dict[str, int]:
+    totals = dict(super().compact_chat_change_log(**kwargs))
+    for result in self._for_each_shard(lambda shard: shard.compact_chat_change_log(**kwargs)):
+      for key, value in result.items():
+        totals[key] = totals.get(key, 0) + int(value)
+    return totals
+
+  def get_file_stats(self) -> dict[str, Any]:
+    stats = super().get_file_stats()
+    files = self._shard_files()
+    shard_bytes = 0
+    for path in files:
+      for candidate in (path, Path(f"{path}-wal")):
+        try:
+          shard_bytes += candidate.stat().st_size if candidate.exists() else 0
+        except OSError:
+          pass
+    stats["shards"] = {
+      "files": len(files),
+      "bytes": shard_bytes,
+      **self._shard_pool.snapshot(),
+    }
+    return stats
+
+  def get_lock_metrics(self) -> dict[str, Any]:
+    metrics = super().get_lock_metrics()
+    metrics["shards"] = self._shard_pool.snapshot()
+    return metrics
+
+  def reset_runtime_data(self) -> None:
+    super().reset_runtime_data()
+    self._for_each_shard(lambda shard: shard.reset_runtime_data())
+
+  def reset_all(self) -> None:
+    super().reset_all()
+    self._for_each_shard(lambda shard: shard.reset_all())
+
+  def close(self) -> None:
+    self._shard_pool.close()
+    super().close()
+
+
+for _method_name in OWNER_SCOPED_METHODS:
+  setattr(ShardedAppStorage, _method_name, _owner_routed(_method_name))
+
+
+def create_app_storage(db_path: Path, *, shard_by_owner: bool = False) -> AppStorage:
+  if shard_by_owner:
+    return ShardedAppStorage(db_path)
+  return AppStorage(db_path)
+
+
+def split_storage_by_owner(
+  db_path: Path,
+  *,
+  shards_dir: Path | None = None,
+  owners: list[str] | None = None,
+  log: Callable[[str], None] | None = None,
+) -> dict[str, Any]:
+  """Переносит чаты владельцев из основной базы в файлы шардов (сервер должен быть остановлен).
+
+  Для каждого владельца: копия чатов, сообщений (с исходными id), вывода инструментов и прав на вложения одной
+  транзакцией в шард, затем удаление из основной базы. Владелец, у которого шард уже не пуст,
+  пропускается. В журнале изменений шарда ставится маркер reset — клиенты перечитают список чатов.
+  """
+  safe_shards_dir = shards_dir or (db_path.parent / "shards")
+  safe_shards_dir.mkdir(parents=True, exist_ok=True)
+  emit = log or (lambda message: None)
+  main = AppStorage(db_path)
+  moved: list[dict[str, Any]] = []
+  skipped: list[str] = []
+  try:
+    with main._read() as conn:
+      all_owners = [
+        str(row[0])
+        for row in conn.execute(
+          "SELECT DISTINCT owner_user_id FROM chats WHERE owner_user_id <> '' ORDER BY owner_user_id"
+        ).fetchall()
+      ]
+    wanted = set(owners) if owners else None
+    for owner in all_owners:
+      if wanted is not None and owner not in wanted:
+        continue
+      shard_path = shard_path_for_owner(safe_shards_dir, owner)
+      shard = AppStorage(shard_path)
+      try:
+        with shard._lock:
+          exists = shard._conn.execute("SELECT 1 FROM chats WHERE owner_user_id=? LIMIT 1", (owner,)).fetchone()
+          if exists:
+            skipped.append(owner)
+            emit(f"skip {owner}: shard {shard_path.name} already has chats")
+            continue
+          # ATTACH нельзя выполнять внутри транзакции — подключаем до неё.
+          shard._conn.execute("ATTACH DATABASE ? AS src", (str(db_path),))
+          try:
+            with shard._conn:
+              chats = shard._conn.execute(
+                """
+                INSERT INTO chats(owner_user_id, id, title, mood, created_at, updated_at, revision)
+                SELECT owner_user_id, id, title, mood, created_at, updated_at, revision
+                FROM src.chats WHERE owner_user_id=?
+                """,
+                (owner,),
+              ).rowcount
+              messages = shard._conn.execute(
+                """
+                INSERT INTO messages(id, owner_user_id, chat_id, role, text, meta_json, meta_codec, timestamp)
+                SELECT id, owner_user_id, chat_id, role, text, meta_json, meta_codec, timestamp
+                FROM src.messages WHERE owner_user_id=?
+                ORDER BY id ASC
+                """,
+                (owner,),
+              ).rowcount
+              shard._conn.execute(
+                """
+                INSERT INTO message_tool_payloads(message_id, payload_json, payload_codec, args_bytes, output_bytes)
+                SELECT p.message_id, p.payload_json, p.payload_codec, p.args_bytes, p.output_bytes
+                FROM src.message_tool_payloads p
+                JOIN src.messages m ON m.id = p.message_id
+                WHERE m.owner_user_id=?
+                """,
+                (owner,),
+              )
+              shard._conn.execute(
+                """
+                INSERT OR IGNORE INTO attachment_owners(owner_user_id, sha256, created_at)
+                SELECT owner_user_id, sha256, created_at FROM src.attachment_owners WHERE owner_user_id=?
+                """,
+                (owner,),
+              )
+              shard._conn.execute(
+                """
+                INSERT OR REPLACE INTO chat_store_revisions(owner_user_id, revision, change_floor_seq)
+                SELECT owner_user_id, revision, 0 FROM src.chat_store_revisions WHERE owner_user_id=?
+                """,
+                (owner,),
+              )
+              shard._reset_chat_change_log_locked(owner)
+          finally:
+            shard._conn.execute("DETACH DATABASE src")
+        shard.checkpoint_wal(mode="TRUNCATE")
+      finally:
+        shard.close()
+
+      with main._lock, main._conn:
+        main._conn.execute("DELETE FROM messages WHERE owner_user_id=?", (owner,))
+        main._conn.execute("DELETE FROM chats WHERE owner_user_id=?", (owner,))
+        main._conn.execute("DELETE FROM chat_change_log WHERE owner_user_id=?", (owner,))
+        main._conn.execute("DELETE FROM chat_store_revisions WHERE owner_user_id=?", (owner,))
+        main._conn.execute("DELETE FROM attachment_owners WHERE owner_user_id=?", (owner,))
+      moved.append({"owner_user_id": owner, "shard": shard_path.name, "chats": chats, "messages": messages})
+      emit(f"moved {owner}: {chats} chats, {messages} messages -> {shard_path.name}")
+    main.checkpoint_wal(mode="TRUNCATE")
+  finally:
+    main.close()
+  return {"shards_dir": str(safe_shards_dir), "moved": moved, "skipped": skipped}
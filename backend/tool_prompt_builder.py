@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import re
+from functools import lru_cache
 from typing import Any
 
 TOOLS_PROMPT_PLACEHOLDER = "{{TOOLS_RUNTIME_BLOCK}}"
@@ -130,6 +131,7 @@ def build_enabled_tools_prompt(
   return "\n".join(lines).strip()
 
 
+@lru_cache(maxsize=16)
 def strip_legacy_tool_prompt_sections(base_prompt: str) -> str:
   raw = str(base_prompt or "").replace("\r\n", "\n").strip()
   if not raw:
@@ -153,9 +155,15 @@ def apply_enabled_tools_prompt(
   active_tools: set[str],
   *,
   tool_definitions: dict[str, dict[str, Any]] | None = None,
+  tools_block: str | None = None,
 ) -> str:
-  raw = strip_legacy_tool_prompt_sections(base_prompt)
-  dynamic_block = build_enabled_tools_prompt(active_tools, tool_definitions=tool_definitions)
+  raw = strip_legacy_tool_prompt_sections(str(base_prompt or ""))
+  # tools_block позволяет передать заранее отрендеренный (кэшированный реестром) блок инструментов.
+  dynamic_block = (
+    tools_block
+    if tools_block is not None
+    else build_enabled_tools_prompt(active_tools, tool_definitions=tool_definitions)
+  )
 
   if TOOLS_PROMPT_PLACEHOLDER in raw:
     replaced = raw.replace(TOOLS_PROMPT_PLACEHOLDER, dynamic_block).strip()
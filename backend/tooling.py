@@ -4,6 +4,7 @@ import html as html_lib
 import json
 import os
 import re
+import threading
 from html.parser import HTMLParser
 from pathlib import Path
 from typing import Any, Callable
@@ -19,12 +20,14 @@ try:
     normalize_http_url as normalize_http_url_base,
     open_safe_http_request,
   )
+  from backend.tool_prompt_builder import build_enabled_tools_prompt
 except ModuleNotFoundError:
   from netguard import (  # type: ignore
     ensure_safe_outbound_url,
     normalize_http_url as normalize_http_url_base,
     open_safe_http_request,
   )
+  from tool_prompt_builder import build_enabled_tools_prompt  # type: ignore
 
 
 ToolHandler = Callable[[dict[str, Any], Any], dict[str, Any]]
@@ -32,16 +35,65 @@ SAFE_TOOL_NAME_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_.-]{1,127}$")
 SAFE_PLUGIN_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_.-]{1,63}$")
 
 
+_MEMO_MISS = object()
+
+
 class ToolRegistry:
+  RENDER_CACHE_MAX_ENTRIES = 64
+
   def __init__(self) -> None:
     self._handlers: dict[str, ToolHandler] = {}
     self._meta: dict[str, dict[str, Any]] = {}
     self._aliases: dict[str, str] = {}
+    # Версия реестра растёт при любом изменении набора инструментов;
+    # кэш отрендеренных схем/промпта привязан к версии и сбрасывается вместе с ней.
+    self._version = 0
+    self._render_cache: dict[tuple[str, int, frozenset[str]], Any] = {}
+    self._render_cache_lock = threading.Lock()
+
+  @property
+  def version(self) -> int:
+    return self._version
+
+  def _bump_version(self) -> None:
+    with self._render_cache_lock:
+      self._version += 1
+      self._render_cache = {}
+
+  @staticmethod
+  def _normalize_names(names: set[str] | None) -> frozenset[str] | None:
+    if names is None:
+      return None
+    return frozenset(str(name or "").strip().lower() for name in names if str(name or "").strip())
+
+  def _memoize(
+    self,
+    kind: str,
+    names: frozenset[str] | None,
+    factory: Callable[[], Any],
+  ) -> Any:
+    key_names = names if names is not None else frozenset({"*"})
+    with self._render_cache_lock:
+      key = (kind, self._version, key_names)
+      cached = self._render_cache.get(key, _MEMO_MISS)
+    # Пустой блок/карта — тоже результат, поэтому промах отличаем сентинелом, а не по None/пустоте.
+    if cached is not _MEMO_MISS:
+      return cached
+    value = factory()
+    with self._render_cache_lock:
+      # Реестр мог измениться, пока строили значение: такое значение не кэшируем.
+      if key[1] != self._version:
+        return value
+      if len(self._render_cache) >= self.RENDER_CACHE_MAX_ENTRIES:
+        self._render_cache = {}
+      self._render_cache[key] = value
+    return value
 
   def clear(self) -> None:
     self._handlers = {}
     self._meta = {}
     self._aliases = {}
+    self._bump_version()
 
   def register(
     self,
@@ -86,6 +138,7 @@ class ToolRegistry:
         safe_alias = str(alias or "").strip().lower()
         if safe_alias and SAFE_TOOL_NAME_PATTERN.match(safe_alias):
           self._aliases[safe_alias] = normalized_name
+    self._bump_version()
 
   def resolve_tool_name(self, name: str) -> str:
     normalized_name = str(name or "").strip().lower()
@@ -112,12 +165,15 @@ class ToolRegistry:
     return [self._meta[name] for name in sorted(self._meta.keys())]
 
   def build_llm_schema_map(self, names: set[str] | None = None) -> dict[str, dict[str, Any]]:
-    if names is None:
-      target_names = set(self._meta.keys())
-    else:
-      target_names = {str(name or "").strip().lower() for name in names if str(name or "").strip()}
+    target_names = self._normalize_names(names)
+    cached = self._memoize("llm_schema_map", target_names, lambda: self._build_llm_schema_map(target_names))
+    # Кэш общий для запросов: наружу — свой внешний dict, а схемы внутри общие и только для чтения.
+    # Глубокая копия на каждый вызов стоила дороже, чем собрать карту заново.
+    return dict(cached)
+
+  def _build_llm_schema_map(self, target_names: frozenset[str] | None) -> dict[str, dict[str, Any]]:
     out: dict[str, dict[str, Any]] = {}
-    for name in sorted(target_names):
+    for name in sorted(target_names if target_names is not None else self._meta.keys()):
       payload = self._meta.get(name)
       if not isinstance(payload, dict):
         continue
@@ -127,12 +183,17 @@ class ToolRegistry:
     return out
 
   def build_tool_definition_map(self, names: set[str] | None = None) -> dict[str, dict[str, Any]]:
-    if names is None:
-      target_names = set(self._meta.keys())
-    else:
-      target_names = {str(name or "").strip().lower() for name in names if str(name or "").strip()}
+    target_names = self._normalize_names(names)
+    cached = self._memoize(
+      "tool_definition_map",
+      target_names,
+      lambda: self._build_tool_definition_map(target_names),
+    )
+    return dict(cached)
+
+  def _build_tool_definition_map(self, target_names: frozenset[str] | None) -> dict[str, dict[str, Any]]:
     out: dict[str, dict[str, Any]] = {}
-    for name in sorted(target_names):
+    for name in sorted(target_names if target_names is not None else self._meta.keys()):
       payload = self._meta.get(name)
       if not isinstance(payload, dict):
         continue
@@ -157,6 +218,17 @@ class ToolRegistry:
       }
     return out
 
+  def render_tools_prompt_block(self, names: set[str] | None = None) -> str:
+    target_names = self._normalize_names(names) or frozenset()
+    return self._memoize(
+      "tools_prompt_block",
+      target_names,
+      lambda: build_enabled_tools_prompt(
+        set(target_names),
+        tool_definitions=self.build_tool_definition_map(set(target_names)),
+      ),
+    )
+
 
 class PluginDescriptor(BaseModel):
   id: str
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator
+
+from fastapi.routing import APIRoute
+
+WORKLOAD_DB = "db"
+WORKLOAD_CPU = "cpu"
+WORKLOAD_GENERATION = "generation"
+WORKLOAD_NETWORK = "network"
+
+# Размер пула по умолчанию; переопределяется ANCIA_EXECUTOR_<КЛАСС>_WORKERS.
+WORKLOAD_DEFAULT_WORKERS: dict[str, int] = {
+  WORKLOAD_DB: 16,
+  WORKLOAD_CPU: max(2, min(8, os.cpu_count() or 2)),
+  WORKLOAD_GENERATION: 8,
+  WORKLOAD_NETWORK: 8,
+}
+WORKLOAD_MAX_WORKERS = 256
+
+# (метод, шаблон пути) -> класс нагрузки. Всё, чего нет в таблице, — короткие обращения к БД (db).
+WORKLOAD_ROUTE_CLASSES: dict[tuple[str, str], str] = {
+  ("POST", "/chat"): WORKLOAD_GENERATION,
+  ("POST", "/chat/stream"): WORKLOAD_GENERATION,
+  ("POST", "/models/select"): WORKLOAD_GENERATION,
+  ("POST", "/models/load"): WORKLOAD_GENERATION,
+  ("POST", "/models/unload"): WORKLOAD_GENERATION,
+  ("POST", "/context/summarize"): WORKLOAD_GENERATION,
+  ("POST", "/models/context-usage"): WORKLOAD_CPU,
+  ("GET", "/chats/export"): WORKLOAD_CPU,
+  ("POST", "/chats/import"): WORKLOAD_CPU,
+  ("POST", "/chats/import/stream"): WORKLOAD_CPU,
+  ("POST", "/app/reset"): WORKLOAD_CPU,
+  ("POST", "/auth/login"): WORKLOAD_CPU,
+  ("POST", "/auth/bootstrap"): WORKLOAD_CPU,
+  ("POST", "/auth/register"): WORKLOAD_CPU,
+  ("POST", "/admin/users"): WORKLOAD_CPU,
+  ("PATCH", "/admin/users/{user_id}"): WORKLOAD_CPU,
+  ("POST", "/models/catalog/refresh"): WORKLOAD_NETWORK,
+  ("DELETE", "/models/{model_id}/cache"): WORKLOAD_NETWORK,
+  ("GET", "/plugins/registry"): WORKLOAD_NETWORK,
+  ("PATCH", "/plugins/registry"): WORKLOAD_NETWORK,
+  ("POST", "/plugins/install"): WORKLOAD_NETWORK,
+  ("POST", "/plugins/{plugin_id}/update"): WORKLOAD_NETWORK,
+  ("DELETE", "/plugins/{plugin_id}/uninstall"): WORKLOAD_NETWORK,
+}
+
+_CURRENT_EXECUTOR: contextvars.ContextVar["WorkloadExecutor | None"] = contextvars.ContextVar(
+  "ancia_workload_executor",
+  default=None,
+)
+_ITERATION_DONE = object()
+
+
+def _read_workers(workload: str) -> int:
+  fallback = WORKLOAD_DEFAULT_WORKERS.get(workload, 4)
+  raw = str(os.getenv(f"ANCIA_EXECUTOR_{workload.upper()}_WORKERS", "") or "").strip()
+  try:
+    value = int(raw) if raw else fallback
+  except ValueError:
+    value = fallback
+  return max(1, min(WORKLOAD_MAX_WORKERS, value))
+
+
+def classify_route_workload(methods: Iterable[str] | None, path: str) -> str:
+  for method in methods or ():
+    workload = WORKLOAD_ROUTE_CLASSES.get((str(method).upper(), path))
+    if workload:
+      return workload
+  return WORKLOAD_DB
+
+
+class WorkloadExecutor:
+  """Пул потоков одного класса нагрузки со счётчиками очереди (для /health)."""
+
+  def __init__(self, name: str, workers: int) -> None:
+    self.name = name
+    self.workers = max(1, int(workers))
+    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"ancia-{name}")
+    self._lock = threading.Lock()
+    self._queued = 0
+    self._running = 0
+    self._peak_queued = 0
+    self._completed = 0
+    self._wait_total_ms = 0.0
+    self._wait_max_ms = 0.0
+
+  def _invoke(self, submitted_at: float, context: contextvars.Context, fn: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+    wait_ms = (time.perf_counter() - submitted_at) * 1000.0
+    with self._lock:
+      self._queued -= 1
+      self._running += 1
+      self._wait_total_ms += wait_ms
+      self._wait_max_ms = max(self._wait_max_ms, wait_ms)
+    try:
+      return context.run(self._call_in_context, fn, args, kwargs)
+    finally:
+      with self._lock:
+        self._running -= 1
+        self._completed += 1
+
+  def _call_in_context(self, fn: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+    # Обработчик видит свой пул: iterate_in_workload отдаст поток ответа туда же.
+    _CURRENT_EXECUTOR.set(self)
+    return fn(*args, **kwargs)
+
+  async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Выполняет fn в пуле; contextvars копируются, как у run_in_threadpool."""
+    with self._lock:
+      self._queued += 1
+      self._peak_queued = max(self._peak_queued, self._queued)
+    future = self._executor.submit(
+      self._invoke,
+      time.perf_counter(),
+      contextvars.copy_context(),
+      fn,
+      args,
+      kwargs,
+    )
+    try:
+      return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+      # Клиент ушёл, пока задача ждала в очереди, — она не запустится, счётчик возвращаем сами.
+      if future.cancel():
+        with self._lock:
+          self._queued -= 1
+      raise
+
+  async def iterate(self, iterator: Iterator[Any]) -> AsyncIterator[Any]:
+    while True:
+      item = await self.run(next, iterator, _ITERATION_DONE)
+      if item is _ITERATION_DONE:
+        return
+      yield item
+
+  def snapshot(self) -> dict[str, Any]:
+    with self._lock:
+      started = self._completed + self._running
+      return {
+        "workers": self.workers,
+        "queued": self._queued,
+        "running": self._running,
+        "peak_queued": self._peak_queued,
+        "completed": self._completed,
+        "wait_avg_ms": round(self._wait_total_ms / started, 3) if started else 0.0,
+        "wait_max_ms": round(self._wait_max_ms, 3),
+      }
+
+  def shutdown(self) -> None:
+    self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class WorkloadExecutors:
+  def __init__(self, workers: dict[str, int] | None = None) -> None:
+    sizes = workers or {name: _read_workers(name) for name in WORKLOAD_DEFAULT_WORKERS}
+    self._executors = {name: WorkloadExecutor(name, size) for name, size in sizes.items()}
+
+  def get(self, workload: str) -> WorkloadExecutor:
+    return self._executors.get(workload) or self._executors[WORKLOAD_DB]
+
+  def snapshot(self) -> dict[str, Any]:
+    return {name: executor.snapshot() for name, executor in self._executors.items()}
+
+  def shutdown(self) -> None:
+    for executor in self._executors.values():
+      executor.shutdown()
+
+
+def iterate_in_workload(iterator: Iterator[Any]) -> Iterator[Any] | AsyncIterator[Any]:
+  """Тело StreamingResponse из синхронного генератора — в пул текущего обработчика.
+
+  Иначе Starlette перебирает его в общем пуле AnyIO, и долгий поток занимает общий слот.
+  Вне обработчика с пулом возвращает итератор как есть.
+  """
+  executor = _CURRENT_EXECUTOR.get()
+  if executor is None:
+    return iterator
+  return executor.iterate(iterator)
+
+
+async def run_in_workload(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+  """Синхронный вызов из async-обработчика — в пул его класса нагрузки (вне такого обработчика — в пул asyncio)."""
+  executor = _CURRENT_EXECUTOR.get()
+  if executor is None:
+    return await asyncio.to_thread(fn, *args, **kwargs)
+  return await executor.run(fn, *args, **kwargs)
+
+
+def build_workload_route_class(executors: WorkloadExecutors) -> type[APIRoute]:
+  """APIRoute, который выполняет синхронные обработчики в пуле своего класса нагрузки, а не в общем пуле AnyIO."""
+
+  class WorkloadRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any) -> None:
+      executor = executors.get(classify_route_workload(kwargs.get("methods"), path))
+      original_endpoint = endpoint
+      # functools.wraps сохраняет сигнатуру и __wrapped__ — FastAPI разбирает параметры исходной функции.
+      if asyncio.iscoroutinefunction(original_endpoint):
+
+        @functools.wraps(original_endpoint)
+        async def endpoint(*args: Any, **call_kwargs: Any) -> Any:
+          # Async-обработчик сам не занимает пул, но синхронное тело его StreamingResponse пойдёт в пул класса.
+          _CURRENT_EXECUTOR.set(executor)
+          return await original_endpoint(*args, **call_kwargs)
+
+      else:
+
+        @functools.wraps(original_endpoint)
+        async def endpoint(*args: Any, **call_kwargs: Any) -> Any:
+          return await executor.run(original_endpoint, *args, **call_kwargs)
+
+      endpoint.workload = executor.name  # type: ignore[attr-defined]
+      super().__init__(path, endpoint, **kwargs)
+
+  return WorkloadRoute
@@ -226,6 +226,32 @@ def main() -> int:
       else:
         print("[OK] limited POST /plugins/install -> 403")
 
+      # Хранилище вложений общее: чужой sha256 не должен открывать файл другому пользователю.
+      admin_upload = client.post(
+        "/attachments/upload?name=acl.png",
+        content=b"\x89PNG\r\n\x1a\n" + b"acl-smoke" * 8,
+        headers={**admin_headers, "Content-Type": "image/png"},
+      )
+      admin_sha = str((admin_upload.json() or {}).get("sha256") or "") if admin_upload.status_code == 200 else ""
+      if not admin_sha:
+        print(f"[FAIL] admin POST /attachments/upload -> {admin_upload.status_code}")
+        failed = True
+      else:
+        limited_foreign_ref = client.post(
+          "/chat",
+          json={
+            "message": "test",
+            "attachments": [{"id": admin_sha, "sha256": admin_sha, "name": "acl.png", "kind": "image"}],
+            "context": {"chat_id": "acl-limited-foreign-attachment"},
+          },
+          headers=limited_headers,
+        )
+        if limited_foreign_ref.status_code != 404:
+          print(f"[FAIL] limited POST /chat with foreign attachment sha256 -> {limited_foreign_ref.status_code}")
+          failed = True
+        else:
+          print("[OK] limited POST /chat with foreign attachment sha256 -> 404")
+
       if uncached_model_id:
         limited_chat = client.post(
           "/chat",
@@ -249,6 +275,24 @@ def main() -> int:
         else:
           print("[OK] limited POST /chat/stream -> 403")
 
+      admin_rollups = client.get("/admin/audit/rollups?group_by=action", headers=admin_headers)
+      rollup_actions = {
+        str(item.get("action") or "")
+        for item in ((admin_rollups.json() or {}).get("rollups") or [] if admin_rollups.status_code == 200 else [])
+      }
+      if admin_rollups.status_code != 200 or not rollup_actions:
+        print(f"[FAIL] admin GET /admin/audit/rollups -> {admin_rollups.status_code} {sorted(rollup_actions)}")
+        failed = True
+      else:
+        print(f"[OK] admin GET /admin/audit/rollups -> 200 ({len(rollup_actions)} actions)")
+
+      limited_rollups = client.get("/admin/audit/rollups", headers=limited_headers)
+      if not _is_forbidden(limited_rollups):
+        print(f"[FAIL] limited GET /admin/audit/rollups -> {limited_rollups.status_code}")
+        failed = True
+      else:
+        print("[OK] limited GET /admin/audit/rollups -> 403")
+
       # Plugins-only user can download plugins, but cannot download models.
       plugins_only_install = client.post(
         "/plugins/install",
@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import json
 import os
+import shutil
+import sqlite3
+import stat
 import sys
+import tempfile
+import threading
 import time
 from pathlib import Path
 
 # Для smoke-проверки не грузим модель на старте, чтобы тесты работали в CI/песочнице.
 os.environ["ANCIA_ENABLE_MODEL_EAGER_LOAD"] = "0"
+# База и вложения — во временном каталоге, а не в backend/.runtime рабочей копии.
+SMOKE_DATA_DIR = Path(tempfile.mkdtemp(prefix="ancia-smoke-")).resolve()
+os.environ["ANCIA_BACKEND_DATA_DIR"] = str(SMOKE_DATA_DIR)
 ROOT_DIR = Path(__file__).resolve().parents[1]
 if str(ROOT_DIR) not in sys.path:
   sys.path.insert(0, str(ROOT_DIR))
 
-from backend.main import PythonModelEngine, app
+from backend.engine_support import ModelResult
+from backend.main import PythonModelEngine, app, make_app
+from backend.model_server import ModelServer, ModelServerClient
+from backend.schemas import ChatRequest, RuntimeChatContext, ToolEvent
+from backend.startup_gate import DeferredStartupApp
+from backend.storage import AppStorage, MigrationProgress, pending_schema_migration
+from backend.storage_shards import ShardedAppStorage, shard_path_for_owner, split_storage_by_owner
+from backend.tooling import ToolRegistry
 from scripts.asgi_client import create_app_client
 
 
@@ -34,6 +50,426 @@ OPTIONS_PATHS = [
   "/tools",
 ]
 
+MIGRATION_SMOKE_MESSAGES = 120
+
+
+class _SchemaV7FixtureStorage(AppStorage):
+  """Собирает базу схемы v7 — той, с которой обновляются установленные клиенты."""
+
+  LATEST_SCHEMA_VERSION = 7
+
+  def _load_rate_limit_state(self) -> list[tuple[str, float, float]]:
+    # Таблицы состояния лимитов в v7 ещё нет.
+    return []
+
+
+class _MigrationInterrupted(Exception):
+  pass
+
+
+class _InterruptedMigrationStorage(AppStorage):
+  """Обрывает миграцию после первой зафиксированной пачки — как остановка процесса."""
+
+  MIGRATION_BATCH_SIZE = 50
+
+  def _run_migration_batches_locked(self, version, step, batch_fn, *, total):
+    batches = 0
+
+    def interrupt_after_first(cursor: int) -> tuple[int, int]:
+      nonlocal batches
+      if batches >= 1:
+        raise _MigrationInterrupted(f"v{version} {step}")
+      batches += 1
+      return batch_fn(cursor)
+
+    super()._run_migration_batches_locked(version, step, interrupt_after_first, total=total)
+
+
+def _smoke_schema_migration_resume() -> bool:
+  """База v7: миграция обрывается на пакетном шаге, затем продолжается за DeferredStartupApp."""
+  failed = False
+  db_path = (SMOKE_DATA_DIR / "migration-smoke" / "app.db").resolve()
+
+  fixture = _SchemaV7FixtureStorage(db_path)
+  try:
+    with fixture._conn:
+      fixture._conn.execute(
+        "INSERT INTO chats(owner_user_id, id, title, mood, created_at, updated_at) VALUES('', 'legacy', 'Legacy', '', ?, ?)",
+        ("2024-01-01T00:00:00+00:00", "2024-01-01T00:00:00+00:00"),
+      )
+      fixture._conn.executemany(
+        "INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, timestamp) VALUES('', 'legacy', 'user', ?, '{}', ?)",
+        [(f"legacy migration note {index}", "2024-01-01T00:00:00+00:00") for index in range(MIGRATION_SMOKE_MESSAGES)],
+      )
+  finally:
+    fixture.close()
+  pending = pending_schema_migration(db_path)
+  if pending is None or pending[0] != 7:
+    print(f"[FAIL] pending_schema_migration(v7 fixture) -> {pending}")
+    return True
+  print(f"[OK] v7 fixture pending migration -> v{pending[0]} -> v{pending[1]}")
+
+  interrupted_progress = MigrationProgress()
+  try:
+    _InterruptedMigrationStorage(db_path, migration_progress=interrupted_progress)
+  except _MigrationInterrupted as exc:
+    print(f"[OK] migration interrupted at {exc}")
+  else:
+    print("[FAIL] migration finished without reaching a batched step")
+    return True
+  with sqlite3.connect(db_path) as conn:
+    interrupted_version = int(conn.execute("PRAGMA user_version").fetchone()[0])
+    saved_steps = conn.execute("SELECT version, step, cursor FROM schema_migration_state").fetchall()
+  if interrupted_version <= 7 or not saved_steps or int(saved_steps[0][2]) <= 0:
+    print(f"[FAIL] interrupted migration state -> v{interrupted_version} {saved_steps}")
+    failed = True
+  elif interrupted_progress.snapshot().get("status") != "error":
+    print(f"[FAIL] interrupted migration progress -> {interrupted_progress.snapshot()}")
+    failed = True
+  else:
+    print(f"[OK] interrupted migration kept v{interrupted_version} and cursor {tuple(saved_steps[0])}")
+
+  # Продолжение идёт за той же обёрткой, что и при старте сервера: сборка ждёт сигнала,
+  # чтобы проверить ответы шлюза, пока миграция ещё не закончилась.
+  progress = MigrationProgress()
+  release_build = threading.Event()
+  resumed: dict[str, AppStorage] = {}
+
+  def build_app():
+    release_build.wait(30)
+    resumed["storage"] = AppStorage(db_path, migration_progress=progress)
+    from fastapi import FastAPI
+
+    inner = FastAPI()
+
+    @inner.get("/health")
+    def health() -> dict[str, str]:
+      return {"status": "ok"}
+
+    return inner
+
+  gate = DeferredStartupApp(build_app, progress_fn=progress.snapshot)
+  with create_app_client(gate) as client:
+    health_starting = client.get("/health")
+    starting_payload = health_starting.json() if health_starting.status_code == 200 else {}
+    if starting_payload.get("status") != "starting" or (starting_payload.get("startup") or {}).get("stage") != "storage_migration":
+      print(f"[FAIL] gated GET /health -> {health_starting.status_code} {starting_payload}")
+      failed = True
+    else:
+      print("[OK] gated GET /health -> 200 starting")
+    chats_gated = client.get("/chats")
+    if chats_gated.status_code != 503 or not chats_gated.headers.get("retry-after"):
+      print(f"[FAIL] gated GET /chats -> {chats_gated.status_code} retry-after={chats_gated.headers.get('retry-after')!r}")
+      failed = True
+    else:
+      print("[OK] gated GET /chats -> 503 with Retry-After")
+    options_gated = client.options("/chats")
+    if options_gated.status_code != 204:
+      print(f"[FAIL] gated OPTIONS /chats -> {options_gated.status_code}")
+      failed = True
+    else:
+      print("[OK] gated OPTIONS /chats -> 204")
+
+    release_build.set()
+    if not gate.wait_ready(60):
+      print("[FAIL] resumed migration did not finish")
+      return True
+    health_ready = client.get("/health")
+    if health_ready.status_code != 200 or (health_ready.json() or {}).get("status") != "ok":
+      print(f"[FAIL] GET /health after migration -> {health_ready.status_code}")
+      failed = True
+    else:
+      print("[OK] GET /health after migration -> inner app")
+
+  storage = resumed["storage"]
+  try:
+    with sqlite3.connect(db_path) as conn:
+      final_version = int(conn.execute("PRAGMA user_version").fetchone()[0])
+      leftover_steps = conn.execute("SELECT COUNT(*) FROM schema_migration_state").fetchone()[0]
+    # Пачка, зафиксированная до обрыва, не должна попасть в индекс второй раз.
+    found = storage.search_messages("migration", limit=500)
+    first = storage.search_messages("note 0", limit=5)
+    last = storage.search_messages(f"note {MIGRATION_SMOKE_MESSAGES - 1}", limit=5)
+  finally:
+    storage.close()
+  if final_version != AppStorage.LATEST_SCHEMA_VERSION or leftover_steps:
+    print(f"[FAIL] resumed migration -> v{final_version}, state rows={leftover_steps}")
+    failed = True
+  elif len(found) != MIGRATION_SMOKE_MESSAGES or not first or not last:
+    print(f"[FAIL] resumed migration search -> {len(found)} hits, first={len(first)} last={len(last)}")
+    failed = True
+  else:
+    print(f"[OK] resumed migration -> v{final_version}, {len(found)} messages indexed once")
+  return failed
+
+
+def _smoke_owner_shards() -> bool:
+  """remote_server с шардами по владельцу: перенос split_storage_by_owner и маршрутизация запросов API."""
+  failed = False
+  temp_dir = (SMOKE_DATA_DIR / "shards-smoke").resolve()
+  split_db = temp_dir / "split" / "app.db"
+  attachment_sha = "ab" * 32
+
+  legacy = AppStorage(split_db)
+  try:
+    for owner in ("alice", "bob", ""):
+      chat_id = f"shard-{owner or 'local'}"
+      legacy.create_chat(chat_id=chat_id, title=f"Shard {owner or 'local'}", owner_user_id=owner)
+      legacy.append_message(chat_id=chat_id, role="user", text=f"hello from {owner or 'local'}", owner_user_id=owner)
+    legacy.grant_attachment_owner(attachment_sha, owner_user_id="alice")
+  finally:
+    legacy.close()
+
+  split_result = split_storage_by_owner(split_db)
+  moved_owners = sorted(str(item.get("owner_user_id") or "") for item in split_result.get("moved") or [])
+  if moved_owners != ["alice", "bob"]:
+    print(f"[FAIL] split_storage_by_owner moved -> {split_result}")
+    failed = True
+  else:
+    print("[OK] split_storage_by_owner -> alice, bob")
+
+  # Повторный запуск ничего не переносит: в основной базе чатов владельцев уже нет.
+  split_again = split_storage_by_owner(split_db)
+  if split_again.get("moved"):
+    print(f"[FAIL] split_storage_by_owner rerun moved -> {split_again}")
+    failed = True
+  else:
+    print("[OK] split_storage_by_owner rerun -> nothing to move")
+
+  main_only = AppStorage(split_db)
+  try:
+    leftover = main_only.list_chats(owner_user_id="alice")
+    local_chats = [item.get("id") for item in main_only.list_chats(owner_user_id="")]
+    main_grant = main_only.has_attachment_owner(attachment_sha, owner_user_id="alice")
+  finally:
+    main_only.close()
+  if leftover or local_chats != ["shard-local"] or main_grant:
+    print(f"[FAIL] main db after split: owner chats={leftover} local={local_chats} grant={main_grant}")
+    failed = True
+  else:
+    print("[OK] main db after split keeps only ownerless chats")
+
+  sharded = ShardedAppStorage(split_db)
+  try:
+    shard_files = sorted(path.name for path in sharded.shards_dir.glob("*.db"))
+    expected_files = sorted(shard_path_for_owner(sharded.shards_dir, owner).name for owner in ("alice", "bob"))
+    alice_messages = sharded.get_chat_messages("shard-alice", owner_user_id="alice")
+    alice_sees_bob = sharded.get_chat("shard-bob", owner_user_id="alice")
+    alice_grant = sharded.has_attachment_owner(attachment_sha, owner_user_id="alice")
+    bob_grant = sharded.has_attachment_owner(attachment_sha, owner_user_id="bob")
+    local_routed = [item.get("id") for item in sharded.list_chats(owner_user_id="")]
+  finally:
+    sharded.close()
+  if shard_files != expected_files:
+    print(f"[FAIL] shard files -> {shard_files}, expected {expected_files}")
+    failed = True
+  elif [item.get("text") for item in alice_messages] != ["hello from alice"] or alice_sees_bob is not None:
+    print(f"[FAIL] ShardedAppStorage owner routing -> {alice_messages} / {alice_sees_bob}")
+    failed = True
+  elif not alice_grant or bob_grant:
+    print(f"[FAIL] ShardedAppStorage attachment grants -> alice={alice_grant} bob={bob_grant}")
+    failed = True
+  elif local_routed != ["shard-local"]:
+    print(f"[FAIL] ShardedAppStorage ownerless chats -> {local_routed}")
+    failed = True
+  else:
+    print("[OK] ShardedAppStorage routes chats and attachment grants by owner")
+
+  api_data_dir = temp_dir / "api"
+  plugins_dir = temp_dir / "plugins"
+  plugins_dir.mkdir(parents=True, exist_ok=True)
+  managed_env = {
+    "ANCIA_DEPLOYMENT_MODE": "remote_server",
+    "ANCIA_BACKEND_DATA_DIR": str(api_data_dir),
+    "ANCIA_PLUGINS_DIR": str(plugins_dir),
+    "ANCIA_SQLITE_SHARD_BY_OWNER": "1",
+    "ANCIA_DISABLE_MLX_RUNTIME": "1",
+    "HF_HUB_OFFLINE": "1",
+  }
+  original_env = {key: os.environ.get(key) for key in managed_env}
+  try:
+    os.environ.update(managed_env)
+    with create_app_client(make_app()) as client:
+      bootstrap = client.post(
+        "/auth/bootstrap",
+        json={"username": "admin", "password": "Password123", "remember": True},
+      )
+      admin_payload = bootstrap.json() if bootstrap.status_code == 200 else {}
+      admin_headers = {"Authorization": f"Bearer {admin_payload.get('token') or ''}"}
+      admin_id = str((admin_payload.get("user") or {}).get("id") or "")
+      if bootstrap.status_code != 200 or not admin_id:
+        print(f"[FAIL] sharded POST /auth/bootstrap -> {bootstrap.status_code}")
+        return True
+
+      create_admin_chat = client.post("/chats", json={"id": "shard-api", "title": "Admin"}, headers=admin_headers)
+      admin_shard = shard_path_for_owner(api_data_dir / "shards", admin_id)
+      if create_admin_chat.status_code != 200 or not admin_shard.exists():
+        print(f"[FAIL] sharded POST /chats -> {create_admin_chat.status_code}, shard exists={admin_shard.exists()}")
+        failed = True
+      else:
+        print(f"[OK] sharded POST /chats -> {admin_shard.name}")
+
+      create_user = client.post(
+        "/admin/users",
+        json={"username": "shard_user", "password": "Password123", "role": "user"},
+        headers=admin_headers,
+      )
+      login = client.post(
+        "/auth/login",
+        json={"username": "shard_user", "password": "Password123", "remember": True},
+      )
+      user_token = str((login.json() or {}).get("token") or "") if login.status_code == 200 else ""
+      if create_user.status_code != 200 or not user_token:
+        print(f"[FAIL] sharded user setup -> {create_user.status_code}/{login.status_code}")
+        return True
+      user_headers = {"Authorization": f"Bearer {user_token}"}
+
+      # Тот же id чата у другого владельца — другой файл шарда, конфликта нет.
+      create_user_chat = client.post("/chats", json={"id": "shard-api", "title": "User"}, headers=user_headers)
+      user_chats = client.get("/chats", headers=user_headers)
+      user_titles = [
+        str(item.get("title") or "")
+        for item in ((user_chats.json() or {}).get("sessions") or [] if user_chats.status_code == 200 else [])
+        if isinstance(item, dict)
+      ]
+      if create_user_chat.status_code != 200 or user_titles != ["User"]:
+        print(f"[FAIL] sharded GET /chats (second owner) -> {create_user_chat.status_code} {user_titles}")
+        failed = True
+      else:
+        print("[OK] sharded GET /chats sees only the owner's shard")
+  finally:
+    for key, value in original_env.items():
+      if value is None:
+        os.environ.pop(key, None)
+      else:
+        os.environ[key] = value
+  return failed
+
+
+class _StubModelEngine:
+  """Движок без модели для сервера модели: зовёт реестр инструментов воркера и стримит ответ."""
+
+  model_name = "smoke-stub"
+  model_repo = "smoke/stub"
+
+  def is_ready(self) -> bool:
+    return True
+
+  def set_selected_model(self, model_id: str) -> None:
+    raise ValueError(f"unknown model: {model_id}")
+
+  def request_stop_generation(self) -> None:
+    # Сервер зовёт его, когда воркер бросает поток; генерации у заглушки нет.
+    return None
+
+  def iter_complete(self, *, request, runtime, tool_registry, active_tools):
+    tool_name = tool_registry.resolve_tool_name("Smoke.Echo")
+    if not tool_registry.has_tool(tool_name) or tool_name not in active_tools:
+      raise LookupError(f"tool {tool_name!r} is not available")
+    prompt_block = tool_registry.render_tools_prompt_block(active_tools)
+    schema_names = sorted(tool_registry.build_llm_schema_map(active_tools))
+    output = tool_registry.execute(tool_name, {"text": request.message}, runtime)
+    event = ToolEvent(name=tool_name, status="ok", output=output)
+    yield event
+    yield f"echo: {output.get('text')}"
+    return ModelResult(
+      reply=f"echo: {output.get('text')} ({len(prompt_block)} prompt chars, schemas={schema_names})",
+      mood=runtime.mood,
+      tool_events=[event],
+      model_name=self.model_name,
+    )
+
+
+def _smoke_model_server() -> bool:
+  """Сервер модели и API-воркер на одном временном сокете: вызовы, ошибки и поток iter_complete с обратными вызовами."""
+  failed = False
+  socket_path = SMOKE_DATA_DIR / "model-server.sock"
+  engine = _StubModelEngine()
+  server = ModelServer(engine, str(socket_path))
+  server.start()
+  try:
+    socket_mode = stat.S_IMODE(os.stat(socket_path).st_mode)
+    if socket_mode != 0o600:
+      print(f"[FAIL] model server socket mode -> {oct(socket_mode)}")
+      failed = True
+    else:
+      print("[OK] model server socket mode -> 0o600")
+
+    client = ModelServerClient(str(socket_path))
+    if not client.is_ready() or client.model_name != "smoke-stub":
+      print(f"[FAIL] ModelServerClient is_ready/model_name -> {client.is_ready()} {client.model_name!r}")
+      failed = True
+    else:
+      print("[OK] ModelServerClient is_ready/model_name")
+    try:
+      client.set_selected_model("missing")
+    except ValueError as exc:
+      print(f"[OK] ModelServerClient error frame -> ValueError({exc})")
+    except Exception as exc:
+      print(f"[FAIL] ModelServerClient error frame -> {exc.__class__.__name__}: {exc}")
+      failed = True
+    else:
+      print("[FAIL] ModelServerClient error frame -> no exception")
+      failed = True
+
+    # Реестр и runtime остаются в воркере: обработчик инструмента видит исходный контекст запроса.
+    registry = ToolRegistry()
+    registry.register(
+      name="smoke.echo",
+      description="Возвращает переданный текст.",
+      input_schema={"type": "object", "properties": {"text": {"type": "string"}}},
+      handler=lambda args, runtime: {"text": str(args.get("text") or ""), "chat_id": runtime.chat_id},
+    )
+    runtime = RuntimeChatContext(chat_id="smoke-model-server", mood="neutral", user_name="smoke", timezone="UTC")
+    stream = client.iter_complete(
+      request=ChatRequest(message="ping"),
+      runtime=runtime,
+      tool_registry=registry,
+      active_tools={"smoke.echo"},
+    )
+    items = []
+    try:
+      while True:
+        items.append(next(stream))
+    except StopIteration as stop:
+      result = stop.value
+    tool_event = items[0] if items else None
+    if (
+      not isinstance(tool_event, ToolEvent)
+      or tool_event.output != {"text": "ping", "chat_id": "smoke-model-server"}
+      or items[1:] != ["echo: ping"]
+    ):
+      print(f"[FAIL] ModelServerClient.iter_complete items -> {items}")
+      failed = True
+    elif not isinstance(result, ModelResult) or "schemas=['smoke.echo']" not in result.reply or result.mood != "neutral":
+      print(f"[FAIL] ModelServerClient.iter_complete result -> {result}")
+      failed = True
+    else:
+      print(f"[OK] ModelServerClient.iter_complete -> {result.reply}")
+
+    missing_tool = client.iter_complete(
+      request=ChatRequest(message="ping"),
+      runtime=runtime,
+      tool_registry=ToolRegistry(),
+      active_tools=set(),
+    )
+    try:
+      next(missing_tool)
+    except LookupError:
+      print("[OK] ModelServerClient.iter_complete without tool -> LookupError")
+    except Exception as exc:
+      print(f"[FAIL] ModelServerClient.iter_complete without tool -> {exc.__class__.__name__}: {exc}")
+      failed = True
+    else:
+      print("[FAIL] ModelServerClient.iter_complete without tool -> no exception")
+      failed = True
+  finally:
+    server.shutdown()
+  if socket_path.exists():
+    print("[FAIL] model server socket left after shutdown")
+    failed = True
+  return failed
+
 
 def main() -> int:
   failed = False
@@ -114,6 +550,114 @@ def main() -> int:
     else:
       print("[OK] DELETE /plugins/duckduckgo/uninstall -> 409")
 
+    png_bytes = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+    upload_first = client.post(
+      "/attachments/upload?name=smoke.png",
+      content=png_bytes,
+      headers={"Content-Type": "image/png"},
+    )
+    upload_second = client.post(
+      "/attachments/upload",
+      content=png_bytes,
+      headers={"Content-Type": "image/png"},
+    )
+    if upload_first.status_code != 200 or upload_second.status_code != 200:
+      print(f"[FAIL] POST /attachments/upload -> {upload_first.status_code}/{upload_second.status_code}")
+      failed = True
+    else:
+      first_id = str(upload_first.json().get("id") or "")
+      if len(first_id) != 64 or first_id != str(upload_second.json().get("id") or ""):
+        print(f"[FAIL] attachment upload ids are not content-addressed: {first_id!r}")
+        failed = True
+      else:
+        print(f"[OK] POST /attachments/upload -> {first_id[:12]}…")
+    upload_svg = client.post(
+      "/attachments/upload",
+      content=b"<svg xmlns='http://www.w3.org/2000/svg'/>",
+      headers={"Content-Type": "image/svg+xml"},
+    )
+    if upload_svg.status_code != 415:
+      print(f"[FAIL] POST /attachments/upload (svg) -> {upload_svg.status_code}")
+      failed = True
+    else:
+      print("[OK] POST /attachments/upload (svg) -> 415")
+    upload_fake_png = client.post(
+      "/attachments/upload",
+      content=b"<html>not an image</html>",
+      headers={"Content-Type": "image/png"},
+    )
+    if upload_fake_png.status_code != 415:
+      print(f"[FAIL] POST /attachments/upload (html as png) -> {upload_fake_png.status_code}")
+      failed = True
+    else:
+      print("[OK] POST /attachments/upload (html as png) -> 415")
+
+    chats_first = client.get("/chats")
+    chats_etag = str(chats_first.headers.get("etag") or "")
+    change_seq = int((chats_first.json() or {}).get("changeSeq") or 0) if chats_first.status_code == 200 else 0
+    chats_cached = client.get("/chats", headers={"If-None-Match": chats_etag})
+    if chats_first.status_code != 200 or not chats_etag or chats_cached.status_code != 304:
+      print(f"[FAIL] GET /chats ETag -> {chats_first.status_code}/{chats_cached.status_code} etag={chats_etag!r}")
+      failed = True
+    else:
+      print("[OK] GET /chats If-None-Match -> 304")
+
+    import_lines = [
+      '{"type":"header","activeSessionId":"smoke-import-1"}',
+      '{"type":"chat","id":"smoke-import-1","title":"Smoke import"}',
+      '{"type":"message","chatId":"smoke-import-1","role":"user","text":"hello"}',
+    ]
+    import_merge = client.post(
+      "/chats/import/stream?mode=merge",
+      content="\n".join(import_lines).encode("utf-8"),
+      headers={"Content-Type": "application/x-ndjson"},
+    )
+    import_events = [line for line in import_merge.text.splitlines() if line.strip()] if import_merge.status_code == 200 else []
+    import_done = json.loads(import_events[-1]) if import_events else {}
+    if import_done.get("type") != "done" or import_done.get("messages") != 1:
+      print(f"[FAIL] POST /chats/import/stream (merge) -> {import_merge.status_code} {import_done}")
+      failed = True
+    else:
+      print("[OK] POST /chats/import/stream (merge) -> done")
+
+    changes = client.get(f"/chats/changes?since={change_seq}")
+    changes_payload = changes.json() if changes.status_code == 200 else {}
+    changed_chat_ids = {
+      str(item.get("id") or "") if isinstance(item, dict) else str(item)
+      for key in ("upserts", "reloaded")
+      for item in (changes_payload.get("chats") or {}).get(key) or []
+    }
+    if int(changes_payload.get("seq") or 0) <= change_seq or "smoke-import-1" not in changed_chat_ids:
+      print(f"[FAIL] GET /chats/changes -> {changes.status_code} {changes_payload}")
+      failed = True
+    else:
+      print("[OK] GET /chats/changes -> imported chat")
+
+    chats_after_import = client.get("/chats", headers={"If-None-Match": chats_etag})
+    if chats_after_import.status_code != 200:
+      print(f"[FAIL] GET /chats with stale ETag -> {chats_after_import.status_code}")
+      failed = True
+    else:
+      print("[OK] GET /chats with stale ETag -> 200")
+
+    # replace с битой строкой должен отказать целиком и не тронуть уже сохранённые чаты.
+    import_broken = client.post(
+      "/chats/import/stream?mode=replace",
+      content="\n".join([import_lines[0], '{"type":"chat","id":"smoke-replaced"}', '{"type":']).encode("utf-8"),
+      headers={"Content-Type": "application/x-ndjson"},
+    )
+    chats_after_broken = client.get("/chats")
+    surviving_chat_ids = {
+      str(item.get("id") or "")
+      for item in ((chats_after_broken.json() or {}).get("sessions") or [] if chats_after_broken.status_code == 200 else [])
+      if isinstance(item, dict)
+    }
+    if import_broken.status_code != 400 or "smoke-import-1" not in surviving_chat_ids:
+      print(f"[FAIL] POST /chats/import/stream (replace, broken) -> {import_broken.status_code}; chats={sorted(surviving_chat_ids)}")
+      failed = True
+    else:
+      print("[OK] POST /chats/import/stream (replace, broken) -> 400, old chats kept")
+
     sample = '{"name":"web.visit.website","arguments":{"url":"https://ancial.ru/legal/contacts"}}'
     cleaned, calls = PythonModelEngine._extract_tool_calls_from_reply(sample)
     if not calls or calls[0][0] != "web.visit.website":
@@ -174,6 +718,10 @@ def main() -> int:
     if python_cleaned.strip():
       print(f"[WARN] python cleaned text is not empty: {python_cleaned!r}")
 
+  failed = _smoke_schema_migration_resume() or failed
+  failed = _smoke_owner_shards() or failed
+  failed = _smoke_model_server() or failed
+
   if failed:
     print("SMOKE RESULT: FAILED")
     return 1
@@ -182,4 +730,7 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-  raise SystemExit(main())
+  try:
+    raise SystemExit(main())
+  finally:
+    shutil.rmtree(SMOKE_DATA_DIR, ignore_errors=True)
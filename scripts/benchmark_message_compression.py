@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+  sys.path.insert(0, str(ROOT_DIR))
+
+from backend.storage import AppStorage
+from backend.storage_codec import zstandard
+
+OWNER = "bench-user"
+WORDS = (
+  "модель ответ запрос сервер клиент плагин инструмент поиск история сообщение страница "
+  "контекст токен память диск сеть ошибка результат ссылка новости документация цена "
+  "python sqlite index query cache thread stream socket config release server request"
+).split()
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+  return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _page_text(rng: random.Random, paragraphs: int) -> str:
+  return "\n\n".join(" ".join(_sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 7))) for _ in range(paragraphs))
+
+
+def _seed(storage: AppStorage, *, chats: int, turns: int) -> None:
+  # Типичный ход агента: вопрос, вызов web-инструмента с полным текстом страницы в tool_output, ответ.
+  rng = random.Random(42)
+  for chat_index in range(chats):
+    chat_id = f"chat-{chat_index}"
+    storage.ensure_chat(chat_id, f"Чат {chat_index}", owner_user_id=OWNER)
+    for _ in range(turns):
+      storage.append_message(chat_id=chat_id, role="user", text=_sentence(rng, 12), owner_user_id=OWNER)
+      url = f"https://example.org/{rng.randrange(10_000)}"
+      storage.append_message(
+        chat_id=chat_id,
+        role="tool",
+        text="web.visit.website",
+        meta={
+          "meta_suffix": "инструмент • ok",
+          "tool_name": "web.visit.website",
+          "status": "ok",
+          "tool_args": {"url": url},
+          "tool_output": {
+            "url": url,
+            "title": _sentence(rng, 6),
+            "content": _page_text(rng, rng.randint(6, 30)),
+            "links": [f"https://example.org/{rng.randrange(10_000)}" for _ in range(rng.randint(10, 40))],
+          },
+        },
+        owner_user_id=OWNER,
+      )
+      storage.append_message(
+        chat_id=chat_id,
+        role="assistant",
+        text=_page_text(rng, rng.randint(1, 4)),
+        meta={"meta_suffix": "ответ", "model": "bench"},
+        owner_user_id=OWNER,
+      )
+
+
+def _run(min_bytes: int, *, chats: int, turns: int, reads: int, work_dir: Path) -> dict:
+  os.environ["ANCIA_SQLITE_COMPRESS_MIN_BYTES"] = str(min_bytes)
+  db_path = work_dir / f"min-{min_bytes}" / "app.db"
+  storage = AppStorage(db_path)
+  _seed(storage, chats=chats, turns=turns)
+  storage.checkpoint_wal(mode="TRUNCATE")
+  db_bytes = db_path.stat().st_size
+
+  started = time.perf_counter()
+  messages = 0
+  for index in range(reads):
+    messages += len(storage.get_chat_messages(f"chat-{index % chats}", owner_user_id=OWNER))
+  elapsed = time.perf_counter() - started
+  storage.close()
+  return {
+    "min_bytes": min_bytes,
+    "db_mb": db_bytes / (1024 * 1024),
+    "messages_per_second": messages / elapsed if elapsed > 0 else 0.0,
+    "chat_ms": elapsed * 1000.0 / max(1, reads),
+  }
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description="Ancia meta_json compression benchmark (DB size and history read throughput)")
+  parser.add_argument("--chats", type=int, default=50)
+  parser.add_argument("--turns", type=int, default=20, help="ходов (вопрос + инструмент + ответ) в чате")
+  parser.add_argument("--reads", type=int, default=200, help="число чтений истории чата")
+  parser.add_argument("--min-bytes", type=int, default=1024, help="порог сжатия для второго прогона")
+  args = parser.parse_args()
+
+  work_dir = Path(tempfile.mkdtemp(prefix="ancia-compression-bench-"))
+  try:
+    print(f"codec: {'zstd' if zstandard is not None else 'zlib'}")
+    print(f"{'min bytes':>10} {'db, MB':>8} {'msgs/s':>10} {'chat read, ms':>14}")
+    # min_bytes=0 — прежнее поведение: meta_json хранится несжатым.
+    for min_bytes in (0, max(1, args.min_bytes)):
+      result = _run(
+        min_bytes,
+        chats=max(1, args.chats),
+        turns=max(1, args.turns),
+        reads=max(1, args.reads),
+        work_dir=work_dir,
+      )
+      print(
+        f"{result['min_bytes']:>10} {result['db_mb']:>8.1f} {result['messages_per_second']:>10.0f} "
+        f"{result['chat_ms']:>14.2f}"
+      )
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
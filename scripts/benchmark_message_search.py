@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+  sys.path.insert(0, str(ROOT_DIR))
+
+from backend.storage import AppStorage
+
+WORDS = (
+  "модель ответ запрос логирование настройка сервер клиент плагин инструмент поиск "
+  "история сообщение вложение изображение контекст токен память диск сеть ошибка "
+  "deploy python sqlite index query cache thread stream socket config release"
+).split()
+QUERIES = ["логирование", "сервер клиент", "sqlite", "ошибка сети", "нетакогослова", "thread"]
+
+
+def _seed(storage: AppStorage, *, messages: int, chats: int, batch_size: int, owner: str) -> None:
+  rng = random.Random(1234)
+  for chat_index in range(chats):
+    storage.ensure_chat(f"chat-{chat_index}", f"Чат {chat_index}", owner_user_id=owner)
+  inserted = 0
+  now = "2026-01-01T00:00:00+00:00"
+  conn = storage._conn
+  while inserted < messages:
+    size = min(batch_size, messages - inserted)
+    rows = [
+      (
+        owner,
+        f"chat-{rng.randrange(chats)}",
+        "user" if (inserted + offset) % 2 == 0 else "assistant",
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 40))),
+        "{}",
+        now,
+      )
+      for offset in range(size)
+    ]
+    with storage._lock, conn:
+      conn.executemany(
+        "INSERT INTO messages(owner_user_id, chat_id, role, text, meta_json, timestamp) VALUES(?, ?, ?, ?, ?, ?)",
+        rows,
+      )
+    inserted += size
+    print(f"\rseeded {inserted}/{messages}", end="", flush=True)
+  print()
+
+
+def _like_search(storage: AppStorage, query: str, *, owner: str, limit: int) -> int:
+  like_query = f"%{query.lower()}%"
+  with storage._lock:
+    rows = storage._conn.execute(
+      """
+      SELECT m.id, m.text
+      FROM messages m
+      JOIN chats c ON c.owner_user_id = m.owner_user_id AND c.id = m.chat_id
+      WHERE m.owner_user_id = ?
+        AND (LOWER(m.text) LIKE ? OR LOWER(c.title) LIKE ?)
+      ORDER BY m.id DESC
+      LIMIT ?
+      """,
+      (owner, like_query, like_query, limit),
+    ).fetchall()
+  for row in rows:
+    AppStorage._build_search_snippet(str(row["text"] or ""), query)
+  return len(rows)
+
+
+def _measure(fn, repeats: int) -> float:
+  started = time.perf_counter()
+  for _ in range(repeats):
+    fn()
+  return (time.perf_counter() - started) * 1000.0 / max(1, repeats)
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description="Ancia message search benchmark (LIKE vs FTS5)")
+  parser.add_argument("--messages", type=int, default=1_000_000)
+  parser.add_argument("--chats", type=int, default=2_000)
+  parser.add_argument("--batch-size", type=int, default=20_000)
+  parser.add_argument("--limit", type=int, default=120)
+  parser.add_argument("--repeats", type=int, default=3)
+  parser.add_argument("--keep", action="store_true", help="не удалять временную БД")
+  args = parser.parse_args()
+
+  work_dir = Path(tempfile.mkdtemp(prefix="ancia-search-bench-"))
+  owner = "bench-user"
+  try:
+    storage = AppStorage(work_dir / "app.db")
+    print(f"db: {work_dir / 'app.db'}; tokenizer: {storage._message_search_tokenizer or 'none'}")
+    seed_started = time.perf_counter()
+    _seed(storage, messages=args.messages, chats=args.chats, batch_size=args.batch_size, owner=owner)
+    print(f"seed: {time.perf_counter() - seed_started:.1f}s (включая поддержку FTS-индекса триггерами)")
+
+    print(f"{'query':<20} {'like, ms':>10} {'fts, ms':>10} {'fts chat, ms':>13} {'rows':>6}")
+    for query in QUERIES:
+      like_ms = _measure(lambda: _like_search(storage, query, owner=owner, limit=args.limit), args.repeats)
+      fts_rows = storage.search_messages(query, limit=args.limit, owner_user_id=owner)
+      fts_ms = _measure(
+        lambda: storage.search_messages(query, limit=args.limit, owner_user_id=owner),
+        args.repeats,
+      )
+      fts_chat_ms = _measure(
+        lambda: storage.search_messages(query, limit=args.limit, chat_id="chat-7", owner_user_id=owner),
+        args.repeats,
+      )
+      print(f"{query:<20} {like_ms:>10.1f} {fts_ms:>10.1f} {fts_chat_ms:>13.1f} {len(fts_rows):>6}")
+  finally:
+    if args.keep:
+      print(f"kept: {work_dir}")
+    else:
+      shutil.rmtree(work_dir, ignore_errors=True)
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+  sys.path.insert(0, str(ROOT_DIR))
+
+from backend.auth_service import AuthService
+from backend.main import SecurityMiddleware
+from backend.storage import AppStorage
+
+
+class _BaseHttpSecurityMiddleware(BaseHTTPMiddleware):
+  """Те же проверки, что у SecurityMiddleware, но через BaseHTTPMiddleware — как было до перехода на ASGI."""
+
+  def __init__(self, app, *, storage: AppStorage, auth_service: AuthService) -> None:
+    super().__init__(app)
+    self._checks = SecurityMiddleware(app, storage=storage, auth_service=auth_service)
+
+  async def dispatch(self, request: Request, call_next):
+    response = self._checks._check(request)
+    if response is not None:
+      return response
+    return await call_next(request)
+
+
+def _build_app(middleware_cls, *, storage: AppStorage, auth_service: AuthService, chunks: int) -> FastAPI:
+  app = FastAPI()
+
+  @app.get("/ping")
+  def ping() -> dict:
+    return {"ok": True}
+
+  @app.get("/chats/summary")
+  def summary(request: Request) -> dict:
+    auth = getattr(request.state, "auth", None) or {}
+    return {"user": (auth.get("user") or {}).get("username", ""), "items": list(range(20))}
+
+  @app.get("/stream")
+  async def stream() -> StreamingResponse:
+    async def body():
+      for index in range(chunks):
+        yield f"data: {index}\n\n".encode("utf-8")
+        await asyncio.sleep(0)
+
+    return StreamingResponse(body(), media_type="text/event-stream")
+
+  app.add_middleware(middleware_cls, storage=storage, auth_service=auth_service)
+  return app
+
+
+async def _measure_json(app: FastAPI, *, path: str, headers: dict, requests: int, concurrency: int) -> dict:
+  transport = httpx.ASGITransport(app=app)
+  latencies: list[float] = []
+  async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+    for _ in range(20):
+      await client.get(path, headers=headers)
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for index in range(requests):
+      queue.put_nowait(index)
+
+    async def worker() -> None:
+      while True:
+        try:
+          queue.get_nowait()
+        except asyncio.QueueEmpty:
+          return
+        started = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        latencies.append((time.perf_counter() - started) * 1000.0)
+        if response.status_code != 200:
+          raise RuntimeError(f"{path} -> {response.status_code}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    elapsed = time.perf_counter() - started
+  latencies.sort()
+  return {
+    "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    "p50": statistics.median(latencies),
+    "p99": latencies[int(len(latencies) * 0.99)],
+  }
+
+
+async def _measure_stream(app: FastAPI, *, headers: dict, rounds: int) -> float:
+  transport = httpx.ASGITransport(app=app)
+  async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+    started = time.perf_counter()
+    for _ in range(rounds):
+      async with client.stream("GET", "/stream", headers=headers) as response:
+        async for _chunk in response.aiter_raw():
+          pass
+    return (time.perf_counter() - started) * 1000.0 / max(1, rounds)
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description="Ancia security middleware benchmark: BaseHTTPMiddleware vs pure ASGI")
+  parser.add_argument("--requests", type=int, default=3000)
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--stream-chunks", type=int, default=2000)
+  parser.add_argument("--stream-rounds", type=int, default=5)
+  args = parser.parse_args()
+
+  work_dir = Path(tempfile.mkdtemp(prefix="ancia-mw-bench-"))
+  previous_mode = os.environ.get("ANCIA_DEPLOYMENT_MODE")
+  try:
+    storage = AppStorage(work_dir / "app.db")
+    auth_service = AuthService(storage=storage)
+    auth_service.bootstrap_admin(username="bench", password="Password123")
+    token = str(auth_service.login(username="bench", password="Password123")["token"])
+    scenarios = [
+      ("local", "/ping", {}),
+      ("remote_server", "/chats/summary", {"Authorization": f"Bearer {token}"}),
+    ]
+    print(f"{'mode':>14} {'middleware':>12} {'req/s':>9} {'p50, ms':>8} {'p99, ms':>8} {'stream, ms':>11}")
+    for mode, path, headers in scenarios:
+      os.environ["ANCIA_DEPLOYMENT_MODE"] = mode
+      for label, middleware_cls in (("base_http", _BaseHttpSecurityMiddleware), ("asgi", SecurityMiddleware)):
+        app = _build_app(middleware_cls, storage=storage, auth_service=auth_service, chunks=max(1, args.stream_chunks))
+        result = asyncio.run(
+          _measure_json(app, path=path, headers=headers, requests=max(1, args.requests), concurrency=args.concurrency)
+        )
+        stream_ms = asyncio.run(_measure_stream(app, headers=headers, rounds=max(1, args.stream_rounds)))
+        print(
+          f"{mode:>14} {label:>12} {result['rps']:>9.0f} {result['p50']:>8.2f} "
+          f"{result['p99']:>8.2f} {stream_ms:>11.1f}"
+        )
+    auth_service.close()
+    storage.close()
+  finally:
+    if previous_mode is None:
+      os.environ.pop("ANCIA_DEPLOYMENT_MODE", None)
+    else:
+      os.environ["ANCIA_DEPLOYMENT_MODE"] = previous_mode
+    shutil.rmtree(work_dir, ignore_errors=True)
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
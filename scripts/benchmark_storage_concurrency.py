@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+  sys.path.insert(0, str(ROOT_DIR))
+
+from backend.storage import AppStorage
+
+OWNER = "bench-user"
+
+
+def _run(
+  pool_size: int,
+  group_commit_ms: float,
+  *,
+  writers: int,
+  readers: int,
+  seconds: float,
+  work_dir: Path,
+) -> dict:
+  os.environ["ANCIA_SQLITE_READ_POOL_SIZE"] = str(pool_size)
+  os.environ["ANCIA_SQLITE_GROUP_COMMIT_MS"] = str(group_commit_ms)
+  db_dir = work_dir / f"pool-{pool_size}-gc-{group_commit_ms:g}"
+  storage = AppStorage(db_dir / "app.db")
+  for index in range(max(1, writers)):
+    storage.ensure_chat(f"chat-{index}", f"Поток {index}", owner_user_id=OWNER)
+  storage.set_setting("bench.flag", "1")
+  for index in range(200):
+    storage.append_message(
+      chat_id="chat-0",
+      role="user",
+      text=f"сообщение {index} про sqlite и потоки",
+      owner_user_id=OWNER,
+    )
+
+  stop_at = time.perf_counter() + seconds
+  read_latencies: list[float] = []
+  latencies_lock = threading.Lock()
+  counters = {"writes": 0, "reads": 0}
+
+  def writer(index: int) -> None:
+    # Имитация стриминга ответа: частые update_message одного сообщения.
+    chat_id = f"chat-{index}"
+    message_id = storage.append_message(chat_id=chat_id, role="assistant", text="", owner_user_id=OWNER)
+    text = ""
+    while time.perf_counter() < stop_at:
+      text += "токен "
+      storage.update_message(chat_id, message_id, text=text, owner_user_id=OWNER)
+      counters["writes"] += 1
+
+  def reader() -> None:
+    local: list[float] = []
+    while time.perf_counter() < stop_at:
+      started = time.perf_counter()
+      storage.get_chat("chat-0", owner_user_id=OWNER)
+      storage.get_setting("bench.flag")
+      storage.search_messages("sqlite", limit=20, owner_user_id=OWNER)
+      local.append((time.perf_counter() - started) * 1000.0)
+    with latencies_lock:
+      read_latencies.extend(local)
+      counters["reads"] += len(local)
+
+  threads = [threading.Thread(target=writer, args=(index,)) for index in range(writers)]
+  threads += [threading.Thread(target=reader) for _ in range(readers)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  metrics = storage.get_lock_metrics()
+  storage.close()
+  read_latencies.sort()
+  return {
+    "pool": pool_size,
+    "group_commit_ms": group_commit_ms,
+    "avg_batch": (metrics["write_queue"] or {}).get("batch_size", {}).get("avg", 1.0),
+    "writes": counters["writes"],
+    "reads": counters["reads"],
+    "read_p50": statistics.median(read_latencies) if read_latencies else 0.0,
+    "read_p99": read_latencies[int(len(read_latencies) * 0.99)] if read_latencies else 0.0,
+    "writer_wait_ms": metrics["writer_lock"]["wait_ms_total"],
+    "writer_contended": metrics["writer_lock"]["contended"],
+  }
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description="Ancia storage contention benchmark (writer lock vs read pool)")
+  parser.add_argument("--writers", type=int, default=4, help="число одновременных «стримов»")
+  parser.add_argument("--readers", type=int, default=8)
+  parser.add_argument("--seconds", type=float, default=5.0)
+  parser.add_argument("--pool-size", type=int, default=4)
+  parser.add_argument("--group-commit-ms", type=float, default=4.0)
+  args = parser.parse_args()
+
+  work_dir = Path(tempfile.mkdtemp(prefix="ancia-storage-bench-"))
+  try:
+    print(
+      f"{'pool':>5} {'gc, ms':>7} {'batch':>6} {'writes':>8} {'reads':>8} {'read p50, ms':>13} {'read p99, ms':>13} "
+      f"{'lock wait, ms':>14} {'contended':>10}"
+    )
+    # pool=0 — прежний режим: чтение под общей блокировкой писателя; gc=0 — без очереди group commit.
+    pool_size = max(1, args.pool_size)
+    for run_pool_size, group_commit_ms in ((0, 0.0), (pool_size, 0.0), (pool_size, max(0.5, args.group_commit_ms))):
+      result = _run(
+        run_pool_size,
+        group_commit_ms,
+        writers=max(1, args.writers),
+        readers=max(1, args.readers),
+        seconds=max(0.5, args.seconds),
+        work_dir=work_dir,
+      )
+      print(
+        f"{result['pool']:>5} {result['group_commit_ms']:>7g} {result['avg_batch']:>6.1f} {result['writes']:>8} {result['reads']:>8} {result['read_p50']:>13.2f} "
+        f"{result['read_p99']:>13.2f} {result['writer_wait_ms']:>14.1f} {result['writer_contended']:>10}"
+      )
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+  sys.path.insert(0, str(ROOT_DIR))
+
+from backend.storage import AppStorage
+from backend.storage_shards import ShardedAppStorage
+
+
+def _run(sharded: bool, *, users: int, seconds: float, work_dir: Path) -> dict:
+  db_path = work_dir / ("sharded" if sharded else "single") / "app.db"
+  storage = ShardedAppStorage(db_path) if sharded else AppStorage(db_path)
+  owners = [f"user-{index}" for index in range(users)]
+  for owner in owners:
+    storage.ensure_chat("chat-1", "Бенчмарк", owner_user_id=owner)
+
+  stop_at = time.perf_counter() + seconds
+  latencies: list[float] = []
+  latencies_lock = threading.Lock()
+
+  def stream(owner: str) -> None:
+    # Каждый пользователь стримит свой ответ: частые update_message одного сообщения.
+    message_id = storage.append_message(chat_id="chat-1", role="assistant", text="", owner_user_id=owner)
+    text = ""
+    local: list[float] = []
+    while time.perf_counter() < stop_at:
+      text += "токен "
+      started = time.perf_counter()
+      storage.update_message("chat-1", message_id, text=text, owner_user_id=owner)
+      local.append((time.perf_counter() - started) * 1000.0)
+    with latencies_lock:
+      latencies.extend(local)
+
+  threads = [threading.Thread(target=stream, args=(owner,)) for owner in owners]
+  started = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - started
+  storage.close()
+  latencies.sort()
+  return {
+    "mode": "sharded" if sharded else "single",
+    "writes_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    "p50": statistics.median(latencies) if latencies else 0.0,
+    "p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+  }
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description="Ancia per-owner shard benchmark (one writer vs a writer per user)")
+  parser.add_argument("--users", type=int, nargs="+", default=[1, 4, 16], help="число одновременно пишущих пользователей")
+  parser.add_argument("--seconds", type=float, default=3.0)
+  args = parser.parse_args()
+
+  work_dir = Path(tempfile.mkdtemp(prefix="ancia-shard-bench-"))
+  try:
+    print(f"{'users':>6} {'mode':>8} {'writes/s':>10} {'p50, ms':>9} {'p99, ms':>9}")
+    for users in args.users:
+      for sharded in (False, True):
+        result = _run(sharded, users=max(1, users), seconds=max(0.5, args.seconds), work_dir=work_dir / f"u{users}")
+        print(
+          f"{users:>6} {result['mode']:>8} {result['writes_per_second']:>10.0f} "
+          f"{result['p50']:>9.2f} {result['p99']:>9.2f}"
+        )
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
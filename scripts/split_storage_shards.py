@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+  sys.path.insert(0, str(ROOT_DIR))
+
+from backend.storage_shards import split_storage_by_owner
+
+
+def _default_db_path() -> Path:
+  env_path = os.getenv("ANCIA_BACKEND_DATA_DIR", "").strip()
+  data_dir = Path(env_path).expanduser().resolve() if env_path else ROOT_DIR / "backend" / ".runtime"
+  return data_dir / "app.db"
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(
+    description=(
+      "Переносит чаты пользователей из app.db в отдельные файлы шардов "
+      "(для ANCIA_SQLITE_SHARD_BY_OWNER=1 в режиме remote_server). Запускать при остановленном сервере."
+    )
+  )
+  parser.add_argument("--db", type=Path, default=None, help="путь к app.db (по умолчанию из ANCIA_BACKEND_DATA_DIR)")
+  parser.add_argument("--shards-dir", type=Path, default=None, help="каталог шардов (по умолчанию <data>/shards)")
+  parser.add_argument("--owner", action="append", default=[], help="перенести только этого владельца (можно повторять)")
+  args = parser.parse_args()
+
+  db_path = (args.db or _default_db_path()).expanduser().resolve()
+  if not db_path.exists():
+    print(f"database not found: {db_path}", file=sys.stderr)
+    return 1
+  result = split_storage_by_owner(
+    db_path,
+    shards_dir=args.shards_dir.expanduser().resolve() if args.shards_dir else None,
+    owners=[owner for owner in args.owner if owner] or None,
+    log=print,
+  )
+  print(f"shards: {result['shards_dir']}; moved {len(result['moved'])}, skipped {len(result['skipped'])}")
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
@@ -663,6 +663,7 @@ streamRenderer = createChatStreamRenderer({
   getActiveChatSession,
   getAppendMessage: () => appendMessageFn,
   resolveStoredToolPayload,
+  loadToolPayload: (chatId, messageId) => backendClient.getMessageToolPayload(chatId, messageId),
 });
 
   const { ensureSessionForOutgoingMessage } = createChatSessionBootstrap({
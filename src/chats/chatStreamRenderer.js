@@ -12,6 +12,7 @@ export function createChatStreamRenderer({
   getActiveChatSession,
   getAppendMessage,
   resolveStoredToolPayload,
+  loadToolPayload,
 }) {
   let transitionToken = 0;
 
@@ -65,6 +66,9 @@ export function createChatStreamRenderer({
       activeSession.messages.forEach((message, index) => {
         const shouldAnimateEntry = Boolean(animateEntries && index < CHAT_HISTORY_ANIMATED_LIMIT);
         const storedToolPayload = resolveStoredToolPayload(message);
+        if (storedToolPayload?.outputDeferred && typeof loadToolPayload === "function") {
+          storedToolPayload.loadDetails = () => loadToolPayload(activeSession.id, message.id);
+        }
         appendMessage(message.role, message.text, message.metaSuffix, {
           persist: false,
           animate: shouldAnimateEntry,
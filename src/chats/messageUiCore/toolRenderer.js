@@ -418,13 +418,38 @@ export function createToolRenderer({
     details.append(detailsInner);
     wrapper.append(details);
 
-    const detailContent = formatToolOutputText(name, output, {
-      args,
-      payload,
-      phase,
-      rawText: payload.text,
-    });
-    renderMessageBody(detailsBody, detailContent || "_Подробности отсутствуют._");
+    const renderDetails = (detailArgs, detailOutput) => {
+      const detailContent = formatToolOutputText(name, detailOutput, {
+        args: detailArgs,
+        payload,
+        phase,
+        rawText: payload.text,
+      });
+      renderMessageBody(detailsBody, detailContent || "_Подробности отсутствуют._");
+    };
+    renderDetails(args, output);
+
+    let detailsLoad = null;
+    const ensureDetailsLoaded = () => {
+      if (!payload.outputDeferred || typeof payload.loadDetails !== "function") {
+        return;
+      }
+      if (!detailsLoad) {
+        renderMessageBody(detailsBody, "_Загрузка подробностей…_");
+        detailsLoad = Promise.resolve()
+          .then(() => payload.loadDetails())
+          .then((loaded) => {
+            const loadedArgs = loaded?.tool_args && typeof loaded.tool_args === "object" ? loaded.tool_args : args;
+            const loadedOutput = loaded?.tool_output && typeof loaded.tool_output === "object" ? loaded.tool_output : null;
+            payload.outputDeferred = false;
+            renderDetails(loadedArgs, loadedOutput);
+          })
+          .catch(() => {
+            detailsLoad = null;
+            renderMessageBody(detailsBody, "_Не удалось загрузить подробности._");
+          });
+      }
+    };
 
     expandBtn.addEventListener("click", () => {
       if (expandBtn.disabled) {
@@ -432,6 +457,9 @@ export function createToolRenderer({
       }
       const isOpen = details.classList.toggle("is-open");
       expandBtn.setAttribute("aria-expanded", String(isOpen));
+      if (isOpen) {
+        ensureDetailsLoaded();
+      }
     });
   }
 
@@ -55,7 +55,9 @@ export function resolveStoredToolPayload(message) {
   const badge = meta.tool_badge && typeof meta.tool_badge === "object" ? meta.tool_badge : (
     meta.toolBadge && typeof meta.toolBadge === "object" ? meta.toolBadge : null
   );
-  if (!name && !output && !Object.keys(args).length) {
+  // Полный вывод хранится на бэкенде отдельно: в истории только превью аргументов.
+  const outputDeferred = Boolean(meta.tool_payload?.stored) && !output;
+  if (!name && !output && !outputDeferred && !Object.keys(args).length) {
     return null;
   }
 
@@ -67,6 +69,7 @@ export function resolveStoredToolPayload(message) {
     args,
     badge: badge || undefined,
     text: normalizeTextInput(String(message.text || "")),
+    outputDeferred: outputDeferred || undefined,
   };
 }
 
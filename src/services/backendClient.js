@@ -475,6 +475,36 @@ export class BackendClient {
     });
   }
 
+  async getAdminAuditRollups({
+    days = 30,
+    groupBy = ["day"],
+    actorUserId = "",
+    actionPrefix = "",
+  } = {}) {
+    const params = new URLSearchParams();
+    params.set("days", String(Math.max(1, Math.min(3650, Math.round(Number(days || 30))))));
+    const safeGroupBy = (Array.isArray(groupBy) ? groupBy : [groupBy])
+      .map((item) => String(item || "").trim().toLowerCase())
+      .filter(Boolean);
+    if (safeGroupBy.length > 0) {
+      params.set("group_by", safeGroupBy.join(","));
+    }
+
+    const safeActorUserId = String(actorUserId || "").trim();
+    if (safeActorUserId) {
+      params.set("actor_user_id", safeActorUserId);
+    }
+
+    const safeActionPrefix = String(actionPrefix || "").trim().toLowerCase();
+    if (safeActionPrefix) {
+      params.set("action_prefix", safeActionPrefix);
+    }
+
+    return this.request(`/admin/audit/rollups?${params.toString()}`, {
+      method: "GET",
+    });
+  }
+
   async inspectLink(url) {
     const safeUrl = String(url || "").trim();
     if (!safeUrl) {
@@ -642,6 +672,41 @@ export class BackendClient {
     return this.request("/chats", { method: "GET" });
   }
 
+  async listChatSummaries({ limit = 50, cursor = "" } = {}) {
+    const params = new URLSearchParams();
+    if (Number.isFinite(Number(limit)) && Number(limit) > 0) {
+      params.set("limit", String(Math.floor(Number(limit))));
+    }
+    if (String(cursor || "").trim()) {
+      params.set("cursor", String(cursor || "").trim());
+    }
+    return this.request(`/chats/list?${params.toString()}`, { method: "GET" });
+  }
+
+  async listChatChanges(since = 0, { limit = 0 } = {}) {
+    const params = new URLSearchParams();
+    params.set("since", String(Math.max(0, Math.floor(Number(since) || 0))));
+    if (Number.isFinite(Number(limit)) && Number(limit) > 0) {
+      params.set("limit", String(Math.floor(Number(limit))));
+    }
+    return this.request(`/chats/changes?${params.toString()}`, { method: "GET" });
+  }
+
+  async listChatMessages(chatId, { limit = 50, before = "", after = "" } = {}) {
+    const safeChatId = encodePathSegment(chatId);
+    const params = new URLSearchParams();
+    if (Number.isFinite(Number(limit)) && Number(limit) > 0) {
+      params.set("limit", String(Math.floor(Number(limit))));
+    }
+    if (String(before || "").trim()) {
+      params.set("before", String(before || "").trim());
+    }
+    if (String(after || "").trim()) {
+      params.set("after", String(after || "").trim());
+    }
+    return this.request(`/chats/${safeChatId}/messages?${params.toString()}`, { method: "GET" });
+  }
+
   async searchChats(query, { limit = 120, chatId = "" } = {}) {
     const safeQuery = String(query || "").trim();
     const params = new URLSearchParams();
@@ -745,6 +810,14 @@ export class BackendClient {
     });
   }
 
+  async getMessageToolPayload(chatId, messageId) {
+    const safeChatId = encodePathSegment(chatId);
+    const safeMessageId = encodePathSegment(messageId);
+    return this.request(`/chats/${safeChatId}/messages/${safeMessageId}/tool-payload`, {
+      method: "GET",
+    });
+  }
+
   async getChatHistory(chatId, limit = 40) {
     const safeChatId = encodePathSegment(chatId);
     const safeLimit = Number(limit) > 0 ? Number(limit) : 40;